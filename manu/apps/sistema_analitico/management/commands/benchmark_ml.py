@@ -0,0 +1,110 @@
+"""
+Comando para medir la ruta de pronóstico ML (feature store, Prophet, XGBoost,
+predicción y recomendaciones) sobre movimientos sintéticos de distintos tamaños.
+
+Los datos sintéticos se insertan dentro de una transacción que se revierte al
+terminar cada escenario. Ejemplo:
+
+    python manage.py benchmark_ml --escenarios 200x36 2000x48 --salida bench.json
+    python manage.py benchmark_ml --escenarios 200x36 --comparar bench.json
+"""
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.sistema_analitico.services.ml_benchmark import MLBenchmark, comparar_reportes
+
+
+def _escenario(valor):
+    try:
+        articulos, meses = valor.lower().split('x')
+        return int(articulos), int(meses)
+    except ValueError:
+        raise CommandError(f"Escenario inválido '{valor}': use ARTICULOSxMESES (ej: 500x36)")
+
+
+class Command(BaseCommand):
+    help = '⏱️ Benchmark de entrenamiento, predicción y recomendaciones ML sobre datos sintéticos'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--escenarios',
+            nargs='+',
+            default=['100x24', '1000x36'],
+            help='Tamaños ARTICULOSxMESES de historia (default: 100x24 1000x36)',
+        )
+        parser.add_argument(
+            '--horizonte',
+            type=int,
+            default=6,
+            help='Meses reservados para medir el error del pronóstico',
+        )
+        parser.add_argument(
+            '--semilla',
+            type=int,
+            default=42,
+            help='Semilla del generador sintético (mismos datos entre corridas)',
+        )
+        parser.add_argument(
+            '--sin-memoria',
+            action='store_true',
+            help='No medir memoria pico (tracemalloc agrega overhead al tiempo)',
+        )
+        parser.add_argument(
+            '--salida',
+            type=str,
+            help='Ruta del reporte JSON (por defecto se imprime en stdout)',
+        )
+        parser.add_argument(
+            '--comparar',
+            type=str,
+            help='Reporte JSON base: termina con código 1 si hay regresiones',
+        )
+        parser.add_argument(
+            '--tolerancia',
+            type=float,
+            default=0.2,
+            help='Fracción de empeoramiento tolerada frente al reporte base (default: 0.2)',
+        )
+
+    def handle(self, *args, **options):
+        escenarios = [_escenario(valor) for valor in options['escenarios']]
+        benchmark = MLBenchmark(
+            horizonte=options['horizonte'],
+            semilla=options['semilla'],
+            medir_memoria=not options['sin_memoria'],
+        )
+        reporte = benchmark.ejecutar(escenarios)
+
+        for escenario in reporte['escenarios']:
+            titulo = f"{escenario['articulos']} artículos × {escenario['meses']} meses ({escenario.get('movimientos', 0)} movimientos)"
+            self.stderr.write(self.style.SUCCESS(f"📊 {titulo}"))
+            for nombre, etapa in escenario['etapas'].items():
+                memoria = f", {etapa['memoria_pico_mb']} MB" if 'memoria_pico_mb' in etapa else ''
+                error = f"  ❌ {etapa['error']}" if 'error' in etapa else ''
+                self.stderr.write(f"   • {nombre:<18} {etapa['segundos']:>9.3f} s{memoria}{error}")
+            for metodo, metricas in (escenario.get('error_pronostico') or {}).items():
+                if isinstance(metricas, dict):
+                    self.stderr.write(f"   • WAPE {metodo:<20} {metricas.get('wape')}")
+
+        contenido = json.dumps(reporte, indent=2, ensure_ascii=False, default=str)
+        if options['salida']:
+            with open(options['salida'], 'w', encoding='utf-8') as archivo:
+                archivo.write(contenido)
+            self.stderr.write(f"💾 Reporte guardado en {options['salida']}")
+        else:
+            self.stdout.write(contenido)
+
+        if options['comparar']:
+            with open(options['comparar'], encoding='utf-8') as archivo:
+                base = json.load(archivo)
+            regresiones = comparar_reportes(reporte, base, tolerancia=options['tolerancia'])
+            if not regresiones:
+                self.stderr.write(self.style.SUCCESS('✅ Sin regresiones frente al reporte base'))
+                return
+            for r in regresiones:
+                self.stderr.write(self.style.ERROR(
+                    f"❌ {r['escenario']} {r['etapa']} {r['metrica']}: {r['base']} → {r['actual']}"
+                ))
+            sys.exit(1)
@@ -38,6 +38,7 @@ except Exception as e:
 
 from apps.sistema_analitico.models import EmpresaServidor, ConfiguracionS3, BackupS3, Servidor
 from apps.sistema_analitico.services.backup_s3_service import BackupS3Service
+from apps.sistema_analitico.services import indice_s3
 from botocore.exceptions import ClientError
 import re
 
@@ -269,6 +270,8 @@ class Command(BaseCommand):
                             Bucket=servicio.bucket_name,
                             Key=ruta_antigua
                         )
+                        indice_s3.eliminar_objetos(servicio.config, [ruta_antigua])
+                        indice_s3.registrar_objeto(servicio.config, ruta_nueva, mig['objeto']['size'])
                         
                         # Actualizar rutas en BD
                         # Buscar por empresa y nombre de archivo (más confiable)
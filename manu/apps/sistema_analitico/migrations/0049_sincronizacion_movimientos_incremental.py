@@ -0,0 +1,50 @@
+# Generated by Django 5.2.8 on 2026-10-18 02:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sistema_analitico', '0048_agregar_cuenta_puc'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SincronizacionMovimientos',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ultima_fecha', models.DateTimeField(blank=True, help_text='FECHA del último movimiento sincronizado', null=True)),
+                ('ultimo_kardex_id', models.BigIntegerField(blank=True, help_text='KARDEXID del último movimiento sincronizado', null=True)),
+                ('checksums_periodo', models.JSONField(blank=True, default=dict, help_text='Checksum de filas por periodo: {"2024-01": "md5...", ...}')),
+                ('registros_sincronizados', models.BigIntegerField(default=0)),
+                ('ultima_sincronizacion', models.DateTimeField(blank=True, null=True)),
+                ('ultimo_resultado', models.JSONField(blank=True, default=dict)),
+            ],
+            options={
+                'verbose_name': 'Sincronización de Movimientos',
+                'verbose_name_plural': 'Sincronizaciones de Movimientos',
+                'db_table': 'sincronizacion_movimientos',
+            },
+        ),
+        migrations.AddField(
+            model_name='movimientoinventario',
+            name='dekardex_id',
+            field=models.BigIntegerField(blank=True, help_text='DEKARDEXID de la línea en TNS', null=True),
+        ),
+        migrations.AddField(
+            model_name='movimientoinventario',
+            name='kardex_id',
+            field=models.BigIntegerField(blank=True, help_text='KARDEXID del documento en TNS', null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='movimientoinventario',
+            constraint=models.UniqueConstraint(fields=('empresa_servidor', 'kardex_id', 'dekardex_id'), name='movimiento_clave_natural_tns'),
+        ),
+        migrations.AddField(
+            model_name='sincronizacionmovimientos',
+            name='empresa_servidor',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='sincronizacion_movimientos', to='sistema_analitico.empresaservidor'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 02:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sistema_analitico', '0049_sincronizacion_movimientos_incremental'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='servidor',
+            name='max_extracciones_concurrentes',
+            field=models.PositiveSmallIntegerField(default=2, help_text='Máximo de extracciones simultáneas contra este servidor (evita saturar Firebird/VPN)'),
+        ),
+    ]
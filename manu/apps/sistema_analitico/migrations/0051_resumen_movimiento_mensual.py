@@ -0,0 +1,69 @@
+# Generated by Django 5.2.8 on 2026-10-18 02:08
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, DateField, Max, Sum
+from django.db.models.functions import TruncMonth
+
+
+def poblar_resumen_mensual(apps, schema_editor):
+    """Construye el resumen mensual a partir de los movimientos ya extraídos"""
+    MovimientoInventario = apps.get_model('sistema_analitico', 'MovimientoInventario')
+    ResumenMovimientoMensual = apps.get_model('sistema_analitico', 'ResumenMovimientoMensual')
+
+    empresas_ids = MovimientoInventario.objects.values_list('empresa_servidor_id', flat=True).distinct()
+    for empresa_id in list(empresas_ids):
+        agregados = MovimientoInventario.objects.filter(empresa_servidor_id=empresa_id).annotate(
+            periodo=TruncMonth('fecha', output_field=DateField())
+        ).values('periodo', 'tipo_documento', 'articulo_codigo').annotate(
+            nombre=Max('articulo_nombre'),
+            cantidad=Sum('cantidad'),
+            valor=Sum('valor_total'),
+            total=Count('id'),
+        ).order_by()
+        ResumenMovimientoMensual.objects.bulk_create([
+            ResumenMovimientoMensual(
+                empresa_servidor_id=empresa_id,
+                periodo=fila['periodo'],
+                tipo_documento=fila['tipo_documento'],
+                articulo_codigo=fila['articulo_codigo'],
+                articulo_nombre=fila['nombre'] or '',
+                cantidad_total=fila['cantidad'] or 0,
+                valor_total=fila['valor'] or 0,
+                movimientos=fila['total'],
+            )
+            for fila in agregados.iterator(chunk_size=5000)
+        ], batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sistema_analitico', '0050_servidor_max_extracciones_concurrentes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResumenMovimientoMensual',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('periodo', models.DateField(help_text='Primer día del mes (hora local)')),
+                ('tipo_documento', models.CharField(choices=[('FACTURA_VENTA', 'Factura de Venta'), ('REMISION_ENTRADA', 'Remisión de Entrada'), ('DEVOLUCION_VENTA', 'Devolución de Venta'), ('FACTURA_COMPRA', 'Factura de Compra')], max_length=20)),
+                ('articulo_codigo', models.CharField(max_length=100)),
+                ('articulo_nombre', models.CharField(max_length=255)),
+                ('cantidad_total', models.BigIntegerField(default=0)),
+                ('valor_total', models.DecimalField(decimal_places=2, default=0, max_digits=18)),
+                ('movimientos', models.IntegerField(default=0, help_text='Número de líneas de movimiento agregadas')),
+                ('fecha_actualizacion', models.DateTimeField(auto_now=True)),
+                ('empresa_servidor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='resumenes_mensuales', to='sistema_analitico.empresaservidor')),
+            ],
+            options={
+                'verbose_name': 'Resumen Mensual de Movimientos',
+                'verbose_name_plural': 'Resúmenes Mensuales de Movimientos',
+                'db_table': 'resumen_movimientos_mensual',
+                'indexes': [models.Index(fields=['empresa_servidor', 'tipo_documento', 'periodo'], name='resumen_mov_empresa_6d73d0_idx')],
+                'constraints': [models.UniqueConstraint(fields=('empresa_servidor', 'periodo', 'tipo_documento', 'articulo_codigo'), name='resumen_mensual_unico')],
+            },
+        ),
+        migrations.RunPython(poblar_resumen_mensual, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.8 on 2026-10-18 02:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sistema_analitico', '0051_resumen_movimiento_mensual'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeatureArticuloMensual',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('nit_normalizado', models.CharField(max_length=20)),
+                ('periodo', models.DateField(help_text='Primer día del mes (hora local)')),
+                ('articulo_codigo', models.CharField(max_length=100)),
+                ('articulo_nombre', models.CharField(max_length=255)),
+                ('total_transacciones', models.IntegerField(default=0)),
+                ('cantidad', models.BigIntegerField(default=0, help_text='Cantidad total del mes (todos los tipos de documento)')),
+                ('ventas_mes', models.BigIntegerField(default=0)),
+                ('compras_mes', models.BigIntegerField(default=0)),
+                ('precio_promedio', models.FloatField(default=0)),
+                ('bodegas_unicas', models.IntegerField(default=0)),
+                ('es_implante', models.PositiveSmallIntegerField(default=0)),
+                ('es_instrumental', models.PositiveSmallIntegerField(default=0)),
+                ('es_equipo_poder', models.PositiveSmallIntegerField(default=0)),
+                ('cantidad_lag_1', models.FloatField(default=0)),
+                ('cantidad_lag_2', models.FloatField(default=0)),
+                ('cantidad_lag_3', models.FloatField(default=0)),
+                ('cantidad_lag_12', models.FloatField(default=0)),
+                ('cantidad_media_3', models.FloatField(default=0)),
+                ('cantidad_media_6', models.FloatField(default=0)),
+                ('cantidad_media_12', models.FloatField(default=0)),
+                ('fecha_actualizacion', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Features Mensuales de Artículo',
+                'verbose_name_plural': 'Features Mensuales de Artículos',
+                'db_table': 'features_articulo_mensual',
+                'indexes': [models.Index(fields=['nit_normalizado', 'articulo_codigo', 'periodo'], name='features_ar_nit_nor_a2668d_idx')],
+                'constraints': [models.UniqueConstraint(fields=('nit_normalizado', 'periodo', 'articulo_codigo'), name='features_articulo_mensual_unico')],
+            },
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.8 on 2026-10-18 02:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sistema_analitico', '0052_features_articulo_mensual'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='configuracions3',
+            name='indice_reconciliado',
+            field=models.DateTimeField(blank=True, help_text='Última reconciliación del índice de objetos (ObjetoS3) contra el bucket; sin valor el índice no se usa', null=True),
+        ),
+        migrations.CreateModel(
+            name='ObjetoS3',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(db_index=True, help_text='Ruta completa del objeto en el bucket', max_length=1024)),
+                ('directorio', models.CharField(help_text='Prefijo hasta el último "/" (vacío en la raíz)', max_length=1024)),
+                ('servidor_nombre', models.CharField(help_text='Primer segmento de la ruta', max_length=255)),
+                ('nit_normalizado', models.CharField(blank=True, default='', max_length=50)),
+                ('anio_fiscal', models.IntegerField(blank=True, null=True)),
+                ('tamano', models.BigIntegerField(help_text='Tamaño en bytes')),
+                ('etag', models.CharField(blank=True, default='', max_length=100)),
+                ('ultima_modificacion', models.DateTimeField(blank=True, null=True)),
+                ('fecha_indexado', models.DateTimeField(auto_now=True)),
+                ('configuracion_s3', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='objetos', to='sistema_analitico.configuracions3')),
+            ],
+            options={
+                'verbose_name': 'Objeto S3',
+                'verbose_name_plural': 'Objetos S3',
+                'db_table': 'objetos_s3',
+                'indexes': [models.Index(fields=['configuracion_s3', 'servidor_nombre', 'nit_normalizado', 'anio_fiscal'], name='objetos_s3_configu_ff6120_idx'), models.Index(fields=['configuracion_s3', 'directorio'], name='objetos_s3_configu_6f3566_idx')],
+                'constraints': [models.UniqueConstraint(fields=('configuracion_s3', 'key'), name='objetos_s3_key_unica')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.8 on 2026-10-18 03:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sistema_analitico', '0053_indice_objetos_s3'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='servidor',
+            name='ancho_banda_backup_mbps',
+            field=models.PositiveIntegerField(default=0, help_text='Ancho de banda total para backups de este servidor en Mbps, repartido entre sus backups simultáneos (0 = sin límite)'),
+        ),
+        migrations.AddField(
+            model_name='servidor',
+            name='max_backups_concurrentes',
+            field=models.PositiveSmallIntegerField(default=2, help_text='Máximo de backups (gbak) simultáneos contra este servidor'),
+        ),
+    ]
@@ -23,6 +23,18 @@ class Servidor(models.Model):
     ruta_maestra = models.CharField(max_length=500, null=True, blank=True)
     puerto = models.IntegerField(default=0)
     activo = models.BooleanField(default=True)
+    max_extracciones_concurrentes = models.PositiveSmallIntegerField(
+        default=2,
+        help_text='Máximo de extracciones simultáneas contra este servidor (evita saturar Firebird/VPN)'
+    )
+    max_backups_concurrentes = models.PositiveSmallIntegerField(
+        default=2,
+        help_text='Máximo de backups (gbak) simultáneos contra este servidor'
+    )
+    ancho_banda_backup_mbps = models.PositiveIntegerField(
+        default=0,
+        help_text='Ancho de banda total para backups de este servidor en Mbps, repartido entre sus backups simultáneos (0 = sin límite)'
+    )
     fecha_creacion = models.DateTimeField(auto_now_add=True)
     
     class Meta:
@@ -1117,8 +1129,19 @@ class MovimientoInventario(models.Model):
     
     fecha_extraccion = models.DateTimeField(auto_now_add=True)
     
+    # Clave natural en TNS (para sincronización incremental con upsert)
+    kardex_id = models.BigIntegerField(null=True, blank=True, help_text='KARDEXID del documento en TNS')
+    dekardex_id = models.BigIntegerField(null=True, blank=True, help_text='DEKARDEXID de la línea en TNS')
+    
     class Meta:
         db_table = 'movimientos_inventario'
+        constraints = [
+            # NULLs son distintos: las filas históricas sin clave no colisionan
+            models.UniqueConstraint(
+                fields=['empresa_servidor', 'kardex_id', 'dekardex_id'],
+                name='movimiento_clave_natural_tns',
+            ),
+        ]
         indexes = [
             # Índices existentes
             models.Index(fields=['empresa_servidor', 'fecha']),
@@ -1148,6 +1171,124 @@ class MovimientoInventario(models.Model):
     def __str__(self):
         return f"{self.tipo_documento} - {self.articulo_codigo} ({self.cantidad})"
         
+class SincronizacionMovimientos(models.Model):
+    """
+    Marca de agua de la sincronización incremental de movimientos TNS por empresa.
+    Guarda el último (fecha, KARDEXID) visto y un checksum por periodo (YYYY-MM)
+    para detectar meses modificados en Firebird sin releerlos completos.
+    """
+    empresa_servidor = models.OneToOneField(
+        EmpresaServidor,
+        on_delete=models.CASCADE,
+        related_name='sincronizacion_movimientos'
+    )
+    ultima_fecha = models.DateTimeField(null=True, blank=True, help_text='FECHA del último movimiento sincronizado')
+    ultimo_kardex_id = models.BigIntegerField(null=True, blank=True, help_text='KARDEXID del último movimiento sincronizado')
+    checksums_periodo = models.JSONField(
+        default=dict,
+        blank=True,
+        help_text='Checksum de filas por periodo: {"2024-01": "md5...", ...}'
+    )
+    registros_sincronizados = models.BigIntegerField(default=0)
+    ultima_sincronizacion = models.DateTimeField(null=True, blank=True)
+    ultimo_resultado = models.JSONField(default=dict, blank=True)
+    
+    class Meta:
+        db_table = 'sincronizacion_movimientos'
+        verbose_name = 'Sincronización de Movimientos'
+        verbose_name_plural = 'Sincronizaciones de Movimientos'
+    
+    def __str__(self):
+        return f"{self.empresa_servidor.nombre} - KARDEXID {self.ultimo_kardex_id} ({self.ultima_fecha})"
+
+
+class ResumenMovimientoMensual(models.Model):
+    """
+    Agregado mensual de movimientos por empresa, artículo y tipo de documento.
+    Se recalcula por mes al ingerir movimientos (extracción o sincronización) y
+    lo usan las consultas de periodos/comparaciones en lugar de la tabla cruda.
+    """
+    empresa_servidor = models.ForeignKey(
+        EmpresaServidor,
+        on_delete=models.CASCADE,
+        related_name='resumenes_mensuales'
+    )
+    periodo = models.DateField(help_text='Primer día del mes (hora local)')
+    tipo_documento = models.CharField(max_length=20, choices=MovimientoInventario.TIPO_DOCUMENTO_CHOICES)
+    articulo_codigo = models.CharField(max_length=100)
+    articulo_nombre = models.CharField(max_length=255)
+    cantidad_total = models.BigIntegerField(default=0)
+    valor_total = models.DecimalField(max_digits=18, decimal_places=2, default=0)
+    movimientos = models.IntegerField(default=0, help_text='Número de líneas de movimiento agregadas')
+    fecha_actualizacion = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        db_table = 'resumen_movimientos_mensual'
+        verbose_name = 'Resumen Mensual de Movimientos'
+        verbose_name_plural = 'Resúmenes Mensuales de Movimientos'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['empresa_servidor', 'periodo', 'tipo_documento', 'articulo_codigo'],
+                name='resumen_mensual_unico',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['empresa_servidor', 'tipo_documento', 'periodo']),
+        ]
+    
+    def __str__(self):
+        return f"{self.empresa_servidor_id} {self.periodo:%Y-%m} {self.tipo_documento} {self.articulo_codigo}"
+
+
+class FeatureArticuloMensual(models.Model):
+    """
+    Features mensuales por NIT y artículo para los modelos ML.
+
+    Agrega todas las empresas (años fiscales) del NIT, igual que el entrenamiento,
+    e incluye rezagos y ventanas móviles de la cantidad mensual. Se recalcula por
+    mes al ingerir movimientos; entrenamiento e inferencia leen de aquí.
+    """
+    nit_normalizado = models.CharField(max_length=20)
+    periodo = models.DateField(help_text='Primer día del mes (hora local)')
+    articulo_codigo = models.CharField(max_length=100)
+    articulo_nombre = models.CharField(max_length=255)
+    total_transacciones = models.IntegerField(default=0)
+    cantidad = models.BigIntegerField(default=0, help_text='Cantidad total del mes (todos los tipos de documento)')
+    ventas_mes = models.BigIntegerField(default=0)
+    compras_mes = models.BigIntegerField(default=0)
+    precio_promedio = models.FloatField(default=0)
+    bodegas_unicas = models.IntegerField(default=0)
+    es_implante = models.PositiveSmallIntegerField(default=0)
+    es_instrumental = models.PositiveSmallIntegerField(default=0)
+    es_equipo_poder = models.PositiveSmallIntegerField(default=0)
+    # Rezagos y ventanas móviles de cantidad (meses sin movimiento cuentan como 0)
+    cantidad_lag_1 = models.FloatField(default=0)
+    cantidad_lag_2 = models.FloatField(default=0)
+    cantidad_lag_3 = models.FloatField(default=0)
+    cantidad_lag_12 = models.FloatField(default=0)
+    cantidad_media_3 = models.FloatField(default=0)
+    cantidad_media_6 = models.FloatField(default=0)
+    cantidad_media_12 = models.FloatField(default=0)
+    fecha_actualizacion = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        db_table = 'features_articulo_mensual'
+        verbose_name = 'Features Mensuales de Artículo'
+        verbose_name_plural = 'Features Mensuales de Artículos'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['nit_normalizado', 'periodo', 'articulo_codigo'],
+                name='features_articulo_mensual_unico',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['nit_normalizado', 'articulo_codigo', 'periodo']),
+        ]
+    
+    def __str__(self):
+        return f"{self.nit_normalizado} {self.periodo:%Y-%m} {self.articulo_codigo}"
+
+
 class APIKeyCliente(models.Model):
     nit = models.CharField(max_length=20, unique=True)
     nombre_cliente = models.CharField(max_length=255)
@@ -2342,6 +2483,11 @@ class ConfiguracionS3(models.Model):
         default=True,
         help_text='Indica si esta configuración está activa'
     )
+    indice_reconciliado = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text='Última reconciliación del índice de objetos (ObjetoS3) contra el bucket; sin valor el índice no se usa'
+    )
     fecha_creacion = models.DateTimeField(auto_now_add=True)
     fecha_actualizacion = models.DateTimeField(auto_now=True)
     
@@ -2506,6 +2652,46 @@ class DescargaTemporalBackup(models.Model):
         return self.estado == 'listo' and not self.esta_expirado()
 
 
+class ObjetoS3(models.Model):
+    """
+    Índice local de los objetos del bucket de una configuración S3.
+
+    Se mantiene al subir y eliminar desde BackupS3Service y se reconcilia
+    periódicamente contra S3; cuotas, navegación y estadísticas consultan esta
+    tabla en lugar de listar el bucket. Servidor, NIT y año fiscal se extraen de
+    la ruta ({server_name}/{nit_normalizado}/{anio_fiscal}/...).
+    """
+    configuracion_s3 = models.ForeignKey(
+        ConfiguracionS3,
+        on_delete=models.CASCADE,
+        related_name='objetos',
+    )
+    key = models.CharField(max_length=1024, db_index=True, help_text='Ruta completa del objeto en el bucket')
+    directorio = models.CharField(max_length=1024, help_text='Prefijo hasta el último "/" (vacío en la raíz)')
+    servidor_nombre = models.CharField(max_length=255, help_text='Primer segmento de la ruta')
+    nit_normalizado = models.CharField(max_length=50, blank=True, default='')
+    anio_fiscal = models.IntegerField(null=True, blank=True)
+    tamano = models.BigIntegerField(help_text='Tamaño en bytes')
+    etag = models.CharField(max_length=100, blank=True, default='')
+    ultima_modificacion = models.DateTimeField(null=True, blank=True)
+    fecha_indexado = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        db_table = 'objetos_s3'
+        verbose_name = 'Objeto S3'
+        verbose_name_plural = 'Objetos S3'
+        constraints = [
+            models.UniqueConstraint(fields=['configuracion_s3', 'key'], name='objetos_s3_key_unica'),
+        ]
+        indexes = [
+            models.Index(fields=['configuracion_s3', 'servidor_nombre', 'nit_normalizado', 'anio_fiscal']),
+            models.Index(fields=['configuracion_s3', 'directorio']),
+        ]
+    
+    def __str__(self):
+        return f"{self.key} ({self.tamano} bytes)"
+
+
 # ==================== Modelo para Clasificación Contable ====================
 
 class Proveedor(models.Model):
@@ -225,6 +225,12 @@ class TNSQuerySerializer(TNSBaseSerializer):
     params = serializers.ListField(child=serializers.CharField(), required=False, default=list)
 
 
+class TNSMetadataSerializer(TNSBaseSerializer):
+    """Consulta del catálogo de metadatos TNS (toda la base o una tabla)"""
+    table_name = serializers.CharField(required=False)
+    refrescar = serializers.BooleanField(required=False, default=False)
+
+
 class TNSProcedureSerializer(TNSBaseSerializer):
     procedure = serializers.CharField()
     params = serializers.DictField(child=serializers.CharField(), required=False, default=dict)
@@ -1080,6 +1086,70 @@ class ExtraerDatosSerializer(serializers.Serializer):
         return value
 
 
+class ExtraerDatosNITSerializer(serializers.Serializer):
+    """Serializer para extraer en paralelo todas las empresas/años de un NIT"""
+    nit = serializers.CharField(required=True, help_text="NIT de la empresa (con o sin puntos/DV)")
+    fecha_inicio = serializers.DateField(required=True, help_text="Fecha de inicio del rango (YYYY-MM-DD)")
+    fecha_fin = serializers.DateField(required=True, help_text="Fecha de fin del rango (YYYY-MM-DD)")
+    forzar_reextraccion = serializers.BooleanField(required=False, default=False, help_text="Si True, fuerza la reextracción incluso si ya existe")
+    
+    def validate(self, attrs):
+        """Validar rango de fechas y normalizar el NIT"""
+        from .models import normalize_nit_and_extract_dv
+        
+        if attrs['fecha_inicio'] > attrs['fecha_fin']:
+            raise serializers.ValidationError("fecha_inicio debe ser anterior a fecha_fin")
+        
+        nit_normalizado, _, _ = normalize_nit_and_extract_dv(attrs['nit'])
+        if not nit_normalizado:
+            raise serializers.ValidationError({'nit': 'NIT inválido'})
+        attrs['nit_normalizado'] = nit_normalizado
+        return attrs
+
+
+class EntrenarModelosSerializer(serializers.Serializer):
+    """Serializer para encolar el entrenamiento ML del NIT de una empresa"""
+    empresa_servidor_id = serializers.IntegerField(required=True, help_text="ID de cualquier empresa del NIT")
+    forzar = serializers.BooleanField(required=False, default=False, help_text="Si True, re-entrena desde cero aunque no haya movimientos nuevos")
+    
+    def validate_empresa_servidor_id(self, value):
+        """Validar que la empresa exista"""
+        from .models import EmpresaServidor
+        if not EmpresaServidor.objects.filter(id=value).exists():
+            raise serializers.ValidationError(f"Empresa con ID {value} no existe")
+        return value
+
+
+class PredecirDemandaSerializer(serializers.Serializer):
+    """Serializer para la predicción de demanda por artículo del NIT de una empresa"""
+    empresa_servidor_id = serializers.IntegerField(required=True, help_text="ID de cualquier empresa del NIT")
+    articulos = serializers.ListField(child=serializers.CharField(), required=False, allow_null=True, default=None, help_text="Códigos de artículo (por defecto todos)")
+    meses = serializers.IntegerField(required=False, default=6, min_value=1, max_value=24, help_text="Horizonte en meses")
+
+
+class RecomendacionesComprasSerializer(serializers.Serializer):
+    """Serializer para las recomendaciones de compra del NIT de una empresa"""
+    empresa_servidor_id = serializers.IntegerField(required=True, help_text="ID de cualquier empresa del NIT")
+    meses = serializers.IntegerField(required=False, default=6, min_value=1, max_value=24, help_text="Horizonte en meses")
+    nivel_servicio = serializers.FloatField(required=False, default=0.95, min_value=0.5, max_value=0.999, help_text="Nivel de servicio objetivo (0.5-0.999)")
+
+
+class PredecirLoteSerializer(serializers.Serializer):
+    """Serializer para la predicción de demanda por lote (muchos artículos y meses)"""
+    empresa_servidor_id = serializers.IntegerField(required=True, help_text="ID de cualquier empresa del NIT")
+    articulos = serializers.JSONField(required=False, default='all', help_text="Lista de códigos de artículo o 'all'")
+    meses = serializers.IntegerField(required=False, default=6, min_value=1, max_value=24, help_text="Horizonte en meses")
+    formato = serializers.ChoiceField(choices=['jsonl', 'arrow'], required=False, default='jsonl')
+    
+    def validate_articulos(self, value):
+        """Aceptar 'all' o una lista no vacía de códigos"""
+        if value == 'all':
+            return value
+        if not isinstance(value, list) or not value:
+            raise serializers.ValidationError("Debe ser 'all' o una lista de códigos de artículo")
+        return [str(codigo) for codigo in value]
+
+
 # ========== SERIALIZERS PARA CALENDARIO TRIBUTARIO ==========
 
 class TipoTerceroSerializer(serializers.ModelSerializer):
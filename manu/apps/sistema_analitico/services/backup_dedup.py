@@ -0,0 +1,449 @@
+"""
+Formato de backup deduplicado: chunks por contenido + manifiesto.
+
+El .fbk que sale de gbak se corta en chunks definidos por contenido (gear hash
+rodante sobre una ventana de 32 bytes, cortes donde los bits altos del hash son
+cero). Como el corte depende solo de los bytes cercanos, insertar o borrar datos
+solo cambia los chunks vecinos y el resto se repite idéntico entre backups.
+
+Cada chunk se guarda comprimido una sola vez por empresa (servidor + NIT, todos
+los años fiscales), direccionado por el SHA-256 de su contenido:
+
+    {server_name}/{nit_normalizado}/chunks/{sha[:2]}/{sha}.{zst|zz}
+
+y cada backup es un manifiesto JSON pequeño en la ruta habitual de backups
+(`backup_..._.fbk.manifest.json`) con la lista ordenada de chunks. Un backup
+repetido de un año fiscal que no cambió solo sube el manifiesto y los pocos
+chunks distintos (encabezado de gbak).
+
+Borrar un backup borra solo su manifiesto; los chunks que ya no referencia
+ningún manifiesto se eliminan con recolectar_chunks_huerfanos. Mientras haya
+subidas deduplicadas en curso para la empresa (contador en caché) la
+recolección se omite, porque esas subidas pueden estar reutilizando chunks
+cuyo manifiesto aún no existe. Para que una subida no empiece a mitad del
+borrado, el recolector marca la empresa antes de comprobar el contador y la
+subida incrementa el contador antes de mirar esa marca (y espera si está
+puesta): siempre uno de los dos ve al otro.
+"""
+import base64
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from django.core.cache import cache
+from django.utils import timezone
+
+from .backup_streaming import ZSTD_AVAILABLE, zstandard
+
+logger = logging.getLogger(__name__)
+
+FORMATO = 'manu-cdc'
+VERSION_FORMATO = 1
+VENTANA = 32  # Bytes que determinan el hash rodante (uint32: un bit por byte)
+TTL_RECOLECCION = 3600  # Máximo que una recolección bloquea el inicio de subidas
+ESPERA_RECOLECCION = 1
+
+# Tabla gear fija derivada de SHA-256: debe ser idéntica en todo proceso y versión
+_GEAR = np.array(
+    [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], 'little') for i in range(256)],
+    dtype=np.uint32,
+)
+
+
+def hash_rodante(datos: np.ndarray) -> np.ndarray:
+    """
+    h[i] = Σ_{k<32} gear[datos[i-k]] << k (mod 2^32), vectorizado por duplicación
+    de ventana: 5 pasadas sobre el arreglo en lugar de una por byte.
+    """
+    h = np.take(_GEAR, datos)
+    paso = 1
+    while paso < VENTANA:
+        # El lado derecho se evalúa completo antes de sumar: no hay solapamiento
+        h[paso:] += h[:-paso] << np.uint32(paso)
+        paso *= 2
+    return h
+
+
+class FragmentadorCDC:
+    """Corta un flujo en chunks definidos por contenido de tamaño [minimo, maximo]."""
+
+    def __init__(self, promedio: int, minimo: Optional[int] = None, maximo: Optional[int] = None):
+        bits = max(promedio.bit_length() - 1, 1)
+        self.mascara = np.uint32(((1 << bits) - 1) << (32 - bits))
+        self.minimo = minimo or promedio // 4
+        self.maximo = maximo or promedio * 4
+        self._pendiente = bytearray()  # Datos desde el inicio del chunk actual
+        self._contexto = b''  # Últimos VENTANA-1 bytes, para el hash del siguiente bloque
+
+    def agregar(self, datos: bytes) -> List[bytes]:
+        """Retorna los chunks que quedan completos con `datos`."""
+        if not datos:
+            return []
+        entrada = np.frombuffer(self._contexto + datos, dtype=np.uint8)
+        hashes = hash_rodante(entrada)[len(self._contexto):]
+        self._contexto = bytes(entrada[-(VENTANA - 1):])
+
+        base = len(self._pendiente)
+        self._pendiente += datos
+        # Índice del último byte de cada chunk candidato, en coordenadas de _pendiente
+        candidatos = np.flatnonzero((hashes & self.mascara) == 0) + base + 1
+
+        cortes = []
+        inicio = 0
+        for fin in candidatos.tolist():
+            while fin - inicio > self.maximo:
+                inicio += self.maximo
+                cortes.append(inicio)
+            if fin - inicio >= self.minimo:
+                cortes.append(fin)
+                inicio = fin
+        while len(self._pendiente) - inicio > self.maximo:
+            inicio += self.maximo
+            cortes.append(inicio)
+
+        chunks = []
+        anterior = 0
+        for corte in cortes:
+            chunks.append(bytes(self._pendiente[anterior:corte]))
+            anterior = corte
+        del self._pendiente[:anterior]
+        return chunks
+
+    def cerrar(self) -> List[bytes]:
+        final = [bytes(self._pendiente)] if self._pendiente else []
+        self._pendiente = bytearray()
+        return final
+
+
+# ---------------------------------------------------------------- compresión
+def _comprimir(datos: bytes, nivel_zstd: int) -> Tuple[bytes, str]:
+    if ZSTD_AVAILABLE:
+        return zstandard.ZstdCompressor(level=nivel_zstd).compress(datos), 'zst'
+    return zlib.compress(datos, 6), 'zz'
+
+
+def _descomprimir(datos: bytes, extension: str) -> bytes:
+    if extension == 'zst':
+        if not ZSTD_AVAILABLE:
+            raise ImportError("zstandard no está instalado. Instala con: pip install zstandard")
+        return zstandard.ZstdDecompressor().decompress(datos)
+    return zlib.decompress(datos)
+
+
+def clave_chunk(prefijo_chunks: str, sha: str, extension: str) -> str:
+    return f"{prefijo_chunks}{sha[:2]}/{sha}.{extension}"
+
+
+def listar_chunks(s3_client, bucket: str, prefijo_chunks: str) -> Dict[str, Dict[str, Any]]:
+    """sha → {key, extension, tamano, fecha} de los chunks ya almacenados."""
+    existentes = {}
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for pagina in paginator.paginate(Bucket=bucket, Prefix=prefijo_chunks):
+        for obj in pagina.get('Contents', []):
+            nombre = obj['Key'].rsplit('/', 1)[-1]
+            sha, _, extension = nombre.partition('.')
+            existentes[sha] = {
+                'key': obj['Key'], 'extension': extension,
+                'tamano': obj['Size'], 'fecha': obj.get('LastModified'),
+            }
+    return existentes
+
+
+# ------------------------------------------------------- subidas en curso
+def _clave_en_uso(prefijo_chunks: str) -> str:
+    return f"backup_dedup_en_uso:{prefijo_chunks}"
+
+
+def _marcar_en_uso(prefijo_chunks: str, delta: int, ttl: int):
+    try:
+        clave = _clave_en_uso(prefijo_chunks)
+        if delta > 0 and cache.add(clave, delta, timeout=ttl):
+            return
+        nuevo = cache.incr(clave, delta)
+        if nuevo <= 0:
+            cache.delete(clave)
+    except ValueError:
+        pass  # La clave expiró entre add e incr: no hay nada que descontar
+    except Exception as e:
+        logger.warning(f"⚠️ No se pudo marcar subida deduplicada en curso ({prefijo_chunks}): {e}")
+
+
+def _clave_recolectando(prefijo_chunks: str) -> str:
+    return f"backup_dedup_recolectando:{prefijo_chunks}"
+
+
+def _esperar_recoleccion(prefijo_chunks: str):
+    """Espera a que termine un borrado de chunks en curso antes de listar los existentes."""
+    limite = time.monotonic() + TTL_RECOLECCION
+    while time.monotonic() < limite:
+        try:
+            if not cache.get(_clave_recolectando(prefijo_chunks)):
+                return
+        except Exception:
+            return  # Sin caché el recolector tampoco borra (hay_subidas_en_curso asume que sí)
+        time.sleep(ESPERA_RECOLECCION)
+
+
+def hay_subidas_en_curso(prefijo_chunks: str) -> bool:
+    """Ante un error de caché asume que sí (la recolección se pospone)."""
+    try:
+        return bool(cache.get(_clave_en_uso(prefijo_chunks)))
+    except Exception:
+        return True
+
+
+class SubidaDeduplicada:
+    """
+    Destino de ejecutar_backup_streaming (misma interfaz que SubidaMultipart):
+    fragmenta el flujo, sube en paralelo los chunks que no existen y al
+    completar escribe el manifiesto en `key`.
+    """
+
+    def __init__(self, s3_client, bucket: str, key: str, prefijo_chunks: str,
+                 chunk_promedio: int, workers: int, nivel_zstd: int = 3, ttl_en_uso: int = 6 * 3600):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.prefijo_chunks = prefijo_chunks
+        self.workers = max(workers, 1)
+        self.nivel_zstd = nivel_zstd
+        self.ttl_en_uso = ttl_en_uso
+        self.bytes_subidos = 0
+        self.objetos_escritos: List[Dict[str, Any]] = []  # {key, tamano, etag} para el índice S3
+        self.estadisticas = {'chunks': 0, 'nuevos': 0, 'reutilizados': 0, 'bytes_fbk': 0, 'bytes_almacenados': 0}
+        self._fragmentador = FragmentadorCDC(chunk_promedio)
+        self._existentes: Dict[str, Dict[str, Any]] = {}
+        self._chunks: List[List[Any]] = []  # [sha, tamano, extension] en orden; extension se completa al subir
+        self._futuros = []
+        self._error: Optional[BaseException] = None
+        self._lock = threading.Lock()
+        self._cupos = threading.BoundedSemaphore(self.workers)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._en_uso = False
+
+    def iniciar(self):
+        _marcar_en_uso(self.prefijo_chunks, 1, self.ttl_en_uso)
+        self._en_uso = True
+        _esperar_recoleccion(self.prefijo_chunks)
+        self._existentes = listar_chunks(self.s3_client, self.bucket, self.prefijo_chunks)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='backup-s3-chunk')
+        logger.info(f"🧩 Backup deduplicado: {len(self._existentes)} chunks ya almacenados en {self.prefijo_chunks}")
+
+    def escribir(self, datos: bytes):
+        for chunk in self._fragmentador.agregar(datos):
+            self._procesar(chunk)
+
+    def _procesar(self, chunk: bytes):
+        if self._error is not None:
+            raise self._error
+        sha = hashlib.sha256(chunk).hexdigest()
+        entrada = [sha, len(chunk), None]
+        self._chunks.append(entrada)
+        self.estadisticas['chunks'] += 1
+        self.estadisticas['bytes_fbk'] += len(chunk)
+
+        existente = self._existentes.get(sha)
+        if existente is not None:
+            # Sin extensión = se está subiendo en este mismo backup; completar() la asigna
+            entrada[2] = existente.get('extension')
+            self.estadisticas['reutilizados'] += 1
+            return
+        # Marcar antes de subir: un chunk repetido dentro del mismo backup se sube una vez
+        self._existentes[sha] = {}
+        self._cupos.acquire()
+        futuro = self._executor.submit(self._subir_chunk, sha, chunk, entrada)
+        futuro.add_done_callback(self._chunk_terminado)
+        self._futuros.append(futuro)
+
+    def _chunk_terminado(self, futuro):
+        self._cupos.release()
+        if futuro.cancelled():
+            return
+        if futuro.exception() is not None and self._error is None:
+            self._error = futuro.exception()
+
+    def _subir_chunk(self, sha: str, chunk: bytes, entrada: List[Any]):
+        comprimido, extension = _comprimir(chunk, self.nivel_zstd)
+        key = clave_chunk(self.prefijo_chunks, sha, extension)
+        respuesta = self.s3_client.put_object(
+            Bucket=self.bucket, Key=key, Body=comprimido,
+            ContentMD5=base64.b64encode(hashlib.md5(comprimido).digest()).decode('ascii'),
+        )
+        with self._lock:
+            self.objetos_escritos.append({'key': key, 'tamano': len(comprimido), 'etag': respuesta.get('ETag')})
+            entrada[2] = extension
+            self._existentes[sha] = {'key': key, 'extension': extension, 'tamano': len(comprimido)}
+            self.bytes_subidos += len(comprimido)
+            self.estadisticas['nuevos'] += 1
+
+    def completar(self) -> Dict[str, Any]:
+        for chunk in self._fragmentador.cerrar():
+            self._procesar(chunk)
+        for futuro in self._futuros:
+            futuro.result()
+        self._executor.shutdown(wait=True)
+
+        # Chunks repetidos dentro del mismo backup toman la extensión de su primera aparición
+        for entrada in self._chunks:
+            if entrada[2] is None:
+                entrada[2] = self._existentes[entrada[0]]['extension']
+        almacenados = sum(self._existentes[sha]['tamano'] for sha in {e[0] for e in self._chunks})
+        self.estadisticas['bytes_almacenados'] = almacenados
+
+        manifiesto = {
+            'formato': FORMATO,
+            'version': VERSION_FORMATO,
+            'creado': timezone.now().isoformat(),
+            'prefijo_chunks': self.prefijo_chunks,
+            'tamano_fbk': self.estadisticas['bytes_fbk'],
+            'tamano_almacenado': almacenados,
+            'chunks': self._chunks,
+        }
+        cuerpo = json.dumps(manifiesto, separators=(',', ':')).encode('utf-8')
+        respuesta = self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=cuerpo, ContentType='application/json')
+        self.objetos_escritos.append({'key': self.key, 'tamano': len(cuerpo), 'etag': respuesta.get('ETag')})
+        self._liberar()
+        logger.info(
+            f"🧩 Manifiesto {self.key}: {self.estadisticas['chunks']} chunks, "
+            f"{self.estadisticas['nuevos']} nuevos ({self.bytes_subidos / (1024 * 1024):.2f} MB subidos), "
+            f"{self.estadisticas['reutilizados']} reutilizados"
+        )
+        # 'bytes' es lo que ocupa este backup en S3 si fuera el único que usa sus chunks
+        return {'partes': len(self._chunks), 'bytes': almacenados + len(cuerpo)}
+
+    def abortar(self):
+        """Nunca lanza. Los chunks ya subidos quedan huérfanos hasta la próxima recolección."""
+        if self._executor is not None:
+            for futuro in self._futuros:
+                futuro.cancel()
+            self._executor.shutdown(wait=True)
+        self._liberar()
+
+    def _liberar(self):
+        if self._en_uso:
+            self._en_uso = False
+            _marcar_en_uso(self.prefijo_chunks, -1, self.ttl_en_uso)
+
+
+# ------------------------------------------------------------- lectura
+def leer_manifiesto(s3_client, bucket: str, key: str) -> Dict[str, Any]:
+    cuerpo = s3_client.get_object(Bucket=bucket, Key=key)['Body']
+    try:
+        manifiesto = json.loads(cuerpo.read())
+    finally:
+        cuerpo.close()
+    if manifiesto.get('formato') != FORMATO:
+        raise ValueError(f"{key} no es un manifiesto de backup deduplicado")
+    return manifiesto
+
+
+def restaurar_desde_manifiesto(s3_client, bucket: str, key: str, destino: str, workers: int = 4):
+    """
+    Reconstruye el .fbk en `destino`. Descarga chunks en paralelo (a lo sumo
+    2 × workers en memoria) y los escribe en orden, verificando el SHA-256 de cada uno.
+    """
+    manifiesto = leer_manifiesto(s3_client, bucket, key)
+    prefijo = manifiesto['prefijo_chunks']
+
+    def descargar(sha: str, tamano: int, extension: str) -> bytes:
+        cuerpo = s3_client.get_object(Bucket=bucket, Key=clave_chunk(prefijo, sha, extension))['Body']
+        try:
+            datos = _descomprimir(cuerpo.read(), extension)
+        finally:
+            cuerpo.close()
+        if len(datos) != tamano or hashlib.sha256(datos).hexdigest() != sha:
+            raise ValueError(f"Chunk {sha} corrupto en {key}")
+        return datos
+
+    escritos = 0
+    pendientes: deque = deque()
+    chunks = iter(manifiesto['chunks'])
+    with ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix='backup-restaurar') as executor, \
+            open(destino, 'wb') as archivo:
+        for sha, tamano, extension in chunks:
+            pendientes.append(executor.submit(descargar, sha, tamano, extension))
+            if len(pendientes) >= 2 * workers:
+                datos = pendientes.popleft().result()
+                archivo.write(datos)
+                escritos += len(datos)
+        while pendientes:
+            datos = pendientes.popleft().result()
+            archivo.write(datos)
+            escritos += len(datos)
+    if escritos != manifiesto['tamano_fbk']:
+        raise ValueError(f"Tamaño reconstruido {escritos} != {manifiesto['tamano_fbk']} en {key}")
+    logger.info(f"✅ FBK reconstruido desde {key}: {escritos / (1024 * 1024):.2f} MB, {len(manifiesto['chunks'])} chunks")
+
+
+def recolectar_chunks_huerfanos(s3_client, bucket: str, prefijo_chunks: str, manifiestos: Iterable[str],
+                                al_eliminar: Optional[Callable[[List[str]], None]] = None) -> Dict[str, int]:
+    """
+    Elimina los chunks de `prefijo_chunks` que no referencia ningún manifiesto
+    vigente. Si algún manifiesto no se puede leer no elimina nada.
+    al_eliminar recibe las claves de cada lote eliminado.
+    """
+    if hay_subidas_en_curso(prefijo_chunks):
+        logger.info(f"⏭️ Recolección de chunks omitida: hay backups en curso en {prefijo_chunks}")
+        return {'eliminados': 0, 'bytes_liberados': 0, 'omitida': 1}
+
+    referenciados = set()
+    for key in manifiestos:
+        try:
+            manifiesto = leer_manifiesto(s3_client, bucket, key)
+        except Exception as e:
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                continue  # Manifiesto ya borrado: no referencia nada
+            logger.warning(f"⚠️ Recolección de chunks cancelada, no se pudo leer {key}: {e}")
+            return {'eliminados': 0, 'bytes_liberados': 0, 'omitida': 1}
+        referenciados.update(sha for sha, _, _ in manifiesto['chunks'])
+
+    huerfanos = [c for sha, c in listar_chunks(s3_client, bucket, prefijo_chunks).items() if sha not in referenciados]
+    if not huerfanos:
+        return {'eliminados': 0, 'bytes_liberados': 0, 'omitida': 0}
+
+    clave = _clave_recolectando(prefijo_chunks)
+    duenio = str(uuid.uuid4())
+    try:
+        tomada = cache.add(clave, duenio, timeout=TTL_RECOLECCION)
+    except Exception:
+        tomada = False
+    if not tomada:
+        logger.info(f"⏭️ Recolección de chunks omitida: otra recolección en curso en {prefijo_chunks}")
+        return {'eliminados': 0, 'bytes_liberados': 0, 'omitida': 1}
+
+    eliminados: List[Dict[str, Any]] = []
+    omitida = 0
+    try:
+        for i in range(0, len(huerfanos), 1000):  # delete_objects admite 1000 claves por llamada
+            # Una subida que empezó durante la lectura de manifiestos pudo listar estos chunks
+            if hay_subidas_en_curso(prefijo_chunks):
+                logger.info(f"⏭️ Recolección de chunks interrumpida: empezó un backup en {prefijo_chunks}")
+                omitida = 1
+                break
+            lote = huerfanos[i:i + 1000]
+            s3_client.delete_objects(
+                Bucket=bucket,
+                Delete={'Objects': [{'Key': c['key']} for c in lote], 'Quiet': True},
+            )
+            eliminados.extend(lote)
+            if al_eliminar is not None:
+                al_eliminar([c['key'] for c in lote])
+    finally:
+        try:
+            if cache.get(clave) == duenio:
+                cache.delete(clave)
+        except Exception:
+            pass  # La marca expira sola (TTL_RECOLECCION)
+
+    liberados = sum(c['tamano'] for c in eliminados)
+    if eliminados:
+        logger.info(f"🧹 Chunks huérfanos eliminados en {prefijo_chunks}: {len(eliminados)} ({liberados / (1024 * 1024):.2f} MB)")
+    return {'eliminados': len(eliminados), 'bytes_liberados': liberados, 'omitida': omitida}
@@ -7,6 +7,7 @@ import logging
 import time
 from datetime import datetime, date
 from typing import Dict, List, Optional, Tuple
+from django.conf import settings
 from django.utils import timezone
 from django.db.models import Q
 
@@ -26,6 +27,12 @@ except ImportError:
     BotoConfig = None
     logger.warning("boto3 no está instalado. Los backups a S3 no funcionarán.")
 
+from .backup_streaming import (
+    EXTENSION_MANIFIESTO, EXTENSION_ZSTD, ZSTD_AVAILABLE, SubidaMultipart, ejecutar_backup_streaming
+)
+from .backup_dedup import SubidaDeduplicada, recolectar_chunks_huerfanos
+from . import backup_scheduler, indice_s3
+
 
 class BackupS3Service:
     """
@@ -119,6 +126,38 @@ class BackupS3Service:
         server_name = empresa.servidor.nombre.replace(' ', '_').replace('/', '_').replace('\\', '_')
         return f"{server_name}/{empresa.nit_normalizado}/{empresa.anio_fiscal}/backups/{nombre_archivo}"
     
+    def obtener_prefijo_chunks(self, empresa: EmpresaServidor) -> str:
+        """
+        Prefijo de los chunks deduplicados, compartidos por todos los años fiscales de la empresa:
+        {server_name}/{nit_normalizado}/chunks/
+        """
+        server_name = empresa.servidor.nombre.replace(' ', '_').replace('/', '_').replace('\\', '_')
+        return f"{server_name}/{empresa.nit_normalizado}/chunks/"
+    
+    def recolectar_chunks(self, empresa: EmpresaServidor) -> Dict[str, int]:
+        """
+        Elimina los chunks deduplicados de la empresa que ya no referencia ningún backup.
+        
+        Args:
+            empresa: Empresa (se consideran todos sus años fiscales en el mismo servidor)
+            
+        Returns:
+            Diccionario con estadísticas de la recolección
+        """
+        manifiestos = BackupS3.objects.filter(
+            empresa_servidor__servidor__nombre=empresa.servidor.nombre,
+            empresa_servidor__nit_normalizado=empresa.nit_normalizado,
+            ruta_s3__endswith=EXTENSION_MANIFIESTO,
+        ).values_list('ruta_s3', flat=True)
+        try:
+            return recolectar_chunks_huerfanos(
+                self.s3_client, self.bucket_name, self.obtener_prefijo_chunks(empresa), list(manifiestos),
+                al_eliminar=lambda keys: indice_s3.eliminar_objetos(self.config, keys),
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudieron recolectar chunks de {empresa.nombre}: {e}")
+            return {'eliminados': 0, 'bytes_liberados': 0, 'omitida': 1}
+    
     def _normalizar_nombre_archivo(self, nombre: str) -> str:
         """
         Normaliza un nombre de archivo para S3 (sin caracteres especiales).
@@ -220,12 +259,13 @@ class BackupS3Service:
             
             # Subir el archivo actualizado
             contenido_bytes = nuevo_contenido.encode('utf-8')
-            self.s3_client.put_object(
+            respuesta = self.s3_client.put_object(
                 Bucket=self.bucket_name,
                 Key=ruta_s3_txt,
                 Body=contenido_bytes,
                 ContentType='text/plain; charset=utf-8'
             )
+            indice_s3.registrar_objeto(self.config, ruta_s3_txt, len(contenido_bytes), respuesta.get('ETag'))
             
             logger.debug(f"Backup registrado en log: {ruta_s3_txt}")
             return True
@@ -238,6 +278,9 @@ class BackupS3Service:
         """
         Calcula el tamaño total en GB usado en S3 por una empresa (por servidor y NIT normalizado),
         considerando TODOS los años fiscales, backups y demás carpetas/documentos.
+        Los chunks de backups deduplicados están bajo el mismo prefijo y se cuentan una
+        sola vez aunque los compartan varios backups. Usa el índice ObjetoS3 si está
+        reconciliado; si no, lista el prefijo en S3.
         
         Args:
             empresa: EmpresaServidor específica (se usa servidor.nombre + nit_normalizado)
@@ -255,6 +298,11 @@ class BackupS3Service:
             prefix = f"{server_name}/{empresa.nit_normalizado}/"
             total_bytes = 0
             
+            # Con el índice reconciliado basta una suma en la base de datos
+            if indice_s3.indice_disponible(self.config):
+                total_bytes = indice_s3.tamano_empresa(self.config, server_name, empresa.nit_normalizado)
+                return round(total_bytes / (1024 * 1024 * 1024), 2)
+            
             # Para path-style, el bucket debe ir en la ruta, no en el dominio
             # Usar list_objects_v2 con el bucket en el parámetro
             logger.debug(f"Listando objetos en S3 con prefix: {prefix}, bucket: {self.bucket_name}")
@@ -269,28 +317,16 @@ class BackupS3Service:
             logger.error(f"Error calculando tamaño de backups para {empresa.nombre}: {e}")
             return 0.0
     
-    def crear_backup_firebird(
-        self,
-        empresa: EmpresaServidor,
-        gbak_path: Optional[str] = None,
-        usuario: str = "SYSDBA",
-        contrasena: str = "masterkey"
-    ) -> Tuple[bool, Optional[str], Optional[int]]:
+    def _ruta_origen_firebird(self, empresa: EmpresaServidor) -> Optional[str]:
         """
-        Crea un backup de la base de datos Firebird de una empresa.
+        Ruta de la base de datos para gbak: ruta local o host:ruta_base si el servidor es remoto.
         
-        Args:
-            empresa: Empresa para la cual crear el backup
-            gbak_path: Ruta al ejecutable gbak.exe
-            usuario: Usuario de Firebird
-            contrasena: Contraseña de Firebird
-            
         Returns:
-            Tupla (éxito, ruta_archivo_temporal, tamano_bytes)
+            Ruta para gbak, o None si la empresa no tiene una base de datos accesible
         """
         if not empresa.ruta_base:
             logger.error(f"Empresa {empresa.nombre} no tiene ruta_base configurada")
-            return False, None, None
+            return None
 
         # Construir ruta completa considerando servidor remoto
         # Si ruta_base es una ruta local, usarla directamente
@@ -349,7 +385,16 @@ class BackupS3Service:
             # Verificar que existe localmente
             if not os.path.exists(empresa.ruta_base):
                 logger.error(f"Archivo de base de datos no existe localmente: {empresa.ruta_base}")
-                return False, None, None
+                return None
+        return ruta_completa
+    
+    def _resolver_gbak(self, gbak_path: Optional[str] = None) -> Optional[str]:
+        """
+        Ubica el ejecutable gbak (parámetro, FIREBIRD_GBAK_PATH o rutas comunes según el SO).
+        
+        Returns:
+            Ruta a gbak, o None si no se encontró
+        """
         # Determinar ruta de gbak de forma portable:
         # - Si se pasa explícitamente, usarla.
         # - Si no, leer FIREBIRD_GBAK_PATH de settings.
@@ -396,12 +441,12 @@ class BackupS3Service:
                     logger.error("❌ No se encontró gbak.exe en ninguna ubicación.")
                     logger.error(f"Ubicaciones verificadas: {posibles_rutas}")
                     logger.error("Configure FIREBIRD_GBAK_PATH en settings.py o instale Firebird.")
-                    return False, None, None
+                    return None
                 
                 # Verificar una vez más que existe antes de continuar
                 if not os.path.exists(gbak_path):
                     logger.error(f"❌ gbak.exe no existe en la ruta encontrada: {gbak_path}")
-                    return False, None, None
+                    return None
             else:
                 # En Linux/Ubuntu (VPS): gbak normalmente está en el PATH después de instalar Firebird
                 # Si no está, puede estar en /usr/bin/gbak o /usr/local/bin/gbak
@@ -437,9 +482,36 @@ class BackupS3Service:
                         "   sudo apt-get install firebird3.0-utils\n"
                         "3. O configurar FIREBIRD_GBAK_PATH en settings.py con la ruta completa a gbak 2.5"
                     )
-                    return False, None, None
+                    return None
                 
                 logger.info(f"Usando gbak desde: {gbak_path}")
+        return gbak_path
+    
+    def crear_backup_firebird(
+        self,
+        empresa: EmpresaServidor,
+        gbak_path: Optional[str] = None,
+        usuario: str = "SYSDBA",
+        contrasena: str = "masterkey"
+    ) -> Tuple[bool, Optional[str], Optional[int]]:
+        """
+        Crea un backup de la base de datos Firebird de una empresa.
+        
+        Args:
+            empresa: Empresa para la cual crear el backup
+            gbak_path: Ruta al ejecutable gbak.exe
+            usuario: Usuario de Firebird
+            contrasena: Contraseña de Firebird
+            
+        Returns:
+            Tupla (éxito, ruta_archivo_temporal, tamano_bytes)
+        """
+        ruta_completa = self._ruta_origen_firebird(empresa)
+        if ruta_completa is None:
+            return False, None, None
+        gbak_path = self._resolver_gbak(gbak_path)
+        if gbak_path is None:
+            return False, None, None
         
         # Generar nombre de archivo temporal (siempre local, no en servidor remoto)
         fecha_str = datetime.now().strftime("%Y-%m-%d_%H-%M")
@@ -718,6 +790,7 @@ class BackupS3Service:
                 ruta_s3
             )
             tiempo_upload = time.time() - inicio_upload
+            indice_s3.registrar_objeto(self.config, ruta_s3, tamano_archivo)
             
             logger.info(f"✅ Backup subido exitosamente a S3: {ruta_s3} (tiempo: {tiempo_upload:.2f}s, velocidad: {tamano_mb/tiempo_upload:.2f} MB/s)")
             
@@ -755,6 +828,7 @@ class BackupS3Service:
         """
         try:
             self.s3_client.delete_object(Bucket=self.bucket_name, Key=ruta_s3)
+            indice_s3.eliminar_objetos(self.config, [ruta_s3])
             logger.info(f"Backup eliminado de S3: {ruta_s3}")
             return True
         except Exception as e:
@@ -917,6 +991,7 @@ class BackupS3Service:
         
         eliminados = 0
         conservados = 0
+        hay_deduplicados = any(b.ruta_s3.endswith(EXTENSION_MANIFIESTO) for b in backups)
         
         # Agrupar por año fiscal
         backups_por_anio = {}
@@ -962,9 +1037,15 @@ class BackupS3Service:
                         eliminados += 1
                 conservados += min(3, len(backups_ordenados))
         
+        # Borrar un backup deduplicado solo borra su manifiesto; liberar los chunks que quedaron sin usar
+        chunks_eliminados = 0
+        if eliminados and hay_deduplicados:
+            chunks_eliminados = self.recolectar_chunks(empresa)['eliminados']
+        
         return {
             'eliminados': eliminados,
-            'conservados': conservados
+            'conservados': conservados,
+            'chunks_eliminados': chunks_eliminados
         }
     
     def verificar_limite_espacio(self, empresa: EmpresaServidor) -> Tuple[bool, float, float]:
@@ -1010,6 +1091,7 @@ class BackupS3Service:
     ) -> Tuple[bool, Optional[BackupS3], Optional[str]]:
         """
         Realiza un backup completo: crea el backup local, lo sube a S3 y aplica política de retención.
+        Con BACKUP_STREAMING_ENABLED gbak se sube en streaming, sin backup local.
         
         Args:
             empresa: Empresa para la cual realizar el backup
@@ -1027,6 +1109,9 @@ class BackupS3Service:
             logger.warning(f"Backup no realizado para {empresa.nombre}: {mensaje}")
             return False, None, mensaje
         
+        if getattr(settings, 'BACKUP_STREAMING_ENABLED', True):
+            return self._realizar_backup_streaming(empresa, gbak_path, usuario, contrasena)
+        
         # Crear backup local
         logger.info(f"📦 Creando backup local con gbak para {empresa.nombre}...")
         exito, ruta_local, tamano = self.crear_backup_firebird(empresa, gbak_path, usuario, contrasena)
@@ -1074,24 +1159,7 @@ class BackupS3Service:
             
             logger.info(f"✅ Backup subido exitosamente a S3: {ruta_s3}")
             
-            # Registrar en BD
-            logger.info(f"💾 Creando registro en base de datos para {empresa.nombre}...")
-            backup_s3 = BackupS3.objects.create(
-                empresa_servidor=empresa,
-                configuracion_s3=self.config,
-                ruta_s3=ruta_s3,
-                nombre_archivo=nombre_archivo,
-                tamano_bytes=tamano,
-                fecha_backup=timezone.now(),
-                anio_fiscal=empresa.anio_fiscal,
-                estado='completado'
-            )
-            logger.info(f"✅ Registro creado: BackupS3 ID {backup_s3.id}")
-            
-            # Aplicar política de retención
-            logger.info(f"🧹 Aplicando política de retención para {empresa.nombre}...")
-            stats = self.aplicar_politica_retencion(empresa)
-            logger.info(f"✅ Política aplicada: {stats['eliminados']} eliminados, {stats['conservados']} conservados")
+            backup_s3 = self._registrar_backup_completado(empresa, ruta_s3, nombre_archivo, tamano)
             
             # Limpiar archivo local
             if os.path.exists(ruta_local):
@@ -1117,6 +1185,182 @@ class BackupS3Service:
                 os.remove(ruta_local)
             return False, None, error_msg
     
+    def _registrar_backup_completado(
+        self,
+        empresa: EmpresaServidor,
+        ruta_s3: str,
+        nombre_archivo: str,
+        tamano: int
+    ) -> BackupS3:
+        """
+        Crea el registro BackupS3 de un backup ya subido y aplica la política de retención.
+        """
+        logger.info(f"💾 Creando registro en base de datos para {empresa.nombre}...")
+        backup_s3 = BackupS3.objects.create(
+            empresa_servidor=empresa,
+            configuracion_s3=self.config,
+            ruta_s3=ruta_s3,
+            nombre_archivo=nombre_archivo,
+            tamano_bytes=tamano,
+            fecha_backup=timezone.now(),
+            anio_fiscal=empresa.anio_fiscal,
+            estado='completado'
+        )
+        logger.info(f"✅ Registro creado: BackupS3 ID {backup_s3.id}")
+        
+        # Aplicar política de retención
+        logger.info(f"🧹 Aplicando política de retención para {empresa.nombre}...")
+        stats = self.aplicar_politica_retencion(empresa)
+        logger.info(f"✅ Política aplicada: {stats['eliminados']} eliminados, {stats['conservados']} conservados")
+        return backup_s3
+    
+    def subir_backup_streaming(
+        self,
+        empresa: EmpresaServidor,
+        gbak_path: Optional[str] = None,
+        usuario: str = "SYSDBA",
+        contrasena: str = "masterkey"
+    ) -> Tuple[bool, Optional[str], Optional[str], Optional[int], Optional[str]]:
+        """
+        Backup sin archivo temporal: gbak escribe a stdout y la salida se sube a S3
+        por multipart mientras se genera (ver backup_streaming). Con
+        BACKUP_DEDUP_ENABLED se guarda en chunks deduplicados + manifiesto (ver backup_dedup).
+        La lectura de gbak respeta la parte del ancho de banda del servidor que le
+        corresponde a cada backup (ver backup_scheduler).
+        
+        Args:
+            empresa: Empresa para la cual crear el backup
+            gbak_path: Ruta al ejecutable gbak
+            usuario: Usuario de Firebird
+            contrasena: Contraseña de Firebird
+            
+        Returns:
+            Tupla (éxito, ruta_s3, nombre_archivo, tamano_bytes_en_s3, mensaje_error)
+        """
+        ruta_completa = self._ruta_origen_firebird(empresa)
+        if ruta_completa is None:
+            return False, None, None, None, "Error al crear backup: base de datos no accesible"
+        gbak_path = self._resolver_gbak(gbak_path)
+        if gbak_path is None:
+            return False, None, None, None, "Error al crear backup: no se encontró gbak"
+        
+        deduplicar = getattr(settings, 'BACKUP_DEDUP_ENABLED', True)
+        # Los chunks deduplicados se comprimen uno a uno; el flujo completo solo sin deduplicar
+        comprimir = getattr(settings, 'BACKUP_STREAMING_ZSTD', False) and not deduplicar
+        if comprimir and not ZSTD_AVAILABLE:
+            logger.warning("zstandard no está instalado. El backup se sube sin comprimir.")
+            comprimir = False
+        
+        # Mismo nombre que el backup local (backup_{nit}_{nombre temporal}) más la extensión del formato
+        fecha_str = datetime.now().strftime("%Y-%m-%d_%H-%M")
+        nombre_archivo = f"backup_{empresa.nit_normalizado}_backup_{fecha_str}.fbk"
+        if deduplicar:
+            nombre_archivo += EXTENSION_MANIFIESTO
+        elif comprimir:
+            nombre_archivo += EXTENSION_ZSTD
+        ruta_s3 = self.obtener_ruta_s3(empresa, nombre_archivo)
+        
+        # 'stdout' como archivo de destino hace que gbak escriba el backup a su salida estándar
+        comando = [gbak_path, '-user', usuario, '-pass', contrasena, '-b', ruta_completa, 'stdout']
+        env = os.environ.copy()
+        env['LC_ALL'] = 'C.UTF-8'
+        env['LANG'] = 'C.UTF-8'
+        
+        timeout_total = getattr(settings, 'BACKUP_STREAMING_TIMEOUT', 6 * 3600)
+        if deduplicar:
+            subida = SubidaDeduplicada(
+                self.s3_client,
+                self.bucket_name,
+                ruta_s3,
+                prefijo_chunks=self.obtener_prefijo_chunks(empresa),
+                chunk_promedio=getattr(settings, 'BACKUP_DEDUP_CHUNK_MB', 4) * 1024 * 1024,
+                workers=getattr(settings, 'BACKUP_STREAMING_WORKERS', 4),
+                nivel_zstd=getattr(settings, 'BACKUP_STREAMING_ZSTD_NIVEL', 3),
+                ttl_en_uso=timeout_total,
+            )
+        else:
+            subida = SubidaMultipart(
+                self.s3_client,
+                self.bucket_name,
+                ruta_s3,
+                tamano_parte=getattr(settings, 'BACKUP_STREAMING_PARTE_MB', 16) * 1024 * 1024,
+                workers=getattr(settings, 'BACKUP_STREAMING_WORKERS', 4),
+            )
+        logger.info(f"☁️ Backup en streaming: {ruta_completa} → bucket={self.bucket_name}, key={ruta_s3}")
+        try:
+            resultado = ejecutar_backup_streaming(
+                comando,
+                subida,
+                comprimir=comprimir,
+                nivel_zstd=getattr(settings, 'BACKUP_STREAMING_ZSTD_NIVEL', 3),
+                timeout_total=timeout_total,
+                timeout_sin_progreso=getattr(settings, 'BACKUP_STREAMING_TIMEOUT_SIN_PROGRESO', 300),
+                env=env,
+                limite_bytes_por_segundo=backup_scheduler.limite_bytes_por_segundo(empresa.servidor),
+            )
+        except Exception as e:
+            logger.error(f"❌ Error en backup streaming para {empresa.nombre}: {e}", exc_info=True)
+            return False, None, nombre_archivo, None, f"Error en backup streaming: {e}"
+        finally:
+            # Si falla, los chunks ya subidos existen en S3 (huérfanos hasta la recolección)
+            indice_s3.registrar_objetos(self.config, subida.objetos_escritos)
+        
+        logger.info(f"   SHA-256: {resultado['sha256']}")
+        try:
+            self.registrar_backup_en_log(
+                empresa=empresa,
+                exito=True,
+                peso_bytes=resultado['tamano_bytes'],
+                nombre_archivo=nombre_archivo
+            )
+        except Exception as e:
+            logger.warning(f"No se pudo registrar backup en log para {empresa.nombre}: {e}")
+        return True, ruta_s3, nombre_archivo, resultado['tamano_bytes'], None
+    
+    def _realizar_backup_streaming(
+        self,
+        empresa: EmpresaServidor,
+        gbak_path: Optional[str],
+        usuario: str,
+        contrasena: str
+    ) -> Tuple[bool, Optional[BackupS3], Optional[str]]:
+        """
+        Variante en streaming de realizar_backup_completo (mismo retorno).
+        """
+        logger.info(f"📦 Backup en streaming (gbak → S3) para {empresa.nombre}...")
+        exito, ruta_s3, nombre_archivo, tamano, error_msg = self.subir_backup_streaming(
+            empresa, gbak_path, usuario, contrasena
+        )
+        if not exito:
+            try:
+                self.registrar_backup_en_log(
+                    empresa=empresa,
+                    exito=False,
+                    nombre_archivo=nombre_archivo,
+                    error=error_msg
+                )
+            except Exception as e:
+                logger.warning(f"No se pudo registrar error en log: {e}")
+            return False, None, error_msg
+        
+        try:
+            backup_s3 = self._registrar_backup_completado(empresa, ruta_s3, nombre_archivo, tamano)
+        except Exception as e:
+            error_msg = str(e)
+            logger.error(f"Error en backup completo para {empresa.nombre}: {error_msg}", exc_info=True)
+            try:
+                self.registrar_backup_en_log(
+                    empresa=empresa,
+                    exito=False,
+                    error=error_msg
+                )
+            except Exception as log_error:
+                logger.warning(f"No se pudo registrar error en log: {log_error}")
+            return False, None, error_msg
+        
+        logger.info(f"🎉 Backup completado exitosamente para {empresa.nombre}: {ruta_s3}")
+        return True, backup_s3, None
+    
     def listar_backups(self, empresa: EmpresaServidor) -> List[Dict]:
         """
         Lista todos los backups de una empresa en S3.
@@ -1161,6 +1405,8 @@ class BackupS3Service:
             
             if self.eliminar_backup_s3(ruta_s3):
                 backup.delete()
+                if ruta_s3.endswith(EXTENSION_MANIFIESTO):
+                    self.recolectar_chunks(backup.empresa_servidor)
                 return True
             return False
         except BackupS3.DoesNotExist:
@@ -0,0 +1,232 @@
+"""
+Planificador global de backups programados.
+
+Cada Servidor es un recurso con max_backups_concurrentes cupos (gbak simultáneos
+contra el mismo host Firebird / enlace VPN) y un presupuesto de ancho de banda
+(ancho_banda_backup_mbps) repartido en partes iguales entre esos cupos. Los cupos
+son claves en caché (backup_cupo:{servidor_id}:{n}) tomadas con cache.add, así
+todos los workers Celery ven la misma ocupación; si un worker muere el cupo
+expira solo (BACKUP_CUPO_TTL).
+
+La cola no se guarda: se recalcula desde BackupS3 cada vez que se despacha (cada
+hora y cada vez que termina un backup del servidor), en orden de prioridad: año
+fiscal actual primero y luego el backup más antiguo (sin backup = el más antiguo).
+Los años anteriores solo se despachan dentro de la ventana nocturna.
+"""
+import logging
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Max, OuterRef, Q, Subquery
+from django.utils import timezone
+
+from ..models import BackupS3, EmpresaServidor, Servidor
+
+logger = logging.getLogger(__name__)
+
+PREFIJO_CUPO = 'backup_cupo'
+PREFIJO_EMPRESA = 'backup_empresa'
+PREFIJO_FALLO = 'backup_fallo'
+
+
+def _ttl() -> int:
+    return getattr(settings, 'BACKUP_CUPO_TTL', 8 * 3600)
+
+
+def _clave_cupo(servidor_id: int, numero: int) -> str:
+    return f"{PREFIJO_CUPO}:{servidor_id}:{numero}"
+
+
+def _clave_empresa(empresa_id: int) -> str:
+    return f"{PREFIJO_EMPRESA}:{empresa_id}"
+
+
+def limite_concurrencia(servidor: Servidor) -> int:
+    return max(1, servidor.max_backups_concurrentes or 1)
+
+
+# ------------------------------------------------------------------ cupos
+def tomar_cupo(servidor: Servidor, duenio: str) -> Optional[str]:
+    """Reserva un cupo libre del servidor para `duenio` (task_id); None si están todos ocupados."""
+    for numero in range(limite_concurrencia(servidor)):
+        clave = _clave_cupo(servidor.id, numero)
+        if cache.add(clave, duenio, timeout=_ttl()):
+            return clave
+    return None
+
+
+def liberar_cupo(clave: Optional[str], duenio: str):
+    """Libera el cupo solo si sigue perteneciendo a `duenio`."""
+    if clave and cache.get(clave) == duenio:
+        cache.delete(clave)
+
+
+def cupos_ocupados(servidor: Servidor) -> int:
+    claves = [_clave_cupo(servidor.id, n) for n in range(limite_concurrencia(servidor))]
+    return len(cache.get_many(claves))
+
+
+def reservar_empresa(empresa_id: int, duenio: str) -> bool:
+    """Evita dos backups simultáneos de la misma empresa (programado + manual)."""
+    if cache.add(_clave_empresa(empresa_id), duenio, timeout=_ttl()):
+        return True
+    return cache.get(_clave_empresa(empresa_id)) == duenio
+
+
+def liberar_empresa(empresa_id: int, duenio: str):
+    clave = _clave_empresa(empresa_id)
+    if cache.get(clave) == duenio:
+        cache.delete(clave)
+
+
+def registrar_fallo(empresa_id: int):
+    """Saca la empresa de la cola por BACKUP_ESPERA_TRAS_ERROR: un backup que falla no se relanza en bucle."""
+    cache.set(f"{PREFIJO_FALLO}:{empresa_id}", 1, timeout=getattr(settings, 'BACKUP_ESPERA_TRAS_ERROR', 3600))
+
+
+def limite_bytes_por_segundo(servidor: Servidor) -> Optional[float]:
+    """Parte del ancho de banda del servidor que le toca a cada backup (None = sin límite)."""
+    if not servidor.ancho_banda_backup_mbps:
+        return None
+    return servidor.ancho_banda_backup_mbps * 1_000_000 / 8 / limite_concurrencia(servidor)
+
+
+# ------------------------------------------------------------- planificación
+def _en_ventana(hora: int) -> bool:
+    inicio = getattr(settings, 'BACKUP_VENTANA_INICIO', 19)
+    fin = getattr(settings, 'BACKUP_VENTANA_FIN', 7)
+    if inicio <= fin:
+        return inicio <= hora < fin
+    return hora >= inicio or hora < fin
+
+
+def _ultima_hora_programada(local: datetime, hora_backup) -> datetime:
+    programada = local.replace(hour=hora_backup.hour, minute=hora_backup.minute, second=0, microsecond=0)
+    if programada > local:
+        programada -= timedelta(days=1)
+    return programada
+
+
+def trabajos_pendientes(servidor_ids: Optional[Iterable[int]] = None,
+                        ahora: Optional[datetime] = None) -> Dict[int, List[Dict[str, Any]]]:
+    """
+    Empresas que necesitan backup, agrupadas por servidor y ordenadas por prioridad:
+    - Año fiscal actual: sin backup completado desde su última hora_backup.
+    - Años anteriores: backup de más de BACKUP_DIAS_ANIOS_ANTERIORES días, solo dentro de la ventana.
+    Se omiten las empresas con un fallo reciente (registrar_fallo).
+    """
+    ahora = ahora or timezone.now()
+    local = timezone.localtime(ahora)
+    anio_actual = local.year
+    limite_anteriores = ahora - timedelta(days=getattr(settings, 'BACKUP_DIAS_ANIOS_ANTERIORES', 30))
+    incluir_anteriores = _en_ventana(local.hour)
+
+    ultimo_tamano = BackupS3.objects.filter(
+        empresa_servidor=OuterRef('pk'), estado='completado'
+    ).order_by('-fecha_backup').values('tamano_bytes')[:1]
+    empresas = EmpresaServidor.objects.filter(
+        backups_habilitados=True, servidor__activo=True, anio_fiscal__lte=anio_actual
+    ).annotate(
+        ultimo_backup=Max('backups_s3__fecha_backup', filter=Q(backups_s3__estado='completado')),
+        ultimo_tamano=Subquery(ultimo_tamano),
+    )
+    if servidor_ids is not None:
+        empresas = empresas.filter(servidor_id__in=list(servidor_ids))
+    if not incluir_anteriores:
+        empresas = empresas.filter(anio_fiscal=anio_actual)
+
+    empresas = list(empresas)
+    fallidas = cache.get_many([f"{PREFIJO_FALLO}:{e.id}" for e in empresas])
+
+    por_servidor: Dict[int, List[Dict[str, Any]]] = {}
+    for empresa in empresas:
+        if f"{PREFIJO_FALLO}:{empresa.id}" in fallidas:
+            continue
+        actual = empresa.anio_fiscal == anio_actual
+        if actual:
+            vence = _ultima_hora_programada(local, empresa.hora_backup)
+        else:
+            vence = limite_anteriores
+        if empresa.ultimo_backup is not None and empresa.ultimo_backup >= vence:
+            continue
+        por_servidor.setdefault(empresa.servidor_id, []).append({
+            'empresa_id': empresa.id,
+            'empresa_nombre': empresa.nombre,
+            'anio_fiscal': empresa.anio_fiscal,
+            'anio_actual': actual,
+            'ultimo_backup': empresa.ultimo_backup,
+            'tamano_estimado': empresa.ultimo_tamano or 0,
+        })
+
+    minimo = datetime.min.replace(tzinfo=ahora.tzinfo)
+    for trabajos in por_servidor.values():
+        trabajos.sort(key=lambda t: (not t['anio_actual'], t['ultimo_backup'] or minimo, t['empresa_id']))
+    return por_servidor
+
+
+def despachar(configuracion_s3_id: int, servidor_ids: Optional[Iterable[int]] = None,
+              ahora: Optional[datetime] = None) -> Dict[str, Any]:
+    """
+    Lanza realizar_backup_empresa_task para los trabajos más prioritarios de cada
+    servidor mientras tenga cupos libres. El cupo se reserva aquí y se entrega a la
+    tarea, que lo libera al terminar y vuelve a despachar su servidor.
+    """
+    from ..tasks import realizar_backup_empresa_task
+
+    pendientes = trabajos_pendientes(servidor_ids, ahora)
+    servidores = Servidor.objects.in_bulk(list(pendientes))
+    resumen = []
+    for servidor_id, trabajos in pendientes.items():
+        servidor = servidores[servidor_id]
+        lanzados, en_curso = [], []
+        for trabajo in trabajos:
+            task_id = str(uuid.uuid4())
+            if not reservar_empresa(trabajo['empresa_id'], task_id):
+                en_curso.append(trabajo['empresa_id'])  # Ya hay un backup de esta empresa en cola o en curso
+                continue
+            cupo = tomar_cupo(servidor, task_id)
+            if cupo is None:
+                liberar_empresa(trabajo['empresa_id'], task_id)
+                break
+            try:
+                realizar_backup_empresa_task.apply_async(
+                    args=(trabajo['empresa_id'], configuracion_s3_id),
+                    kwargs={'cupo': cupo},
+                    task_id=task_id,
+                )
+            except Exception:
+                liberar_cupo(cupo, task_id)
+                liberar_empresa(trabajo['empresa_id'], task_id)
+                raise
+            lanzados.append(trabajo['empresa_id'])
+            logger.info(
+                f"📦 Backup despachado: {trabajo['empresa_nombre']} (año {trabajo['anio_fiscal']}) "
+                f"en {servidor.nombre} [{cupo}]"
+            )
+
+        restantes = [t for t in trabajos if t['empresa_id'] not in lanzados and t['empresa_id'] not in en_curso]
+        bytes_por_segundo = limite_bytes_por_segundo(servidor)
+        horas_estimadas = None
+        if bytes_por_segundo:
+            # Cada cupo avanza en paralelo a bytes_por_segundo
+            total = sum(t['tamano_estimado'] for t in trabajos)
+            horas_estimadas = round(total / bytes_por_segundo / limite_concurrencia(servidor) / 3600, 2)
+        resumen.append({
+            'servidor_id': servidor_id,
+            'servidor': servidor.nombre,
+            'limite_concurrencia': limite_concurrencia(servidor),
+            'ocupados': cupos_ocupados(servidor),
+            'lanzados': len(lanzados),
+            'en_cola': len(restantes),
+            'anio_actual_en_cola': len([t for t in restantes if t['anio_actual']]),
+            'horas_estimadas': horas_estimadas,
+        })
+
+    return {
+        'lanzados': sum(s['lanzados'] for s in resumen),
+        'en_cola': sum(s['en_cola'] for s in resumen),
+        'servidores': resumen,
+    }
@@ -0,0 +1,395 @@
+"""
+Pipeline de backup en streaming: gbak (stdout) → zstd opcional → multipart S3.
+
+gbak escribe el .fbk a stdout; el hilo principal lo lee por bloques, lo
+comprime si corresponde y lo acumula en partes que suben workers en paralelo.
+No hay archivo temporal: el disco local no crece con el tamaño de la base y
+gbak y la subida se solapan, así que el backup tarda lo que la etapa más lenta.
+
+Memoria acotada: como máximo `workers` partes subiéndose más la que se está
+llenando. Si S3 va más lento que gbak, el productor se bloquea en el semáforo,
+deja de leer el pipe y gbak espera (contrapresión natural del pipe).
+
+Integridad: cada parte lleva Content-MD5 (S3 rechaza la parte si no coincide)
+y se calcula el SHA-256 del objeto completo. El multipart solo se completa si
+gbak termina con código 0; ante cualquier error se aborta y S3 descarta las
+partes, de modo que nunca queda visible un backup truncado.
+"""
+import base64
+import hashlib
+import logging
+import os
+import subprocess
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    zstandard = None
+    ZSTD_AVAILABLE = False
+
+EXTENSION_ZSTD = '.zst'
+EXTENSION_MANIFIESTO = '.manifest.json'  # Backups deduplicados (ver backup_dedup)
+TAMANO_LECTURA = 1024 * 1024  # Bloque leído del stdout de gbak
+TAMANO_MINIMO_PARTE = 5 * 1024 * 1024  # Mínimo de S3 para todas las partes menos la última
+MAX_PARTES = 10000  # Límite de S3 por subida multipart
+PARTES_POR_ESCALON = 2000  # Cada cuántas partes se duplica el tamaño de parte
+
+
+class SubidaMultipart:
+    """
+    Subida multipart de un flujo de tamaño desconocido.
+
+    El tamaño de parte se duplica cada PARTES_POR_ESCALON partes: con 16 MB
+    iniciales se llega a ~1 TB antes de las 10.000 partes, y los backups
+    normales nunca pasan del primer escalón.
+    """
+
+    def __init__(self, s3_client, bucket: str, key: str, tamano_parte: int, workers: int):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.tamano_parte = max(tamano_parte, TAMANO_MINIMO_PARTE)
+        self.workers = max(workers, 1)
+        self.upload_id: Optional[str] = None
+        self.bytes_subidos = 0
+        self.objetos_escritos: List[Dict[str, Any]] = []  # {key, tamano, etag} para el índice S3
+        self._buffer = bytearray()
+        self._numero = 0
+        self._partes: List[Dict[str, Any]] = []
+        self._futuros = []
+        self._error: Optional[BaseException] = None
+        self._lock = threading.Lock()
+        self._cupos = threading.BoundedSemaphore(self.workers)
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def iniciar(self):
+        respuesta = self.s3_client.create_multipart_upload(
+            Bucket=self.bucket, Key=self.key, ContentType='application/octet-stream'
+        )
+        self.upload_id = respuesta['UploadId']
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='backup-s3-parte')
+
+    def _tamano_parte_actual(self) -> int:
+        return self.tamano_parte * (2 ** (self._numero // PARTES_POR_ESCALON))
+
+    def escribir(self, datos: bytes):
+        self._buffer += datos
+        while len(self._buffer) >= self._tamano_parte_actual():
+            tamano = self._tamano_parte_actual()
+            parte = bytes(self._buffer[:tamano])
+            del self._buffer[:tamano]
+            self._enviar(parte)
+
+    def _enviar(self, parte: bytes):
+        if self._error is not None:
+            raise self._error
+        self._numero += 1
+        if self._numero > MAX_PARTES:
+            raise ValueError(f"El backup supera {MAX_PARTES} partes; aumenta BACKUP_STREAMING_PARTE_MB")
+        # Bloquea al productor mientras haya `workers` partes en vuelo
+        self._cupos.acquire()
+        futuro = self._executor.submit(self._subir_parte, self._numero, parte)
+        futuro.add_done_callback(self._parte_terminada)
+        self._futuros.append(futuro)
+
+    def _parte_terminada(self, futuro):
+        self._cupos.release()
+        if futuro.cancelled():
+            return
+        if futuro.exception() is not None and self._error is None:
+            self._error = futuro.exception()
+
+    def _subir_parte(self, numero: int, datos: bytes) -> Dict[str, Any]:
+        md5 = base64.b64encode(hashlib.md5(datos).digest()).decode('ascii')
+        respuesta = self.s3_client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=numero, Body=datos, ContentMD5=md5,
+        )
+        parte = {'PartNumber': numero, 'ETag': respuesta['ETag']}
+        with self._lock:
+            self._partes.append(parte)
+            self.bytes_subidos += len(datos)
+        return parte
+
+    def completar(self) -> Dict[str, Any]:
+        # La última parte puede ser menor al mínimo (o vacía si el flujo lo era)
+        if self._buffer or self._numero == 0:
+            self._enviar(bytes(self._buffer))
+            self._buffer = bytearray()
+        for futuro in self._futuros:
+            futuro.result()
+        self._executor.shutdown(wait=True)
+        partes = sorted(self._partes, key=lambda p: p['PartNumber'])
+        respuesta = self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': partes},
+        )
+        self.objetos_escritos.append({'key': self.key, 'tamano': self.bytes_subidos, 'etag': respuesta.get('ETag')})
+        return {'partes': len(partes), 'bytes': self.bytes_subidos}
+
+    def abortar(self):
+        """Nunca lanza: se usa en el manejo de errores del pipeline."""
+        if self._executor is not None:
+            for futuro in self._futuros:
+                futuro.cancel()
+            self._executor.shutdown(wait=True)
+        if self.upload_id is None:
+            return
+        try:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            logger.info(f"🧹 Subida multipart abortada: {self.key}")
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo abortar la subida multipart {self.key} ({self.upload_id}): {e}")
+
+
+class _Vigilante(threading.Thread):
+    """
+    Mata a gbak si supera el tiempo total o si el pipeline deja de avanzar. Las
+    partes que terminan de subir también cuentan como progreso: con S3 lento el
+    productor está bloqueado a propósito y gbak no escribe, sin estar colgado.
+    """
+
+    def __init__(self, proceso: subprocess.Popen, subida: SubidaMultipart,
+                 timeout_total: int, timeout_sin_progreso: int):
+        super().__init__(name='backup-vigilante', daemon=True)
+        self.proceso = proceso
+        self.subida = subida
+        self.timeout_total = timeout_total
+        self.timeout_sin_progreso = timeout_sin_progreso
+        self.inicio = time.monotonic()
+        self.ultimo_progreso = self.inicio
+        self.bytes_leidos = 0
+        self.motivo: Optional[str] = None
+        self._fin = threading.Event()
+
+    def progreso(self, n: int):
+        self.bytes_leidos += n
+        self.ultimo_progreso = time.monotonic()
+
+    def detener(self):
+        self._fin.set()
+
+    def run(self):
+        ultimo_log = self.inicio
+        ultimos_subidos = 0
+        while not self._fin.wait(2):
+            ahora = time.monotonic()
+            if self.subida.bytes_subidos != ultimos_subidos:
+                ultimos_subidos = self.subida.bytes_subidos
+                self.ultimo_progreso = ahora
+            if ahora - self.inicio > self.timeout_total:
+                self.motivo = f"el backup superó {self.timeout_total // 60} minutos"
+            elif ahora - self.ultimo_progreso > self.timeout_sin_progreso:
+                self.motivo = f"ni gbak ni S3 avanzaron en {self.timeout_sin_progreso // 60} minutos"
+            if self.motivo:
+                logger.error(f"⏱️ Timeout: {self.motivo}. Terminando gbak (PID: {self.proceso.pid})")
+                self.proceso.kill()
+                return
+            if ahora - ultimo_log >= 30:
+                transcurrido = ahora - self.inicio
+                logger.info(
+                    f"⏳ Backup en streaming... Tiempo: {int(transcurrido // 60)}m {int(transcurrido % 60)}s, "
+                    f"Leído de gbak: {self.bytes_leidos / (1024 * 1024):.2f} MB, "
+                    f"Subido: {self.subida.bytes_subidos / (1024 * 1024):.2f} MB"
+                )
+                ultimo_log = ahora
+
+
+def _leer_stderr(flujo, ultimas: deque):
+    for linea in iter(flujo.readline, b''):
+        ultimas.append(linea.decode('utf-8', errors='replace').rstrip())
+
+
+def ejecutar_backup_streaming(
+    comando: List[str],
+    subida: SubidaMultipart,
+    comprimir: bool = False,
+    nivel_zstd: int = 3,
+    timeout_total: int = 6 * 3600,
+    timeout_sin_progreso: int = 300,
+    env: Optional[Dict[str, str]] = None,
+    limite_bytes_por_segundo: Optional[float] = None,
+) -> Dict[str, Any]:
+    """
+    Ejecuta gbak (que debe escribir a stdout) y sube su salida a S3.
+    Con limite_bytes_por_segundo se lee stdout a ese ritmo: la tubería llena
+    frena a gbak y con él el tráfico contra el servidor Firebird.
+
+    Returns:
+        dict con tamano_bytes (almacenado en S3), tamano_fbk (salida de gbak),
+        sha256 (del objeto almacenado), partes y segundos
+
+    Raises:
+        RuntimeError si gbak falla o se cuelga; errores de S3 se propagan.
+        En ambos casos la subida multipart queda abortada.
+    """
+    if comprimir and not ZSTD_AVAILABLE:
+        raise ImportError("zstandard no está instalado. Instala con: pip install zstandard")
+
+    compresor = zstandard.ZstdCompressor(level=nivel_zstd, threads=-1).compressobj() if comprimir else None
+    sha256 = hashlib.sha256()
+    ultimas_stderr: deque = deque(maxlen=50)
+    inicio = time.monotonic()
+
+    subida.iniciar()
+    try:
+        proceso = subprocess.Popen(comando, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0, env=env)
+    except OSError:
+        subida.abortar()
+        raise
+    lector_stderr = threading.Thread(
+        target=_leer_stderr, args=(proceso.stderr, ultimas_stderr), name='backup-gbak-stderr', daemon=True
+    )
+    lector_stderr.start()
+    vigilante = _Vigilante(proceso, subida, timeout_total, timeout_sin_progreso)
+    vigilante.start()
+    logger.info(f"⏳ gbak en streaming (PID: {proceso.pid}) → s3://{subida.bucket}/{subida.key}")
+
+    try:
+        while True:
+            bloque = proceso.stdout.read(TAMANO_LECTURA)
+            if not bloque:
+                break
+            vigilante.progreso(len(bloque))
+            if limite_bytes_por_segundo:
+                adelanto = vigilante.bytes_leidos / limite_bytes_por_segundo - (time.monotonic() - inicio)
+                if adelanto > 0:
+                    time.sleep(adelanto)
+            if compresor is not None:
+                bloque = compresor.compress(bloque)
+                if not bloque:
+                    continue
+            sha256.update(bloque)
+            subida.escribir(bloque)
+        if compresor is not None:
+            final = compresor.flush()
+            sha256.update(final)
+            subida.escribir(final)
+
+        codigo = proceso.wait()
+        vigilante.detener()
+        lector_stderr.join(timeout=5)
+        if vigilante.motivo:
+            raise RuntimeError(f"Timeout: {vigilante.motivo}")
+        if codigo != 0:
+            detalle = '\n'.join(ultimas_stderr) or 'Error desconocido'
+            raise RuntimeError(f"gbak terminó con código {codigo}: {detalle}")
+
+        resultado = subida.completar()
+    except BaseException:
+        vigilante.detener()
+        if proceso.poll() is None:
+            proceso.kill()
+            proceso.wait()
+        subida.abortar()
+        raise
+    finally:
+        proceso.stdout.close()
+
+    segundos = time.monotonic() - inicio
+    logger.info(
+        f"✅ Backup en streaming completado: {vigilante.bytes_leidos / (1024 * 1024):.2f} MB de gbak, "
+        f"{resultado['bytes'] / (1024 * 1024):.2f} MB en S3, {resultado['partes']} partes, {segundos:.1f}s"
+    )
+    return {
+        'tamano_bytes': resultado['bytes'],
+        'tamano_fbk': vigilante.bytes_leidos,
+        'sha256': sha256.hexdigest(),
+        'partes': resultado['partes'],
+        'segundos': round(segundos, 2),
+    }
+
+
+def nombre_fbk(nombre: str) -> str:
+    """Nombre .fbk con el que se entrega un backup guardado comprimido o deduplicado."""
+    for extension in (EXTENSION_MANIFIESTO, EXTENSION_ZSTD):
+        if nombre.endswith(extension):
+            return nombre[:-len(extension)]
+    return nombre
+
+
+def descargar_objeto_reanudable(s3_client, bucket: str, key: str, destino: str, intentos: int = 5):
+    """
+    Descarga `key` a `destino` con GETs por rango. Lo recibido se acumula en
+    {destino}.parcial, así que un corte de red (o un reintento de la tarea)
+    continúa desde el último byte escrito en lugar de empezar de cero. El ETag
+    se guarda junto al parcial y se exige con IfMatch: si el objeto cambió, el
+    parcial se descarta en vez de mezclar dos versiones.
+
+    Returns:
+        ETag del objeto descargado (sin comillas)
+    """
+    cabecera = s3_client.head_object(Bucket=bucket, Key=key)
+    tamano = cabecera['ContentLength']
+    etag = cabecera['ETag']
+    parcial = f"{destino}.parcial"
+    marca = f"{parcial}.etag"
+
+    if os.path.exists(parcial):
+        previo = open(marca).read() if os.path.exists(marca) else None
+        if previo != etag or os.path.getsize(parcial) > tamano:
+            os.remove(parcial)
+        else:
+            logger.info(f"⏯️ Reanudando descarga de {key} desde {os.path.getsize(parcial) / (1024 * 1024):.1f} MB")
+    with open(marca, 'w') as archivo_marca:
+        archivo_marca.write(etag)
+
+    fallos = 0
+    with open(parcial, 'ab') as archivo:
+        while archivo.tell() < tamano:
+            try:
+                cuerpo = s3_client.get_object(
+                    Bucket=bucket, Key=key, Range=f"bytes={archivo.tell()}-", IfMatch=etag
+                )['Body']
+                try:
+                    for bloque in iter(lambda: cuerpo.read(TAMANO_LECTURA), b''):
+                        archivo.write(bloque)
+                finally:
+                    cuerpo.close()
+            except Exception as e:
+                if getattr(e, 'response', {}).get('Error', {}).get('Code') in ('PreconditionFailed', '412'):
+                    archivo.close()
+                    os.remove(parcial)
+                    raise Exception(f"El objeto {key} cambió durante la descarga; se descartó lo descargado")
+                fallos += 1
+                if fallos > intentos:
+                    raise
+                logger.warning(f"⚠️ Descarga de {key} interrumpida en {archivo.tell()} bytes ({e}); reintento {fallos}/{intentos}")
+                archivo.flush()
+                time.sleep(min(2 ** fallos, 30))
+
+    os.replace(parcial, destino)
+    os.remove(marca)
+    return etag.strip('"')
+
+
+def descargar_backup_fbk(s3_client, bucket: str, key: str, destino: str):
+    """
+    Descarga un backup a `destino` como .fbk. Los objetos planos y .zst se bajan
+    con descargar_objeto_reanudable (los .zst se descomprimen al terminar) y los
+    manifiestos se reconstruyen desde sus chunks.
+    """
+    if key.endswith(EXTENSION_MANIFIESTO):
+        from .backup_dedup import restaurar_desde_manifiesto
+        restaurar_desde_manifiesto(s3_client, bucket, key, destino)
+        return
+    if not key.endswith(EXTENSION_ZSTD):
+        descargar_objeto_reanudable(s3_client, bucket, key, destino)
+        return
+    if not ZSTD_AVAILABLE:
+        raise ImportError("zstandard no está instalado. Instala con: pip install zstandard")
+    comprimido = f"{destino}{EXTENSION_ZSTD}"
+    descargar_objeto_reanudable(s3_client, bucket, key, comprimido)
+    try:
+        with open(comprimido, 'rb') as origen, open(destino, 'wb') as archivo:
+            zstandard.ZstdDecompressor().copy_stream(origen, archivo, write_size=TAMANO_LECTURA)
+    finally:
+        os.remove(comprimido)
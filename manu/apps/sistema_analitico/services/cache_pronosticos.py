@@ -0,0 +1,155 @@
+"""
+Caché de pronósticos ML (predicción de demanda y recomendaciones de compra).
+
+La clave es un hash canónico de (modelo_id, versión del artefacto, tipo, artículos,
+horizonte, nivel de servicio) más una generación por modelo. Los valores se
+guardan en Redis con el compresor zlib configurado en CACHES.
+
+Invalidación:
+  - Re-entrenamiento: la versión del artefacto cambia con cada publicación y
+    además se incrementa la generación del modelo.
+  - Ingesta de movimientos: incrementa la generación (las recomendaciones leen
+    el histórico vigente).
+Las claves antiguas quedan huérfanas y expiran por TTL.
+
+Precalentamiento: cada consulta suma a un conteo por (tipo, parámetros) del
+modelo; tras re-entrenar se recalculan las combinaciones más pedidas.
+"""
+import hashlib
+import json
+import logging
+from typing import Any, Callable, Dict, List, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+PREFIJO = 'ml_pronostico'
+MAX_POPULARES = 20  # Combinaciones distintas que se siguen contando por modelo
+
+
+def _canonico(valor: Any) -> str:
+    return json.dumps(valor, sort_keys=True, default=str, separators=(',', ':'))
+
+
+def _parametros(parametros: Dict[str, Any]) -> Dict[str, Any]:
+    # El orden de los artículos pedidos no cambia el resultado
+    normalizados = dict(parametros)
+    if normalizados.get('articulos'):
+        normalizados['articulos'] = sorted({str(a) for a in normalizados['articulos']})
+    else:
+        normalizados['articulos'] = None
+    return normalizados
+
+
+def _clave_generacion(modelo_id: str) -> str:
+    return f"{PREFIJO}:gen:{modelo_id}"
+
+
+def _clave_populares(modelo_id: str) -> str:
+    return f"{PREFIJO}:populares:{modelo_id}"
+
+
+def clave(modelo_id: str, version: str, tipo: str, parametros: Dict[str, Any]) -> str:
+    generacion = cache.get(_clave_generacion(modelo_id), 0)
+    huella = _canonico([modelo_id, version, generacion, tipo, _parametros(parametros)])
+    return f"{PREFIJO}:{tipo}:{modelo_id}:{hashlib.sha256(huella.encode()).hexdigest()}"
+
+
+def obtener_o_calcular(modelo_id: str, version: Optional[str], tipo: str, parametros: Dict[str, Any],
+                       calcular: Callable[[], Dict[str, Any]], registrar: bool = True):
+    """
+    Retorna (resultado, desde_cache). Sin versión (modelo inexistente) o con la
+    caché deshabilitada siempre calcula; los resultados con 'error' no se guardan.
+    registrar=False no cuenta la consulta (precalentamiento).
+    """
+    if not getattr(settings, 'ML_PRONOSTICOS_CACHE_ENABLED', True) or not version:
+        return calcular(), False
+
+    if registrar:
+        registrar_consulta(modelo_id, tipo, parametros)
+    try:
+        llave = clave(modelo_id, version, tipo, parametros)
+        resultado = cache.get(llave)
+    except Exception as e:
+        logger.warning(f"⚠️ Caché de pronósticos no disponible: {e}")
+        return calcular(), False
+    if resultado is not None:
+        return resultado, True
+
+    resultado = calcular()
+    if isinstance(resultado, dict) and 'error' not in resultado:
+        try:
+            cache.set(llave, resultado, timeout=getattr(settings, 'ML_PRONOSTICOS_CACHE_TTL', 24 * 3600))
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo guardar pronóstico en caché: {e}")
+    return resultado, False
+
+
+def registrar_consulta(modelo_id: str, tipo: str, parametros: Dict[str, Any]):
+    """Cuenta la consulta para el precalentamiento (aproximado: lectura-escritura sin candado)."""
+    try:
+        clave_populares = _clave_populares(modelo_id)
+        populares = cache.get(clave_populares) or {}
+        combinacion = _canonico([tipo, _parametros(parametros)])
+        populares[combinacion] = populares.get(combinacion, 0) + 1
+        if len(populares) > MAX_POPULARES:
+            populares = dict(sorted(populares.items(), key=lambda item: -item[1])[:MAX_POPULARES])
+        cache.set(clave_populares, populares, timeout=None)
+    except Exception as e:
+        logger.debug(f"No se pudo registrar consulta de pronóstico: {e}")
+
+
+def mas_consultados(modelo_id: str, limite: int) -> List[Dict[str, Any]]:
+    populares = cache.get(_clave_populares(modelo_id)) or {}
+    ordenados = sorted(populares.items(), key=lambda item: -item[1])[:limite]
+    combinaciones = []
+    for combinacion, _ in ordenados:
+        tipo, parametros = json.loads(combinacion)
+        combinaciones.append({'tipo': tipo, 'parametros': parametros})
+    return combinaciones
+
+
+def invalidar_pronosticos(modelo_id: str):
+    """Hook de entrenamiento/ingesta: nunca debe romper la operación que lo llama."""
+    try:
+        try:
+            cache.incr(_clave_generacion(modelo_id))
+        except ValueError:
+            cache.set(_clave_generacion(modelo_id), 1, timeout=None)
+        logger.info(f"🧹 Pronósticos en caché invalidados: {modelo_id}")
+    except Exception as e:
+        logger.warning(f"⚠️ No se pudo invalidar caché de pronósticos de {modelo_id}: {e}")
+
+
+def precalentar_pronosticos(motor, empresa_servidor_id: int, modelo_id: str,
+                            limite: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Recalcula (y deja en caché) las combinaciones más consultadas del modelo. Sin
+    historial de consultas usa los valores por defecto de los endpoints.
+    """
+    if limite is None:
+        limite = getattr(settings, 'ML_PRONOSTICOS_PRECALENTAR', 3)
+    combinaciones = mas_consultados(modelo_id, limite) or [
+        {'tipo': 'recomendaciones', 'parametros': {'meses': 6, 'nivel_servicio': 0.95}},
+        {'tipo': 'demanda', 'parametros': {'meses': 6, 'articulos': None}},
+    ][:limite]
+
+    precalentadas = []
+    motor.contar_consultas = False
+    for combinacion in combinaciones:
+        parametros = combinacion['parametros']
+        if combinacion['tipo'] == 'recomendaciones':
+            resultado = motor.generar_recomendaciones_compras(
+                empresa_servidor_id, meses=parametros['meses'], nivel_servicio=parametros['nivel_servicio']
+            )
+        elif combinacion['tipo'] == 'demanda':
+            resultado = motor.predecir_demanda_articulos(
+                empresa_servidor_id, articulos=parametros.get('articulos'), meses=parametros['meses']
+            )
+        else:
+            continue
+        precalentadas.append({**combinacion, 'ok': 'error' not in resultado})
+    logger.info(f"🔥 Pronósticos precalentados para {modelo_id}: {len(precalentadas)}")
+    return precalentadas
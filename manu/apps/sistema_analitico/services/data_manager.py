@@ -2,9 +2,11 @@
 import pandas as pd
 import pickle
 import os
-from datetime import datetime
+from datetime import date, datetime
 from django.conf import settings
+from django.db import connection, transaction
 from django.utils import timezone
+import io
 import logging
 
 from ..models import Servidor, EmpresaServidor, MovimientoInventario
@@ -12,6 +14,26 @@ from .database_connectors import DatabaseConnector
 
 logger = logging.getLogger(__name__)
 
+# Clave natural de MovimientoInventario en TNS (restricción movimiento_clave_natural_tns)
+CAMPOS_CLAVE = ['empresa_servidor', 'kardex_id', 'dekardex_id']
+COLUMNAS_NO_ACTUALIZABLES = {'empresa_servidor_id', 'kardex_id', 'dekardex_id', 'fecha_extraccion'}
+COLUMNAS_CLAVE = ['empresa_servidor_id', 'kardex_id', 'dekardex_id']
+
+
+def deduplicar_por_clave(movimientos):
+    """
+    Deja una fila por clave natural (la última, como harían upserts sucesivos).
+    ON CONFLICT DO UPDATE no admite dos filas con la misma clave en un mismo
+    comando, cosa que ocurre con consultas personalizadas con JOIN. Las filas sin
+    clave no chocan con la restricción y se conservan todas.
+    """
+    con_clave = movimientos['kardex_id'].notna() & movimientos['dekardex_id'].notna()
+    duplicadas = con_clave & movimientos.duplicated(COLUMNAS_CLAVE, keep='last')
+    if duplicadas.any():
+        logger.warning(f"Lote con {int(duplicadas.sum())} movimientos repetidos por clave natural: se conserva el último")
+        movimientos = movimientos[~duplicadas]
+    return movimientos
+
 class DataManager:
     def __init__(self):
         self.maestro_path = os.path.join(settings.BASE_DIR, 'data/maestro.pkl')
@@ -162,12 +184,16 @@ class DataManager:
             else:
                 raise Exception(f"Error conectando al servidor '{servidor.nombre}': {error_msg}")
     
-    def extraer_datos_empresa(self, empresa_servidor_id, fecha_inicio, fecha_fin, forzar_reextraccion=False):
+    def extraer_datos_empresa(self, empresa_servidor_id, fecha_inicio, fecha_fin, forzar_reextraccion=False,
+                              streaming=True):
         emp_serv = EmpresaServidor.objects.get(id=empresa_servidor_id)
         servidor = emp_serv.servidor
 
         print(f"🔍 EMPRESA: {emp_serv.nombre}")
 
+        if streaming and servidor.tipo_servidor == 'FIREBIRD':
+            return self._extraer_streaming(emp_serv, servidor, fecha_inicio, fecha_fin, forzar_reextraccion)
+
         if not forzar_reextraccion and self._ya_extraido(emp_serv, fecha_inicio, fecha_fin):
             return {"estado": "ya_extraido", "mensaje": f"Datos ya extraídos para {fecha_inicio} a {fecha_fin}"}
 
@@ -209,6 +235,7 @@ class DataManager:
 
             emp_serv.ultima_extraccion = timezone.now()
             emp_serv.save()
+            self.notificar_movimientos_actualizados(emp_serv.id, fecha_inicio, fecha_fin)
 
             return {
                 "estado": "exito", 
@@ -221,6 +248,208 @@ class DataManager:
             print(f"❌ ERROR EN EXTRACCIÓN: {e}")
             return {"estado": "error", "error": str(e)}
 
+    # ------------------------------------------------------------ streaming
+    def _extraer_streaming(self, emp_serv, servidor, fecha_inicio, fecha_fin, forzar_reextraccion=False):
+        """
+        Extrae con una sola conexión y un solo cursor, paginando por keyset
+        sobre (FECHA, KARDEXID) y guardando cada lote con fetchmany.
+
+        Si una extracción anterior del mismo rango quedó interrumpida, continúa
+        desde la marca de agua guardada en EmpresaServidor.configuracion.
+        """
+        hwm = None if forzar_reextraccion else self._leer_marca_agua(emp_serv, fecha_inicio, fecha_fin)
+
+        if hwm is None and not forzar_reextraccion and self._ya_extraido(emp_serv, fecha_inicio, fecha_fin):
+            return {"estado": "ya_extraido", "mensaje": f"Datos ya extraídos para {fecha_inicio} a {fecha_fin}"}
+
+        consulta_original = emp_serv.consulta_sql
+        batch_size = getattr(settings, 'EXTRACCION_BATCH_SIZE', 2000)
+        total_guardados = 0
+        usar_keyset = False
+        lotes = 0
+
+        conexion = None
+        cursor = None
+        try:
+            conexion = self._conectar_servidor_empresa(servidor, emp_serv.ruta_base)
+            cursor = conexion.cursor()
+
+            # La clave de paginación se decide por las columnas que realmente devuelve
+            # la consulta (un KARDEXID en un JOIN o comentario no cuenta)
+            usar_keyset = {'FECHA', 'KARDEXID'} <= set(self._columnas_consulta(cursor, consulta_original, fecha_inicio, fecha_fin))
+            if not usar_keyset:
+                logger.warning(
+                    f"La consulta de {emp_serv.nombre} no expone FECHA y KARDEXID; se extrae en streaming sin reanudación"
+                )
+                hwm = None
+            total_guardados = hwm.get('registros', 0) if hwm else 0
+            if hwm:
+                print(f"⏩ REANUDANDO DESDE FECHA={hwm['fecha']} KARDEXID={hwm['kardex_id']}")
+
+            consulta, params = self._consulta_keyset(consulta_original, fecha_inicio, fecha_fin, hwm, usar_keyset)
+            cursor.execute(consulta, params)
+            columnas = [desc[0].strip() for desc in cursor.description]
+
+            for df in self._lotes_por_kardex(cursor, columnas, batch_size, usar_keyset):
+                total_guardados += self._guardar_movimientos(df, emp_serv)
+                lotes += 1
+                if usar_keyset:
+                    ultima = df.iloc[-1]
+                    self._guardar_marca_agua(emp_serv, fecha_inicio, fecha_fin, {
+                        'fecha': self._serializar_clave(ultima['FECHA']),
+                        'kardex_id': int(ultima['KARDEXID']),
+                        'registros': total_guardados,
+                    })
+                print(f"✅ LOTE {lotes}: {len(df)} registros (acumulado {total_guardados})")
+
+            self._limpiar_marca_agua(emp_serv)
+            emp_serv.ultima_extraccion = timezone.now()
+            emp_serv.save()
+
+            if total_guardados == 0:
+                return {"estado": "sin_datos", "registros": 0}
+
+            return {
+                "estado": "exito",
+                "registros_guardados": total_guardados,
+                "lotes_procesados": lotes,
+                "reanudado": hwm is not None,
+            }
+
+        except Exception as e:
+            print(f"❌ ERROR EN EXTRACCIÓN STREAMING: {e}")
+            return {
+                "estado": "error",
+                "error": str(e),
+                "registros_guardados": total_guardados,
+                "reanudable": usar_keyset,
+            }
+        finally:
+            if cursor is not None:
+                try:
+                    cursor.close()
+                except Exception:
+                    pass
+            if conexion is not None and hasattr(conexion, 'close'):
+                try:
+                    conexion.close()
+                except Exception:
+                    pass
+            # También tras un fallo a mitad: los lotes ya guardados deben llegar al resumen y las cachés
+            if total_guardados > 0:
+                self.notificar_movimientos_actualizados(emp_serv.id, fecha_inicio, fecha_fin)
+
+    def _columnas_consulta(self, cursor, consulta_sql, fecha_inicio, fecha_fin):
+        """Nombres de las columnas que devuelve la consulta configurada, sin traer filas"""
+        cursor.execute(f"SELECT FIRST 0 Q.* FROM ({consulta_sql}) Q", [fecha_inicio, fecha_fin])
+        columnas = [desc[0].strip() for desc in cursor.description]
+        cursor.fetchall()
+        return columnas
+
+    def notificar_movimientos_actualizados(self, empresa_servidor_id, fecha_inicio, fecha_fin, periodos=None):
+        """
+        Recalcula el resumen mensual de los meses tocados, invalida su caché
+        columnar y programa el refresco de esa caché y del feature store ML.
+        Se llama después de guardar movimientos (extracción o sincronización).
+        """
+        from .movimientos_columnar import MovimientosColumnarCache, periodos_en_rango
+        from .resumen_mensual import recalcular_resumen_mensual
+
+        periodos = sorted(set(periodos or []) | set(periodos_en_rango(fecha_inicio, fecha_fin)))
+        try:
+            recalcular_resumen_mensual(empresa_servidor_id, periodos)
+        except Exception as e:
+            logger.error(f"Error recalculando resumen mensual de empresa {empresa_servidor_id}: {e}", exc_info=True)
+        try:
+            MovimientosColumnarCache().invalidar(empresa_servidor_id, periodos)
+            from ..tasks import refrescar_cache_columnar_task
+            refrescar_cache_columnar_task.delay(empresa_servidor_id, periodos)
+        except Exception as e:
+            logger.warning(f"No se pudo programar el refresco analítico de empresa {empresa_servidor_id}: {e}")
+        try:
+            from ..tasks import recalcular_features_ml_task
+            recalcular_features_ml_task.delay(empresa_servidor_id, periodos)
+        except Exception as e:
+            logger.warning(f"No se pudo programar el recálculo de features ML de empresa {empresa_servidor_id}: {e}")
+
+    def _consulta_keyset(self, consulta_sql, fecha_inicio, fecha_fin, hwm, usar_keyset):
+        """Envuelve la consulta configurada en una tabla derivada ordenada por (FECHA, KARDEXID)"""
+        params = [fecha_inicio, fecha_fin]
+        if not usar_keyset:
+            return consulta_sql, params
+
+        consulta = f"SELECT Q.* FROM ({consulta_sql}) Q"
+        if hwm:
+            consulta += " WHERE (Q.FECHA > ? OR (Q.FECHA = ? AND Q.KARDEXID > ?))"
+            fecha_hwm = self._deserializar_clave(hwm['fecha'])
+            params += [fecha_hwm, fecha_hwm, hwm['kardex_id']]
+        consulta += " ORDER BY Q.FECHA, Q.KARDEXID"
+        return consulta, params
+
+    def _lotes_por_kardex(self, cursor, columnas, batch_size, usar_keyset):
+        """
+        Genera DataFrames de ~batch_size filas con fetchmany.
+
+        Un KARDEX tiene varias líneas de detalle: las filas del último
+        (FECHA, KARDEXID) de cada lote se arrastran al siguiente para que la
+        marca de agua nunca quede en medio de un documento.
+        """
+        pendientes = []
+        idx_fecha = columnas.index('FECHA') if usar_keyset else None
+        idx_kardex = columnas.index('KARDEXID') if usar_keyset else None
+
+        while True:
+            filas = cursor.fetchmany(batch_size)
+            if not filas:
+                break
+            filas = pendientes + list(filas)
+            pendientes = []
+
+            if usar_keyset:
+                clave = (filas[-1][idx_fecha], filas[-1][idx_kardex])
+                corte = len(filas)
+                while corte > 0 and (filas[corte - 1][idx_fecha], filas[corte - 1][idx_kardex]) == clave:
+                    corte -= 1
+                if corte > 0:
+                    filas, pendientes = filas[:corte], filas[corte:]
+                else:
+                    # Todo el lote es un mismo documento: seguir acumulando
+                    pendientes = filas
+                    continue
+
+            yield pd.DataFrame(filas, columns=columnas)
+
+        if pendientes:
+            yield pd.DataFrame(pendientes, columns=columnas)
+
+    def _leer_marca_agua(self, emp_serv, fecha_inicio, fecha_fin):
+        hwm = (emp_serv.configuracion or {}).get('extraccion_hwm')
+        if hwm and hwm.get('rango') == [str(fecha_inicio), str(fecha_fin)]:
+            return hwm
+        return None
+
+    def _guardar_marca_agua(self, emp_serv, fecha_inicio, fecha_fin, marca):
+        configuracion = dict(emp_serv.configuracion or {})
+        configuracion['extraccion_hwm'] = {'rango': [str(fecha_inicio), str(fecha_fin)], **marca}
+        emp_serv.configuracion = configuracion
+        emp_serv.save(update_fields=['configuracion'])
+
+    def _limpiar_marca_agua(self, emp_serv):
+        configuracion = dict(emp_serv.configuracion or {})
+        if configuracion.pop('extraccion_hwm', None) is not None:
+            emp_serv.configuracion = configuracion
+            emp_serv.save(update_fields=['configuracion'])
+
+    def _serializar_clave(self, fecha):
+        return fecha.isoformat() if hasattr(fecha, 'isoformat') else str(fecha)
+
+    def _deserializar_clave(self, fecha):
+        # FECHA puede venir como DATE o TIMESTAMP según la consulta configurada
+        if 'T' in fecha or ' ' in fecha:
+            return datetime.fromisoformat(fecha)
+        return date.fromisoformat(fecha)
+
+    # --------------------------------------------------------------- chunks
     def _contar_registros(self, emp_serv, servidor, fecha_inicio, fecha_fin):
         """Cuenta total de registros con la consulta original + WHERE"""
         try:
@@ -304,6 +533,36 @@ class DataManager:
             empresa_servidor=empresa_servidor, fecha__gte=fecha_inicio, fecha__lte=fecha_fin
         ).exists()
     
+    # Columnas del SQL de extracción -> campos de MovimientoInventario copiados tal cual
+    COLUMNAS_DIRECTAS = {
+        'PACIENTE': 'paciente',
+        'CEDULA_PACIENTE': 'cedula_paciente',
+        'PAGADOR': 'pagador',
+        'CLINICA': 'clinica',
+        'MEDICO': 'medico',
+        'CEDULA_MEDICO': 'cedula_medico',
+        'MEDICO2': 'medico2',
+        'CEDULA_MEDICO2': 'cedula_medico2',
+        'PROCEDIMIENTOS': 'procedimientos',
+        'CODIGO_CIUDAD': 'codigo_ciudad',
+        'CIUDAD': 'ciudad',
+        'TIPO_BODEGA': 'tipo_bodega',
+        'CODIGO_BODEGA': 'codigo_bodega',
+        'SISTEMA_BODEGA': 'sistema_bodega',
+        'BODEGA_CONTENEDOR': 'bodega_contenedor',
+        'ARTICULO_NOMBRE': 'articulo_nombre',
+        'ARTICULO_CODIGO': 'articulo_codigo',
+        'LOTE': 'lote',
+    }
+
+    MAPEO_TIPO_DOCUMENTO = {
+        'FV': 'FACTURA_VENTA',
+        'FC': 'FACTURA_COMPRA',
+        'DV': 'DEVOLUCION_VENTA',
+        'DC': 'DEVOLUCION_COMPRA',
+        'RE': 'REMISION_ENTRADA',
+    }
+
     def _guardar_movimientos(self, df, empresa_servidor):
         print(f"🔄 PROCESANDO {len(df)} FILAS")
 
@@ -315,82 +574,130 @@ class DataManager:
             print(f"❌ COLUMNAS FALTANTES: {columnas_faltantes}")
             return 0
 
-        movimientos = []
-        print(f"Procesando {len(df)} filas para la empresa {empresa_servidor.nombre}...")
-        for _, fila in df.iterrows():
-          
-            nit_pagador = self._limpiar_nit(fila.get('NIT_PAGADOR'))
-            nit_clinica = self._limpiar_nit(fila.get('NIT_CLINICA'))
-
-            movimiento = MovimientoInventario(
-                empresa_servidor=empresa_servidor,
-                tipo_documento=self._mapear_tipo_documento(fila.get('TIPO_DOCUMENTO')),
-                fecha=self._parsear_fecha(fila.get('FECHA')),
-                fecha_orden_pedido=self._parsear_fecha(fila.get('FECHA_ORDEN_PEDIDO')),
-
-              
-                paciente=fila.get('PACIENTE'),
-                cedula_paciente=fila.get('CEDULA_PACIENTE'),
-
-               
-                pagador=fila.get('PAGADOR'),
-                nit_pagador=nit_pagador,
-
-               
-                clinica=fila.get('CLINICA'),
-                nit_clinica=nit_clinica,
-
-             
-                medico=fila.get('MEDICO'),
-                cedula_medico=fila.get('CEDULA_MEDICO'),
-                medico2=fila.get('MEDICO2'),
-                cedula_medico2=fila.get('CEDULA_MEDICO2'),
-
-                procedimientos=fila.get('PROCEDIMIENTOS'),
-
-              
-                codigo_ciudad=fila.get('CODIGO_CIUDAD'),
-                ciudad=fila.get('CIUDAD'),
-
-               
-                tipo_bodega=fila.get('TIPO_BODEGA'),
-                codigo_bodega=fila.get('CODIGO_BODEGA'),
-                sistema_bodega=fila.get('SISTEMA_BODEGA'),
-                bodega_contenedor=fila.get('BODEGA_CONTENEDOR'),
-
-               
-                articulo_nombre=fila.get('ARTICULO_NOMBRE'),
-                articulo_codigo=fila.get('ARTICULO_CODIGO'),
-                cantidad=fila.get('CANTIDAD', 0),
-                precio_unitario=fila.get('PRECIO_UNITARIO', 0),
-                lote=fila.get('LOTE'),
-                stock_previo=fila.get('STOCK_PREVIO'),
-                stock_nuevo=fila.get('STOCK_NUEVO')
-            )
-
-            
-            movimiento.valor_total = movimiento.cantidad * movimiento.precio_unitario
-
-            if movimiento.fecha and movimiento.fecha_orden_pedido:
-                movimiento.lead_time_dias = (movimiento.fecha - movimiento.fecha_orden_pedido).days
-
-            # Calcular booleanos de tipo de bodega basado en TIPO_BODEGA del SQL
-            # El SQL ya calcula: 'IMPLANTE', 'EQUIPO DE PODER', o 'INSTRUMENTAL'
-            if movimiento.tipo_bodega:
-                tipo_bodega = str(movimiento.tipo_bodega).upper().strip()
-                movimiento.es_implante = tipo_bodega == 'IMPLANTE'
-                movimiento.es_instrumental = tipo_bodega == 'INSTRUMENTAL'
-                movimiento.es_equipo_poder = tipo_bodega == 'EQUIPO DE PODER'
-            else:
-                # Si no hay tipo_bodega, usar valores por defecto
-                movimiento.es_implante = False
-                movimiento.es_instrumental = False
-                movimiento.es_equipo_poder = False
+        if df.empty:
+            return 0
 
-            movimientos.append(movimiento)
+        movimientos = self._transformar_movimientos(df, empresa_servidor)
 
         print(f"Guardando {len(movimientos)} movimientos para la empresa {empresa_servidor.nombre}...")
-        MovimientoInventario.objects.bulk_create(movimientos, batch_size=1000)
+        return self._cargar_movimientos(movimientos)
+
+    def _transformar_movimientos(self, df, empresa_servidor):
+        """
+        Convierte el DataFrame crudo de Firebird en columnas de MovimientoInventario
+        usando operaciones vectorizadas (equivalente a _limpiar_nit,
+        _mapear_tipo_documento y _parsear_fecha aplicados fila a fila).
+        """
+        def columna(nombre, default=None):
+            if nombre in df.columns:
+                return df[nombre].reset_index(drop=True)
+            return pd.Series([default] * len(df), dtype=object)
+
+        salida = pd.DataFrame(index=pd.RangeIndex(len(df)))
+        salida['empresa_servidor_id'] = empresa_servidor.id
+        salida['tipo_documento'] = (
+            columna('TIPO_DOCUMENTO').astype(str).str.strip().str.upper()
+            .map(self.MAPEO_TIPO_DOCUMENTO).fillna('FACTURA_VENTA')
+        )
+        salida['fecha'] = self._parsear_fechas(columna('FECHA'))
+        salida['fecha_orden_pedido'] = self._parsear_fechas(columna('FECHA_ORDEN_PEDIDO'))
+        salida['nit_pagador'] = self._limpiar_nits(columna('NIT_PAGADOR'))
+        salida['nit_clinica'] = self._limpiar_nits(columna('NIT_CLINICA'))
+
+        for origen, destino in self.COLUMNAS_DIRECTAS.items():
+            salida[destino] = columna(origen)
+
+        cantidad = pd.to_numeric(columna('CANTIDAD', 0), errors='coerce')
+        precio = pd.to_numeric(columna('PRECIO_UNITARIO', 0), errors='coerce')
+        salida['cantidad'] = cantidad.round().astype('Int64')
+        salida['precio_unitario'] = precio.round(2)
+        salida['valor_total'] = (cantidad * precio).round(2)
+        salida['stock_previo'] = pd.to_numeric(columna('STOCK_PREVIO'), errors='coerce').round().astype('Int64')
+        salida['stock_nuevo'] = pd.to_numeric(columna('STOCK_NUEVO'), errors='coerce').round().astype('Int64')
+
+        salida['kardex_id'] = pd.to_numeric(columna('KARDEXID'), errors='coerce').astype('Int64')
+        salida['dekardex_id'] = pd.to_numeric(columna('DEKARDEXID'), errors='coerce').astype('Int64')
+
+        salida['lead_time_dias'] = (salida['fecha'] - salida['fecha_orden_pedido']).dt.days.astype('Int64')
+
+        # El SQL ya calcula TIPO_BODEGA: 'IMPLANTE', 'EQUIPO DE PODER' o 'INSTRUMENTAL'
+        tipo_bodega = columna('TIPO_BODEGA').astype(object).where(columna('TIPO_BODEGA').notna(), '')
+        tipo_bodega = tipo_bodega.astype(str).str.upper().str.strip()
+        salida['es_implante'] = tipo_bodega == 'IMPLANTE'
+        salida['es_instrumental'] = tipo_bodega == 'INSTRUMENTAL'
+        salida['es_equipo_poder'] = tipo_bodega == 'EQUIPO DE PODER'
+
+        salida['fecha_extraccion'] = timezone.now()
+        return salida
+
+    def _limpiar_nits(self, serie):
+        """Versión vectorizada de _limpiar_nit: elimina todo después del guión"""
+        texto = serie.astype(str)
+        con_guion = serie.notna() & texto.str.contains('-', regex=False)
+        resultado = serie.astype(object).copy()
+        resultado[con_guion] = texto[con_guion].str.split('-', n=1).str[0].str.strip()
+        return resultado
+
+    def _parsear_fechas(self, serie):
+        """Versión vectorizada de _parsear_fecha: fechas tz-aware en la zona horaria actual"""
+        fechas = pd.to_datetime(serie, errors='coerce')
+        if fechas.dt.tz is None:
+            return fechas.dt.tz_localize(
+                timezone.get_current_timezone_name(), ambiguous='NaT', nonexistent='shift_forward'
+            )
+        return fechas
+
+    def _cargar_movimientos(self, movimientos):
+        """
+        Inserta el lote transformado con upsert por clave natural (empresa_servidor,
+        kardex_id, dekardex_id): una re-extracción forzada o una ejecución reanudada
+        que vuelve a traer filas ya guardadas las actualiza en lugar de fallar.
+        En PostgreSQL usa COPY a una tabla temporal + INSERT ... ON CONFLICT (ruta
+        rápida); en otros motores, o si COPY falla, usa bulk_create(update_conflicts).
+        """
+        movimientos = deduplicar_por_clave(movimientos)
+        if connection.vendor == 'postgresql':
+            try:
+                return self._copy_movimientos(movimientos)
+            except Exception as e:
+                logger.warning(f"COPY de movimientos falló, usando bulk_create: {e}")
+
+        campos_actualizables = [c for c in movimientos.columns if c not in COLUMNAS_NO_ACTUALIZABLES]
+        registros = movimientos.astype(object).where(movimientos.notna(), None).to_dict('records')
+        MovimientoInventario.objects.bulk_create(
+            [MovimientoInventario(**registro) for registro in registros],
+            batch_size=1000,
+            update_conflicts=True,
+            unique_fields=CAMPOS_CLAVE,
+            update_fields=campos_actualizables,
+        )
+        return len(registros)
+
+    def _copy_movimientos(self, movimientos):
+        columnas = list(movimientos.columns)
+        buffer = io.StringIO()
+        movimientos.to_csv(buffer, index=False, header=False, na_rep='\\N', date_format='%Y-%m-%d %H:%M:%S%z')
+        buffer.seek(0)
+
+        tabla = MovimientoInventario._meta.db_table
+        staging = f"{tabla}_staging"
+        lista_columnas = ', '.join(columnas)
+        actualizaciones = ', '.join(
+            f"{c} = EXCLUDED.{c}" for c in columnas if c not in COLUMNAS_NO_ACTUALIZABLES
+        )
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE TEMP TABLE {staging} ON COMMIT DROP AS "
+                f"SELECT {lista_columnas} FROM {tabla} WITH NO DATA"
+            )
+            cursor.copy_expert(
+                f"COPY {staging} ({lista_columnas}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer
+            )
+            cursor.execute(
+                f"INSERT INTO {tabla} ({lista_columnas}) "
+                f"SELECT {lista_columnas} FROM {staging} "
+                f"ON CONFLICT (empresa_servidor_id, kardex_id, dekardex_id) DO UPDATE SET {actualizaciones}"
+            )
         return len(movimientos)
 
     def _limpiar_nit(self, nit):
@@ -0,0 +1,275 @@
+"""
+Planificador de extracciones paralelas para varias empresas/años fiscales.
+
+Reparte los trabajos de DataManager.extraer_datos_empresa en un pool de hilos,
+respetando Servidor.max_extracciones_concurrentes para no saturar un mismo host
+Firebird (por WireGuard) y ejecutando servidores distintos en paralelo.
+
+El límite por servidor es global: cada extracción (de este planificador, de
+SistemaViewSet.extraer_datos o de la sincronización incremental) toma un cupo
+en caché (extraccion_cupo:{servidor_id}:{n}) con cache.add, igual que los
+cupos de backup_scheduler, y reserva su empresa (extraccion_empresa:{id}) para
+que no corran dos cargas de la misma empresa a la vez. Si un worker muere, las
+claves expiran solas (EXTRACCION_CUPO_TTL).
+"""
+import logging
+import time
+import uuid
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import date
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+from ..models import EmpresaServidor
+from .data_manager import DataManager
+
+logger = logging.getLogger(__name__)
+
+PREFIJO_CUPO = 'extraccion_cupo'
+PREFIJO_EMPRESA = 'extraccion_empresa'
+ESPERA_CUPO = 2  # Segundos entre intentos de tomar cupo
+
+
+def _ttl() -> int:
+    return getattr(settings, 'EXTRACCION_CUPO_TTL', 6 * 3600)
+
+
+def limite_concurrencia(servidor) -> int:
+    return max(1, servidor.max_extracciones_concurrentes or 1)
+
+
+def tomar_cupo(servidor, duenio: str) -> Optional[str]:
+    """Reserva un cupo libre del servidor para `duenio`; None si están todos ocupados."""
+    for numero in range(limite_concurrencia(servidor)):
+        clave = f"{PREFIJO_CUPO}:{servidor.id}:{numero}"
+        if cache.add(clave, duenio, timeout=_ttl()):
+            return clave
+    return None
+
+
+def liberar_cupo(clave: Optional[str], duenio: str):
+    """Libera el cupo solo si sigue perteneciendo a `duenio`."""
+    if clave and cache.get(clave) == duenio:
+        cache.delete(clave)
+
+
+def reservar_extraccion(empresa: EmpresaServidor, duenio: str,
+                        espera: Optional[int] = None) -> Tuple[Optional[str], Optional[Dict]]:
+    """
+    Reserva la empresa y un cupo de su servidor, esperando hasta `espera` segundos
+    (EXTRACCION_ESPERA_CUPO por defecto) a que se libere uno.
+
+    Retorna (clave_cupo, None) o (None, resultado) con el estado a devolver si no
+    se pudo reservar.
+    """
+    clave_empresa = f"{PREFIJO_EMPRESA}:{empresa.id}"
+    if not cache.add(clave_empresa, duenio, timeout=_ttl()):
+        return None, {
+            'estado': 'en_curso',
+            'mensaje': f"La empresa {empresa.nombre} ya tiene una extracción o sincronización en curso",
+        }
+
+    if espera is None:
+        espera = getattr(settings, 'EXTRACCION_ESPERA_CUPO', 600)
+    limite = time.monotonic() + espera
+    while True:
+        clave = tomar_cupo(empresa.servidor, duenio)
+        if clave is not None:
+            return clave, None
+        if time.monotonic() >= limite:
+            liberar_extraccion(empresa.id, None, duenio)
+            return None, {
+                'estado': 'error',
+                'error': f"Sin cupo de extracción en el servidor {empresa.servidor.nombre} tras {espera}s",
+            }
+        time.sleep(ESPERA_CUPO)
+
+
+def liberar_extraccion(empresa_id: int, clave_cupo: Optional[str], duenio: str):
+    liberar_cupo(clave_cupo, duenio)
+    clave_empresa = f"{PREFIJO_EMPRESA}:{empresa_id}"
+    if cache.get(clave_empresa) == duenio:
+        cache.delete(clave_empresa)
+
+
+def extraer_con_cupo(empresa_servidor_id: int, fecha_inicio: date, fecha_fin: date,
+                     forzar_reextraccion: bool = False, espera: Optional[int] = None) -> Dict:
+    """DataManager.extraer_datos_empresa bajo la reserva de empresa y cupo de servidor."""
+    empresa = EmpresaServidor.objects.select_related('servidor').get(id=empresa_servidor_id)
+    duenio = str(uuid.uuid4())
+    clave, rechazo = reservar_extraccion(empresa, duenio, espera)
+    if rechazo is not None:
+        return rechazo
+    try:
+        return DataManager().extraer_datos_empresa(
+            empresa_servidor_id=empresa_servidor_id,
+            fecha_inicio=fecha_inicio,
+            fecha_fin=fecha_fin,
+            forzar_reextraccion=forzar_reextraccion,
+        )
+    finally:
+        liberar_extraccion(empresa_servidor_id, clave, duenio)
+
+
+class ExtraccionScheduler:
+    """
+    Ejecuta extracciones de varias EmpresaServidor con límite de concurrencia por servidor.
+
+    progreso_callback recibe el resumen actual (mismo formato que el resultado final)
+    cada vez que un trabajo empieza o termina.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None,
+                 progreso_callback: Optional[Callable[[Dict], None]] = None):
+        self.max_workers = max_workers or getattr(settings, 'EXTRACCION_MAX_WORKERS', 8)
+        self.progreso_callback = progreso_callback
+        self.trabajos: Dict[int, Dict] = {}
+        self.servidores: Dict[int, Dict] = {}
+
+    # ------------------------------------------------------------------ public
+    def ejecutar(self, empresas: Iterable[EmpresaServidor], fecha_inicio: date, fecha_fin: date,
+                 forzar_reextraccion: bool = False) -> Dict:
+        colas = defaultdict(deque)
+        for empresa in empresas:
+            rango = self._rango_empresa(empresa, fecha_inicio, fecha_fin)
+            if rango is None:
+                continue
+            servidor = empresa.servidor
+            colas[servidor.id].append((empresa, rango))
+            self.trabajos[empresa.id] = {
+                'empresa_servidor_id': empresa.id,
+                'empresa': empresa.nombre,
+                'anio_fiscal': empresa.anio_fiscal,
+                'servidor_id': servidor.id,
+                'fecha_inicio': str(rango[0]),
+                'fecha_fin': str(rango[1]),
+                'estado': 'pendiente',
+                'registros': 0,
+            }
+            self.servidores.setdefault(servidor.id, {
+                'servidor_id': servidor.id,
+                'servidor': servidor.nombre,
+                'limite': max(1, servidor.max_extracciones_concurrentes or 1),
+                'activos': 0,
+                'registros': 0,
+                'inicio': None,
+                'fin': None,
+            })
+
+        en_curso = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                # Lanzar trabajos mientras haya cupo en el pool y en su servidor
+                for servidor_id, cola in colas.items():
+                    info = self.servidores[servidor_id]
+                    while cola and info['activos'] < info['limite'] and len(en_curso) < self.max_workers:
+                        empresa, rango = cola.popleft()
+                        info['activos'] += 1
+                        if info['inicio'] is None:
+                            info['inicio'] = time.monotonic()
+                        trabajo = self.trabajos[empresa.id]
+                        trabajo['estado'] = 'en_proceso'
+                        trabajo['_inicio'] = time.monotonic()
+                        futuro = executor.submit(self._extraer, empresa.id, rango, forzar_reextraccion)
+                        en_curso[futuro] = (servidor_id, empresa.id)
+                        self._notificar()
+
+                if not en_curso:
+                    break
+
+                terminados, _ = wait(en_curso, return_when=FIRST_COMPLETED)
+                for futuro in terminados:
+                    servidor_id, empresa_id = en_curso.pop(futuro)
+                    self._registrar_resultado(servidor_id, empresa_id, futuro)
+                self._notificar()
+
+        return self.resumen()
+
+    def resumen(self) -> Dict:
+        servidores = []
+        for info in self.servidores.values():
+            segundos = 0.0
+            if info['inicio'] is not None:
+                segundos = (info['fin'] or time.monotonic()) - info['inicio']
+            servidores.append({
+                'servidor_id': info['servidor_id'],
+                'servidor': info['servidor'],
+                'limite_concurrencia': info['limite'],
+                'activos': info['activos'],
+                'registros': info['registros'],
+                'segundos': round(segundos, 2),
+                'registros_por_segundo': round(info['registros'] / segundos, 2) if segundos else 0.0,
+            })
+
+        trabajos = [
+            {k: v for k, v in trabajo.items() if not k.startswith('_')}
+            for trabajo in self.trabajos.values()
+        ]
+        terminados = [t for t in trabajos if t['estado'] in ('exito', 'sin_datos', 'ya_extraido', 'en_curso', 'error')]
+        return {
+            'total_trabajos': len(trabajos),
+            'terminados': len(terminados),
+            'errores': len([t for t in trabajos if t['estado'] == 'error']),
+            'registros_guardados': sum(t['registros'] for t in trabajos),
+            'progreso': int(len(terminados) / len(trabajos) * 100) if trabajos else 100,
+            'servidores': servidores,
+            'trabajos': trabajos,
+        }
+
+    # ----------------------------------------------------------------- helpers
+    def _extraer(self, empresa_id: int, rango, forzar_reextraccion: bool) -> Dict:
+        try:
+            # El límite local evita ocupar hilos de más; el cupo en caché es el límite real
+            return extraer_con_cupo(empresa_id, rango[0], rango[1], forzar_reextraccion)
+        finally:
+            # Cada hilo abre su propia conexión a la BD de Django: cerrarla al terminar
+            connections.close_all()
+
+    def _registrar_resultado(self, servidor_id: int, empresa_id: int, futuro):
+        info = self.servidores[servidor_id]
+        trabajo = self.trabajos[empresa_id]
+        info['activos'] -= 1
+        try:
+            resultado = futuro.result()
+        except Exception as e:
+            logger.error(f"Error extrayendo empresa {empresa_id}: {e}", exc_info=True)
+            resultado = {'estado': 'error', 'error': str(e)}
+
+        registros = resultado.get('registros_guardados', 0) or 0
+        trabajo['estado'] = resultado.get('estado', 'error')
+        trabajo['registros'] = registros
+        trabajo['segundos'] = round(time.monotonic() - trabajo.pop('_inicio'), 2)
+        if resultado.get('error'):
+            trabajo['error'] = resultado['error']
+        info['registros'] += registros
+        info['fin'] = time.monotonic()
+
+    def _rango_empresa(self, empresa: EmpresaServidor, fecha_inicio: date, fecha_fin: date):
+        """Recorta el rango pedido al año fiscal de la empresa (None si no se cruzan)."""
+        inicio = max(fecha_inicio, date(empresa.anio_fiscal, 1, 1))
+        fin = min(fecha_fin, date(empresa.anio_fiscal, 12, 31))
+        if inicio > fin:
+            return None
+        return inicio, fin
+
+    def _notificar(self):
+        if not self.progreso_callback:
+            return
+        try:
+            self.progreso_callback(self.resumen())
+        except Exception as e:
+            logger.warning(f"Error notificando progreso de extracción: {e}")
+
+
+def empresas_por_nit(nit_normalizado: str) -> List[EmpresaServidor]:
+    return list(
+        EmpresaServidor.objects.select_related('servidor')
+        .filter(nit_normalizado=nit_normalizado, estado='ACTIVO')
+        .exclude(consulta_sql__isnull=True)
+        .exclude(consulta_sql='')
+        .order_by('servidor_id', '-anio_fiscal')
+    )
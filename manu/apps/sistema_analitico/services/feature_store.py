@@ -0,0 +1,282 @@
+"""
+Feature store mensual por NIT y artículo (FeatureArticuloMensual).
+
+Entrenamiento e inferencia de MLEngine leen las mismas features:
+  - Base del mes: transacciones, cantidad, ventas, compras, precio promedio,
+    bodegas y banderas de tipo de artículo, agregadas sobre todas las empresas
+    (años fiscales) del NIT.
+  - Derivadas: rezagos de cantidad (1, 2, 3 y 12 meses) y medias móviles de los
+    3, 6 y 12 meses anteriores; los meses sin movimiento cuentan como 0.
+
+Al ingerir movimientos se recalculan solo los meses tocados y se reescriben los
+12 meses siguientes (los únicos cuyas derivadas dependen de ellos). Para inferencia, la
+serie conocida se extiende hacia el futuro con la media de los últimos 3 meses y
+se toman rezagos/medias sobre esa serie extendida.
+"""
+import hashlib
+import logging
+from datetime import date, datetime
+from typing import Iterable, Optional
+
+import numpy as np
+import pandas as pd
+from django.db import connection, transaction
+from django.db.models import Avg, Case, Count, DateField, IntegerField, Max, Q, Sum, When
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from ..models import EmpresaServidor, FeatureArticuloMensual, MovimientoInventario
+from .resumen_mensual import inicio_mes, mes_siguiente
+
+logger = logging.getLogger(__name__)
+
+LAGS = (1, 2, 3, 12)
+VENTANAS = (3, 6, 12)
+ALCANCE = max(LAGS + VENTANAS)  # Meses hacia adelante que dependen de un mes dado
+CAMPOS_BASE = [
+    'total_transacciones', 'cantidad', 'ventas_mes', 'compras_mes', 'precio_promedio',
+    'bodegas_unicas', 'es_implante', 'es_instrumental', 'es_equipo_poder',
+]
+CAMPOS_DERIVADOS = [f'cantidad_lag_{k}' for k in LAGS] + [f'cantidad_media_{v}' for v in VENTANAS]
+
+
+def _indice_mes(fechas) -> np.ndarray:
+    """Número de mes absoluto (año*12 + mes) de una serie de fechas."""
+    fechas = pd.to_datetime(pd.Series(fechas))
+    return (fechas.dt.year * 12 + fechas.dt.month - 1).to_numpy()
+
+
+def _sumar_meses(fecha: date, meses: int) -> date:
+    indice = fecha.year * 12 + fecha.month - 1 + meses
+    return date(indice // 12, indice % 12 + 1, 1)
+
+
+def _bandera(campo):
+    return Max(Case(When(**{campo: True}, then=1), default=0, output_field=IntegerField()))
+
+
+def _bloquear_nit(nit_normalizado: str):
+    """
+    Lock transaccional por NIT (PostgreSQL): las empresas de distintos años fiscales
+    de un NIT comparten filas del store y sus extracciones corren en paralelo, así
+    que los recálculos del mismo NIT se hacen uno tras otro. En otros motores las
+    escrituras ya se serializan.
+    """
+    if connection.vendor != 'postgresql':
+        return
+    clave = int.from_bytes(hashlib.sha1(f"features:{nit_normalizado}".encode()).digest()[:8], 'big', signed=True)
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", [clave])
+
+
+def recalcular_features(nit_normalizado: str, periodos: Optional[Iterable[str]] = None) -> int:
+    """
+    Recalcula las features de los periodos 'YYYY-MM' indicados (None = todos) y las
+    derivadas de los meses que dependen de ellos. Retorna las filas escritas.
+
+    Lectura y escritura van en una transacción bajo el lock del NIT: un recálculo
+    concurrente espera y luego parte de lo que este dejó escrito.
+    """
+    with transaction.atomic():
+        _bloquear_nit(nit_normalizado)
+        return _recalcular_features(nit_normalizado, periodos)
+
+
+def _recalcular_features(nit_normalizado: str, periodos: Optional[Iterable[str]]) -> int:
+    empresas_ids = list(
+        EmpresaServidor.objects.filter(nit_normalizado=nit_normalizado).values_list('id', flat=True)
+    )
+    movimientos = MovimientoInventario.objects.filter(empresa_servidor_id__in=empresas_ids)
+
+    meses = None
+    if periodos is not None:
+        meses = sorted({inicio_mes(periodo) for periodo in periodos})
+        if not meses:
+            return 0
+        filtro = Q()
+        for mes in meses:
+            filtro |= Q(
+                fecha__gte=timezone.make_aware(datetime.combine(mes, datetime.min.time())),
+                fecha__lt=timezone.make_aware(datetime.combine(mes_siguiente(mes), datetime.min.time())),
+            )
+        movimientos = movimientos.filter(filtro)
+
+    # Los alias llevan prefijo: 'cantidad' y las banderas ya son campos de MovimientoInventario
+    agregados = movimientos.annotate(
+        periodo=TruncMonth('fecha', output_field=DateField())
+    ).values('periodo', 'articulo_codigo').annotate(
+        f_articulo_nombre=Max('articulo_nombre'),
+        f_total_transacciones=Count('id'),
+        f_cantidad=Sum('cantidad'),
+        f_ventas_mes=Sum('cantidad', filter=Q(tipo_documento='FACTURA_VENTA')),
+        f_compras_mes=Sum('cantidad', filter=Q(tipo_documento='FACTURA_COMPRA')),
+        f_precio_promedio=Avg('precio_unitario'),
+        f_bodegas_unicas=Count('tipo_bodega', distinct=True),
+        f_es_implante=_bandera('es_implante'),
+        f_es_instrumental=_bandera('es_instrumental'),
+        f_es_equipo_poder=_bandera('es_equipo_poder'),
+    ).order_by()
+
+    columnas = ['periodo', 'articulo_codigo', 'articulo_nombre'] + CAMPOS_BASE
+    nuevas = pd.DataFrame([
+        {
+            'periodo': fila['periodo'],
+            'articulo_codigo': fila['articulo_codigo'],
+            'articulo_nombre': fila['f_articulo_nombre'] or '',
+            'total_transacciones': fila['f_total_transacciones'],
+            'cantidad': fila['f_cantidad'] or 0,
+            'ventas_mes': fila['f_ventas_mes'] or 0,
+            'compras_mes': fila['f_compras_mes'] or 0,
+            'precio_promedio': float(fila['f_precio_promedio'] or 0),
+            'bodegas_unicas': fila['f_bodegas_unicas'],
+            'es_implante': fila['f_es_implante'] or 0,
+            'es_instrumental': fila['f_es_instrumental'] or 0,
+            'es_equipo_poder': fila['f_es_equipo_poder'] or 0,
+        }
+        for fila in agregados.iterator(chunk_size=5000)
+    ], columns=columnas)
+
+    # Las derivadas de [desde, hasta] dependen de los ALCANCE meses previos: esas filas
+    # (sin tocar) se leen del store y las de [desde, hasta] se reescriben completas.
+    # Se reinsertan en lugar de bulk_update: el UPDATE con CASE por fila de Django es
+    # órdenes de magnitud más lento que el INSERT por lotes.
+    reescribir = FeatureArticuloMensual.objects.filter(nit_normalizado=nit_normalizado)
+    if meses is not None:
+        desde, hasta = meses[0], _sumar_meses(meses[-1], ALCANCE)
+        reescribir = reescribir.filter(periodo__gte=desde, periodo__lte=hasta)
+        conservadas = pd.DataFrame(list(
+            FeatureArticuloMensual.objects.filter(
+                nit_normalizado=nit_normalizado,
+                periodo__gte=_sumar_meses(desde, -ALCANCE),
+                periodo__lte=hasta,
+            ).exclude(periodo__in=meses).values(*columnas)
+        ), columns=columnas)
+        nuevas = pd.concat([nuevas, conservadas], ignore_index=True)
+
+    filas = _con_derivadas(nuevas)
+    if meses is not None:
+        filas = filas[filas['periodo'] >= desde]
+
+    objetos = [
+        FeatureArticuloMensual(nit_normalizado=nit_normalizado, **registro)
+        for registro in filas.to_dict('records')
+    ]
+    with transaction.atomic():
+        reescribir.delete()
+        FeatureArticuloMensual.objects.bulk_create(objetos, batch_size=2000)
+
+    logger.info(
+        f"🧮 Features NIT {nit_normalizado}: {len(objetos)} filas escritas "
+        f"({'todos los periodos' if periodos is None else ', '.join(sorted(set(periodos)))})"
+    )
+    return len(objetos)
+
+
+def _con_derivadas(df: pd.DataFrame) -> pd.DataFrame:
+    """Agrega a df (articulo_codigo, periodo, cantidad, ...) rezagos y medias de los meses anteriores."""
+    df = df.reset_index(drop=True)
+    if df.empty:
+        return df.assign(**{campo: pd.Series(dtype=float) for campo in CAMPOS_DERIVADOS})
+
+    mes = _indice_mes(df['periodo'])
+    codigos, fila_articulo = np.unique(df['articulo_codigo'].to_numpy().astype(str), return_inverse=True)
+    columna_mes = mes - mes.min()
+
+    serie = np.zeros((len(codigos), columna_mes.max() + 1))
+    np.add.at(serie, (fila_articulo, columna_mes), df['cantidad'].to_numpy(dtype=float))
+    for campo, matriz in _derivadas(serie).items():
+        df[campo] = matriz[fila_articulo, columna_mes]
+    return df
+
+
+def _derivadas(serie: np.ndarray) -> dict:
+    """Rezagos y medias de los meses anteriores para cada celda de la matriz artículo × mes."""
+    derivadas = {}
+    for k in LAGS:
+        rezago = np.zeros_like(serie)
+        if k < serie.shape[1]:
+            rezago[:, k:] = serie[:, :-k]
+        derivadas[f'cantidad_lag_{k}'] = rezago
+
+    # Suma acumulada con columna inicial en 0: suma(t-v .. t-1) = acumulada[t] - acumulada[t-v]
+    acumulada = np.concatenate([np.zeros((serie.shape[0], 1)), np.cumsum(serie, axis=1)], axis=1)
+    columnas = np.arange(serie.shape[1])
+    for v in VENTANAS:
+        derivadas[f'cantidad_media_{v}'] = (
+            acumulada[:, columnas] - acumulada[:, np.maximum(columnas - v, 0)]
+        ) / v
+    return derivadas
+
+
+def features_entrenamiento(nit_normalizado: str, min_transacciones: int = 3) -> pd.DataFrame:
+    """Features de todos los meses del NIT; construye el store la primera vez."""
+    if not FeatureArticuloMensual.objects.filter(nit_normalizado=nit_normalizado).exists():
+        recalcular_features(nit_normalizado)
+    return pd.DataFrame(list(
+        FeatureArticuloMensual.objects.filter(
+            nit_normalizado=nit_normalizado,
+            total_transacciones__gte=min_transacciones,
+        ).values('articulo_codigo', 'articulo_nombre', 'periodo', *CAMPOS_BASE, *CAMPOS_DERIVADOS)
+    ))
+
+
+def features_inferencia(nit_normalizado: str, df_futuro: pd.DataFrame) -> pd.DataFrame:
+    """
+    Agrega a df_futuro (articulo_codigo, fecha) las features del store: las base del
+    último mes conocido de cada artículo y las derivadas sobre la serie extendida.
+    Artículos sin historia quedan en 0.
+    """
+    resultado = df_futuro.copy()
+    for campo in CAMPOS_BASE + CAMPOS_DERIVADOS:
+        if campo != 'cantidad':
+            resultado[campo] = 0.0
+    if resultado.empty:
+        return resultado
+
+    codigos = pd.unique(resultado['articulo_codigo'].astype(str))
+    ultimo = FeatureArticuloMensual.objects.filter(nit_normalizado=nit_normalizado).aggregate(
+        ultimo=Max('periodo')
+    )['ultimo']
+    if ultimo is None:
+        return resultado
+
+    historia = pd.DataFrame(list(
+        FeatureArticuloMensual.objects.filter(
+            nit_normalizado=nit_normalizado,
+            articulo_codigo__in=list(codigos),
+            periodo__gt=_sumar_meses(ultimo, -ALCANCE),
+        ).values('articulo_codigo', 'periodo', *CAMPOS_BASE).order_by('periodo')
+    ))
+    if historia.empty:
+        return resultado
+
+    mes_ultimo = ultimo.year * 12 + ultimo.month - 1
+    meses_futuros = _indice_mes(resultado['fecha'])
+    horizonte = max(int(meses_futuros.max() - mes_ultimo), 0)
+
+    # Serie conocida (últimos ALCANCE meses) extendida con la media de los últimos 3
+    fila_de = {codigo: i for i, codigo in enumerate(codigos)}
+    filas = historia['articulo_codigo'].map(fila_de).to_numpy()
+    columnas = _indice_mes(historia['periodo']) - (mes_ultimo - ALCANCE + 1)
+    serie = np.zeros((len(codigos), ALCANCE + horizonte))
+    np.add.at(serie, (filas, columnas), historia['cantidad'].to_numpy(dtype=float))
+    serie[:, ALCANCE:] = serie[:, ALCANCE - 3:ALCANCE].mean(axis=1)[:, None]
+    derivadas = _derivadas(serie)
+
+    fila_resultado = resultado['articulo_codigo'].astype(str).map(fila_de).to_numpy()
+    columna_resultado = np.clip(meses_futuros - (mes_ultimo - ALCANCE + 1), 0, serie.shape[1] - 1)
+    for campo, matriz in derivadas.items():
+        resultado[campo] = matriz[fila_resultado, columna_resultado]
+
+    # Base: último estado conocido de cada artículo
+    base = historia.drop_duplicates('articulo_codigo', keep='last').set_index('articulo_codigo')
+    for campo in CAMPOS_BASE:
+        if campo != 'cantidad':
+            resultado[campo] = resultado['articulo_codigo'].astype(str).map(base[campo]).fillna(0).astype(float).to_numpy()
+    return resultado
+
+
+def recalcular_features_empresa(empresa_servidor_id: int, periodos: Optional[Iterable[str]] = None) -> int:
+    """Punto de entrada de la ingesta: recalcula el NIT de la empresa."""
+    nit_normalizado = EmpresaServidor.objects.values_list('nit_normalizado', flat=True).get(id=empresa_servidor_id)
+    return recalcular_features(nit_normalizado, periodos)
@@ -0,0 +1,295 @@
+"""
+Pool de conexiones Firebird thread-safe para TNSBridge.
+
+Mantiene, por cada pool_key (host/puerto/usuario/ruta), un conjunto acotado de
+conexiones reutilizables con checkout/checkin bajo lock, verificación de vida
+solo cuando la conexión estuvo inactiva, expulsión de conexiones ociosas,
+tiempo de vida máximo y estadísticas para los endpoints de operación.
+"""
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+POOL_MIN_SIZE = int(getattr(settings, 'TNS_POOL_MIN_SIZE', 0))
+POOL_MAX_SIZE = int(getattr(settings, 'TNS_POOL_MAX_SIZE', 8))
+POOL_TIMEOUT = float(getattr(settings, 'TNS_POOL_TIMEOUT', 30))
+POOL_MAX_IDLE = float(getattr(settings, 'TNS_POOL_MAX_IDLE', 300))
+POOL_MAX_LIFETIME = float(getattr(settings, 'TNS_POOL_MAX_LIFETIME', 3600))
+POOL_PING_AFTER_IDLE = float(getattr(settings, 'TNS_POOL_PING_AFTER_IDLE', 30))
+
+
+class FirebirdPoolTimeout(TimeoutError):
+    """No se liberó ninguna conexión del pool dentro del tiempo de espera."""
+
+
+def _close_quietly(conn):
+    """Cierra una conexión sin parsear errores (el socket puede estar muerto)."""
+    try:
+        if hasattr(conn, 'sock') and conn.sock:
+            try:
+                conn.sock.close()
+            except Exception:
+                pass
+        if hasattr(conn, 'close'):
+            conn.close()
+    except Exception:
+        pass
+
+
+class _PooledConnection:
+    __slots__ = ('conn', 'created_at', 'last_used')
+
+    def __init__(self, conn):
+        now = time.monotonic()
+        self.conn = conn
+        self.created_at = now
+        self.last_used = now
+
+
+class FirebirdConnectionPool:
+    """
+    Pool acotado de conexiones Firebird para una misma base de datos.
+
+    Las conexiones libres se guardan en una pila (LIFO) para que las más
+    recientes se reutilicen primero y las antiguas envejezcan hasta expulsarse.
+    """
+
+    def __init__(
+        self,
+        key: str,
+        factory: Callable[[], Any],
+        min_size: int = POOL_MIN_SIZE,
+        max_size: int = POOL_MAX_SIZE,
+        timeout: float = POOL_TIMEOUT,
+        max_idle: float = POOL_MAX_IDLE,
+        max_lifetime: float = POOL_MAX_LIFETIME,
+        ping_after_idle: float = POOL_PING_AFTER_IDLE,
+    ):
+        self.key = key
+        self.factory = factory
+        self.max_size = max(1, max_size)
+        self.min_size = max(0, min(min_size, self.max_size))
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.ping_after_idle = ping_after_idle
+
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._idle: List[_PooledConnection] = []
+        self._in_use: Dict[int, _PooledConnection] = {}
+        self._size = 0
+
+        self._checkouts = 0
+        self._waits = 0
+        self._timeouts = 0
+        self._created = 0
+        self._discarded = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._last_eviction = time.monotonic()
+
+    # ----------------------------------------------------------------- helpers
+    def _expired(self, entry: _PooledConnection, now: float) -> bool:
+        return bool(self.max_lifetime) and now - entry.created_at > self.max_lifetime
+
+    def _is_alive(self, entry: _PooledConnection) -> bool:
+        try:
+            cur = entry.conn.cursor()
+            cur.execute('SELECT 1 FROM RDB$DATABASE')
+            cur.fetchone()
+            cur.close()
+            return True
+        except Exception as e:
+            logger.debug(f"[firebird_pool] Conexión muerta en pool {self.key[:8]}: {e}")
+            return False
+
+    def _discard(self, entry: _PooledConnection):
+        """Cierra una conexión fuera del lock y libera su cupo."""
+        _close_quietly(entry.conn)
+        with self._lock:
+            self._size -= 1
+            self._discarded += 1
+            self._available.notify()
+
+    def _maybe_evict(self):
+        # Expulsión oportunista: como mucho una pasada cada max_idle segundos
+        if self.max_idle and time.monotonic() - self._last_eviction > self.max_idle:
+            self.evict_idle()
+
+    # ----------------------------------------------------------------- public
+    def checkout(self):
+        """
+        Entrega una conexión del pool, creando una nueva si hay cupo.
+
+        Solo se hace ping a conexiones que estuvieron inactivas más de
+        ping_after_idle segundos; las usadas recientemente se entregan directo.
+        """
+        self._maybe_evict()
+        started = time.monotonic()
+        deadline = started + self.timeout
+        waited = False
+
+        while True:
+            entry = None
+            create = False
+            with self._lock:
+                while True:
+                    if self._idle:
+                        entry = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        create = True
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise FirebirdPoolTimeout(
+                            f'No hay conexiones Firebird disponibles '
+                            f'(max_size={self.max_size}, timeout={self.timeout}s)'
+                        )
+                    if not waited:
+                        waited = True
+                        self._waits += 1
+                    self._available.wait(remaining)
+
+            if create:
+                try:
+                    entry = _PooledConnection(self.factory())
+                except Exception:
+                    with self._lock:
+                        self._size -= 1
+                        self._available.notify()
+                    raise
+                with self._lock:
+                    self._created += 1
+            else:
+                now = time.monotonic()
+                if self._expired(entry, now) or (
+                    now - entry.last_used > self.ping_after_idle and not self._is_alive(entry)
+                ):
+                    self._discard(entry)
+                    continue
+
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self._in_use[id(entry.conn)] = entry
+                self._checkouts += 1
+                self._wait_total += elapsed
+                self._wait_max = max(self._wait_max, elapsed)
+            return entry.conn
+
+    def checkin(self, conn, discard: bool = False):
+        """Devuelve una conexión al pool (o la descarta si quedó inservible)."""
+        with self._lock:
+            entry = self._in_use.pop(id(conn), None)
+        if entry is None:
+            # No pertenece al pool (ya descartada o ajena): solo cerrarla
+            _close_quietly(conn)
+            return
+
+        if not discard:
+            try:
+                # No dejar transacciones abiertas en conexiones compartidas
+                conn.rollback()
+            except Exception:
+                discard = True
+
+        if discard or self._expired(entry, time.monotonic()):
+            self._discard(entry)
+            return
+
+        with self._lock:
+            entry.last_used = time.monotonic()
+            self._idle.append(entry)
+            self._available.notify()
+        self._maybe_evict()
+
+    def evict_idle(self) -> int:
+        """Cierra conexiones ociosas o vencidas, respetando min_size."""
+        now = time.monotonic()
+        evicted: List[_PooledConnection] = []
+        with self._lock:
+            self._last_eviction = now
+            keep: List[_PooledConnection] = []
+            # El fondo de la pila tiene las conexiones más antiguas
+            for entry in self._idle:
+                stale = bool(self.max_idle) and now - entry.last_used > self.max_idle
+                if (stale or self._expired(entry, now)) and self._size - len(evicted) > self.min_size:
+                    evicted.append(entry)
+                else:
+                    keep.append(entry)
+            self._idle = keep
+        for entry in evicted:
+            self._discard(entry)
+        return len(evicted)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+            in_use, self._in_use = list(self._in_use.values()), {}
+            self._size = 0
+            self._available.notify_all()
+        for entry in idle + in_use:
+            _close_quietly(entry.conn)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'pool_key': self.key,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': len(self._in_use),
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'checkouts': self._checkouts,
+                'waits': self._waits,
+                'timeouts': self._timeouts,
+                'created': self._created,
+                'discarded': self._discarded,
+                'checkout_avg_ms': round(self._wait_total / self._checkouts * 1000, 3) if self._checkouts else 0.0,
+                'checkout_max_ms': round(self._wait_max * 1000, 3),
+            }
+
+
+_pools: Dict[str, FirebirdConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(key: str, factory: Callable[[], Any]) -> FirebirdConnectionPool:
+    """Obtiene (o crea) el pool del proceso para un pool_key."""
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = FirebirdConnectionPool(key, factory)
+                _pools[key] = pool
+    return pool
+
+
+def evict_idle_connections() -> int:
+    """Expulsa conexiones ociosas de todos los pools del proceso."""
+    with _pools_lock:
+        pools = list(_pools.values())
+    return sum(pool.evict_idle() for pool in pools)
+
+
+def pool_stats() -> List[Dict[str, Any]]:
+    with _pools_lock:
+        pools = list(_pools.values())
+    return [pool.stats() for pool in pools]
+
+
+def close_all_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close_all()
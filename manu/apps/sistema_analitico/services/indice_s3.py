@@ -0,0 +1,202 @@
+"""
+Índice local de objetos S3 (ObjetoS3).
+
+BackupS3Service registra aquí cada objeto que sube o elimina; la tarea de
+reconciliación lista el bucket completo y corrige lo que el índice no vio
+(subidas fallidas a medias, cambios hechos fuera de la aplicación). Las
+cuotas (obtener_tamano_actual_gb), el explorador de archivos y las
+estadísticas consultan la tabla en lugar de paginar list_objects_v2.
+
+Mientras una configuración no se haya reconciliado al menos una vez
+(ConfiguracionS3.indice_reconciliado vacío) el índice no se usa y se sigue
+listando S3. Las escrituras al índice nunca rompen la operación que las llama:
+si fallan, la próxima reconciliación las repara.
+"""
+import logging
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.db.models import Sum
+from django.utils import timezone
+
+from ..models import ConfiguracionS3, ObjetoS3
+
+logger = logging.getLogger(__name__)
+
+TAMANO_LOTE = 1000
+
+
+def _campos_ruta(key: str) -> Dict[str, Any]:
+    partes = key.split('/')
+    anio = partes[2] if len(partes) > 3 else ''
+    return {
+        'directorio': key.rsplit('/', 1)[0] + '/' if '/' in key else '',
+        'servidor_nombre': partes[0] if len(partes) > 1 else '',
+        'nit_normalizado': partes[1] if len(partes) > 2 else '',
+        'anio_fiscal': int(anio) if anio.isdigit() else None,
+    }
+
+
+def _etag(valor: Optional[str]) -> str:
+    return (valor or '').strip('"')
+
+
+def indice_disponible(config: Optional[ConfiguracionS3]) -> bool:
+    return (
+        config is not None
+        and config.pk is not None
+        and config.indice_reconciliado is not None
+        and getattr(settings, 'S3_INDICE_ENABLED', True)
+    )
+
+
+# ------------------------------------------------------------ escrituras
+def registrar_objetos(config: Optional[ConfiguracionS3], objetos: Iterable[Dict[str, Any]]):
+    """
+    Inserta o actualiza objetos ({key, tamano, etag?, ultima_modificacion?}).
+    Sin fecha de modificación se usa la actual (el objeto se acaba de escribir).
+    """
+    if config is None or config.pk is None:
+        return
+    try:
+        _guardar_objetos(config, objetos)
+    except Exception as e:
+        logger.warning(f"⚠️ No se pudo actualizar el índice S3 ({config}): {e}")
+
+
+def _guardar_objetos(config: ConfiguracionS3, objetos: Iterable[Dict[str, Any]]):
+    """Como registrar_objetos pero propagando los errores (la reconciliación los necesita)."""
+    ahora = timezone.now()
+    filas = [
+        ObjetoS3(
+            configuracion_s3=config,
+            key=obj['key'],
+            tamano=obj['tamano'],
+            etag=_etag(obj.get('etag')),
+            ultima_modificacion=obj.get('ultima_modificacion') or ahora,
+            **_campos_ruta(obj['key']),
+        )
+        for obj in objetos
+    ]
+    for i in range(0, len(filas), TAMANO_LOTE):
+        ObjetoS3.objects.bulk_create(
+            filas[i:i + TAMANO_LOTE],
+            update_conflicts=True,
+            unique_fields=['configuracion_s3', 'key'],
+            update_fields=['tamano', 'etag', 'ultima_modificacion', 'fecha_indexado'],
+        )
+
+
+def registrar_objeto(config: Optional[ConfiguracionS3], key: str, tamano: int, etag: Optional[str] = None):
+    registrar_objetos(config, [{'key': key, 'tamano': tamano, 'etag': etag}])
+
+
+def eliminar_objetos(config: Optional[ConfiguracionS3], keys: Iterable[str]):
+    if config is None or config.pk is None:
+        return
+    try:
+        keys = list(keys)
+        for i in range(0, len(keys), TAMANO_LOTE):
+            ObjetoS3.objects.filter(configuracion_s3=config, key__in=keys[i:i + TAMANO_LOTE]).delete()
+    except Exception as e:
+        logger.warning(f"⚠️ No se pudo actualizar el índice S3 ({config}): {e}")
+
+
+# -------------------------------------------------------------- consultas
+def tamano_empresa(config: ConfiguracionS3, servidor_nombre: str, nit_normalizado: str) -> int:
+    """Bytes bajo {servidor_nombre}/{nit_normalizado}/ (todos los años, logs y chunks)."""
+    total = ObjetoS3.objects.filter(
+        configuracion_s3=config, servidor_nombre=servidor_nombre, nit_normalizado=nit_normalizado
+    ).aggregate(total=Sum('tamano'))['total']
+    return total or 0
+
+
+def tamano_por_anio(config: ConfiguracionS3, servidor_nombre: str, nit_normalizado: str) -> Dict[str, int]:
+    """Bytes por año fiscal; 'otros' agrupa lo que no está bajo un año (logs, chunks)."""
+    filas = ObjetoS3.objects.filter(
+        configuracion_s3=config, servidor_nombre=servidor_nombre, nit_normalizado=nit_normalizado
+    ).values('anio_fiscal').annotate(total=Sum('tamano'))
+    return {str(f['anio_fiscal'] or 'otros'): f['total'] for f in filas}
+
+
+def pagina_directorio(config: ConfiguracionS3, prefijo: str) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Equivalente a una página de list_objects_v2(Prefix=prefijo, Delimiter='/')
+    con todos los resultados: CommonPrefixes (subcarpetas) y Contents (archivos).
+    """
+    archivos = ObjetoS3.objects.filter(
+        configuracion_s3=config, directorio=prefijo
+    ).order_by('key').values_list('key', 'tamano', 'ultima_modificacion')
+
+    # Subcarpetas directas: primer segmento de los directorios más profundos
+    subcarpetas = set()
+    directorios = ObjetoS3.objects.filter(
+        configuracion_s3=config, directorio__startswith=prefijo
+    ).exclude(directorio=prefijo).values_list('directorio', flat=True).distinct()
+    for directorio in directorios:
+        siguiente = directorio[len(prefijo):].split('/', 1)[0]
+        subcarpetas.add(f"{prefijo}{siguiente}/")
+
+    contenido = []
+    for key, tamano, modificado in archivos:
+        obj = {'Key': key, 'Size': tamano}
+        if modificado is not None:
+            obj['LastModified'] = modificado
+        contenido.append(obj)
+    return {
+        'CommonPrefixes': [{'Prefix': p} for p in sorted(subcarpetas)],
+        'Contents': contenido,
+    }
+
+
+# ----------------------------------------------------------- reconciliación
+def reconciliar(config: ConfiguracionS3, s3_client, bucket: str) -> Dict[str, int]:
+    """
+    Lista el bucket completo y deja el índice igual a S3: inserta lo que falta,
+    actualiza lo que cambió (tamaño/etag) y borra lo que ya no existe.
+
+    Un error al escribir cualquier lote se propaga: indice_reconciliado solo se
+    marca cuando el índice quedó completo, porque habilita su uso en las cuotas.
+    """
+    indexados: Dict[str, Tuple[int, str]] = {
+        key: (tamano, etag)
+        for key, tamano, etag in ObjetoS3.objects.filter(configuracion_s3=config).values_list('key', 'tamano', 'etag')
+    }
+    inicio = timezone.now()
+    cambios: List[Dict[str, Any]] = []
+    vistos = set()
+    total = 0
+
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for pagina in paginator.paginate(Bucket=bucket):
+        for obj in pagina.get('Contents', []):
+            key = obj['Key']
+            if key.endswith('/'):
+                continue
+            total += 1
+            vistos.add(key)
+            etag = _etag(obj.get('ETag'))
+            if indexados.get(key) != (obj['Size'], etag):
+                cambios.append({
+                    'key': key, 'tamano': obj['Size'], 'etag': etag,
+                    'ultima_modificacion': obj.get('LastModified'),
+                })
+        if len(cambios) >= TAMANO_LOTE:
+            _guardar_objetos(config, cambios)
+            cambios = []
+    _guardar_objetos(config, cambios)
+
+    # Lo indexado durante el listado puede no haber aparecido en él: solo se
+    # borran filas anteriores al inicio de la reconciliación
+    sobrantes = [key for key in indexados if key not in vistos]
+    eliminados = 0
+    for i in range(0, len(sobrantes), TAMANO_LOTE):
+        eliminados += ObjetoS3.objects.filter(
+            configuracion_s3=config, key__in=sobrantes[i:i + TAMANO_LOTE], fecha_indexado__lt=inicio
+        ).delete()[0]
+
+    nuevos = sum(1 for key in vistos if key not in indexados)
+    config.indice_reconciliado = timezone.now()
+    ConfiguracionS3.objects.filter(pk=config.pk).update(indice_reconciliado=config.indice_reconciliado)
+    logger.info(f"🗂️ Índice S3 reconciliado ({config.nombre}): {total} objetos, {nuevos} nuevos, {eliminados} eliminados")
+    return {'objetos': total, 'nuevos': nuevos, 'eliminados': eliminados}
@@ -2,6 +2,7 @@ import pandas as pd
 import numpy as np
 from scipy import stats
 import logging
+from django.utils import timezone
 
 logger = logging.getLogger(__name__)
 
@@ -45,35 +46,103 @@ class InventoryOptimizer:
     
     def calcular_stock_optimo(self, df, lead_time_dias=30):
         try:
-            resultados = []
-            
-            for articulo in df['articulo_codigo'].unique():
-                df_articulo = df[df['articulo_codigo'] == articulo].copy()
-                
-                if len(df_articulo) < 10:
-                    continue
-                
-                demanda_diaria = df_articulo.groupby('fecha')['cantidad'].sum()
-                demanda_promedio = demanda_diaria.mean()
-                desviacion_demanda = demanda_diaria.std()
-                
-                demanda_lead_time = demanda_promedio * lead_time_dias
-                desviacion_lead_time = desviacion_demanda * np.sqrt(lead_time_dias)
-                
-                z_score = stats.norm.ppf(self.nivel_servicio)
-                punto_reorden = demanda_lead_time + z_score * desviacion_lead_time
-                stock_seguridad = z_score * desviacion_lead_time
-                
-                resultados.append({
+            # Demanda diaria por artículo en un solo groupby (antes: un filtro del DataFrame por artículo)
+            filas_por_articulo = df.groupby('articulo_codigo', sort=False).size()
+            articulos = filas_por_articulo.index[filas_por_articulo >= 10]
+            if len(articulos) == 0:
+                return []
+
+            df_validos = df[df['articulo_codigo'].isin(articulos)]
+            demanda_diaria = df_validos.groupby(['articulo_codigo', 'fecha'], sort=False)['cantidad'].sum()
+            estadisticas = demanda_diaria.groupby(level=0, sort=False).agg(['mean', 'std']).reindex(articulos)
+            nombres = df_validos.drop_duplicates('articulo_codigo').set_index('articulo_codigo')['articulo_nombre'].reindex(articulos)
+
+            demanda_promedio = estadisticas['mean'].to_numpy(dtype=float)
+            # Un solo día con movimientos no tiene variabilidad medible
+            desviacion_demanda = np.nan_to_num(estadisticas['std'].to_numpy(dtype=float), nan=0.0)
+
+            z_score = stats.norm.ppf(self.nivel_servicio)
+            demanda_lead_time = demanda_promedio * lead_time_dias
+            desviacion_lead_time = desviacion_demanda * np.sqrt(lead_time_dias)
+            punto_reorden = demanda_lead_time + z_score * desviacion_lead_time
+            stock_seguridad = z_score * desviacion_lead_time
+
+            return [
+                {
                     'articulo_codigo': articulo,
-                    'articulo_nombre': df_articulo['articulo_nombre'].iloc[0],
-                    'demanda_promedio_diaria': round(demanda_promedio, 2),
-                    'punto_reorden': round(punto_reorden),
-                    'stock_seguridad': round(stock_seguridad)
-                })
-            
-            return resultados
-            
+                    'articulo_nombre': nombre,
+                    'demanda_promedio_diaria': round(promedio, 2),
+                    'punto_reorden': round(reorden),
+                    'stock_seguridad': round(seguridad)
+                }
+                for articulo, nombre, promedio, reorden, seguridad in zip(
+                    articulos, nombres.tolist(), demanda_promedio, punto_reorden, stock_seguridad
+                )
+            ]
+
         except Exception as e:
             logger.error(f"Error calculando stock óptimo: {e}")
-            return []
\ No newline at end of file
+            return []
+
+    def recomendar_compras(self, df_historicos, meses, demanda_pronosticada=None, limite=15):
+        """
+        Recomendaciones de compra para todos los artículos de df_historicos a la vez.
+
+        df_historicos: una fila por artículo con ventas_totales, transacciones,
+        precio_promedio, ultima_venta y valor_total_ventas. demanda_pronosticada:
+        {articulo_codigo: demanda de los próximos `meses`}; los artículos sin
+        pronóstico usan el promedio histórico (ventas_totales / 12 por mes).
+        Retorna las `limite` recomendaciones más urgentes, ordenadas por
+        urgencia y demanda.
+        """
+        if df_historicos.empty:
+            return []
+
+        # Demanda proyectada y urgencia como arreglos: solo se necesitan para ordenar
+        promedio_historico = df_historicos['ventas_totales'].to_numpy(dtype=float) / 12 * meses
+        pronostico = df_historicos['articulo_codigo'].astype(str).map(demanda_pronosticada or {})
+        demanda_proyectada = pronostico.fillna(pd.Series(promedio_historico, index=df_historicos.index)).to_numpy(dtype=float)
+        demanda_predicha = np.rint(demanda_proyectada)
+
+        dias_desde_ultima_venta = (
+            timezone.now() - pd.to_datetime(df_historicos['ultima_venta'], utc=True)
+        ).dt.days.to_numpy(dtype=float)
+        orden_urgencia = np.where(dias_desde_ultima_venta < 30, 3, np.where(dias_desde_ultima_venta > 90, 1, 2))
+
+        # Orden estable descendente por (urgencia, demanda), como sort(reverse=True)
+        seleccion = np.lexsort((-demanda_predicha, -orden_urgencia))[:limite]
+
+        recomendaciones = []
+        # Solo las filas seleccionadas se recorren en Python (mismos tipos que iterrows)
+        for posicion, (_, articulo) in zip(seleccion, df_historicos.iloc[seleccion].iterrows()):
+            demanda = demanda_proyectada[posicion]
+            cantidad_recomendada = max(int(demanda * 1.2), 1)  # 20% buffer
+
+            urgencia = {3: "ALTA", 2: "MEDIA", 1: "BAJA"}[orden_urgencia[posicion]]
+
+            valor_total = articulo['valor_total_ventas'] or 0
+            if valor_total > 10000000:
+                clasificacion = "A"
+            elif valor_total > 1000000:
+                clasificacion = "B"
+            else:
+                clasificacion = "C"
+
+            precio_promedio = float(articulo['precio_promedio'] or 0)
+            inversion_estimada = cantidad_recomendada * precio_promedio
+
+            recomendaciones.append({
+                'articulo_codigo': articulo['articulo_codigo'],
+                'articulo_nombre': articulo['articulo_nombre'],
+                'clasificacion_abc': clasificacion,
+                'demanda_predicha': round(demanda),
+                'cantidad_recomendada': cantidad_recomendada,
+                'ventas_historicas': articulo['ventas_totales'],
+                'transacciones_historicas': articulo['transacciones'],
+                'urgencia': urgencia,
+                'precio_promedio': precio_promedio,
+                'inversion_estimada': round(inversion_estimada, 2),
+                'ultima_venta': articulo['ultima_venta'].strftime('%Y-%m-%d') if pd.notna(articulo['ultima_venta']) else 'N/A'
+            })
+
+        return recomendaciones
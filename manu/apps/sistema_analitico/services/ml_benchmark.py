@@ -0,0 +1,371 @@
+"""
+Benchmark de la ruta de pronóstico ML sobre MovimientoInventario sintético.
+
+Por escenario (artículos × meses de historia) genera movimientos con tendencia,
+estacionalidad anual y artículos intermitentes, los inserta en una empresa de
+prueba dentro de una transacción que se revierte al final, y mide cada etapa:
+
+  agregacion_orm     feature store (recalcular_features: agregados mensuales + derivadas)
+  features           lectura de features de entrenamiento (features_entrenamiento)
+  prophet_fit        Prophet agregado (ProphetForecaster)
+  prophet_articulos  pronóstico por artículo (ProphetBatchForecaster)
+  xgboost_fit        XGBoostPredictor.entrenar_modelo_demanda
+  prediccion         MLEngine._lotes_prediccion (features de inferencia + XGBoost + por artículo)
+  recomendaciones    histórico ORM + InventoryOptimizer.recomendar_compras
+
+Los últimos `horizonte` meses generados no se insertan: son la verdad contra la
+que se mide el error (MAE, WAPE, sesgo) de XGBoost, del pronóstico por artículo
+y de un ingenuo (media de los últimos 3 meses).
+
+La memoria pico por etapa se mide con tracemalloc (asignaciones Python/numpy del
+proceso; los workers de Prophet en otros procesos no cuentan) y agrega overhead
+al tiempo: los reportes solo son comparables con la misma opción de memoria.
+"""
+import logging
+import os
+import platform
+import random
+import resource
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import date
+from decimal import Decimal
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from django.db import transaction
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+VERSION_REPORTE = 1
+INICIO_HISTORIA = date(2020, 1, 1)
+PROPORCION_INTERMITENTES = 0.3
+TIPOS_BODEGA = ['PRINCIPAL', 'CONSIGNACION', 'TRANSITO']
+
+
+class _Abortar(Exception):
+    """Fuerza el rollback de los datos sintéticos del escenario."""
+
+
+class MLBenchmark:
+    def __init__(self, horizonte: int = 6, semilla: int = 42, medir_memoria: bool = True):
+        self.horizonte = horizonte
+        self.semilla = semilla
+        self.medir_memoria = medir_memoria
+
+    # ------------------------------------------------------------------ API
+    def ejecutar(self, escenarios: Iterable[Tuple[int, int]]) -> Dict[str, Any]:
+        """escenarios: pares (articulos, meses_historia). Retorna el reporte JSON-serializable."""
+        return {
+            'version': VERSION_REPORTE,
+            'fecha': timezone.now().isoformat(),
+            'entorno': self._entorno(),
+            'parametros': {
+                'horizonte': self.horizonte,
+                'semilla': self.semilla,
+                'medir_memoria': self.medir_memoria,
+            },
+            'escenarios': [self.ejecutar_escenario(articulos, meses) for articulos, meses in escenarios],
+            'rss_maximo_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        }
+
+    def ejecutar_escenario(self, articulos: int, meses: int) -> Dict[str, Any]:
+        logger.info(f"⏱️ Benchmark ML: {articulos} artículos × {meses} meses")
+        self.etapas: Dict[str, Dict[str, Any]] = {}
+        resultado = {'articulos': articulos, 'meses': meses, 'etapas': self.etapas}
+
+        with self._etapa('generacion'):
+            movimientos, verdad = generar_movimientos(articulos, meses, self.horizonte, self.semilla)
+        resultado['movimientos'] = len(movimientos)
+
+        try:
+            with transaction.atomic():
+                resultado['error_pronostico'] = self._medir_pipeline(movimientos, verdad, meses)
+                raise _Abortar()
+        except _Abortar:
+            pass
+        except Exception as e:
+            logger.warning(f"⚠️ Benchmark ML {articulos}x{meses} interrumpido: {e}")
+            resultado['error'] = str(e)
+        return resultado
+
+    # ------------------------------------------------------------- pipeline
+    def _medir_pipeline(self, movimientos: pd.DataFrame, verdad: pd.DataFrame, meses: int) -> Dict[str, Any]:
+        from .feature_store import features_entrenamiento, recalcular_features
+        from .ml_engine import MLEngine
+        from .prophet_batch_forecaster import ProphetBatchForecaster
+        from .prophet_forecaster import ProphetForecaster
+        from .xgboost_predictor import XGBoostPredictor
+
+        with self._etapa('insercion'):
+            empresa = self._insertar(movimientos)
+        nit = empresa.nit_normalizado
+
+        with self._etapa('agregacion_orm'):
+            recalcular_features(nit)
+
+        with self._etapa('features'):
+            df = features_entrenamiento(nit)
+            df['fecha'] = pd.to_datetime(df['periodo'])
+            df['mes'] = df['fecha'].dt.month
+            df['año'] = df['fecha'].dt.year
+
+        with self._etapa('prophet_fit'):
+            ProphetForecaster().entrenar_modelo_demanda(df)
+
+        prophet_articulos = ProphetBatchForecaster()
+        with self._etapa('prophet_articulos'):
+            prophet_articulos.entrenar(df)
+
+        xgboost = XGBoostPredictor()
+        with self._etapa('xgboost_fit'):
+            xgboost.entrenar_modelo_demanda(df)
+
+        motor = MLEngine(models_dir=tempfile.mkdtemp(prefix='ml_benchmark_'), enable_mlflow=False)
+        motor.xgboost = xgboost
+        motor.prophet_articulos = prophet_articulos
+        df_articulos = (
+            df.groupby('articulo_codigo', as_index=False)['articulo_nombre'].max().sort_values('articulo_codigo')
+        )
+        fechas_futuras = pd.date_range(
+            pd.Timestamp(INICIO_HISTORIA) + pd.DateOffset(months=meses), periods=self.horizonte, freq='ME'
+        )
+
+        with self._etapa('prediccion'):
+            predicciones = pd.concat(list(motor._lotes_prediccion(
+                df_articulos, fechas_futuras, self.horizonte, 5000, nit
+            )), ignore_index=True)
+
+        with self._etapa('recomendaciones'):
+            df_historicos = motor._historicos_recomendacion([empresa.id])
+            motor.optimizer.recomendar_compras(
+                df_historicos, self.horizonte, prophet_articulos.demanda_total(self.horizonte), limite=15
+            )
+
+        return self._errores(predicciones, verdad, df)
+
+    def _insertar(self, movimientos: pd.DataFrame):
+        from ..models import EmpresaServidor, MovimientoInventario, Servidor
+
+        servidor = Servidor.objects.create(
+            nombre='benchmark-ml', host='localhost', usuario='benchmark', password='', tipo_servidor='FIREBIRD'
+        )
+        nit = self._nit_libre()
+        empresa = EmpresaServidor.objects.create(
+            servidor=servidor, codigo='BENCH', nombre='Benchmark ML', nit=nit,
+            anio_fiscal=INICIO_HISTORIA.year, ruta_base='',
+        )
+        fechas = movimientos['fecha'].dt.tz_localize(timezone.get_current_timezone()).tolist()
+        MovimientoInventario.objects.bulk_create((
+            MovimientoInventario(
+                empresa_servidor=empresa,
+                tipo_documento=fila.tipo_documento,
+                fecha=fecha,
+                ciudad='BENCHMARK',
+                tipo_bodega=fila.tipo_bodega,
+                sistema_bodega='BENCHMARK',
+                articulo_nombre=fila.articulo_nombre,
+                articulo_codigo=fila.articulo_codigo,
+                cantidad=int(fila.cantidad),
+                precio_unitario=Decimal(f"{fila.precio_unitario:.2f}"),
+                valor_total=Decimal(f"{fila.cantidad * fila.precio_unitario:.2f}"),
+                es_implante=bool(fila.es_implante),
+                es_instrumental=bool(fila.es_instrumental),
+                es_equipo_poder=bool(fila.es_equipo_poder),
+            )
+            for fila, fecha in zip(movimientos.itertuples(index=False), fechas)
+        ), batch_size=5000)
+        return empresa
+
+    def _nit_libre(self) -> str:
+        from ..models import EmpresaServidor
+
+        aleatorio = random.Random(self.semilla)
+        while True:
+            nit = f"99{aleatorio.randrange(10 ** 7, 10 ** 8)}"
+            if not EmpresaServidor.objects.filter(nit_normalizado=nit).exists():
+                return nit
+
+    # -------------------------------------------------------------- métricas
+    def _errores(self, predicciones: pd.DataFrame, verdad: pd.DataFrame, df: pd.DataFrame) -> Dict[str, Any]:
+        real = verdad.assign(fecha=verdad['fecha'].dt.strftime('%Y-%m-%d'))
+        comparado = predicciones.merge(real, on=['articulo_codigo', 'fecha'], how='left')
+        comparado['cantidad'] = comparado['cantidad'].fillna(0.0)
+
+        # Ingenuo: media de los últimos 3 meses de entrenamiento de cada artículo
+        ultimo = df['fecha'].max()
+        recientes = df[df['fecha'] > ultimo - pd.DateOffset(months=3)]
+        ingenuo = (recientes.groupby('articulo_codigo')['cantidad'].sum() / 3).rename('prediccion_ingenuo')
+        comparado = comparado.merge(ingenuo, left_on='articulo_codigo', right_index=True, how='left')
+        comparado['prediccion_ingenuo'] = comparado['prediccion_ingenuo'].fillna(0.0)
+
+        return {
+            'filas': len(comparado),
+            'xgboost': _metricas(comparado['prediccion_xgboost'], comparado['cantidad']),
+            'pronostico_articulos': _metricas(comparado['prediccion_prophet'], comparado['cantidad']),
+            'ingenuo_media_3': _metricas(comparado['prediccion_ingenuo'], comparado['cantidad']),
+        }
+
+    @contextmanager
+    def _etapa(self, nombre: str):
+        registro: Dict[str, Any] = {}
+        self.etapas[nombre] = registro
+        if self.medir_memoria:
+            tracemalloc.start()
+        inicio = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            registro['error'] = str(e)
+            raise
+        finally:
+            registro['segundos'] = round(time.perf_counter() - inicio, 4)
+            if self.medir_memoria:
+                registro['memoria_pico_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+                tracemalloc.stop()
+
+    def _entorno(self) -> Dict[str, Any]:
+        versiones = {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__}
+        for modulo in ('xgboost', 'prophet', 'sklearn'):
+            try:
+                versiones[modulo] = __import__(modulo).__version__
+            except Exception:
+                versiones[modulo] = None
+        return {'plataforma': platform.platform(), 'cpus': os.cpu_count(), 'versiones': versiones}
+
+
+def _metricas(prediccion: pd.Series, real: pd.Series) -> Dict[str, Optional[float]]:
+    validos = prediccion.notna()
+    if not validos.any():
+        return {'mae': None, 'wape': None, 'sesgo': None, 'cobertura': 0.0}
+    error = prediccion[validos].astype(float) - real[validos].astype(float)
+    total = float(real[validos].abs().sum())
+    return {
+        'mae': round(float(error.abs().mean()), 4),
+        'wape': round(float(error.abs().sum()) / total, 4) if total else None,
+        'sesgo': round(float(error.sum()) / total, 4) if total else None,
+        'cobertura': round(float(validos.mean()), 4),
+    }
+
+
+def generar_movimientos(articulos: int, meses: int, horizonte: int,
+                        semilla: int = 42) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Movimientos sintéticos de `meses` de historia más `horizonte` meses reservados.
+    Retorna (movimientos de la historia, verdad por articulo_codigo/fecha fin de mes
+    de los meses reservados con la misma definición de 'cantidad' que el feature store).
+    """
+    rng = np.random.default_rng(semilla)
+    total_meses = meses + horizonte
+    t = np.arange(total_meses)
+
+    # Demanda mensual esperada: nivel × tendencia × estacionalidad anual
+    nivel = rng.lognormal(mean=2.0, sigma=1.0, size=articulos)
+    tendencia = 1 + rng.normal(0, 0.01, size=articulos)[:, None] * t
+    fase = rng.uniform(0, 2 * np.pi, size=articulos)[:, None]
+    amplitud = rng.uniform(0, 0.4, size=articulos)[:, None]
+    lam = np.clip(nivel[:, None] * tendencia * (1 + amplitud * np.sin(2 * np.pi * t / 12 + fase)), 0.05, None)
+
+    # Intermitentes: demanda solo en una fracción de los meses
+    intermitente = rng.random(articulos) < PROPORCION_INTERMITENTES
+    activo = np.where(intermitente[:, None], rng.random((articulos, total_meses)) < 0.3, True)
+    ventas = rng.poisson(lam) * activo
+
+    codigos = np.array([f"BENCH{i:06d}" for i in range(articulos)])
+    precio = np.round(rng.lognormal(mean=11, sigma=1, size=articulos), 2)
+    banderas = rng.random((articulos, 3)) < [0.3, 0.2, 0.05]
+    bodega = rng.integers(0, len(TIPOS_BODEGA), size=articulos)
+
+    # Cada mes con ventas se reparte en 1..3 facturas; compras trimestrales de reposición
+    fila, columna = np.nonzero(ventas)
+    cantidad = ventas[fila, columna]
+    facturas = np.minimum(cantidad, rng.integers(1, 4, size=len(cantidad)))
+    fila = np.repeat(fila, facturas)
+    columna = np.repeat(columna, facturas)
+    cantidad = np.concatenate([
+        rng.multinomial(total, np.full(partes, 1 / partes)) for total, partes in zip(cantidad, facturas)
+    ]) if len(cantidad) else np.zeros(0, dtype=int)
+    con_cantidad = cantidad > 0
+    fila, columna, cantidad = fila[con_cantidad], columna[con_cantidad], cantidad[con_cantidad]
+    tipo = np.full(len(fila), 'FACTURA_VENTA', dtype=object)
+
+    trimestres = np.arange(0, total_meses, 3)
+    compra_fila = np.repeat(np.arange(articulos), len(trimestres))
+    compra_columna = np.tile(trimestres, articulos)
+    compra_cantidad = np.ceil(lam[compra_fila, compra_columna] * 3).astype(int)
+    fila = np.concatenate([fila, compra_fila])
+    columna = np.concatenate([columna, compra_columna])
+    cantidad = np.concatenate([cantidad, compra_cantidad])
+    tipo = np.concatenate([tipo, np.full(len(compra_fila), 'FACTURA_COMPRA', dtype=object)])
+
+    inicio = pd.Timestamp(INICIO_HISTORIA)
+    fechas = (
+        pd.to_datetime([inicio + pd.DateOffset(months=int(m)) for m in range(total_meses)])[columna]
+        + pd.to_timedelta(rng.integers(0, 28, size=len(columna)), unit='D')
+        + pd.to_timedelta(rng.integers(8 * 3600, 18 * 3600, size=len(columna)), unit='s')
+    )
+    todos = pd.DataFrame({
+        'tipo_documento': tipo,
+        'fecha': fechas,
+        'mes': columna,
+        'articulo_codigo': codigos[fila],
+        'articulo_nombre': np.char.add('ARTICULO ', codigos[fila]),
+        'cantidad': cantidad,
+        'precio_unitario': precio[fila],
+        'tipo_bodega': np.array(TIPOS_BODEGA)[bodega[fila]],
+        'es_implante': banderas[fila, 0],
+        'es_instrumental': banderas[fila, 1],
+        'es_equipo_poder': banderas[fila, 2],
+    })
+
+    historia = todos[todos['mes'] < meses].drop(columns='mes').reset_index(drop=True)
+    reservado = todos[todos['mes'] >= meses]
+    verdad = reservado.groupby(['articulo_codigo', 'mes'], as_index=False)['cantidad'].sum()
+    verdad['fecha'] = pd.to_datetime([
+        inicio + pd.DateOffset(months=int(m)) + pd.offsets.MonthEnd(0) for m in verdad['mes']
+    ])
+    return historia, verdad[['articulo_codigo', 'fecha', 'cantidad']]
+
+
+def comparar_reportes(actual: Dict[str, Any], base: Dict[str, Any], tolerancia: float = 0.2,
+                      segundos_minimos: float = 0.05) -> List[Dict[str, Any]]:
+    """
+    Regresiones de `actual` frente a `base` por escenario (artículos, meses): etapas
+    más lentas o con más memoria que base × (1 + tolerancia) y WAPE peor en la
+    misma proporción. Las etapas de menos de `segundos_minimos` se ignoran (ruido).
+    """
+    regresiones = []
+    escenarios_base = {(e['articulos'], e['meses']): e for e in base.get('escenarios', [])}
+    for escenario in actual.get('escenarios', []):
+        clave = (escenario['articulos'], escenario['meses'])
+        previo = escenarios_base.get(clave)
+        if previo is None:
+            continue
+        for nombre, etapa in escenario['etapas'].items():
+            etapa_base = previo['etapas'].get(nombre) or {}
+            for metrica in ('segundos', 'memoria_pico_mb'):
+                valor, referencia = etapa.get(metrica), etapa_base.get(metrica)
+                if valor is None or referencia is None:
+                    continue
+                if metrica == 'segundos' and referencia < segundos_minimos:
+                    continue
+                if valor > referencia * (1 + tolerancia):
+                    regresiones.append({
+                        'escenario': f"{clave[0]}x{clave[1]}", 'etapa': nombre, 'metrica': metrica,
+                        'base': referencia, 'actual': valor,
+                    })
+        for metodo, metricas in (escenario.get('error_pronostico') or {}).items():
+            if not isinstance(metricas, dict):
+                continue
+            valor = metricas.get('wape')
+            referencia = ((previo.get('error_pronostico') or {}).get(metodo) or {}).get('wape')
+            if valor is not None and referencia is not None and valor > referencia * (1 + tolerancia):
+                regresiones.append({
+                    'escenario': f"{clave[0]}x{clave[1]}", 'etapa': metodo, 'metrica': 'wape',
+                    'base': referencia, 'actual': valor,
+                })
+    return regresiones
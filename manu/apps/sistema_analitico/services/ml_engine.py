@@ -1,16 +1,21 @@
 # sistema_analitico/services/ml_engine.py
 import pandas as pd
+import numpy as np
 import logging
+import threading
 from datetime import datetime, timedelta
 from django.utils import timezone
 import pickle
 import os
-import joblib
 from django.conf import settings
 
 from .prophet_forecaster import ProphetForecaster
+from .prophet_batch_forecaster import ProphetBatchForecaster
 from .xgboost_predictor import XGBoostPredictor
 from .inventory_optimizer import InventoryOptimizer
+from .model_registry import get_model_registry
+from .feature_store import features_entrenamiento, features_inferencia
+from .cache_pronosticos import invalidar_pronosticos, obtener_o_calcular
 
 # MLflow es opcional
 try:
@@ -22,6 +27,24 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# Un solo integrador MLflow por proceso (crear el experimento en cada petición es costoso)
+_mlflow_compartido = None
+_mlflow_lock = threading.Lock()
+
+
+def _obtener_mlflow():
+    global _mlflow_compartido
+    with _mlflow_lock:
+        if _mlflow_compartido is None:
+            try:
+                _mlflow_compartido = MLflowIntegrator()
+                logger.info("✅ MLflow integrado y disponible")
+            except Exception as e:
+                logger.warning(f"⚠️ Error inicializando MLflow: {e}")
+                return None
+        return _mlflow_compartido
+
+
 class MLEngine:
     def __init__(self, models_dir=None, enable_mlflow=True):      
         if models_dir is None:
@@ -30,51 +53,23 @@ class MLEngine:
             self.models_dir = models_dir        
         
         os.makedirs(self.models_dir, exist_ok=True)
-        logger.info(f"📁 Directorio de modelos: {self.models_dir}")
         
         self.prophet = ProphetForecaster()
+        self.prophet_articulos = ProphetBatchForecaster()
         self.xgboost = XGBoostPredictor()
         self.optimizer = InventoryOptimizer()
         
         # Inicializar MLflow si está disponible y habilitado
         self.mlflow = None
         if enable_mlflow and MLFLOW_AVAILABLE and MLflowIntegrator:
-            try:
-                self.mlflow = MLflowIntegrator()
-                logger.info("✅ MLflow integrado y disponible")
-            except Exception as e:
-                logger.warning(f"⚠️ Error inicializando MLflow: {e}")
-                self.mlflow = None
+            self.mlflow = _obtener_mlflow()
         
+        # Los modelos se cargan bajo demanda desde el registro del proceso (LRU compartido);
+        # modelos_entrenados solo guarda referencias a los que usó esta instancia
+        self.registro = get_model_registry(self.models_dir)
         self.modelos_entrenados = {}
-        self._cargar_modelos_existentes()
-    
-    def _cargar_modelos_existentes(self):
-        """Cargar modelos previamente entrenados al inicializar"""
-        try:
-            logger.info(f"🔍 Buscando modelos en: {self.models_dir}")
-            
-            if not os.path.exists(self.models_dir):
-                logger.warning(f"❌ Directorio no existe: {self.models_dir}")
-                return
-            
-            archivos = os.listdir(self.models_dir)
-            logger.info(f"📄 Archivos encontrados: {archivos}")
-            
-            for archivo in archivos:
-                if archivo.endswith('.joblib'):
-                    modelo_id = archivo.replace('.joblib', '')
-                    modelo_path = os.path.join(self.models_dir, archivo)
-                    
-                    try:
-                        modelo_data = joblib.load(modelo_path)
-                        self.modelos_entrenados[modelo_id] = modelo_data
-                        logger.info(f"✅ Modelo cargado: {modelo_id}")
-                    except Exception as e:
-                        logger.error(f"❌ Error cargando modelo {modelo_id}: {e}")
-                        
-        except Exception as e:
-            logger.error(f"⚠️ Error en _cargar_modelos_existentes: {e}")
+        # False al precalentar: esas consultas no cuentan como demanda de los usuarios
+        self.contar_consultas = True
     
     def _obtener_nit_y_empresas_relacionadas(self, empresa_servidor_id):
         """Obtiene el NIT y todas las empresas del mismo NIT"""
@@ -100,11 +95,17 @@ class MLEngine:
             logger.error(f"Error obteniendo empresas relacionadas: {e}")
             return None
     
-    def entrenar_modelos_empresa(self, empresa_servidor_id, fecha_inicio=None, fecha_fin=None):
+    def entrenar_modelos_empresa(self, empresa_servidor_id, fecha_inicio=None, fecha_fin=None, incremental=False):
+        """
+        Entrena Prophet/XGBoost con todas las empresas del NIT.
+
+        incremental=True: si ya existe un modelo, solo re-entrena cuando hay al menos
+        ML_REENTRENAMIENTO_MIN_MOVIMIENTOS movimientos posteriores al último entrenado,
+        y XGBoost continúa desde el booster anterior en lugar de empezar de cero.
+        """
         try:
             from apps.sistema_analitico.models import EmpresaServidor, MovimientoInventario
-            from django.db.models import Count, Sum, Avg, Q, Case, When, IntegerField
-            from django.db.models.functions import TruncMonth
+            from django.db.models import Count, Max
 
             # ✅ OBTENER TODAS LAS EMPRESAS DEL MISMO NIT
             info_empresa = self._obtener_nit_y_empresas_relacionadas(empresa_servidor_id)
@@ -116,65 +117,43 @@ class MLEngine:
 
             logger.info(f"🔧 Entrenamiento para NIT: {nit}, Empresas: {empresas_ids}")
 
+            # ✅ MODELO_ID USANDO NIT
+            modelo_id = f"empresa_{nit}"
+            modelo_previo = self.registro.obtener(modelo_id) or {}
+
+            movimientos = MovimientoInventario.objects.filter(empresa_servidor_id__in=empresas_ids)
+            nuevos_movimientos = None
+            if incremental and modelo_previo:
+                nuevos_movimientos = self._movimientos_nuevos(modelo_previo, movimientos, empresas_ids)
+                umbral = getattr(settings, 'ML_REENTRENAMIENTO_MIN_MOVIMIENTOS', 500)
+                if nuevos_movimientos is not None and nuevos_movimientos < umbral:
+                    logger.info(f"⏭️ {modelo_id}: {nuevos_movimientos} movimientos nuevos (< {umbral}), no se re-entrena")
+                    return {
+                        'estado': 'sin_cambios',
+                        'modelo_id': modelo_id,
+                        'nit_empresa': nit,
+                        'nuevos_movimientos': nuevos_movimientos,
+                        'umbral_movimientos': umbral,
+                        'version_modelo': modelo_previo.get('version_artefacto'),
+                        'fecha_entrenamiento': modelo_previo.get('fecha_entrenamiento')
+                    }
+            corte = movimientos.aggregate(ultimo=Max('fecha'), total=Count('id'))
+
+            # Predictores nuevos: los cargados del registro son compartidos y no deben re-entrenarse
+            self.prophet = ProphetForecaster()
+            self.xgboost = XGBoostPredictor()
+
             # ✅ USAR TODAS LAS EMPRESAS DEL NIT PARA ENTRENAR
-            dataset_ml = MovimientoInventario.objects.filter(
-                empresa_servidor_id__in=empresas_ids
-            ).annotate(
-                periodo=TruncMonth('fecha'), 
-                es_implante_int=Case(
-                    When(es_implante=True, then=1),
-                    default=0,
-                    output_field=IntegerField()
-                ),
-                es_instrumental_int=Case(
-                    When(es_instrumental=True, then=1),
-                    default=0,
-                    output_field=IntegerField()
-                ),
-                es_equipo_poder_int=Case(
-                    When(es_equipo_poder=True, then=1),
-                    default=0,
-                    output_field=IntegerField()
-                )
-            ).values(
-                'articulo_codigo', 'articulo_nombre', 'periodo'
-            ).annotate(
-                total_transacciones=Count('id'),
-                cantidad_total=Sum('cantidad'),
-                precio_promedio=Avg('precio_unitario'),
-                ventas_mes=Sum('cantidad', filter=Q(tipo_documento='FACTURA_VENTA')),
-                compras_mes=Sum('cantidad', filter=Q(tipo_documento='FACTURA_COMPRA')),
-                bodegas_unicas=Count('tipo_bodega', distinct=True),
-                conteo_implante=Sum('es_implante_int'),
-                conteo_instrumental=Sum('es_instrumental_int'), 
-                conteo_equipo_poder=Sum('es_equipo_poder_int')
-            ).filter(total_transacciones__gte=3)
-
-            df = pd.DataFrame(list(dataset_ml))
+            # ✅ FEATURES MENSUALES DEL FEATURE STORE (mantenido en la ingesta; las mismas que usa la inferencia)
+            df = features_entrenamiento(info_empresa['nit_normalizado'])
 
             if df.empty:
                 logger.error("❌ No hay datos suficientes para entrenar modelos")
                 return {"error": "No hay datos suficientes para entrenar modelos"}
 
-            if not df.empty:
-                df['fecha'] = pd.to_datetime(df['periodo'])
-                df['mes'] = df['fecha'].dt.month
-                df['año'] = df['fecha'].dt.year
-
-                if 'cantidad_total' in df.columns:
-                    df['cantidad'] = df['cantidad_total']
-                else:
-                    logger.error("❌ NO EXISTE COLUMNA cantidad_total EN EL DATAFRAME")
-                    return {"error": "No se pudo generar dataset con columna 'cantidad'"}                
-
-                df['es_implante'] = (df['conteo_implante'] > 0).astype(int)
-                df['es_instrumental'] = (df['conteo_instrumental'] > 0).astype(int)
-                df['es_equipo_poder'] = (df['conteo_equipo_poder'] > 0).astype(int)                
-
-                columnas_a_eliminar = ['conteo_implante', 'conteo_instrumental', 'conteo_equipo_poder', 'cantidad_total']
-                for col in columnas_a_eliminar:
-                    if col in df.columns:
-                        df = df.drop(col, axis=1)            
+            df['fecha'] = pd.to_datetime(df['periodo'])
+            df['mes'] = df['fecha'].dt.month
+            df['año'] = df['fecha'].dt.year
 
             logger.info(f"📊 Columnas para entrenamiento: {df.columns.tolist()}")
 
@@ -186,11 +165,20 @@ class MLEngine:
             logger.info("🎯 Entrenando modelo Prophet...")
             resultados['prophet'] = self.prophet.entrenar_modelo_demanda(df)
 
-            logger.info("🎯 Entrenando modelo XGBoost...")
-            resultados['xgboost'] = self.xgboost.entrenar_modelo_demanda(df)
+            logger.info("🎯 Entrenando pronósticos por artículo...")
+            # Los artículos cuya serie no cambió reutilizan el pronóstico del modelo anterior
+            self.prophet_articulos = ProphetBatchForecaster(estado_previo=modelo_previo.get('prophet_articulos'))
+            try:
+                resultados['prophet_articulos'] = self.prophet_articulos.entrenar(df)
+            except Exception as e:
+                logger.warning(f"⚠️ Error en pronóstico por artículo (se usa el agregado): {e}")
+                resultados['prophet_articulos'] = {'error': str(e)}
 
-            # ✅ MODELO_ID USANDO NIT
-            modelo_id = f"empresa_{nit}"
+            logger.info("🎯 Entrenando modelo XGBoost...")
+            # En modo incremental se continúa desde el booster anterior (warm start)
+            resultados['xgboost'] = self.xgboost.entrenar_modelo_demanda(
+                df, modelo_base=modelo_previo.get('xgboost_predictor_completo') if incremental else None
+            )
 
             # ✅ GUARDAR XGBOOST COMPLETO (CON ESCALADOR Y ENCODERS)
             modelo_data = {
@@ -202,6 +190,7 @@ class MLEngine:
                 'filas_entrenamiento': len(df),
                 'xgboost_predictor_completo': self.xgboost,  # ← OBJETO COMPLETO
                 'prophet_model': self.prophet.model,
+                'prophet_articulos': self.prophet_articulos.estado,
                 'metadata': {
                     'columnas_entrenamiento': df.columns.tolist(),
                     'total_articulos': df['articulo_codigo'].nunique(),
@@ -210,22 +199,26 @@ class MLEngine:
                         'max': df['fecha'].max().strftime('%Y-%m-%d')
                     },
                     'empresas_incluidas': empresas_ids,
-                    'total_empresas': len(empresas_ids)
+                    'total_empresas': len(empresas_ids),
+                    'ultimo_movimiento': corte['ultimo'].isoformat() if corte['ultimo'] else None,
+                    'movimientos_entrenamiento': corte['total']
                 }
             }
 
-            modelo_path = os.path.join(self.models_dir, f"{modelo_id}.joblib")
+            modelo_path = self.registro.store.ruta_modelo(modelo_id)
             logger.info(f"💾 Guardando modelo en: {modelo_path}")
 
             try:
-                joblib.dump(modelo_data, modelo_path)
-                logger.info(f"✅ Modelo guardado exitosamente: {modelo_path}")
+                # Manifest JSON + artefactos nativos (UBJ, npy, JSON de Prophet), publicado atómicamente
+                manifest = self.registro.publicar(modelo_id, modelo_data)
+                logger.info(f"✅ Modelo guardado exitosamente: {modelo_path} (versión {manifest['version']})")
             except Exception as e:
                 logger.error(f"❌ Error guardando modelo: {e}")
                 return {"error": f"No se pudo guardar el modelo: {str(e)}"}            
 
             self.modelos_entrenados[modelo_id] = modelo_data
             logger.info(f"✅ Modelo cargado en memoria: {modelo_id}")
+            invalidar_pronosticos(modelo_id)
 
             # Registrar en MLflow si está disponible
             mlflow_run_id = None
@@ -251,6 +244,9 @@ class MLEngine:
                 'resultados': resultados,
                 'filas_entrenamiento': len(df),
                 'ruta_guardado': modelo_path,
+                'tipo_entrenamiento': 'incremental' if (resultados.get('xgboost') or {}).get('warm_start') else 'completo',
+                'nuevos_movimientos': nuevos_movimientos,
+                'version_modelo': manifest['version'],
                 'mlflow_run_id': mlflow_run_id,  # ID del run en MLflow
                 'mlflow_ui_url': f"{self.mlflow.tracking_uri}/#/experiments/0/runs/{mlflow_run_id}" if mlflow_run_id and self.mlflow else None
             }
@@ -259,6 +255,22 @@ class MLEngine:
             logger.error(f"❌ Error entrenando modelos: {e}")
             return {"error": f"Error en entrenamiento: {str(e)}"}
     
+    def _movimientos_nuevos(self, modelo_previo, movimientos, empresas_ids):
+        """Movimientos posteriores al último entrenado; None si no se puede comparar (re-entrenar)."""
+        from django.utils.dateparse import parse_datetime, parse_date
+
+        metadata = modelo_previo.get('metadata', {})
+        if sorted(metadata.get('empresas_incluidas') or []) != sorted(empresas_ids):
+            return None
+        corte = parse_datetime(metadata.get('ultimo_movimiento') or '')
+        if corte is None:
+            # Modelos anteriores solo guardan el mes del último periodo entrenado
+            fecha = parse_date((metadata.get('rango_fechas') or {}).get('max') or '')
+            if fecha is None:
+                return None
+            corte = timezone.make_aware(datetime.combine(fecha, datetime.min.time()))
+        return movimientos.filter(fecha__gt=corte).count()
+
     def _verificar_y_cargar_modelo(self, empresa_servidor_id):
         """Verificar y cargar modelo basado en NIT de la empresa - CORREGIDO COMPLETO"""
         try:
@@ -271,27 +283,18 @@ class MLEngine:
             nit = info_empresa['nit']
             modelo_id = f"empresa_{nit}"
 
-            # ✅ BUSCAR MODELO EN MEMORIA
-            if modelo_id in self.modelos_entrenados:
-                logger.info(f"✅ Modelo encontrado en memoria: {modelo_id}")
-                modelo_data = self.modelos_entrenados[modelo_id]
-            else:
-                # ✅ BUSCAR MODELO EN DISCO
-                modelo_path = os.path.join(self.models_dir, f"{modelo_id}.joblib")
-                logger.info(f"🔍 Buscando modelo por NIT: {modelo_path}")
-
-                if not os.path.exists(modelo_path):
-                    logger.error(f"❌ Modelo no encontrado para NIT: {nit}")
-                    return False
-
-                # ✅ CARGAR MODELO
-                modelo_data = joblib.load(modelo_path)
-                self.modelos_entrenados[modelo_id] = modelo_data
+            # ✅ BUSCAR MODELO EN EL REGISTRO (memoria del proceso o disco)
+            modelo_data = self.registro.obtener(modelo_id)
+            if modelo_data is None:
+                logger.error(f"❌ Modelo no encontrado para NIT: {nit}")
+                return False
+            self.modelos_entrenados[modelo_id] = modelo_data
 
             # ✅ CARGAR COMPONENTES ESPECÍFICOS
             if 'prophet_model' in modelo_data and modelo_data['prophet_model'] is not None:
                 self.prophet.model = modelo_data['prophet_model']
                 logger.info("✅ Prophet model cargado en instancia")
+            self.prophet_articulos = ProphetBatchForecaster.desde_estado(modelo_data.get('prophet_articulos'))
 
             # ✅ CARGAR XGBOOST COMPLETO (CON ESCALADOR Y ENCODERS)
             if 'xgboost_predictor_completo' in modelo_data:
@@ -310,6 +313,44 @@ class MLEngine:
             return False
     
     def generar_recomendaciones_compras(self, empresa_servidor_id, meses=6, nivel_servicio=0.95):
+        """Recomendaciones de compra, servidas desde la caché de pronósticos si el modelo no cambió."""
+        return self._con_cache_pronosticos(
+            empresa_servidor_id, 'recomendaciones', {'meses': meses, 'nivel_servicio': nivel_servicio},
+            lambda: self._generar_recomendaciones_compras(empresa_servidor_id, meses, nivel_servicio)
+        )
+
+    def predecir_demanda_articulos(self, empresa_servidor_id, articulos=None, meses=6):
+        """Predicción de demanda, servida desde la caché de pronósticos si el modelo no cambió."""
+        return self._con_cache_pronosticos(
+            empresa_servidor_id, 'demanda', {'meses': meses, 'articulos': articulos},
+            lambda: self._predecir_demanda_articulos(empresa_servidor_id, articulos, meses)
+        )
+
+    def _con_cache_pronosticos(self, empresa_servidor_id, tipo, parametros, calcular):
+        """Clave (modelo_id, versión del artefacto, parámetros); sin modelo publicado no se cachea."""
+        info_empresa = self._obtener_nit_y_empresas_relacionadas(empresa_servidor_id)
+        if not info_empresa:
+            return calcular()
+        modelo_id = f"empresa_{info_empresa['nit']}"
+        resultado, desde_cache = obtener_o_calcular(
+            modelo_id, self._version_modelo(modelo_id), tipo, parametros, calcular,
+            registrar=self.contar_consultas
+        )
+        if desde_cache:
+            logger.info(f"⚡ Pronóstico '{tipo}' de {modelo_id} servido desde caché")
+            # La entrada es por NIT: se responde con la empresa que consultó
+            resultado = {**resultado, 'empresa_servidor_id': empresa_servidor_id, 'desde_cache': True}
+        return resultado
+
+    def _version_modelo(self, modelo_id):
+        manifest = self.registro.manifest(modelo_id)
+        if manifest:
+            return manifest.get('version')
+        # Modelos .joblib anteriores al manifest: la firma del archivo hace de versión
+        firma = self.registro.store.firma(modelo_id)
+        return '-'.join(str(parte) for parte in firma) if firma else None
+
+    def _generar_recomendaciones_compras(self, empresa_servidor_id, meses=6, nivel_servicio=0.95):
         """CORREGIDO: Usar TODAS las empresas del NIT para recomendaciones"""
         try:
             logger.info(f"🎯 Generando recomendaciones para NIT completo, meses: {meses}")
@@ -323,26 +364,13 @@ class MLEngine:
                 return {"error": "No se pudo obtener información del NIT de la empresa"}
 
             nit = info_empresa['nit']
+            modelo_id = f"empresa_{nit}"
             todas_empresas_ids = info_empresa['empresas_relacionadas']  # ← TODAS las empresas del NIT
 
             logger.info(f"📊 Obteniendo datos históricos para TODAS las empresas del NIT: {todas_empresas_ids}")
 
-            from apps.sistema_analitico.models import MovimientoInventario
-            from django.db.models import Sum, Count, Avg, Max, Q
-
             # ✅ CORRECCIÓN: Usar TODAS las empresas del NIT para obtener datos históricos
-            datos_historicos = MovimientoInventario.objects.filter(
-                empresa_servidor_id__in=todas_empresas_ids  # ← FILTRAR POR TODAS LAS EMPRESAS
-            ).values('articulo_codigo', 'articulo_nombre').annotate(
-                ventas_totales=Sum('cantidad', filter=Q(tipo_documento='FACTURA_VENTA')),
-                compras_totales=Sum('cantidad', filter=Q(tipo_documento='FACTURA_COMPRA')),
-                transacciones=Count('id'),
-                precio_promedio=Avg('precio_unitario'),
-                ultima_venta=Max('fecha', filter=Q(tipo_documento='FACTURA_VENTA')),
-                valor_total_ventas=Sum('valor_total', filter=Q(tipo_documento='FACTURA_VENTA'))
-            ).filter(ventas_totales__gt=0)  # Solo artículos con ventas
-
-            df_historicos = pd.DataFrame(list(datos_historicos))
+            df_historicos = self._historicos_recomendacion(todas_empresas_ids)
 
             if df_historicos.empty:
                 logger.error("❌ No hay datos históricos para generar recomendaciones")
@@ -350,54 +378,13 @@ class MLEngine:
 
             logger.info(f"📈 Procesando {len(df_historicos)} artículos para recomendaciones")
 
-            recomendaciones = []
-
-            for _, articulo in df_historicos.iterrows():
-                # ✅ CALCULAR DEMANDA CON DATOS DE TODAS LAS EMPRESAS
-                demanda_mensual = articulo['ventas_totales'] / 12
-                demanda_proyectada = demanda_mensual * meses
-
-                cantidad_recomendada = max(int(demanda_proyectada * 1.2), 1)  # 20% buffer
-
-                urgencia = "MEDIA"
-                if articulo['ultima_venta']:
-                    dias_desde_ultima_venta = (timezone.now() - articulo['ultima_venta']).days
-                    if dias_desde_ultima_venta < 30:
-                        urgencia = "ALTA"
-                    elif dias_desde_ultima_venta > 90:
-                        urgencia = "BAJA"
+            # Pronóstico por artículo del modelo entrenado; sin él, promedio histórico
+            demanda_pronosticada = self.prophet_articulos.demanda_total(meses)
 
-                valor_total = articulo['valor_total_ventas'] or 0
-                if valor_total > 10000000:  
-                    clasificacion = "A"
-                elif valor_total > 1000000:  
-                    clasificacion = "B" 
-                else:
-                    clasificacion = "C"
-
-                precio_promedio = float(articulo['precio_promedio'] or 0)
-                inversion_estimada = cantidad_recomendada * precio_promedio
-
-                recomendaciones.append({
-                    'articulo_codigo': articulo['articulo_codigo'],
-                    'articulo_nombre': articulo['articulo_nombre'],
-                    'clasificacion_abc': clasificacion,
-                    'demanda_predicha': round(demanda_proyectada),
-                    'cantidad_recomendada': cantidad_recomendada,
-                    'ventas_historicas': articulo['ventas_totales'],
-                    'transacciones_historicas': articulo['transacciones'],
-                    'urgencia': urgencia,
-                    'precio_promedio': precio_promedio,
-                    'inversion_estimada': round(inversion_estimada, 2),
-                    'ultima_venta': articulo['ultima_venta'].strftime('%Y-%m-%d') if articulo['ultima_venta'] else 'N/A'
-                })
-
-            # Ordenar por urgencia (ALTA primero) y luego por demanda
-            orden_urgencia = {"ALTA": 3, "MEDIA": 2, "BAJA": 1}
-            recomendaciones.sort(key=lambda x: (orden_urgencia[x['urgencia']], x['demanda_predicha']), reverse=True)
-
-            # Limitar a top 15 recomendaciones
-            recomendaciones = recomendaciones[:15]
+            # ✅ CALCULAR DEMANDA, URGENCIA Y ORDEN PARA TODOS LOS ARTÍCULOS A LA VEZ (top 15)
+            recomendaciones = self.optimizer.recomendar_compras(
+                df_historicos, meses, demanda_pronosticada, limite=15
+            )
 
             inversion_total = sum(r['inversion_estimada'] for r in recomendaciones)
 
@@ -409,7 +396,7 @@ class MLEngine:
                 'inversion_estimada': round(inversion_total, 2),
                 'nivel_servicio': nivel_servicio,
                 'meses_proyeccion': meses,
-                'modelo_utilizado': 'analisis_historico_avanzado',
+                'modelo_utilizado': 'pronostico_por_articulo' if demanda_pronosticada else 'analisis_historico_avanzado',
                 'empresa_servidor_id': empresa_servidor_id,
                 'nit_empresa': nit
             }
@@ -443,7 +430,25 @@ class MLEngine:
             logger.error(f"❌ Error generando recomendaciones: {e}")
             return {"error": f"Error generando recomendaciones: {str(e)}"}
     
-    def predecir_demanda_articulos(self, empresa_servidor_id, articulos=None, meses=6):
+    def _historicos_recomendacion(self, empresas_ids):
+        """Una fila por artículo con ventas en las empresas indicadas (entrada de recomendar_compras)."""
+        from apps.sistema_analitico.models import MovimientoInventario
+        from django.db.models import Sum, Count, Avg, Max, Q
+
+        datos_historicos = MovimientoInventario.objects.filter(
+            empresa_servidor_id__in=empresas_ids  # ← FILTRAR POR TODAS LAS EMPRESAS
+        ).values('articulo_codigo', 'articulo_nombre').annotate(
+            ventas_totales=Sum('cantidad', filter=Q(tipo_documento='FACTURA_VENTA')),
+            compras_totales=Sum('cantidad', filter=Q(tipo_documento='FACTURA_COMPRA')),
+            transacciones=Count('id'),
+            precio_promedio=Avg('precio_unitario'),
+            ultima_venta=Max('fecha', filter=Q(tipo_documento='FACTURA_VENTA')),
+            valor_total_ventas=Sum('valor_total', filter=Q(tipo_documento='FACTURA_VENTA'))
+        ).filter(ventas_totales__gt=0)  # Solo artículos con ventas
+
+        return pd.DataFrame(list(datos_historicos))
+
+    def _predecir_demanda_articulos(self, empresa_servidor_id, articulos=None, meses=6):
         """CORREGIDA: Sin typos y con validaciones robustas"""
         try:
             logger.info(f"🔮 Prediciendo demanda para NIT completo, meses: {meses}")
@@ -477,8 +482,12 @@ class MLEngine:
             
             # ✅ PREDICCIÓN PROPHET CORREGIDA (sin typo)
             try:
-                # CORRECCIÓN: Usar el nombre correcto del parámetro
-                predicciones_prophet = self.prophet.predecir_demanda(periodos_futuro=meses)
+                if self.prophet_articulos.estado:
+                    # Pronóstico por artículo precalculado en el entrenamiento (un solo slice)
+                    predicciones_prophet = self.prophet_articulos.predecir(meses, articulos).to_dict('records')
+                else:
+                    # Modelos entrenados antes del pronóstico por artículo: serie agregada
+                    predicciones_prophet = self.prophet.predecir_demanda(periodos_futuro=meses)
                 confianza_prophet = "alta" if predictor_principal == 'prophet' else "media"
                 logger.info(f"✅ Prophet generó {len(predicciones_prophet) if isinstance(predicciones_prophet, list) else 'algunas'} predicciones")
             except Exception as e:
@@ -492,9 +501,12 @@ class MLEngine:
             
             articulos_populares = MovimientoInventario.objects.filter(
                 empresa_servidor_id__in=todas_empresas_ids
-            ).values('articulo_codigo', 'articulo_nombre').annotate(
+            )
+            if articulos:
+                articulos_populares = articulos_populares.filter(articulo_codigo__in=articulos)
+            articulos_populares = articulos_populares.values('articulo_codigo', 'articulo_nombre').annotate(
                 total=Count('id')
-            ).order_by('-total')[:10]
+            ).order_by('-total')[:len(articulos) if articulos else 10]
             
             # ✅ OBTENER CARACTERÍSTICAS EXACTAS DEL ENTRENAMIENTO
             caracteristicas_entrenamiento = modelo_data.get('resultados_entrenamiento', {}).get('xgboost', {}).get('caracteristicas_usadas', [])
@@ -505,45 +517,19 @@ class MLEngine:
     
             logger.info(f"🎯 Características de entrenamiento: {caracteristicas_entrenamiento}")
     
-            # ✅ CREAR DATOS FUTUROS CON VALIDACIÓN
-            datos_futuros = []
-            if articulos_populares:
-                for fecha in fechas_futuras:
-                    for art in articulos_populares:
-                        fila = {
-                            'fecha': fecha,
-                            'articulo_codigo': art['articulo_codigo'],
-                            'articulo_nombre': art['articulo_nombre'],
-                        }
-                        
-                        # HOMOLOGACIÓN EXACTA: SOLO USAR CARACTERÍSTICAS DEL ENTRENAMIENTO
-                        for caracteristica in caracteristicas_entrenamiento:
-                            if caracteristica == 'mes':
-                                fila['mes'] = fecha.month
-                            elif caracteristica == 'año':
-                                fila['año'] = fecha.year
-                            elif caracteristica == 'trimestre':
-                                fila['trimestre'] = (fecha.month - 1) // 3 + 1
-                            elif caracteristica == 'dia_semana':
-                                fila['dia_semana'] = fecha.weekday()
-                            elif caracteristica in ['total_transacciones', 'ventas_mes', 'compras_mes', 'bodegas_unicas']:
-                                fila[caracteristica] = 1
-                            elif caracteristica in ['es_implante', 'es_instrumental', 'es_equipo_poder']:
-                                fila[caracteristica] = 0
-                            else:
-                                fila[caracteristica] = 0
-                        
-                        datos_futuros.append(fila)
+            # ✅ CREAR DATOS FUTUROS (producto artículos × fechas vectorizado)
+            df_futuro = self._datos_futuros(
+                pd.DataFrame(list(articulos_populares)), fechas_futuras, info_empresa['nit_normalizado']
+            )
     
-            # ✅ VALIDAR QUE HAY DATOS ANTES DE CREAR DATAFRAME
-            if not datos_futuros:
+            # ✅ VALIDAR QUE HAY DATOS ANTES DE PREDECIR
+            if df_futuro.empty:
                 logger.warning("⚠️ No se pudieron crear datos futuros, usando fallback histórico")
                 predicciones_xgboost = self._generar_predicciones_fallback_basico(
                     todas_empresas_ids, meses, fechas_futuras
                 )
                 confianza_xgboost = "media"
             else:
-                df_futuro = pd.DataFrame(datos_futuros)
                 logger.info(f"✅ DataFrame futuro creado con {len(df_futuro)} filas")
                 
                 # ✅ PREDICCIÓN XGBOOST CON MANEJO DE ERRORES ROBUSTO
@@ -623,6 +609,98 @@ class MLEngine:
             logger.error(f"❌ Error prediciendo demanda: {e}")
             return {"error": f"Error prediciendo demanda: {str(e)}"}
         
+    def predecir_demanda_lote(self, empresa_servidor_id, articulos=None, meses=6, tamano_lote=None):
+        """
+        Predicción de demanda para muchos artículos y meses en una sola pasada.
+
+        articulos: lista de códigos, o None / 'all' para todos los artículos del NIT.
+        Retorna {'error': ...} o la información del lote con 'lotes': un generador de
+        DataFrames (tamano_lote artículos × meses filas cada uno) con la predicción de
+        XGBoost y el pronóstico por artículo (prophet/croston/ets) alineado por fecha.
+        """
+        if not self._verificar_y_cargar_modelo(empresa_servidor_id):
+            return {"error": "Modelo no encontrado. Entrene primero los modelos."}
+
+        info_empresa = self._obtener_nit_y_empresas_relacionadas(empresa_servidor_id)
+        if not info_empresa:
+            return {"error": "No se pudo obtener información del NIT"}
+
+        from apps.sistema_analitico.models import MovimientoInventario
+        from django.db.models import Max
+
+        nit = info_empresa['nit']
+        consulta = MovimientoInventario.objects.filter(empresa_servidor_id__in=info_empresa['empresas_relacionadas'])
+        todos = articulos is None or articulos == 'all'
+        if not todos:
+            consulta = consulta.filter(articulo_codigo__in=articulos)
+        df_articulos = pd.DataFrame(list(
+            consulta.values('articulo_codigo').annotate(articulo_nombre=Max('articulo_nombre')).order_by('articulo_codigo')
+        ), columns=['articulo_codigo', 'articulo_nombre'])
+        if not todos:
+            # Artículos pedidos sin movimientos también se predicen (sin nombre)
+            codigos = pd.Index(dict.fromkeys(str(a) for a in articulos))
+            df_articulos = df_articulos.set_index('articulo_codigo').reindex(codigos).rename_axis('articulo_codigo').reset_index()
+
+        fechas_futuras = pd.date_range(
+            start=timezone.now(), end=timezone.now() + timedelta(days=meses * 30), freq='ME'
+        )
+        tamano_lote = tamano_lote or getattr(settings, 'ML_PREDICCION_LOTE_ARTICULOS', 5000)
+
+        return {
+            'modelo_id': f"empresa_{nit}",
+            'nit_empresa': nit,
+            'version_modelo': self.modelos_entrenados.get(f"empresa_{nit}", {}).get('version_artefacto'),
+            'total_articulos': len(df_articulos),
+            'meses': len(fechas_futuras),
+            'lotes': self._lotes_prediccion(df_articulos, fechas_futuras, meses, tamano_lote, info_empresa['nit_normalizado']),
+        }
+
+    def _lotes_prediccion(self, df_articulos, fechas_futuras, meses, tamano_lote, nit_normalizado=None):
+        for inicio in range(0, len(df_articulos), tamano_lote):
+            lote = df_articulos.iloc[inicio:inicio + tamano_lote]
+            df_futuro = self._datos_futuros(lote, fechas_futuras, nit_normalizado)
+            if self.xgboost.model is not None:
+                prediccion_xgboost = self.xgboost.predecir_lote(df_futuro)
+            else:
+                prediccion_xgboost = np.full(len(df_futuro), np.nan)
+
+            resultado = pd.DataFrame({
+                'articulo_codigo': df_futuro['articulo_codigo'].astype(str).to_numpy(),
+                'articulo_nombre': df_futuro['articulo_nombre'].to_numpy(),
+                'fecha': df_futuro['fecha'].dt.strftime('%Y-%m-%d').to_numpy(),
+                'prediccion_xgboost': prediccion_xgboost,
+            })
+            pronostico = self.prophet_articulos.predecir(meses, lote['articulo_codigo'].astype(str), fechas=fechas_futuras)
+            if len(pronostico) and pronostico['prediccion'].isna().all():
+                logger.warning(
+                    f"⚠️ Las fechas pedidas quedan fuera del horizonte del pronóstico por artículo "
+                    f"(inicio {self.prophet_articulos.estado['inicio']}); solo se usa XGBoost"
+                )
+            resultado = resultado.merge(
+                pronostico.rename(columns={'prediccion': 'prediccion_prophet'}),
+                on=['articulo_codigo', 'fecha'], how='left'
+            )
+            # Agrupar por artículo (en el orden del lote) con sus meses consecutivos
+            orden = np.argsort(np.tile(np.arange(len(lote)), len(fechas_futuras)), kind='stable')
+            yield resultado.iloc[orden].reset_index(drop=True)
+
+    def _datos_futuros(self, df_articulos, fechas_futuras, nit_normalizado=None):
+        """
+        Una fila por (fecha, artículo) en el mismo orden que los bucles anidados originales,
+        con las features del feature store del NIT (las mismas del entrenamiento).
+        """
+        if df_articulos.empty or len(fechas_futuras) == 0:
+            return pd.DataFrame(columns=['fecha', 'articulo_codigo', 'articulo_nombre'])
+        n_articulos = len(df_articulos)
+        df_futuro = pd.DataFrame({
+            'fecha': pd.DatetimeIndex(fechas_futuras).repeat(n_articulos),
+            'articulo_codigo': np.tile(df_articulos['articulo_codigo'].to_numpy(), len(fechas_futuras)),
+            'articulo_nombre': np.tile(df_articulos['articulo_nombre'].to_numpy(), len(fechas_futuras)),
+        })
+        if nit_normalizado:
+            df_futuro = features_inferencia(nit_normalizado, df_futuro)
+        return df_futuro
+
     def _generar_predicciones_fallback_basico(self, empresas_ids, meses, fechas_futuras):
         """Genera predicciones básicas basadas en promedios históricos cuando XGBoost falla"""
         try:
@@ -689,8 +767,11 @@ class MLEngine:
             nit = info_empresa['nit']
             modelo_id = f"empresa_{nit}"
    
-            if modelo_id in self.modelos_entrenados:
-                modelo_data = self.modelos_entrenados[modelo_id]
+            if modelo_id in self.registro.modelos_en_memoria():
+                modelo_data = self.registro.obtener(modelo_id)
+            else:
+                modelo_data = None
+            if modelo_data is not None:
                 return {
                     'estado': 'entrenado_en_memoria',
                     'modelo_id': modelo_id,
@@ -701,10 +782,29 @@ class MLEngine:
                     'filas_entrenamiento': modelo_data.get('filas_entrenamiento')
                 }
         
-            modelo_path = os.path.join(self.models_dir, f"{modelo_id}.joblib")
+            # Solo el manifest JSON: no hace falta deserializar el modelo para conocer su estado
+            modelo_path = self.registro.store.ruta_modelo(modelo_id)
+            manifest = self.registro.manifest(modelo_id)
+            if manifest is not None:
+                datos = manifest.get('datos', {})
+                return {
+                    'estado': 'disponible_en_disco',
+                    'modelo_id': modelo_id,
+                    'ruta': modelo_path,
+                    'version': manifest.get('version'),
+                    'fecha_entrenamiento': datos.get('fecha_entrenamiento'),
+                    'empresa_servidor_id': datos.get('empresa_servidor_id_original'),
+                    'nit_empresa': datos.get('nit_empresa'),
+                    'empresas_incluidas': datos.get('empresas_servidor_ids', []),
+                    'filas_entrenamiento': datos.get('filas_entrenamiento')
+                }
+
+            modelo_path = self.registro.store.ruta_legacy(modelo_id)
             if os.path.exists(modelo_path):
                 try:
-                    modelo_data = joblib.load(modelo_path)
+                    modelo_data = self.registro.obtener(modelo_id)
+                    if modelo_data is None:
+                        raise ValueError(f"No se pudo cargar {modelo_path}")
                     return {
                         'estado': 'disponible_en_disco',
                         'modelo_id': modelo_id,
@@ -725,7 +825,7 @@ class MLEngine:
                 return {
                     'estado': 'no_entrenado',
                     'modelo_id': modelo_id,
-                    'ruta_buscada': modelo_path
+                    'ruta_buscada': self.registro.store.ruta_modelo(modelo_id)
                 }
         except Exception as e:
             return {
@@ -741,28 +841,32 @@ class MLEngine:
         if not os.path.exists(self.models_dir):
             return {"error": f"Directorio no existe: {self.models_dir}"}
         
-        for archivo in os.listdir(self.models_dir):
-            if archivo.endswith('.joblib'):
-                modelo_id = archivo.replace('.joblib', '')
-                # Para listar, necesitamos obtener el empresa_servidor_id de alguna manera
-                # Podemos cargar el modelo y obtener el empresa_servidor_id_original
-                try:
-                    modelo_path = os.path.join(self.models_dir, archivo)
-                    modelo_data = joblib.load(modelo_path)
-                    
-                    modelos.append({
-                        'modelo_id': modelo_id,
-                        'nit_empresa': modelo_data.get('nit_empresa', 'N/A'),
-                        'empresa_servidor_id_original': modelo_data.get('empresa_servidor_id_original', 'N/A'),
-                        'empresas_incluidas': modelo_data.get('empresas_servidor_ids', []),
-                        'fecha_entrenamiento': modelo_data.get('fecha_entrenamiento'),
-                        'filas_entrenamiento': modelo_data.get('filas_entrenamiento')
-                    })
-                except Exception as e:
-                    modelos.append({
-                        'modelo_id': modelo_id,
-                        'error': f"No se pudo cargar: {str(e)}"
-                    })
+        for modelo_id in self.registro.store.listar():
+            try:
+                manifest = self.registro.manifest(modelo_id)
+                if manifest is not None:
+                    datos = manifest.get('datos', {})
+                else:
+                    # Modelo .joblib antiguo: hay que cargarlo para leer sus metadatos.
+                    # Sin cachear: listar no debe expulsar del registro los modelos en uso
+                    datos = self.registro.obtener(modelo_id, cachear=False)
+                    if datos is None:
+                        raise ValueError("archivo ilegible")
+
+                modelos.append({
+                    'modelo_id': modelo_id,
+                    'version': manifest.get('version') if manifest else None,
+                    'nit_empresa': datos.get('nit_empresa', 'N/A'),
+                    'empresa_servidor_id_original': datos.get('empresa_servidor_id_original', 'N/A'),
+                    'empresas_incluidas': datos.get('empresas_servidor_ids', []),
+                    'fecha_entrenamiento': datos.get('fecha_entrenamiento'),
+                    'filas_entrenamiento': datos.get('filas_entrenamiento')
+                })
+            except Exception as e:
+                modelos.append({
+                    'modelo_id': modelo_id,
+                    'error': f"No se pudo cargar: {str(e)}"
+                })
         
         return {
             'directorio_modelos': self.models_dir,
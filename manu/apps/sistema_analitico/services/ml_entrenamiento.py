@@ -0,0 +1,83 @@
+"""
+Cola de entrenamiento de modelos ML en segundo plano.
+
+El entrenamiento (agregación ORM + Prophet + XGBoost + MLflow) corre en la tarea
+Celery sistema_analitico.entrenar_modelos_empresa, enrutada a la cola
+ML_ENTRENAMIENTO_QUEUE (por defecto la cola 'celery'). Por modelo (empresa_{nit}) hay a lo sumo un
+entrenamiento en curso: la clave ml_entrenamiento:{modelo_id} en caché guarda el
+task_id vigente y las peticiones repetidas reciben ese mismo task_id.
+"""
+import logging
+import uuid
+from typing import Any, Dict, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+PREFIJO = 'ml_entrenamiento'
+
+
+def _clave(modelo_id: str) -> str:
+    return f"{PREFIJO}:{modelo_id}"
+
+
+def modelo_id_empresa(empresa_servidor_id: int) -> str:
+    from apps.sistema_analitico.models import EmpresaServidor
+    nit = EmpresaServidor.objects.values_list('nit', flat=True).get(id=empresa_servidor_id)
+    return f"empresa_{nit}"
+
+
+def encolar_entrenamiento(empresa_servidor_id: int, forzar: bool = False) -> Dict[str, Any]:
+    """Encola el entrenamiento del NIT de la empresa, o retorna el que ya está en curso."""
+    from apps.sistema_analitico.tasks import entrenar_modelos_empresa_task
+
+    modelo_id = modelo_id_empresa(empresa_servidor_id)
+    clave = _clave(modelo_id)
+    ttl = getattr(settings, 'ML_ENTRENAMIENTO_LOCK_TTL', 3 * 3600)
+
+    task_id = str(uuid.uuid4())
+    if not cache.add(clave, task_id, timeout=ttl):
+        en_curso = cache.get(clave)
+        if en_curso and not _terminada(en_curso):
+            logger.info(f"🔁 Entrenamiento de {modelo_id} ya en curso: {en_curso}")
+            return {'modelo_id': modelo_id, 'task_id': en_curso, 'duplicado': True}
+        # La tarea anterior terminó sin liberar la clave (worker reiniciado): se reemplaza
+        cache.delete(clave)
+        if not cache.add(clave, task_id, timeout=ttl):
+            return {'modelo_id': modelo_id, 'task_id': cache.get(clave), 'duplicado': True}
+
+    try:
+        entrenar_modelos_empresa_task.apply_async(
+            kwargs={'empresa_servidor_id': empresa_servidor_id, 'modelo_id': modelo_id, 'forzar': forzar},
+            task_id=task_id,
+        )
+    except Exception:
+        cache.delete(clave)
+        raise
+    logger.info(f"📥 Entrenamiento de {modelo_id} encolado: {task_id}")
+    return {'modelo_id': modelo_id, 'task_id': task_id, 'duplicado': False}
+
+
+def entrenamiento_en_curso(modelo_id: str) -> Optional[str]:
+    task_id = cache.get(_clave(modelo_id))
+    if task_id and _terminada(task_id):
+        return None
+    return task_id
+
+
+def liberar_entrenamiento(modelo_id: str, task_id: str):
+    """Libera la clave solo si sigue perteneciendo a esta tarea."""
+    clave = _clave(modelo_id)
+    if cache.get(clave) == task_id:
+        cache.delete(clave)
+
+
+def _terminada(task_id: str) -> bool:
+    from celery.result import AsyncResult
+    from config.celery import app as celery_app
+    try:
+        return AsyncResult(task_id, app=celery_app).ready()
+    except Exception:
+        return False
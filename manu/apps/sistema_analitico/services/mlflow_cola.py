@@ -0,0 +1,175 @@
+"""
+Cola asíncrona de registros MLflow (MLflowIntegrator).
+
+Entrenamiento y predicción solo arman un evento (parámetros, métricas, JSONs y
+tablas ya muestreadas) y lo encolan; un hilo de fondo por proceso crea el run y
+escribe todo con una llamada log_batch por run en lugar de un log_param/log_metric
+por valor. Así la latencia del pronóstico no depende del I/O de MLflow.
+
+Contrapresión: con la cola llena (o si MLflow falla) el evento se escribe como
+JSON line en MLFLOW_SPOOL_DIR y el hilo lo reproduce cuando la cola está vacía. El modelo
+XGBoost no se guarda en el spool (solo viaja por la cola en memoria).
+
+El hilo se crea bajo demanda y se vuelve a crear tras un fork (workers Celery
+prefork, gunicorn), donde los hilos del proceso padre no existen.
+"""
+import atexit
+import glob
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+ESPERA_CIERRE = 5  # Segundos para vaciar la cola al terminar el proceso
+ESPERA_REINTENTO = 60  # Segundos sin reproducir el spool tras un fallo de MLflow
+MAX_INTENTOS = 5  # Intentos por evento antes de descartarlo
+
+
+class MLflowLogQueue:
+    """Cola acotada + hilo escritor; escribir(evento) hace el I/O real contra MLflow."""
+
+    def __init__(self, escribir: Callable[[Dict[str, Any]], None], max_eventos: int, spool_dir: str):
+        self.escribir = escribir
+        self.max_eventos = max_eventos
+        self.spool_dir = spool_dir
+        self._lock = threading.Lock()
+        self._pid = None
+        self._cola: Optional[queue.Queue] = None
+        self._hilo: Optional[threading.Thread] = None
+        self._proximo_reintento = 0.0
+        self.estadisticas = {'encolados': 0, 'escritos': 0, 'fallidos': 0, 'en_spool': 0, 'reproducidos': 0}
+
+    # ------------------------------------------------------------ productores
+    def encolar(self, evento: Dict[str, Any]) -> str:
+        """Nunca bloquea: si la cola está llena el evento va al spool local."""
+        evento.setdefault('evento_id', uuid.uuid4().hex)
+        evento.setdefault('creado', time.time())
+        self._asegurar_hilo()
+        try:
+            self._cola.put_nowait(evento)
+            self.estadisticas['encolados'] += 1
+        except queue.Full:
+            self._a_spool(evento)
+        return evento['evento_id']
+
+    def vaciar(self, timeout: float = ESPERA_CIERRE) -> bool:
+        """Espera (hasta timeout) a que se escriban los eventos en cola."""
+        if self._cola is None or self._pid != os.getpid():
+            return True
+        limite = time.monotonic() + timeout
+        while self._cola.unfinished_tasks and time.monotonic() < limite:
+            time.sleep(0.05)
+        return not self._cola.unfinished_tasks
+
+    # ------------------------------------------------------------------ hilo
+    def _asegurar_hilo(self):
+        if self._pid == os.getpid() and self._hilo is not None and self._hilo.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._hilo is not None and self._hilo.is_alive():
+                return
+            if self._pid != os.getpid():
+                self._cola = queue.Queue(maxsize=self.max_eventos)
+            self._pid = os.getpid()
+            self._hilo = threading.Thread(target=self._trabajar, name='mlflow-log', daemon=True)
+            self._hilo.start()
+
+    def _trabajar(self):
+        while True:
+            try:
+                evento = self._cola.get(timeout=1.0)
+            except queue.Empty:
+                self._reproducir_spool()
+                continue
+            try:
+                if not self._escribir(evento):
+                    self._a_spool(evento)
+            finally:
+                self._cola.task_done()
+
+    def _escribir(self, evento: Dict[str, Any]) -> bool:
+        try:
+            self.escribir(evento)
+            self.estadisticas['escritos'] += 1
+            return True
+        except Exception as e:
+            self.estadisticas['fallidos'] += 1
+            evento['intentos'] = evento.get('intentos', 0) + 1
+            self._proximo_reintento = time.monotonic() + ESPERA_REINTENTO
+            logger.warning(f"⚠️ MLflow: no se pudo registrar {evento.get('run_name')} (intento {evento['intentos']}): {e}")
+            return False
+
+    # ----------------------------------------------------------------- spool
+    def _ruta_spool(self) -> str:
+        return os.path.join(self.spool_dir, f"eventos_{os.getpid()}.jsonl")
+
+    def _a_spool(self, evento: Dict[str, Any]):
+        if evento.get('intentos', 0) >= MAX_INTENTOS:
+            logger.warning(f"⚠️ MLflow: evento {evento.get('run_name')} descartado tras {MAX_INTENTOS} intentos")
+            return
+        serializable = {k: v for k, v in evento.items() if k != 'modelo_xgboost'}
+        try:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            with open(self._ruta_spool(), 'a', encoding='utf-8') as archivo:
+                archivo.write(json.dumps(serializable, default=str) + '\n')
+            self.estadisticas['en_spool'] += 1
+            logger.warning(f"⚠️ MLflow: {evento.get('run_name')} enviado al spool")
+        except OSError as e:
+            logger.warning(f"⚠️ MLflow: evento descartado, spool no disponible: {e}")
+
+    def _reproducir_spool(self):
+        """Reproduce los spools (de cualquier proceso) cuando la cola está ociosa."""
+        if time.monotonic() < self._proximo_reintento:
+            return
+        for ruta in sorted(glob.glob(os.path.join(self.spool_dir, 'eventos_*.jsonl'))):
+            if not self._cola.empty():
+                return
+            # Renombrar primero: otro proceso no reproduce el mismo archivo y este sigue recibiendo
+            reclamado = f"{ruta}.{os.getpid()}.reproduciendo"
+            try:
+                os.rename(ruta, reclamado)
+            except OSError:
+                continue
+            pendientes = self._reproducir_archivo(reclamado)
+            os.remove(reclamado)
+            if pendientes:
+                os.makedirs(self.spool_dir, exist_ok=True)
+                with open(self._ruta_spool(), 'a', encoding='utf-8') as archivo:
+                    archivo.writelines(json.dumps(e, default=str) + '\n' for e in pendientes)
+                return
+
+    def _reproducir_archivo(self, ruta: str) -> List[Dict[str, Any]]:
+        with open(ruta, encoding='utf-8') as archivo:
+            eventos = [json.loads(linea) for linea in archivo if linea.strip()]
+        for i, evento in enumerate(eventos):
+            if not self._escribir(evento):
+                # MLflow sigue caído: se conserva el resto para el próximo intento
+                return [e for e in eventos[i:] if e.get('intentos', 0) < MAX_INTENTOS]
+            self.estadisticas['reproducidos'] += 1
+        return []
+
+
+_colas: Dict[str, MLflowLogQueue] = {}
+_colas_lock = threading.Lock()
+
+
+def obtener_cola(clave: str, escribir: Callable[[Dict[str, Any]], None],
+                 max_eventos: int, spool_dir: str) -> MLflowLogQueue:
+    """Una cola por (tracking_uri, experimento) en el proceso."""
+    with _colas_lock:
+        cola = _colas.get(clave)
+        if cola is None:
+            cola = _colas[clave] = MLflowLogQueue(escribir, max_eventos, spool_dir)
+        return cola
+
+
+@atexit.register
+def _vaciar_al_salir():
+    for cola in list(_colas.values()):
+        cola.vaciar()
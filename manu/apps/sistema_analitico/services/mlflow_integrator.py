@@ -4,10 +4,16 @@ Permite registrar modelos, loguear métricas y visualizar predicciones en MLflow
 Sin romper la funcionalidad existente - funciona como wrapper opcional
 """
 import os
+import json
 import logging
+import random
+import time
 from datetime import datetime
 from typing import Dict, Any, Optional, List
 import pandas as pd
+from django.conf import settings
+
+from .mlflow_cola import obtener_cola
 
 logger = logging.getLogger(__name__)
 
@@ -27,6 +33,10 @@ class MLflowIntegrator:
     """
     Integrador MLflow que envuelve MLEngine sin romper funcionalidad existente.
     Si MLflow no está disponible, todas las operaciones son no-ops (no fallan).
+
+    Con MLFLOW_ASYNC (default) los registros se encolan y los escribe un hilo de
+    fondo (ver mlflow_cola.py): log_model_training y log_prediction retornan None
+    porque el run_id aún no existe.
     """
     
     def __init__(self, tracking_uri: Optional[str] = None, experiment_name: str = "tnsfull_ml"):
@@ -42,6 +52,11 @@ class MLflowIntegrator:
         # Lee dinámicamente desde variable de entorno o usa default
         self.tracking_uri = tracking_uri or os.getenv('MLFLOW_TRACKING_URI', 'http://localhost:5000')
         self.experiment_name = experiment_name
+        self.asincrono = getattr(settings, 'MLFLOW_ASYNC', True)
+        self.muestreo_predicciones = getattr(settings, 'MLFLOW_MUESTREO_PREDICCIONES', 1.0)
+        self.max_filas = getattr(settings, 'MLFLOW_MAX_FILAS_ARTEFACTO', 1000)
+        self._experiment_id = None
+        self.cola = None
         
         if not self.mlflow_available:
             logger.info("📊 MLflow no disponible - operaciones serán no-ops")
@@ -50,22 +65,38 @@ class MLflowIntegrator:
         try:
             # Configurar tracking URI
             mlflow.set_tracking_uri(self.tracking_uri)
-            
-            # Crear o obtener experimento
-            try:
-                experiment = mlflow.get_experiment_by_name(experiment_name)
-                if experiment is None:
-                    experiment_id = mlflow.create_experiment(experiment_name)
-                    logger.info(f"✅ Experimento creado: {experiment_name} (ID: {experiment_id})")
-                else:
-                    logger.info(f"✅ Experimento encontrado: {experiment_name} (ID: {experiment.experiment_id})")
-            except Exception as e:
-                logger.warning(f"⚠️ Error configurando experimento MLflow: {e}")
-                self.mlflow_available = False
-                
         except Exception as e:
             logger.warning(f"⚠️ Error inicializando MLflow: {e}")
             self.mlflow_available = False
+            return
+        
+        if self.asincrono:
+            # El experimento se crea en el hilo escritor: construir el integrador no hace I/O de red
+            self.cola = obtener_cola(
+                f"{self.tracking_uri}|{experiment_name}",
+                self._escribir_evento,
+                getattr(settings, 'MLFLOW_COLA_MAX_EVENTOS', 1000),
+                getattr(settings, 'MLFLOW_SPOOL_DIR', os.path.join(settings.BASE_DIR, 'mlflow_spool')),
+            )
+            return
+        
+        try:
+            self._obtener_experimento(MlflowClient(tracking_uri=self.tracking_uri))
+        except Exception as e:
+            logger.warning(f"⚠️ Error configurando experimento MLflow: {e}")
+            self.mlflow_available = False
+    
+    def _obtener_experimento(self, client) -> str:
+        """Crear u obtener el experimento (una vez por integrador)."""
+        if self._experiment_id is None:
+            experiment = client.get_experiment_by_name(self.experiment_name)
+            if experiment is None:
+                self._experiment_id = client.create_experiment(self.experiment_name)
+                logger.info(f"✅ Experimento creado: {self.experiment_name} (ID: {self._experiment_id})")
+            else:
+                self._experiment_id = experiment.experiment_id
+                logger.info(f"✅ Experimento encontrado: {self.experiment_name} (ID: {self._experiment_id})")
+        return self._experiment_id
     
     def log_model_training(
         self,
@@ -79,73 +110,50 @@ class MLflowIntegrator:
         Registra el entrenamiento de un modelo en MLflow
         
         Returns:
-            run_id del experimento o None si MLflow no está disponible
+            run_id del experimento, o None si MLflow no está disponible o el registro es asíncrono
         """
         if not self.mlflow_available:
             return None
         
         try:
-            mlflow.set_experiment(self.experiment_name)
+            prophet_metrics = resultados_entrenamiento.get('prophet') or {}
+            xgboost_metrics = resultados_entrenamiento.get('xgboost') or {}
+            evento = {
+                'run_name': f"entrenamiento_{modelo_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}",
+                'params': {
+                    'modelo_id': modelo_id,
+                    'nit_empresa': nit_empresa,
+                    'fecha_entrenamiento': modelo_data.get('fecha_entrenamiento', ''),
+                    'filas_entrenamiento': modelo_data.get('filas_entrenamiento', 0),
+                    'total_articulos': modelo_data.get('metadata', {}).get('total_articulos', 0),
+                },
+                'metricas': {
+                    'prophet_datos_entrenamiento': prophet_metrics.get('datos_entrenamiento', 0),
+                    'xgboost_mae': xgboost_metrics.get('mae', 0),
+                    'xgboost_r2': xgboost_metrics.get('r2_score', 0),
+                    'xgboost_rmse': xgboost_metrics.get('rmse', 0),
+                },
+                'dicts': {},
+                'tablas': {},
+            }
             
-            with mlflow.start_run(run_name=f"entrenamiento_{modelo_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"):
-                # Log parámetros
-                mlflow.log_param("modelo_id", modelo_id)
-                mlflow.log_param("nit_empresa", nit_empresa)
-                mlflow.log_param("fecha_entrenamiento", modelo_data.get('fecha_entrenamiento', ''))
-                mlflow.log_param("filas_entrenamiento", modelo_data.get('filas_entrenamiento', 0))
-                mlflow.log_param("total_articulos", modelo_data.get('metadata', {}).get('total_articulos', 0))
-                
-                # Log métricas de Prophet
-                if 'prophet' in resultados_entrenamiento:
-                    prophet_metrics = resultados_entrenamiento['prophet']
-                    mlflow.log_metric("prophet_datos_entrenamiento", prophet_metrics.get('datos_entrenamiento', 0))
-                
-                # Log métricas de XGBoost
-                if 'xgboost' in resultados_entrenamiento:
-                    xgboost_metrics = resultados_entrenamiento['xgboost']
-                    mlflow.log_metric("xgboost_mae", xgboost_metrics.get('mae', 0))
-                    mlflow.log_metric("xgboost_r2", xgboost_metrics.get('r2_score', 0))
-                    mlflow.log_metric("xgboost_rmse", xgboost_metrics.get('rmse', 0))
-                
-                # Log modelos
-                if 'prophet_model' in modelo_data and modelo_data['prophet_model'] is not None:
-                    try:
-                        # Prophet no es directamente compatible con mlflow, guardamos metadata
-                        mlflow.log_dict({
-                            'prophet_trained': True,
-                            'prophet_info': modelo_data.get('resultados_entrenamiento', {}).get('prophet', {})
-                        }, "prophet_model_info.json")
-                    except Exception as e:
-                        logger.warning(f"⚠️ Error logueando Prophet: {e}")
-                
-                if 'xgboost_predictor_completo' in modelo_data:
-                    try:
-                        xgboost_predictor = modelo_data['xgboost_predictor_completo']
-                        if hasattr(xgboost_predictor, 'model') and xgboost_predictor.model is not None:
-                            mlflow.xgboost.log_model(
-                                xgboost_predictor.model,
-                                "xgboost_model",
-                                registered_model_name=f"xgboost_{nit_empresa}"
-                            )
-                    except Exception as e:
-                        logger.warning(f"⚠️ Error logueando XGBoost: {e}")
-                
-                # Log dataset de entrenamiento (sample)
-                if df_entrenamiento is not None and not df_entrenamiento.empty:
-                    try:
-                        sample_df = df_entrenamiento.head(1000)  # Sample para no sobrecargar
-                        # Guardar como artefacto CSV
-                        import tempfile
-                        with tempfile.NamedTemporaryFile(mode='w', suffix='.csv', delete=False) as tmp:
-                            sample_df.to_csv(tmp.name, index=False)
-                            mlflow.log_artifact(tmp.name, "training_data_sample.csv")
-                            os.unlink(tmp.name)  # Limpiar archivo temporal
-                    except Exception as e:
-                        logger.warning(f"⚠️ Error logueando dataset: {e}")
-                
-                run_id = mlflow.active_run().info.run_id
-                logger.info(f"✅ Modelo registrado en MLflow - Run ID: {run_id}")
-                return run_id
+            if modelo_data.get('prophet_model') is not None:
+                # Prophet no es directamente compatible con mlflow, guardamos metadata
+                evento['dicts']['prophet_model_info.json'] = {
+                    'prophet_trained': True,
+                    'prophet_info': prophet_metrics
+                }
+            
+            xgboost_predictor = modelo_data.get('xgboost_predictor_completo')
+            if getattr(xgboost_predictor, 'model', None) is not None:
+                evento['modelo_xgboost'] = xgboost_predictor.model
+                evento['registered_model_name'] = f"xgboost_{nit_empresa}"
+            
+            # Dataset de entrenamiento (sample para no sobrecargar)
+            if df_entrenamiento is not None and not df_entrenamiento.empty:
+                evento['tablas']['training_data_sample.csv'] = _registros(df_entrenamiento.head(self.max_filas))
+            
+            return self._registrar(evento)
                 
         except Exception as e:
             logger.error(f"❌ Error registrando modelo en MLflow: {e}")
@@ -160,7 +168,8 @@ class MLflowIntegrator:
         metadata: Dict[str, Any]
     ) -> Optional[str]:
         """
-        Registra una predicción en MLflow para visualización
+        Registra una predicción en MLflow para visualización. Solo se registra una
+        fracción MLFLOW_MUESTREO_PREDICCIONES de las predicciones.
         
         Args:
             modelo_id: ID del modelo usado
@@ -170,69 +179,105 @@ class MLflowIntegrator:
             metadata: Metadata adicional (meses, predictor usado, etc.)
         
         Returns:
-            run_id del experimento o None
+            run_id del experimento, o None (MLflow no disponible, no muestreada o asíncrono)
         """
         if not self.mlflow_available:
             return None
+        if self.muestreo_predicciones < 1.0 and random.random() >= self.muestreo_predicciones:
+            return None
         
         try:
-            mlflow.set_experiment(self.experiment_name)
-            
-            run_name = f"prediccion_{tipo_prediccion}_{nit_empresa}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            evento = {
+                'run_name': f"prediccion_{tipo_prediccion}_{nit_empresa}_{datetime.now().strftime('%Y%m%d_%H%M%S')}",
+                'params': {
+                    'modelo_id': modelo_id,
+                    'nit_empresa': nit_empresa,
+                    'tipo_prediccion': tipo_prediccion,
+                    'predictor_principal': metadata.get('predictor_principal', 'unknown'),
+                    'meses_proyeccion': metadata.get('meses', 6),
+                    'total_predicciones': len(predicciones),
+                },
+                'metricas': {},
+                'dicts': {'prediction_metadata.json': json.loads(json.dumps(metadata, default=str))},
+                'tablas': {},
+            }
             
-            with mlflow.start_run(run_name=run_name):
-                # Log parámetros
-                mlflow.log_param("modelo_id", modelo_id)
-                mlflow.log_param("nit_empresa", nit_empresa)
-                mlflow.log_param("tipo_prediccion", tipo_prediccion)
-                mlflow.log_param("predictor_principal", metadata.get('predictor_principal', 'unknown'))
-                mlflow.log_param("meses_proyeccion", metadata.get('meses', 6))
-                mlflow.log_param("total_predicciones", len(predicciones))
+            # Métricas agregadas
+            metricas = evento['metricas']
+            if predicciones:
+                if tipo_prediccion == 'demanda':
+                    demandas = [p.get('prediccion', 0) for p in predicciones if isinstance(p, dict)]
+                    if demandas:
+                        metricas['demanda_total_predicha'] = sum(demandas)
+                        metricas['demanda_promedio'] = sum(demandas) / len(demandas)
+                        metricas['demanda_maxima'] = max(demandas)
+                        metricas['demanda_minima'] = min(demandas)
                 
-                # Log métricas agregadas
-                if predicciones:
-                    if tipo_prediccion == 'demanda':
-                        demandas = [p.get('prediccion', 0) for p in predicciones if isinstance(p, dict)]
-                        if demandas:
-                            mlflow.log_metric("demanda_total_predicha", sum(demandas))
-                            mlflow.log_metric("demanda_promedio", sum(demandas) / len(demandas))
-                            mlflow.log_metric("demanda_maxima", max(demandas))
-                            mlflow.log_metric("demanda_minima", min(demandas))
-                    
-                    elif tipo_prediccion == 'recomendaciones':
-                        cantidades = [r.get('cantidad_recomendada', 0) for r in predicciones if isinstance(r, dict)]
-                        inversiones = [r.get('inversion_estimada', 0) for r in predicciones if isinstance(r, dict)]
-                        if cantidades:
-                            mlflow.log_metric("total_articulos_recomendados", len(predicciones))
-                            mlflow.log_metric("cantidad_total_recomendada", sum(cantidades))
-                        if inversiones:
-                            mlflow.log_metric("inversion_total_estimada", sum(inversiones))
+                elif tipo_prediccion == 'recomendaciones':
+                    cantidades = [r.get('cantidad_recomendada', 0) for r in predicciones if isinstance(r, dict)]
+                    inversiones = [r.get('inversion_estimada', 0) for r in predicciones if isinstance(r, dict)]
+                    if cantidades:
+                        metricas['total_articulos_recomendados'] = len(predicciones)
+                        metricas['cantidad_total_recomendada'] = sum(cantidades)
+                    if inversiones:
+                        metricas['inversion_total_estimada'] = sum(inversiones)
                 
-                # Log predicciones como tabla
-                try:
-                    if predicciones:
-                        df_predicciones = pd.DataFrame(predicciones)
-                        # Guardar como artefacto CSV
-                        import tempfile
-                        with tempfile.NamedTemporaryFile(mode='w', suffix='.csv', delete=False) as tmp:
-                            df_predicciones.to_csv(tmp.name, index=False)
-                            mlflow.log_artifact(tmp.name, f"{tipo_prediccion}_results.csv")
-                            os.unlink(tmp.name)  # Limpiar archivo temporal
-                except Exception as e:
-                    logger.warning(f"⚠️ Error logueando tabla de predicciones: {e}")
-                
-                # Log metadata completa
-                mlflow.log_dict(metadata, "prediction_metadata.json")
-                
-                run_id = mlflow.active_run().info.run_id
-                logger.info(f"✅ Predicción registrada en MLflow - Run ID: {run_id}")
-                logger.info(f"📊 Ver en MLflow UI: {self.tracking_uri}/#/experiments/0/runs/{run_id}")
-                return run_id
+                # Predicciones como tabla (primeras MLFLOW_MAX_FILAS_ARTEFACTO)
+                evento['tablas'][f"{tipo_prediccion}_results.csv"] = _registros(
+                    pd.DataFrame(predicciones[:self.max_filas])
+                )
+            
+            return self._registrar(evento)
                 
         except Exception as e:
             logger.error(f"❌ Error registrando predicción en MLflow: {e}")
             return None
     
+    def _registrar(self, evento: Dict[str, Any]) -> Optional[str]:
+        if self.cola is not None:
+            self.cola.encolar(evento)
+            return None
+        return self._escribir_evento(evento)
+    
+    def _escribir_evento(self, evento: Dict[str, Any]) -> str:
+        """Escribe un evento como un run: una llamada log_batch para parámetros y métricas."""
+        from mlflow.entities import Metric, Param, RunTag
+        
+        client = MlflowClient(tracking_uri=self.tracking_uri)
+        marca = int(evento.get('creado', time.time()) * 1000)
+        run = client.create_run(self._obtener_experimento(client), start_time=marca, run_name=evento['run_name'])
+        run_id = run.info.run_id
+        try:
+            client.log_batch(
+                run_id,
+                metrics=[Metric(k, float(v), marca, 0) for k, v in evento.get('metricas', {}).items()],
+                params=[Param(k, str(v)) for k, v in evento.get('params', {}).items()],
+                tags=[RunTag('evento_id', evento['evento_id'])] if evento.get('evento_id') else [],
+            )
+            for nombre, contenido in evento.get('dicts', {}).items():
+                client.log_dict(run_id, contenido, nombre)
+            for nombre, filas in evento.get('tablas', {}).items():
+                client.log_text(run_id, pd.DataFrame(filas).to_csv(index=False), nombre)
+            
+            modelo = evento.get('modelo_xgboost')
+            if modelo is not None:
+                try:
+                    # log_model usa el run activo (por hilo): se reanuda el run recién creado
+                    with mlflow.start_run(run_id=run_id):
+                        mlflow.xgboost.log_model(
+                            modelo, "xgboost_model", registered_model_name=evento.get('registered_model_name')
+                        )
+                except Exception as e:
+                    logger.warning(f"⚠️ Error logueando XGBoost: {e}")
+            client.set_terminated(run_id)
+        except Exception:
+            client.set_terminated(run_id, status='FAILED')
+            raise
+        
+        logger.info(f"✅ {evento['run_name']} registrado en MLflow - Run ID: {run_id}")
+        logger.info(f"📊 Ver en MLflow UI: {self.tracking_uri}/#/experiments/{self._experiment_id}/runs/{run_id}")
+        return run_id
+    
     def get_experiment_runs(self, nit_empresa: Optional[str] = None, limit: int = 100):
         """
         Obtiene los runs del experimento (para consultas desde el frontend)
@@ -280,3 +325,7 @@ class MLflowIntegrator:
             logger.error(f"❌ Error obteniendo runs de MLflow: {e}")
             return None
 
+
+def _registros(df: pd.DataFrame) -> List[Dict[str, Any]]:
+    """Copia JSON-serializable de las filas (el evento no debe compartir el DataFrame del llamador)."""
+    return json.loads(df.to_json(orient='records', date_format='iso', default_handler=str))
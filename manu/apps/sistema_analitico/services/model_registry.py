@@ -0,0 +1,170 @@
+"""
+Registro de modelos ML compartido por todo el proceso.
+
+Sustituye la carga de todos los modelos de modelos_ml/ en cada MLEngine():
+cada modelo (empresa_{nit}) se carga la primera vez que se usa y queda en una
+caché LRU acotada por número de modelos y por tamaño en disco. Antes de
+entregar un modelo se compara la firma de su manifest (ver model_store); si
+cambió (otro worker re-entrenó) se vuelve a cargar.
+
+Los objetos entregados se comparten entre peticiones sin copiarse: quien los
+use debe tratarlos como inmutables (predecir, no re-entrenar sobre ellos).
+"""
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+from .model_store import ModelArtifactStore
+
+logger = logging.getLogger(__name__)
+
+
+class _Entrada:
+    __slots__ = ('modelo_data', 'firma', 'tamano')
+
+    def __init__(self, modelo_data, firma: Tuple[int, int, int], tamano: int):
+        self.modelo_data = modelo_data
+        self.firma = firma
+        self.tamano = tamano
+
+
+class ModelRegistry:
+    """Caché LRU thread-safe de modelos entrenados, indexada por modelo_id."""
+
+    def __init__(self, models_dir: str, max_modelos: int, max_bytes: int):
+        self.models_dir = models_dir
+        self.store = ModelArtifactStore(models_dir)
+        self.max_modelos = max(1, max_modelos)
+        self.max_bytes = max_bytes
+        self._entradas: 'OrderedDict[str, _Entrada]' = OrderedDict()
+        self._lock = threading.Lock()
+        # Un lock por modelo: dos peticiones del mismo NIT no cargan el archivo dos veces
+        self._locks_carga: Dict[str, threading.Lock] = {}
+        self.aciertos = 0
+        self.cargas = 0
+        self.expulsiones = 0
+
+    # ---------------------------------------------------------------- lectura
+    def obtener(self, modelo_id: str, cachear: bool = True) -> Optional[Dict[str, Any]]:
+        """Retorna modelo_data (compartido) o None si no existe en disco o no se pudo cargar."""
+        firma = self.store.firma(modelo_id)
+        if firma is None:
+            self.descartar(modelo_id)
+            return None
+
+        entrada = self._vigente(modelo_id, firma)
+        if entrada is not None:
+            return entrada.modelo_data
+
+        with self._lock_carga(modelo_id):
+            # Otro hilo pudo cargarlo mientras esperábamos
+            entrada = self._vigente(modelo_id, firma)
+            if entrada is not None:
+                return entrada.modelo_data
+            try:
+                cargado = self.store.cargar(modelo_id)
+            except Exception as e:
+                logger.error(f"❌ Error cargando modelo {modelo_id}: {e}")
+                return None
+            if cargado is None:
+                return None
+            modelo_data, tamano = cargado
+            self.cargas += 1
+            logger.info(f"✅ Modelo cargado en registro: {modelo_id} ({tamano / 1e6:.1f} MB)")
+            if cachear:
+                self._guardar(modelo_id, _Entrada(modelo_data, firma, tamano))
+            return modelo_data
+
+    def _vigente(self, modelo_id: str, firma: Tuple[int, int, int]) -> Optional[_Entrada]:
+        with self._lock:
+            entrada = self._entradas.get(modelo_id)
+            if entrada is None:
+                return None
+            if entrada.firma != firma:
+                logger.info(f"🔄 Modelo {modelo_id} cambió en disco, se recarga")
+                del self._entradas[modelo_id]
+                return None
+            self._entradas.move_to_end(modelo_id)
+            self.aciertos += 1
+            return entrada
+
+    def _lock_carga(self, modelo_id: str) -> threading.Lock:
+        with self._lock:
+            return self._locks_carga.setdefault(modelo_id, threading.Lock())
+
+    # ---------------------------------------------------------------- escritura
+    def publicar(self, modelo_id: str, modelo_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Guarda una nueva versión en el almacén y la registra sin volver a leerla."""
+        with self._lock_carga(modelo_id):
+            manifest = self.store.guardar(modelo_id, modelo_data)
+            firma = self.store.firma(modelo_id)
+            self._guardar(modelo_id, _Entrada(modelo_data, firma, manifest['bytes']))
+        return manifest
+
+    def manifest(self, modelo_id: str) -> Optional[Dict[str, Any]]:
+        """Metadatos del modelo sin deserializarlo (None para modelos .joblib antiguos)."""
+        return self.store.leer_manifest(modelo_id)
+
+    def descartar(self, modelo_id: str):
+        with self._lock:
+            self._entradas.pop(modelo_id, None)
+
+    def limpiar(self):
+        with self._lock:
+            self._entradas.clear()
+
+    def _guardar(self, modelo_id: str, entrada: _Entrada):
+        with self._lock:
+            self._entradas[modelo_id] = entrada
+            self._entradas.move_to_end(modelo_id)
+            # Expulsar los menos usados recientemente; el recién guardado nunca se expulsa
+            while len(self._entradas) > 1 and (
+                len(self._entradas) > self.max_modelos or self._bytes_en_memoria() > self.max_bytes
+            ):
+                expulsado, _ = self._entradas.popitem(last=False)
+                self.expulsiones += 1
+                logger.info(f"♻️ Modelo expulsado del registro (LRU): {expulsado}")
+
+    def _bytes_en_memoria(self) -> int:
+        # El tamaño de los artefactos en disco es la aproximación disponible del peso en memoria
+        return sum(entrada.tamano for entrada in self._entradas.values())
+
+    # ------------------------------------------------------------ operación
+    def modelos_en_memoria(self) -> List[str]:
+        with self._lock:
+            return list(self._entradas)
+
+    def estadisticas(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'modelos_en_memoria': list(self._entradas),
+                'bytes_en_memoria': self._bytes_en_memoria(),
+                'max_modelos': self.max_modelos,
+                'max_bytes': self.max_bytes,
+                'aciertos': self.aciertos,
+                'cargas': self.cargas,
+                'expulsiones': self.expulsiones,
+            }
+
+
+_registros: Dict[str, ModelRegistry] = {}
+_registros_lock = threading.Lock()
+
+
+def get_model_registry(models_dir: Optional[str] = None) -> ModelRegistry:
+    """Registro del proceso para un directorio de modelos (por defecto BASE_DIR/modelos_ml)."""
+    models_dir = models_dir or os.path.join(settings.BASE_DIR, 'modelos_ml')
+    with _registros_lock:
+        registro = _registros.get(models_dir)
+        if registro is None:
+            registro = ModelRegistry(
+                models_dir,
+                max_modelos=getattr(settings, 'ML_REGISTRY_MAX_MODELOS', 20),
+                max_bytes=getattr(settings, 'ML_REGISTRY_MAX_MB', 512) * 1024 * 1024,
+            )
+            _registros[models_dir] = registro
+        return registro
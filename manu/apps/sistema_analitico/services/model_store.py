@@ -0,0 +1,303 @@
+"""
+Almacén versionado de artefactos de modelos ML.
+
+Reemplaza el pickle único empresa_{nit}.joblib por un directorio por modelo:
+
+    modelos_ml/empresa_{nit}/
+        manifest.json            ← metadatos + versión + hash de cada archivo
+        <version>/xgboost.ubj    ← booster en formato nativo UBJ de XGBoost
+        <version>/scaler.npy     ← media/escala/varianza del StandardScaler (mmap)
+        <version>/prophet.json   ← serialización nativa de Prophet
+        <version>/articulos_*.npy← pronósticos por artículo (mmap)
+
+La versión es el hash del contenido. Se escribe primero el directorio de la
+versión (en un temporal que se renombra) y al final se reemplaza manifest.json
+con os.replace: un worker que lea el manifest siempre encuentra una versión
+completa. Los metadatos (estado, listados) se leen solo del manifest, sin
+deserializar los modelos.
+
+Los modelos antiguos en .joblib se siguen leyendo; se eliminan al guardar la
+primera versión en el formato nuevo.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+import joblib
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+FORMATO = 1
+MANIFEST = 'manifest.json'
+# Claves de modelo_data que se guardan como archivos; el resto va al manifest
+COMPONENTES = ('xgboost_predictor_completo', 'prophet_model', 'prophet_articulos')
+ARREGLOS_ARTICULOS = ('codigos', 'metodos', 'huellas', 'pred', 'minimo', 'maximo')
+
+
+def _json_seguro(valor):
+    if hasattr(valor, 'item') and getattr(valor, 'ndim', 0) == 0:
+        return valor.item()
+    if hasattr(valor, 'tolist'):
+        return valor.tolist()
+    if hasattr(valor, 'isoformat'):
+        return valor.isoformat()
+    return str(valor)
+
+
+def _sha256(ruta: str) -> str:
+    h = hashlib.sha256()
+    with open(ruta, 'rb') as f:
+        for bloque in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(bloque)
+    return h.hexdigest()
+
+
+class ModelArtifactStore:
+    """Lectura y escritura atómica de modelos empresa_{nit} en un directorio."""
+
+    def __init__(self, models_dir: str):
+        self.models_dir = models_dir
+
+    # ------------------------------------------------------------------ rutas
+    def ruta_modelo(self, modelo_id: str) -> str:
+        return os.path.join(self.models_dir, modelo_id)
+
+    def ruta_manifest(self, modelo_id: str) -> str:
+        return os.path.join(self.ruta_modelo(modelo_id), MANIFEST)
+
+    def ruta_legacy(self, modelo_id: str) -> str:
+        return os.path.join(self.models_dir, f"{modelo_id}.joblib")
+
+    def firma(self, modelo_id: str) -> Optional[Tuple[int, int, int]]:
+        """(mtime_ns, tamaño, inodo) del manifest (o del .joblib antiguo); None si no existe."""
+        for ruta in (self.ruta_manifest(modelo_id), self.ruta_legacy(modelo_id)):
+            try:
+                stat = os.stat(ruta)
+            except FileNotFoundError:
+                continue
+            return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        return None
+
+    def listar(self) -> List[str]:
+        if not os.path.isdir(self.models_dir):
+            return []
+        modelos = set()
+        for nombre in os.listdir(self.models_dir):
+            if nombre.endswith('.joblib'):
+                modelos.add(nombre[:-len('.joblib')])
+            elif os.path.isfile(os.path.join(self.models_dir, nombre, MANIFEST)):
+                modelos.add(nombre)
+        return sorted(modelos)
+
+    # ---------------------------------------------------------------- lectura
+    def leer_manifest(self, modelo_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.ruta_manifest(modelo_id), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def cargar(self, modelo_id: str) -> Optional[Tuple[Dict[str, Any], int]]:
+        """Retorna (modelo_data, bytes en disco) o None si el modelo no existe."""
+        manifest = self.leer_manifest(modelo_id)
+        if manifest is None:
+            ruta = self.ruta_legacy(modelo_id)
+            if not os.path.exists(ruta):
+                return None
+            return joblib.load(ruta), os.path.getsize(ruta)
+
+        if manifest.get('formato') != FORMATO:
+            raise ValueError(f"Formato de modelo no soportado: {manifest.get('formato')}")
+
+        directorio = os.path.join(self.ruta_modelo(modelo_id), manifest['version'])
+        componentes = manifest['componentes']
+        modelo_data = dict(manifest['datos'])
+        modelo_data['version_artefacto'] = manifest['version']
+        modelo_data['xgboost_predictor_completo'] = self._cargar_xgboost(directorio, componentes.get('xgboost'))
+        modelo_data['prophet_model'] = self._cargar_prophet(directorio, componentes.get('prophet'))
+        modelo_data['prophet_articulos'] = self._cargar_articulos(directorio, componentes.get('prophet_articulos'))
+        return modelo_data, manifest['bytes']
+
+    def _cargar_xgboost(self, directorio: str, info: Optional[Dict[str, Any]]):
+        from sklearn.preprocessing import LabelEncoder, StandardScaler
+        from xgboost import XGBRegressor
+        from .xgboost_predictor import XGBoostPredictor
+
+        predictor = XGBoostPredictor()
+        if not info:
+            return predictor
+
+        predictor.model = XGBRegressor()
+        predictor.model.load_model(os.path.join(directorio, info['archivo']))
+        predictor.feature_names_ = list(info['feature_names'])
+        for feature, clases in info['label_encoders'].items():
+            encoder = LabelEncoder()
+            encoder.classes_ = np.array(clases)
+            predictor.label_encoders[feature] = encoder
+
+        escalador = info.get('scaler')
+        if escalador:
+            media, escala, varianza = np.load(os.path.join(directorio, escalador['archivo']), mmap_mode='r')
+            scaler = StandardScaler()
+            scaler.mean_, scaler.scale_, scaler.var_ = media, escala, varianza
+            scaler.n_features_in_ = len(media)
+            scaler.n_samples_seen_ = escalador['n_samples_seen']
+            if escalador.get('feature_names_in'):
+                scaler.feature_names_in_ = np.array(escalador['feature_names_in'], dtype=object)
+            predictor.scaler = scaler
+        return predictor
+
+    def _cargar_prophet(self, directorio: str, info: Optional[Dict[str, Any]]):
+        if not info:
+            return None
+        from prophet.serialize import model_from_json
+        with open(os.path.join(directorio, info['archivo']), encoding='utf-8') as f:
+            return model_from_json(f.read())
+
+    def _cargar_articulos(self, directorio: str, info: Optional[Dict[str, Any]]):
+        if not info:
+            return None
+        estado = {clave: valor for clave, valor in info.items() if clave != 'arreglos'}
+        for nombre, archivo in info['arreglos'].items():
+            estado[nombre] = np.load(os.path.join(directorio, archivo), mmap_mode='r')
+        return estado
+
+    # ---------------------------------------------------------------- escritura
+    def guardar(self, modelo_id: str, modelo_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Escribe una nueva versión del modelo y la publica reemplazando el manifest."""
+        raiz = self.ruta_modelo(modelo_id)
+        os.makedirs(raiz, exist_ok=True)
+        temporal = os.path.join(raiz, f".tmp-{uuid.uuid4().hex}")
+        os.makedirs(temporal)
+        try:
+            componentes = {
+                'xgboost': self._guardar_xgboost(temporal, modelo_data.get('xgboost_predictor_completo')),
+                'prophet': self._guardar_prophet(temporal, modelo_data.get('prophet_model')),
+                'prophet_articulos': self._guardar_articulos(temporal, modelo_data.get('prophet_articulos')),
+            }
+            archivos = {
+                nombre: {'sha256': _sha256(os.path.join(temporal, nombre)),
+                         'bytes': os.path.getsize(os.path.join(temporal, nombre))}
+                for nombre in sorted(os.listdir(temporal))
+            }
+            version = hashlib.sha256(
+                json.dumps({nombre: info['sha256'] for nombre, info in archivos.items()}, sort_keys=True).encode()
+            ).hexdigest()[:16]
+
+            directorio = os.path.join(raiz, version)
+            if os.path.isdir(directorio):
+                # Mismo contenido ya publicado (re-entrenamiento sin cambios)
+                shutil.rmtree(temporal)
+            else:
+                try:
+                    os.rename(temporal, directorio)
+                except OSError:
+                    # Otro proceso publicó el mismo contenido entre la comprobación y el rename
+                    if not os.path.isdir(directorio):
+                        raise
+                    shutil.rmtree(temporal)
+        except Exception:
+            shutil.rmtree(temporal, ignore_errors=True)
+            raise
+
+        manifest = {
+            'formato': FORMATO,
+            'modelo_id': modelo_id,
+            'version': version,
+            'fecha_guardado': timezone.now().isoformat(),
+            'datos': json.loads(json.dumps(
+                {clave: valor for clave, valor in modelo_data.items()
+                 if clave not in COMPONENTES and clave != 'version_artefacto'},
+                default=_json_seguro
+            )),
+            'componentes': componentes,
+            'archivos': archivos,
+            'bytes': sum(info['bytes'] for info in archivos.values()),
+        }
+        self._escribir_atomico(self.ruta_manifest(modelo_id), json.dumps(manifest, ensure_ascii=False, indent=2))
+        modelo_data['version_artefacto'] = version
+
+        legacy = self.ruta_legacy(modelo_id)
+        if os.path.exists(legacy):
+            os.remove(legacy)
+        self._purgar_versiones(modelo_id, version)
+        logger.info(f"💾 Modelo {modelo_id} publicado: versión {version} ({manifest['bytes'] / 1e6:.1f} MB)")
+        return manifest
+
+    def _guardar_xgboost(self, directorio: str, predictor) -> Optional[Dict[str, Any]]:
+        if predictor is None or getattr(predictor, 'model', None) is None:
+            return None
+        predictor.model.save_model(os.path.join(directorio, 'xgboost.ubj'))
+        info = {
+            'archivo': 'xgboost.ubj',
+            'feature_names': list(predictor.feature_names_ or []),
+            'label_encoders': {
+                feature: encoder.classes_.tolist() for feature, encoder in predictor.label_encoders.items()
+            },
+            'scaler': None,
+        }
+        scaler = predictor.scaler
+        if hasattr(scaler, 'mean_'):
+            np.save(os.path.join(directorio, 'scaler.npy'),
+                    np.vstack([scaler.mean_, scaler.scale_, scaler.var_]).astype(float))
+            info['scaler'] = {
+                'archivo': 'scaler.npy',
+                'n_samples_seen': int(np.max(scaler.n_samples_seen_)),
+                'feature_names_in': [str(c) for c in getattr(scaler, 'feature_names_in_', [])],
+            }
+        return info
+
+    def _guardar_prophet(self, directorio: str, modelo) -> Optional[Dict[str, Any]]:
+        if modelo is None:
+            return None
+        from prophet.serialize import model_to_json
+        with open(os.path.join(directorio, 'prophet.json'), 'w', encoding='utf-8') as f:
+            f.write(model_to_json(modelo))
+        return {'archivo': 'prophet.json'}
+
+    def _guardar_articulos(self, directorio: str, estado: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        if not estado:
+            return None
+        info = {clave: valor for clave, valor in estado.items() if clave not in ARREGLOS_ARTICULOS}
+        info['arreglos'] = {}
+        for nombre in ARREGLOS_ARTICULOS:
+            arreglo = np.asarray(estado[nombre])
+            if arreglo.dtype == object:
+                arreglo = arreglo.astype(str)
+            archivo = f"articulos_{nombre}.npy"
+            np.save(os.path.join(directorio, archivo), arreglo, allow_pickle=False)
+            info['arreglos'][nombre] = archivo
+        return info
+
+    def _escribir_atomico(self, ruta: str, contenido: str):
+        temporal = f"{ruta}.tmp-{uuid.uuid4().hex}"
+        with open(temporal, 'w', encoding='utf-8') as f:
+            f.write(contenido)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporal, ruta)
+
+    def _purgar_versiones(self, modelo_id: str, vigente: str):
+        """Conserva la versión vigente y las más recientes (lectores en curso pueden usarlas)."""
+        conservar = getattr(settings, 'ML_STORE_VERSIONES', 3)
+        raiz = self.ruta_modelo(modelo_id)
+        versiones = [
+            nombre for nombre in os.listdir(raiz)
+            if nombre != vigente and not nombre.startswith('.') and os.path.isdir(os.path.join(raiz, nombre))
+        ]
+        versiones.sort(key=lambda nombre: os.path.getmtime(os.path.join(raiz, nombre)), reverse=True)
+        for nombre in versiones[max(conservar - 1, 0):]:
+            shutil.rmtree(os.path.join(raiz, nombre), ignore_errors=True)
+
+    def eliminar(self, modelo_id: str):
+        shutil.rmtree(self.ruta_modelo(modelo_id), ignore_errors=True)
+        legacy = self.ruta_legacy(modelo_id)
+        if os.path.exists(legacy):
+            os.remove(legacy)
@@ -0,0 +1,328 @@
+"""
+Caché columnar (Parquet) de MovimientoInventario por empresa y mes.
+
+Las consultas en lenguaje natural agregan millones de movimientos; en lugar de
+re-agregar la tabla movimientos_inventario vía ORM en cada petición, se guarda
+una copia columnar particionada como:
+
+    <MOVIMIENTOS_PARQUET_DIR>/empresa_<id>/<YYYY-MM>.parquet
+    <MOVIMIENTOS_PARQUET_DIR>/empresa_<id>/_manifest.json
+
+Las particiones se reconstruyen tras cada extracción/sincronización (tarea
+refrescar_cache_columnar) y se leen con memory-map, proyectando solo las
+columnas y filtrando el tipo de documento dentro de pyarrow. Mientras un mes
+está pendiente de refresco, leer() devuelve None y el llamador usa el ORM.
+El manifest lo modifican varios procesos (web y workers Celery), así que cada
+lectura-modificación-escritura se hace bajo un flock sobre _manifest.lock.
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, time as dt_time, timedelta
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+import pandas as pd
+from django.conf import settings
+from django.db.models import Max, Min
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+try:
+    import fcntl
+    HAS_FCNTL = True
+except ImportError:
+    HAS_FCNTL = False
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+    logger.warning("pyarrow no está instalado. Las consultas analíticas usarán el ORM.")
+
+MANIFEST = '_manifest.json'
+MANIFEST_LOCK = '_manifest.lock'
+
+# Columnas que usan los análisis históricos (el resto de MovimientoInventario no se copia)
+COLUMNAS = [
+    'fecha', 'tipo_documento', 'articulo_codigo', 'articulo_nombre', 'cantidad',
+    'precio_unitario', 'valor_total', 'tipo_bodega', 'ciudad', 'nit_pagador',
+]
+COLUMNAS_NUMERICAS = ['cantidad', 'precio_unitario', 'valor_total']
+
+
+def periodos_en_rango(fecha_inicio, fecha_fin) -> List[str]:
+    """Lista de periodos 'YYYY-MM' que cubre el rango (ambos extremos incluidos)."""
+    if isinstance(fecha_inicio, datetime):
+        fecha_inicio = fecha_inicio.date()
+    if isinstance(fecha_fin, datetime):
+        fecha_fin = fecha_fin.date()
+    periodos = []
+    anio, mes = fecha_inicio.year, fecha_inicio.month
+    while (anio, mes) <= (fecha_fin.year, fecha_fin.month):
+        periodos.append(f"{anio:04d}-{mes:02d}")
+        anio, mes = (anio + 1, 1) if mes == 12 else (anio, mes + 1)
+    return periodos
+
+
+def fin_de_rango(fecha_fin):
+    """
+    Extremo final inclusivo de un rango de fechas. Una fecha sin hora (o un
+    datetime a medianoche) cubre todo ese día; la caché y el ORM deben usar
+    este mismo valor para devolver las mismas filas.
+    """
+    if not isinstance(fecha_fin, datetime):
+        fecha_fin = datetime.combine(fecha_fin, dt_time())
+    if fecha_fin.time() == dt_time():
+        return fecha_fin + timedelta(days=1) - timedelta(microseconds=1)
+    return fecha_fin
+
+
+class MovimientosColumnarCache:
+    """Lectura/escritura de las particiones Parquet de movimientos."""
+
+    _lock = threading.Lock()
+
+    def __init__(self, base_dir: Optional[str] = None):
+        self.base_dir = Path(base_dir or getattr(
+            settings, 'MOVIMIENTOS_PARQUET_DIR', Path(settings.BASE_DIR) / 'data' / 'parquet_movimientos'
+        ))
+        self.objetivo_ms = getattr(settings, 'MOVIMIENTOS_PARQUET_OBJETIVO_MS', 500)
+
+    @property
+    def habilitado(self) -> bool:
+        return PYARROW_AVAILABLE and getattr(settings, 'MOVIMIENTOS_PARQUET_ENABLED', True)
+
+    # ---------------------------------------------------------------- manifest
+    def _dir_empresa(self, empresa_servidor_id: int) -> Path:
+        return self.base_dir / f"empresa_{empresa_servidor_id}"
+
+    @contextmanager
+    def _bloqueo_manifest(self, empresa_servidor_id: int):
+        """Serializa la lectura-modificación-escritura del manifest entre hilos y procesos."""
+        with self._lock:
+            directorio = self._dir_empresa(empresa_servidor_id)
+            directorio.mkdir(parents=True, exist_ok=True)
+            with open(directorio / MANIFEST_LOCK, 'a') as archivo_lock:
+                if HAS_FCNTL:
+                    fcntl.flock(archivo_lock.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if HAS_FCNTL:
+                        fcntl.flock(archivo_lock.fileno(), fcntl.LOCK_UN)
+
+    def _leer_manifest(self, empresa_servidor_id: int) -> Optional[Dict]:
+        ruta = self._dir_empresa(empresa_servidor_id) / MANIFEST
+        try:
+            with open(ruta, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _guardar_manifest(self, empresa_servidor_id: int, manifest: Dict):
+        manifest['actualizado'] = timezone.now().isoformat()
+        self._escribir_atomico(
+            self._dir_empresa(empresa_servidor_id) / MANIFEST,
+            lambda ruta: Path(ruta).write_text(json.dumps(manifest), encoding='utf-8'),
+        )
+
+    def _escribir_atomico(self, destino: Path, escribir):
+        destino.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=destino.parent, suffix='.tmp')
+        os.close(fd)
+        try:
+            escribir(tmp)
+            os.replace(tmp, destino)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    # ---------------------------------------------------------------- escritura
+    def invalidar(self, empresa_servidor_id: int, periodos: Optional[Iterable[str]] = None):
+        """
+        Marca periodos como pendientes (o toda la empresa si periodos es None) para
+        que las lecturas caigan al ORM hasta el próximo refresco.
+        """
+        if not (self._dir_empresa(empresa_servidor_id) / MANIFEST).exists():
+            return
+        with self._bloqueo_manifest(empresa_servidor_id):
+            manifest = self._leer_manifest(empresa_servidor_id)
+            if manifest is None:
+                return
+            if periodos is None:
+                manifest['completo'] = False
+            else:
+                manifest['pendientes'] = sorted(set(manifest.get('pendientes', [])) | set(periodos))
+            self._guardar_manifest(empresa_servidor_id, manifest)
+
+    def refrescar_empresa(self, empresa_servidor_id: int, periodos: Optional[Iterable[str]] = None) -> Dict:
+        """
+        Reconstruye las particiones de los periodos indicados desde la base de datos.
+        Sin manifest previo (o con periodos=None) reconstruye la empresa completa.
+        """
+        from ..models import MovimientoInventario
+
+        if not PYARROW_AVAILABLE:
+            return {'estado': 'omitido', 'mensaje': 'pyarrow no está instalado'}
+
+        inicio = time.monotonic()
+        manifest = self._leer_manifest(empresa_servidor_id)
+        pendientes_iniciales = set((manifest or {}).get('pendientes', []))
+        completo = periodos is None or manifest is None or not manifest.get('completo')
+        movimientos = MovimientoInventario.objects.filter(empresa_servidor_id=empresa_servidor_id)
+
+        if completo:
+            rango = movimientos.aggregate(min_fecha=Min('fecha'), max_fecha=Max('fecha'))
+            periodos = []
+            if rango['min_fecha']:
+                periodos = periodos_en_rango(
+                    timezone.localtime(rango['min_fecha']), timezone.localtime(rango['max_fecha'])
+                )
+            # Las particiones viejas fuera del rango actual se eliminan
+            directorio = self._dir_empresa(empresa_servidor_id)
+            if directorio.exists():
+                for archivo in directorio.glob('*.parquet'):
+                    if archivo.stem not in periodos:
+                        archivo.unlink()
+            manifest = {'periodos': {}, 'pendientes': []}
+
+        filas_total = 0
+        for periodo in sorted(set(periodos)):
+            filas = self._escribir_periodo(empresa_servidor_id, periodo, movimientos)
+            filas_total += filas
+            if filas:
+                manifest['periodos'][periodo] = filas
+            else:
+                manifest['periodos'].pop(periodo, None)
+
+        with self._bloqueo_manifest(empresa_servidor_id):
+            actual = self._leer_manifest(empresa_servidor_id) or manifest
+            # Invalidaciones que llegaron durante el refresco siguen pendientes
+            pendientes_nuevas = set(actual.get('pendientes', [])) - pendientes_iniciales
+            restantes = set() if completo else pendientes_iniciales - set(periodos)
+            manifest['pendientes'] = sorted(restantes | pendientes_nuevas)
+            manifest['completo'] = True
+            self._guardar_manifest(empresa_servidor_id, manifest)
+
+        segundos = round(time.monotonic() - inicio, 2)
+        logger.info(
+            f"🧊 Caché columnar empresa {empresa_servidor_id}: {len(set(periodos))} periodo(s), "
+            f"{filas_total} filas en {segundos}s"
+        )
+        return {'estado': 'exito', 'periodos': len(set(periodos)), 'filas': filas_total, 'segundos': segundos}
+
+    def _escribir_periodo(self, empresa_servidor_id: int, periodo: str, movimientos) -> int:
+        anio, mes = (int(parte) for parte in periodo.split('-'))
+        desde = timezone.make_aware(datetime(anio, mes, 1))
+        hasta = timezone.make_aware(datetime(anio + 1, 1, 1) if mes == 12 else datetime(anio, mes + 1, 1))
+        filas = movimientos.filter(fecha__gte=desde, fecha__lt=hasta).values_list(*COLUMNAS)
+
+        df = pd.DataFrame.from_records(filas.iterator(chunk_size=20000), columns=COLUMNAS)
+        destino = self._dir_empresa(empresa_servidor_id) / f"{periodo}.parquet"
+        if df.empty:
+            if destino.exists():
+                destino.unlink()
+            return 0
+
+        # Fechas en hora local sin zona (igual que los filtros de las consultas)
+        df['fecha'] = pd.to_datetime(df['fecha'], utc=True).dt.tz_convert(
+            timezone.get_current_timezone_name()
+        ).dt.tz_localize(None)
+        for columna in COLUMNAS_NUMERICAS:
+            df[columna] = pd.to_numeric(df[columna], errors='coerce').astype('float64')
+        for columna in ('tipo_documento', 'tipo_bodega', 'ciudad'):
+            df[columna] = df[columna].astype('category')
+        df = df.sort_values('fecha', kind='stable')
+
+        tabla = pa.Table.from_pandas(df, preserve_index=False)
+        self._escribir_atomico(destino, lambda ruta: pq.write_table(tabla, ruta, compression='zstd'))
+        return len(df)
+
+    # ------------------------------------------------------------------ lectura
+    def leer(self, empresas_ids: Iterable[int], fecha_inicio=None, fecha_fin=None,
+             tipo_documento: Optional[str] = None, columnas: Optional[List[str]] = None) -> Optional[pd.DataFrame]:
+        """
+        Lee los movimientos de las empresas en el rango como DataFrame.
+
+        Retorna None si la caché no está disponible o algún periodo requerido está
+        pendiente, para que el llamador use el ORM.
+        """
+        if not self.habilitado:
+            return None
+
+        inicio = time.monotonic()
+        columnas = list(dict.fromkeys(['fecha'] + (columnas or COLUMNAS)))
+        filtros = [('tipo_documento', '=', tipo_documento)] if tipo_documento else None
+        tablas = []
+
+        for empresa_id in empresas_ids:
+            manifest = self._leer_manifest(empresa_id)
+            if not manifest or not manifest.get('completo'):
+                return None
+            periodos = list(manifest.get('periodos', {}))
+            if fecha_inicio is not None or fecha_fin is not None:
+                requeridos = set(periodos_en_rango(
+                    fecha_inicio or date(1900, 1, 1), fecha_fin or timezone.localtime().date()
+                ))
+                if requeridos & set(manifest.get('pendientes', [])):
+                    return None
+                periodos = [p for p in periodos if p in requeridos]
+            elif manifest.get('pendientes'):
+                return None
+
+            for periodo in periodos:
+                ruta = self._dir_empresa(empresa_id) / f"{periodo}.parquet"
+                try:
+                    tablas.append(pq.read_table(ruta, columns=columnas, filters=filtros, memory_map=True))
+                except (FileNotFoundError, OSError) as e:
+                    logger.warning(f"Partición columnar ilegible {ruta}: {e}")
+                    return None
+
+        if tablas:
+            df = pa.concat_tables(tablas, promote_options='default').to_pandas()
+        else:
+            df = pd.DataFrame(columns=columnas)
+
+        if fecha_inicio is not None:
+            df = df[df['fecha'] >= pd.Timestamp(fecha_inicio)]
+        if fecha_fin is not None:
+            df = df[df['fecha'] <= pd.Timestamp(fin_de_rango(fecha_fin))]
+
+        duracion_ms = (time.monotonic() - inicio) * 1000
+        if duracion_ms > self.objetivo_ms:
+            logger.warning(
+                f"🐢 Escaneo columnar de {len(df)} filas tardó {duracion_ms:.0f} ms "
+                f"(objetivo {self.objetivo_ms} ms)"
+            )
+        else:
+            logger.debug(f"Escaneo columnar de {len(df)} filas en {duracion_ms:.0f} ms")
+        return df
+
+
+def agregar_por_articulo(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Agrega movimientos por (articulo_codigo, articulo_nombre) como lo hacen las
+    consultas ORM: suma de cantidad y valor, transacciones, precio promedio y última fecha.
+    """
+    agregaciones = {
+        'total_vendido': ('cantidad', 'sum'),
+        'valor_total': ('valor_total', 'sum'),
+        'transacciones': ('cantidad', 'size'),
+        'precio_promedio': ('precio_unitario', 'mean'),
+        'ultima_venta': ('fecha', 'max'),
+    }
+    agregaciones = {nombre: spec for nombre, spec in agregaciones.items() if spec[0] in df.columns}
+    agregado = df.groupby(['articulo_codigo', 'articulo_nombre'], sort=False, observed=True).agg(
+        **agregaciones
+    ).reset_index()
+    return agregado
+
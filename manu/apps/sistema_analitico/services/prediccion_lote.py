@@ -0,0 +1,73 @@
+"""
+Codificación en streaming de predicciones por lote (MLEngine.predecir_demanda_lote).
+
+Cada lote de artículos se serializa apenas se predice, de modo que la respuesta
+HTTP empieza a fluir sin esperar todos los artículos:
+  - jsonl: una línea JSON por (artículo, mes), application/x-ndjson
+  - arrow: stream IPC de Apache Arrow, un record batch por lote (requiere pyarrow)
+"""
+import io
+import logging
+from typing import Iterable, Iterator
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+try:
+    import pyarrow as pa
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+FORMATOS = {
+    'jsonl': 'application/x-ndjson',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+
+COLUMNAS = [
+    'articulo_codigo', 'articulo_nombre', 'fecha', 'prediccion_xgboost',
+    'prediccion_prophet', 'minimo', 'maximo', 'metodo',
+]
+
+
+def _normalizar(lote: pd.DataFrame) -> pd.DataFrame:
+    return lote.reindex(columns=COLUMNAS)
+
+
+def a_jsonl(lotes: Iterable[pd.DataFrame]) -> Iterator[bytes]:
+    for lote in lotes:
+        if lote.empty:
+            continue
+        # to_json(lines=True) ya termina cada registro con salto de línea
+        yield _normalizar(lote).to_json(orient='records', lines=True, force_ascii=False).encode('utf-8')
+
+
+def a_arrow(lotes: Iterable[pd.DataFrame]) -> Iterator[bytes]:
+    esquema = pa.schema([
+        ('articulo_codigo', pa.string()),
+        ('articulo_nombre', pa.string()),
+        ('fecha', pa.string()),
+        ('prediccion_xgboost', pa.float64()),
+        ('prediccion_prophet', pa.float64()),
+        ('minimo', pa.float64()),
+        ('maximo', pa.float64()),
+        ('metodo', pa.string()),
+    ])
+    buffer = io.BytesIO()
+    with pa.ipc.new_stream(buffer, esquema) as writer:
+        for lote in lotes:
+            writer.write_table(pa.Table.from_pandas(_normalizar(lote), schema=esquema, preserve_index=False))
+            # Entregar lo escrito y reutilizar el buffer para el siguiente lote
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def codificar(lotes: Iterable[pd.DataFrame], formato: str) -> Iterator[bytes]:
+    if formato == 'arrow':
+        if not PYARROW_AVAILABLE:
+            raise ValueError("El formato arrow requiere pyarrow instalado")
+        return a_arrow(lotes)
+    return a_jsonl(lotes)
@@ -0,0 +1,315 @@
+"""
+Pronóstico de demanda por artículo en lote.
+
+En lugar de un único Prophet sobre el agregado de todos los artículos:
+  - Se arma una matriz artículo × mes (una sola operación pivot).
+  - Los artículos con historia suficiente y demanda regular se ajustan con un
+    Prophet por artículo, repartidos en un pool de procesos (o de hilos si el
+    proceso actual es un worker daemon de Celery, que no puede tener hijos).
+  - Las series cortas o intermitentes usan un método barato vectorizado sobre
+    todos esos artículos a la vez: Croston (SBA) si la demanda es intermitente,
+    suavizamiento exponencial simple (ETS A,N,N) si la serie es corta.
+  - Cada artículo guarda la huella de sus datos; al re-entrenar, los artículos
+    cuya serie no cambió reutilizan el pronóstico anterior sin re-ajustar.
+
+Los pronósticos se guardan como matrices (artículos × horizonte) para que
+predecir() responda para todos los artículos con un solo slice vectorizado.
+"""
+import hashlib
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+FORMATO = 1
+ALFA_CROSTON = 0.1
+ALFA_ETS = 0.3
+Z_INTERVALO = 1.2816  # Intervalo 80%, igual que interval_width por defecto de Prophet
+ADI_INTERMITENTE = 1.32  # Umbral de Syntetos-Boylan para demanda intermitente
+
+
+def _ajustar_prophet(codigo: str, fechas: List[pd.Timestamp], valores: List[float],
+                     horizonte: int, frecuencia: str):
+    """Se ejecuta en un proceso/hilo del pool: ajusta y pronostica un artículo."""
+    logging.getLogger('cmdstanpy').setLevel(logging.WARNING)
+    from prophet import Prophet
+
+    df = pd.DataFrame({'ds': fechas, 'y': valores})
+    modelo = Prophet(
+        yearly_seasonality=len(df) >= 24,
+        weekly_seasonality=False,
+        daily_seasonality=False,
+        changepoint_prior_scale=0.05
+    )
+    modelo.fit(df)
+    futuro = modelo.make_future_dataframe(periods=horizonte, freq=frecuencia, include_history=False)
+    forecast = modelo.predict(futuro)
+    return (
+        codigo,
+        forecast['yhat'].to_numpy(dtype=float),
+        forecast['yhat_lower'].to_numpy(dtype=float),
+        forecast['yhat_upper'].to_numpy(dtype=float),
+    )
+
+
+def _croston(matriz: np.ndarray) -> np.ndarray:
+    """Croston-SBA vectorizado; NaN marca los meses antes del inicio de cada serie."""
+    nivel = np.full(matriz.shape[0], np.nan)
+    intervalo = np.full(matriz.shape[0], np.nan)
+    desde_ultima = np.ones(matriz.shape[0])
+    for t in range(matriz.shape[1]):
+        y = matriz[:, t]
+        activo = ~np.isnan(y)
+        demanda = activo & (y > 0)
+        nuevo = demanda & np.isnan(nivel)
+        actualizar = demanda & ~nuevo
+        nivel[nuevo] = y[nuevo]
+        intervalo[nuevo] = desde_ultima[nuevo]
+        nivel[actualizar] += ALFA_CROSTON * (y[actualizar] - nivel[actualizar])
+        intervalo[actualizar] += ALFA_CROSTON * (desde_ultima[actualizar] - intervalo[actualizar])
+        desde_ultima[demanda] = 1
+        desde_ultima[activo & ~demanda] += 1
+    pronostico = (1 - ALFA_CROSTON / 2) * nivel / intervalo
+    return np.nan_to_num(pronostico, nan=0.0)
+
+
+def _suavizamiento_simple(matriz: np.ndarray) -> np.ndarray:
+    """ETS(A,N,N) con alfa fijo, vectorizado: el pronóstico es el último nivel."""
+    nivel = np.full(matriz.shape[0], np.nan)
+    for t in range(matriz.shape[1]):
+        y = matriz[:, t]
+        activo = ~np.isnan(y)
+        inicial = activo & np.isnan(nivel)
+        nivel[inicial] = y[inicial]
+        seguir = activo & ~inicial
+        nivel[seguir] = ALFA_ETS * y[seguir] + (1 - ALFA_ETS) * nivel[seguir]
+    return np.nan_to_num(nivel, nan=0.0)
+
+
+class ProphetBatchForecaster:
+    """Entrena y sirve pronósticos mensuales por artículo para un NIT."""
+
+    def __init__(self, estado_previo: Optional[Dict[str, Any]] = None, frecuencia: str = 'ME'):
+        self.frecuencia = frecuencia
+        self.horizonte = getattr(settings, 'PROPHET_HORIZONTE_MESES', 24)
+        self.min_meses = getattr(settings, 'PROPHET_MIN_MESES', 12)
+        self.max_articulos = getattr(settings, 'PROPHET_MAX_ARTICULOS', 300)
+        self.max_workers = getattr(settings, 'PROPHET_MAX_WORKERS', None) or min(4, os.cpu_count() or 1)
+        self.estado_previo = estado_previo if (estado_previo or {}).get('formato') == FORMATO else None
+        self.estado: Optional[Dict[str, Any]] = None
+
+    # ------------------------------------------------------------ entrenamiento
+    def entrenar(self, df: pd.DataFrame, columna: str = 'cantidad') -> Dict[str, Any]:
+        """df: filas (articulo_codigo, fecha, cantidad). Retorna resumen del entrenamiento."""
+        inicio = time.monotonic()
+        matriz, codigos, meses = self._matriz(df, columna)
+        if matriz.size == 0:
+            self.estado = None
+            return {'articulos': 0}
+
+        # Recortar cada serie a partir de su primera demanda (NaN antes)
+        primera = np.argmax(matriz > 0, axis=1)
+        columnas = np.arange(matriz.shape[1])
+        series = np.where(columnas[None, :] >= primera[:, None], matriz, np.nan)
+        puntos = (~np.isnan(series)).sum(axis=1)
+        con_demanda = (series > 0).sum(axis=1)
+        adi = puntos / np.maximum(con_demanda, 1)
+
+        ultimo_mes = meses[-1].strftime('%Y-%m')
+        huellas = np.array([
+            hashlib.sha1(
+                f"{ultimo_mes}|{self.horizonte}|".encode() + series[i, ~np.isnan(series[i])].tobytes()
+            ).hexdigest()
+            for i in range(len(codigos))
+        ])
+
+        # Método por artículo: Prophet para los de mayor volumen con serie larga y regular
+        apto_prophet = (puntos >= self.min_meses) & (adi <= ADI_INTERMITENTE)
+        volumen = np.nansum(series, axis=1)
+        candidatos = np.flatnonzero(apto_prophet)
+        candidatos = candidatos[np.argsort(-volumen[candidatos])][:self.max_articulos]
+        metodo = np.where(adi > ADI_INTERMITENTE, 'croston', 'ets').astype(object)
+        metodo[candidatos] = 'prophet'
+
+        pred = np.zeros((len(codigos), self.horizonte))
+        minimo = np.zeros_like(pred)
+        maximo = np.zeros_like(pred)
+
+        # Reutilizar pronósticos cuya huella no cambió
+        reutilizados = self._reutilizar(codigos, huellas, metodo, pred, minimo, maximo)
+
+        # Métodos baratos: una pasada vectorizada por método
+        desviacion = np.nan_to_num(np.nanstd(series, axis=1), nan=0.0)
+        for nombre, funcion in (('croston', _croston), ('ets', _suavizamiento_simple)):
+            filas = np.flatnonzero((metodo == nombre) & ~reutilizados)
+            if len(filas):
+                nivel = funcion(series[filas])
+                pred[filas] = nivel[:, None]
+                minimo[filas] = np.maximum(nivel - Z_INTERVALO * desviacion[filas], 0)[:, None]
+                maximo[filas] = (nivel + Z_INTERVALO * desviacion[filas])[:, None]
+
+        # Prophet por artículo en paralelo
+        filas_prophet = [i for i in np.flatnonzero((metodo == 'prophet') & ~reutilizados)]
+        fallidos = self._ajustar_en_paralelo(filas_prophet, codigos, series, meses, pred, minimo, maximo)
+        if fallidos:
+            filas = np.array(fallidos)
+            nivel = _suavizamiento_simple(series[filas])
+            pred[filas] = nivel[:, None]
+            minimo[filas] = np.maximum(nivel - Z_INTERVALO * desviacion[filas], 0)[:, None]
+            maximo[filas] = (nivel + Z_INTERVALO * desviacion[filas])[:, None]
+            metodo[filas] = 'ets'
+
+        self.estado = {
+            'formato': FORMATO,
+            'frecuencia': self.frecuencia,
+            'inicio': (meses[-1] + pd.offsets.MonthEnd(1)).strftime('%Y-%m-%d'),
+            'horizonte': self.horizonte,
+            'codigos': codigos,
+            'metodos': metodo.astype(str),
+            'huellas': huellas,
+            'pred': np.clip(pred, 0, None),
+            'minimo': np.clip(minimo, 0, None),
+            'maximo': np.clip(maximo, 0, None),
+        }
+
+        metodos, conteos = np.unique(self.estado['metodos'], return_counts=True)
+        resumen = {
+            'articulos': len(codigos),
+            'por_metodo': dict(zip(metodos.tolist(), conteos.tolist())),
+            'reutilizados': int(reutilizados.sum()),
+            'prophet_ajustados': len(filas_prophet) - len(fallidos),
+            'prophet_fallidos': len(fallidos),
+            'segundos': round(time.monotonic() - inicio, 2),
+            'datos_entrenamiento': len(meses),
+        }
+        logger.info(f"📈 Pronóstico por artículo: {resumen}")
+        return resumen
+
+    def _matriz(self, df: pd.DataFrame, columna: str):
+        datos = df[['articulo_codigo', 'fecha', columna]].copy()
+        datos['fecha'] = pd.to_datetime(datos['fecha'])
+        if getattr(datos['fecha'].dt, 'tz', None) is not None:
+            datos['fecha'] = datos['fecha'].dt.tz_localize(None)
+        datos['mes'] = datos['fecha'] + pd.offsets.MonthEnd(0)
+        datos['mes'] = datos['mes'].dt.normalize()
+        tabla = datos.pivot_table(index='articulo_codigo', columns='mes', values=columna,
+                                  aggfunc='sum', fill_value=0)
+        if tabla.empty:
+            return np.empty((0, 0)), np.array([]), pd.DatetimeIndex([])
+        meses = pd.date_range(tabla.columns.min(), tabla.columns.max(), freq='ME')
+        tabla = tabla.reindex(columns=meses, fill_value=0)
+        return tabla.to_numpy(dtype=float), tabla.index.astype(str).to_numpy(), meses
+
+    def _reutilizar(self, codigos, huellas, metodo, pred, minimo, maximo) -> np.ndarray:
+        reutilizados = np.zeros(len(codigos), dtype=bool)
+        previo = self.estado_previo
+        if not previo or previo.get('horizonte') != self.horizonte:
+            return reutilizados
+        indice_previo = {codigo: i for i, codigo in enumerate(previo['codigos'])}
+        for i, codigo in enumerate(codigos):
+            j = indice_previo.get(codigo)
+            if j is not None and previo['huellas'][j] == huellas[i]:
+                pred[i], minimo[i], maximo[i] = previo['pred'][j], previo['minimo'][j], previo['maximo'][j]
+                metodo[i] = previo['metodos'][j]
+                reutilizados[i] = True
+        return reutilizados
+
+    def _ajustar_en_paralelo(self, filas, codigos, series, meses, pred, minimo, maximo) -> List[int]:
+        if not filas:
+            return []
+        fila_de = {codigos[i]: i for i in filas}
+        fallidos = []
+        with self._executor(len(filas)) as executor:
+            futuros = {}
+            for i in filas:
+                validos = ~np.isnan(series[i])
+                futuros[executor.submit(
+                    _ajustar_prophet, codigos[i], list(meses[validos]), series[i, validos].tolist(),
+                    self.horizonte, self.frecuencia
+                )] = codigos[i]
+            for futuro in as_completed(futuros):
+                codigo = futuros[futuro]
+                try:
+                    _, yhat, inferior, superior = futuro.result()
+                    i = fila_de[codigo]
+                    pred[i], minimo[i], maximo[i] = yhat, inferior, superior
+                except Exception as e:
+                    logger.warning(f"⚠️ Prophet falló para artículo {codigo}, se usa ETS: {e}")
+                    fallidos.append(fila_de[codigo])
+        return fallidos
+
+    def _executor(self, tareas: int):
+        workers = max(1, min(self.max_workers, tareas))
+        if multiprocessing.current_process().daemon:
+            # Los workers prefork de Celery son daemon y no pueden crear procesos hijos;
+            # Prophet ajusta en un subproceso de CmdStan, así que los hilos también paralelizan
+            return ThreadPoolExecutor(max_workers=workers)
+        return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+    # --------------------------------------------------------------- predicción
+    def predecir(self, meses: int, articulos: Optional[Iterable[str]] = None,
+                 fechas: Optional[Iterable] = None) -> pd.DataFrame:
+        """
+        Pronóstico de los próximos `meses` para todos los artículos (o los indicados),
+        en formato largo: articulo_codigo, fecha, prediccion, minimo, maximo, metodo.
+
+        Con `fechas` se responde exactamente para esos meses: cada fecha se ubica en el
+        paso del horizonte que le corresponde contando meses desde estado['inicio']
+        (el mes siguiente al último entrenado); las que caen fuera quedan en NaN.
+        """
+        estado = self.estado
+        if not estado:
+            return pd.DataFrame(columns=['articulo_codigo', 'fecha', 'prediccion', 'minimo', 'maximo', 'metodo'])
+
+        filas = np.arange(len(estado['codigos']))
+        if articulos is not None:
+            filas = np.flatnonzero(np.isin(estado['codigos'], [str(a) for a in articulos]))
+
+        if fechas is None:
+            meses = max(1, min(meses, estado['horizonte']))
+            fechas = pd.date_range(estado['inicio'], periods=meses, freq=estado['frecuencia'])
+            pasos = np.arange(meses)
+        else:
+            fechas = pd.DatetimeIndex(fechas)
+            inicio = pd.Timestamp(estado['inicio'])
+            pasos = (fechas.year - inicio.year) * 12 + (fechas.month - inicio.month)
+            pasos = np.asarray(pasos)
+        validos = (pasos >= 0) & (pasos < estado['horizonte'])
+        columnas = np.clip(pasos, 0, estado['horizonte'] - 1)
+
+        def valores(matriz):
+            tomados = matriz[filas][:, columnas].astype(float)
+            tomados[:, ~validos] = np.nan
+            return tomados.ravel()
+
+        return pd.DataFrame({
+            'articulo_codigo': np.repeat(estado['codigos'][filas], len(fechas)),
+            'fecha': np.tile(fechas.strftime('%Y-%m-%d').to_numpy(), len(filas)),
+            'prediccion': valores(estado['pred']),
+            'minimo': valores(estado['minimo']),
+            'maximo': valores(estado['maximo']),
+            'metodo': np.repeat(estado['metodos'][filas], len(fechas)),
+        })
+
+    def demanda_total(self, meses: int) -> Dict[str, float]:
+        """Suma del pronóstico de los próximos `meses` por artículo (vectorizado)."""
+        estado = self.estado
+        if not estado:
+            return {}
+        meses = max(1, min(meses, estado['horizonte']))
+        totales = estado['pred'][:, :meses].sum(axis=1)
+        return dict(zip(estado['codigos'].tolist(), totales.tolist()))
+
+    @classmethod
+    def desde_estado(cls, estado: Optional[Dict[str, Any]]) -> 'ProphetBatchForecaster':
+        forecaster = cls(frecuencia=(estado or {}).get('frecuencia', 'ME'))
+        forecaster.estado = estado if (estado or {}).get('formato') == FORMATO else None
+        return forecaster
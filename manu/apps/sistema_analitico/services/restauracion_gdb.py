@@ -0,0 +1,439 @@
+"""
+Restauración FBK → GDB para las descargas en formato GDB, con caché.
+
+Un GDB restaurado depende solo del objeto en S3 (id del backup + ETag), así que
+se guarda en BACKUP_GDB_CACHE_DIR/{backup_id}_{etag}/ y las solicitudes
+siguientes del mismo backup lo reutilizan sin descargar ni restaurar nada. La
+caché es LRU por la fecha de modificación del directorio (se toca en cada
+acierto) y se acota a BACKUP_GDB_CACHE_MAX_GB; nunca se expulsa un GDB al que
+apunte una DescargaTemporalBackup vigente.
+
+Solicitudes simultáneas del mismo backup comparten una restauración: la
+primera toma el lock en caché (cache.add) y las demás esperan a que aparezca la
+entrada. La entrada se arma en un directorio oculto y se publica con os.rename,
+así que nunca se ve un GDB a medias.
+
+La descarga del FBK es reanudable (descargar_objeto_reanudable): si se corta,
+el siguiente intento continúa desde el parcial en BACKUP_GDB_CACHE_DIR/descargas.
+
+TrabajadorFirebird mantiene por proceso una conexión abierta a la Services API
+del servidor Firebird local: la restauración la ejecuta el propio servidor
+leyendo el FBK del disco, sin lanzar gbak ni pasar el backup por el socket.
+Si la Services API falla se usa gbak -c, resuelto una sola vez por proceso.
+
+Como el GDB lo crea el proceso del servidor Firebird (otro usuario), el
+directorio de construcción debe ser escribible por él: se le da el grupo
+BACKUP_GDB_GRUPO_FIREBIRD (770 + setgid) o, sin grupo configurado, 777.
+BACKUP_GDB_CACHE_DIR debe además ser atravesable por ese usuario (755).
+"""
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Iterable, Optional, Set
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from ..models import BackupS3, DescargaTemporalBackup
+from .backup_streaming import descargar_backup_fbk
+
+logger = logging.getLogger(__name__)
+
+try:
+    from firebirdsql import services as firebird_services
+    FIREBIRDSQL_AVAILABLE = True
+except ImportError:
+    firebird_services = None
+    FIREBIRDSQL_AVAILABLE = False
+
+PREFIJO_LOCK = 'restauracion_gdb'
+MARCA_COMPLETA = 'entrada.json'
+DIRECTORIO_DESCARGAS = 'descargas'
+ESPERA_SONDEO = 2  # Segundos entre comprobaciones mientras otro worker restaura
+ANTIGUEDAD_PARCIALES = 24 * 3600  # FBK parciales sin reanudar que se descartan
+ERRORES_CONEXION = ('Error reading data from the connection', 'Unable to complete network request')
+
+
+def directorio_cache() -> str:
+    return getattr(settings, 'BACKUP_GDB_CACHE_DIR', '') or os.path.join(tempfile.gettempdir(), 'backups_gdb_cache')
+
+
+def _limite_bytes() -> int:
+    return getattr(settings, 'BACKUP_GDB_CACHE_MAX_GB', 20) * 1024 ** 3
+
+
+def _timeout() -> int:
+    return getattr(settings, 'BACKUP_GDB_RESTAURACION_TIMEOUT', 3600)
+
+
+def _parametros_firebird() -> Dict[str, Any]:
+    return {
+        'host': getattr(settings, 'BACKUP_GDB_FIREBIRD_HOST', 'localhost'),
+        'port': getattr(settings, 'BACKUP_GDB_FIREBIRD_PORT', 3050),
+        'user': getattr(settings, 'BACKUP_GDB_FIREBIRD_USER', 'SYSDBA'),
+        'password': getattr(settings, 'BACKUP_GDB_FIREBIRD_PASSWORD', 'masterkey'),
+    }
+
+
+def clave_cache(backup_id: int, etag: str) -> str:
+    etag = etag.strip('"')
+    return f"{backup_id}_{etag}"
+
+
+def _tiene_error(salida: str) -> bool:
+    """gbak puede reportar errores aunque termine con código 0."""
+    return (
+        'ERROR:' in salida
+        or 'failed to create database' in salida.lower()
+        or 'do not recognize record type' in salida.lower()
+        or any(error in salida for error in ERRORES_CONEXION)
+    )
+
+
+def _explicar_error(salida: str) -> str:
+    if any(error in salida for error in ERRORES_CONEXION):
+        salida += "\n\n💡 NOTA: la restauración requiere que el servidor Firebird esté corriendo. Verifica con: sudo systemctl status firebird2.5 o firebird3.0"
+    elif 'do not recognize record type' in salida.lower():
+        salida += "\n\n💡 NOTA: Este error puede indicar que el backup FBK está corrupto, incompleto, o fue creado con una versión incompatible de Firebird."
+    return salida
+
+
+def _iniciar_servidor_firebird() -> bool:
+    for unidad in ('firebird2.5', 'firebird3.0'):
+        try:
+            resultado = subprocess.run(['sudo', 'systemctl', 'start', unidad], capture_output=True, text=True, timeout=10)
+        except Exception as e:
+            logger.debug(f"systemctl {unidad} no disponible: {e}")
+            continue
+        if resultado.returncode == 0:
+            logger.info(f"✅ Servidor Firebird iniciado ({unidad})")
+            time.sleep(2)
+            return True
+    logger.error("❌ No se pudo iniciar el servidor Firebird. Inícialo manualmente o instala firebird3.0-server / Firebird 2.5")
+    return False
+
+
+# ------------------------------------------------------------ trabajador
+class TrabajadorFirebird:
+    """
+    Servidor Firebird local listo para restaurar, compartido por las tareas del
+    proceso. La conexión de servicios y gbak se resuelven la primera vez que se
+    usan; una conexión caída se descarta y se reabre en la siguiente restauración.
+    Las restauraciones del proceso se serializan (la conexión no es thread-safe).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._servicios = None
+        self._gbak: Optional[str] = None
+
+    def _conectar(self):
+        if self._servicios is not None:
+            return self._servicios
+        parametros = _parametros_firebird()
+        try:
+            self._servicios = firebird_services.connect(**parametros)
+        except Exception as e:
+            logger.warning(f"⚠️ Servidor Firebird no responde ({e}). Intentando iniciarlo...")
+            if not _iniciar_servidor_firebird():
+                raise
+            self._servicios = firebird_services.connect(**parametros)
+        logger.info(f"🔥 Conexión de servicios Firebird abierta ({parametros['host']}:{parametros['port']})")
+        return self._servicios
+
+    def _cerrar(self):
+        if self._servicios is not None:
+            try:
+                self._servicios.close()
+            except Exception:
+                pass
+            self._servicios = None
+
+    def _restaurar_servicios(self, fbk: str, gdb: str):
+        lineas = []
+        self._conectar().restore_database(fbk, gdb, create=True, callback=lineas.append)
+        salida = '\n'.join(lineas)
+        if _tiene_error(salida):
+            raise Exception(f'Error al convertir backup a GDB: {_explicar_error(salida[-4000:])}')
+
+    def _restaurar_gbak(self, fbk: str, gdb: str, resolver_gbak: Callable[[], Optional[str]]):
+        if self._gbak is None:
+            self._gbak = resolver_gbak()
+            if not self._gbak:
+                raise ValueError('No se encontró gbak para convertir el backup')
+        parametros = _parametros_firebird()
+        env = os.environ.copy()
+        env['LC_ALL'] = 'C.UTF-8'
+        env['LANG'] = 'C.UTF-8'
+
+        salida = ''
+        # Primero con puerto explícito; sin él solo si falló la conexión
+        for destino in (f"{parametros['host']}/{parametros['port']}:{gdb}", f"{parametros['host']}:{gdb}"):
+            comando = [
+                self._gbak, '-c', '-v',
+                '-user', parametros['user'], '-password', parametros['password'],
+                fbk, destino,
+            ]
+            resultado = subprocess.run(comando, capture_output=True, text=True, timeout=_timeout(), env=env)
+            salida = (resultado.stdout or '') + (resultado.stderr or '')
+            if resultado.returncode == 0 and not _tiene_error(salida):
+                return
+            if os.path.exists(gdb):
+                os.remove(gdb)
+            if not any(error in salida for error in ERRORES_CONEXION):
+                break
+            logger.warning(f"⚠️ gbak falló con {destino}, reintentando sin puerto explícito")
+        raise Exception(f'Error al convertir backup a GDB: {_explicar_error(salida[-4000:] or "Error desconocido")}')
+
+    def restaurar(self, fbk: str, gdb: str, resolver_gbak: Callable[[], Optional[str]]):
+        """Restaura `fbk` en `gdb` (que no debe existir); `gdb` lo escribe el servidor Firebird."""
+        with self._lock:
+            if FIREBIRDSQL_AVAILABLE:
+                try:
+                    self._restaurar_servicios(fbk, gdb)
+                    return
+                except Exception as e:
+                    # Conexión caída o error del servidor: se descarta la conexión y gbak da el diagnóstico
+                    logger.warning(f"⚠️ Restauración por Services API falló ({e}); usando gbak")
+                    self._cerrar()
+                    if os.path.exists(gdb):
+                        os.remove(gdb)
+            self._restaurar_gbak(fbk, gdb, resolver_gbak)
+
+
+trabajador = TrabajadorFirebird()
+
+
+# ---------------------------------------------------------------- entradas
+def _leer_entrada(clave: str) -> Optional[str]:
+    """Ruta del GDB si la entrada está completa; None si no existe o está incompleta."""
+    directorio = os.path.join(directorio_cache(), clave)
+    try:
+        with open(os.path.join(directorio, MARCA_COMPLETA)) as archivo:
+            datos = json.load(archivo)
+    except (OSError, ValueError):
+        return None
+    ruta = os.path.join(directorio, datos['gdb'])
+    return ruta if os.path.exists(ruta) else None
+
+
+def _tocar(clave: str):
+    try:
+        os.utime(os.path.join(directorio_cache(), clave))
+    except OSError:
+        pass
+
+
+def _validar_gdb(fbk_size: int, gdb: str):
+    if not os.path.exists(gdb):
+        raise Exception('Error al convertir backup a GDB: el archivo GDB no se creó')
+    gdb_size = os.path.getsize(gdb)
+    logger.info(f"📊 Archivo GDB creado. Tamaño: {gdb_size / (1024 * 1024):.2f} MB (FBK: {fbk_size / (1024 * 1024):.2f} MB)")
+    # El GDB suele ser menor que el FBK, pero menos del 2% o de 500KB indica una restauración incompleta
+    if (fbk_size > 0 and gdb_size < fbk_size * 0.02) or gdb_size < 500 * 1024:
+        raise Exception(f'Error al convertir backup a GDB: archivo GDB demasiado pequeño ({gdb_size} bytes), probablemente incompleto')
+
+
+def _preparar_construccion(construccion: str):
+    """Crea el directorio donde el servidor Firebird escribirá el GDB restaurado."""
+    os.makedirs(construccion)
+    grupo = getattr(settings, 'BACKUP_GDB_GRUPO_FIREBIRD', '')
+    if grupo:
+        shutil.chown(construccion, group=grupo)
+        os.chmod(construccion, 0o2770)
+    else:
+        # Sin grupo compartido: escribible por cualquiera, como el /tmp que se usaba antes
+        # (sin sticky bit, para que el worker pueda borrar lo que deje Firebird)
+        os.chmod(construccion, 0o777)
+
+
+def _asegurar_lectura(ruta: str):
+    """
+    El servidor Firebird crea el GDB con su propio usuario: se pasa al usuario
+    del worker con permisos 644 para que la vista de descarga pueda leerlo.
+    """
+    if os.stat(ruta).st_uid != os.getuid():
+        try:
+            import pwd
+            usuario = pwd.getpwuid(os.getuid()).pw_name
+        except Exception:
+            usuario = os.getenv('USER') or os.getenv('USERNAME') or 'victus'
+        for comando in (['sudo', 'chown', f'{usuario}:{usuario}', ruta], ['sudo', 'chmod', '644', ruta]):
+            try:
+                subprocess.run(comando, check=True, timeout=10, capture_output=True, text=True)
+            except Exception as e:
+                logger.error(f"❌ Error ejecutando {' '.join(comando[:2])}: {e}")
+    try:
+        os.chmod(ruta, 0o644)
+    except OSError:
+        pass
+    if not os.access(ruta, os.R_OK):
+        raise Exception(f"No se pudieron establecer permisos de lectura para el archivo GDB: {ruta}")
+
+
+def _restaurar(servicio, backup: BackupS3, clave: str, nombre_gdb: str) -> str:
+    base = directorio_cache()
+    descargas = os.path.join(base, DIRECTORIO_DESCARGAS)
+    os.makedirs(descargas, exist_ok=True)
+    fbk = os.path.join(descargas, f"{clave}.fbk")
+    construccion = os.path.join(base, f".{clave}.{uuid.uuid4().hex[:8]}")
+
+    try:
+        inicio = time.monotonic()
+        descargar_backup_fbk(servicio.s3_client, servicio.bucket_name, backup.ruta_s3, fbk)
+        fbk_size = os.path.getsize(fbk)
+        logger.info(f"📥 FBK del backup {backup.id} descargado ({fbk_size / (1024 * 1024):.2f} MB) en {time.monotonic() - inicio:.1f}s")
+
+        _preparar_construccion(construccion)
+        gdb = os.path.join(construccion, nombre_gdb)
+        inicio = time.monotonic()
+        trabajador.restaurar(fbk, gdb, servicio._resolver_gbak)
+        _validar_gdb(fbk_size, gdb)
+        _asegurar_lectura(gdb)
+        logger.info(f"🔄 Backup {backup.id} restaurado a GDB en {time.monotonic() - inicio:.1f}s")
+
+        with open(os.path.join(construccion, MARCA_COMPLETA), 'w') as archivo:
+            json.dump({
+                'backup_id': backup.id,
+                'ruta_s3': backup.ruta_s3,
+                'gdb': nombre_gdb,
+                'fecha': timezone.now().isoformat(),
+            }, archivo)
+        destino = os.path.join(base, clave)
+        if os.path.exists(destino):
+            shutil.rmtree(destino)  # Entrada de un intento anterior a la que le falta el GDB
+        os.rename(construccion, destino)
+        return os.path.join(destino, nombre_gdb)
+    except Exception:
+        shutil.rmtree(construccion, ignore_errors=True)
+        raise
+    finally:
+        if os.path.exists(fbk):
+            os.remove(fbk)
+
+
+_locks_locales: Dict[str, threading.Lock] = {}
+_locks_guardia = threading.Lock()
+
+
+def _lock_local(clave: str) -> threading.Lock:
+    with _locks_guardia:
+        return _locks_locales.setdefault(clave, threading.Lock())
+
+
+def obtener_gdb(servicio, backup: BackupS3, nombre_gdb: str) -> str:
+    """
+    Ruta de un GDB restaurado desde el backup: de la caché si ya existe, si no lo
+    restaura (o espera a que termine quien lo esté restaurando).
+
+    Args:
+        servicio: BackupS3Service de la configuración del backup
+        backup: BackupS3 a restaurar
+        nombre_gdb: Nombre del archivo GDB si hay que crear la entrada
+    """
+    etag = servicio.s3_client.head_object(Bucket=servicio.bucket_name, Key=backup.ruta_s3)['ETag']
+    clave = clave_cache(backup.id, etag)
+    lock = f"{PREFIJO_LOCK}:{clave}"
+    limite = time.monotonic() + _timeout()
+
+    with _lock_local(clave):
+        while True:
+            ruta = _leer_entrada(clave)
+            if ruta:
+                _tocar(clave)
+                logger.info(f"♻️ GDB del backup {backup.id} servido desde caché: {ruta}")
+                return ruta
+
+            duenio = str(uuid.uuid4())
+            if cache.add(lock, duenio, timeout=_timeout()):
+                try:
+                    ruta = _leer_entrada(clave) or _restaurar(servicio, backup, clave, nombre_gdb)
+                finally:
+                    if cache.get(lock) == duenio:
+                        cache.delete(lock)
+                break
+
+            if time.monotonic() > limite:
+                raise TimeoutError(f"Se agotó la espera de la restauración en curso del backup {backup.id}")
+            time.sleep(ESPERA_SONDEO)
+
+    expulsar(proteger=[clave])
+    return ruta
+
+
+# ---------------------------------------------------------------- expulsión
+def _entradas_en_uso(base: str) -> Set[str]:
+    rutas = DescargaTemporalBackup.objects.filter(
+        estado='listo', fecha_expiracion__gt=timezone.now(), ruta_gdb_temporal__startswith=base
+    ).values_list('ruta_gdb_temporal', flat=True)
+    return {os.path.relpath(ruta, base).split(os.sep)[0] for ruta in rutas}
+
+
+def _tamano_directorio(directorio: str) -> int:
+    total = 0
+    for nombre in os.listdir(directorio):
+        try:
+            total += os.path.getsize(os.path.join(directorio, nombre))
+        except OSError:
+            pass
+    return total
+
+
+def _limpiar_restos(base: str):
+    """Borra construcciones abandonadas por un worker caído y FBK parciales que nadie reanudó."""
+    ahora = time.time()
+    for nombre in os.listdir(base):
+        ruta = os.path.join(base, nombre)
+        if nombre.startswith('.') and ahora - os.path.getmtime(ruta) > _timeout():
+            shutil.rmtree(ruta, ignore_errors=True)
+    descargas = os.path.join(base, DIRECTORIO_DESCARGAS)
+    if os.path.isdir(descargas):
+        for nombre in os.listdir(descargas):
+            ruta = os.path.join(descargas, nombre)
+            if ahora - os.path.getmtime(ruta) > ANTIGUEDAD_PARCIALES:
+                os.remove(ruta)
+
+
+def expulsar(proteger: Iterable[str] = ()) -> Dict[str, int]:
+    """
+    Borra las entradas menos usadas hasta dejar la caché bajo BACKUP_GDB_CACHE_MAX_GB.
+    Las entradas en `proteger` y las que tienen una descarga vigente no se tocan,
+    así que el límite puede excederse mientras esas descargas sigan activas.
+    """
+    base = directorio_cache()
+    if not os.path.isdir(base):
+        return {'entradas': 0, 'eliminadas': 0, 'bytes': 0}
+    try:
+        _limpiar_restos(base)
+    except OSError as e:
+        logger.warning(f"⚠️ No se pudieron limpiar restos de la caché GDB: {e}")
+
+    entradas = []
+    for nombre in os.listdir(base):
+        directorio = os.path.join(base, nombre)
+        if nombre.startswith('.') or not os.path.isfile(os.path.join(directorio, MARCA_COMPLETA)):
+            continue
+        entradas.append((os.path.getmtime(directorio), nombre, _tamano_directorio(directorio)))
+
+    total = sum(tamano for _, _, tamano in entradas)
+    limite = _limite_bytes()
+    eliminadas = 0
+    if total > limite:
+        fijadas = _entradas_en_uso(base) | set(proteger)
+        for _, nombre, tamano in sorted(entradas):
+            if total <= limite:
+                break
+            if nombre in fijadas:
+                continue
+            shutil.rmtree(os.path.join(base, nombre), ignore_errors=True)
+            total -= tamano
+            eliminadas += 1
+            logger.info(f"🗑️ GDB expulsado de la caché: {nombre} ({tamano / (1024 * 1024):.1f} MB)")
+    return {'entradas': len(entradas) - eliminadas, 'eliminadas': eliminadas, 'bytes': total}
@@ -0,0 +1,99 @@
+"""
+Mantenimiento y lectura de ResumenMovimientoMensual.
+
+El agregado (empresa × mes × artículo × tipo de documento) se recalcula solo para
+los meses tocados por cada ingesta: se borran las filas del mes y se reinsertan
+desde una única consulta agrupada sobre movimientos_inventario.
+"""
+import logging
+from datetime import date, datetime
+from typing import Iterable, Optional
+
+from django.db import transaction
+from django.db.models import Count, DateField, Max, Q, Sum
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from ..models import MovimientoInventario, ResumenMovimientoMensual
+
+logger = logging.getLogger(__name__)
+
+
+def inicio_mes(periodo: str) -> date:
+    anio, mes = (int(parte) for parte in periodo.split('-'))
+    return date(anio, mes, 1)
+
+
+def mes_siguiente(fecha: date) -> date:
+    return date(fecha.year + 1, 1, 1) if fecha.month == 12 else date(fecha.year, fecha.month + 1, 1)
+
+
+def recalcular_resumen_mensual(empresa_servidor_id: int, periodos: Optional[Iterable[str]] = None) -> int:
+    """
+    Recalcula el resumen de los periodos 'YYYY-MM' indicados (None = todos).
+    Retorna el número de filas de resumen escritas.
+    """
+    movimientos = MovimientoInventario.objects.filter(empresa_servidor_id=empresa_servidor_id)
+    resumen = ResumenMovimientoMensual.objects.filter(empresa_servidor_id=empresa_servidor_id)
+
+    if periodos is not None:
+        meses = sorted({inicio_mes(periodo) for periodo in periodos})
+        if not meses:
+            return 0
+        filtro = Q()
+        for mes in meses:
+            filtro |= Q(
+                fecha__gte=timezone.make_aware(datetime.combine(mes, datetime.min.time())),
+                fecha__lt=timezone.make_aware(datetime.combine(mes_siguiente(mes), datetime.min.time())),
+            )
+        movimientos = movimientos.filter(filtro)
+        resumen = resumen.filter(periodo__in=meses)
+
+    agregados = movimientos.annotate(
+        periodo=TruncMonth('fecha', output_field=DateField())
+    ).values('periodo', 'tipo_documento', 'articulo_codigo').annotate(
+        articulo_nombre=Max('articulo_nombre'),
+        cantidad_total=Sum('cantidad'),
+        valor_total=Sum('valor_total'),
+        movimientos=Count('id'),
+    ).order_by()
+
+    filas = [
+        ResumenMovimientoMensual(
+            empresa_servidor_id=empresa_servidor_id,
+            periodo=fila['periodo'],
+            tipo_documento=fila['tipo_documento'],
+            articulo_codigo=fila['articulo_codigo'],
+            articulo_nombre=fila['articulo_nombre'] or '',
+            cantidad_total=fila['cantidad_total'] or 0,
+            valor_total=fila['valor_total'] or 0,
+            movimientos=fila['movimientos'],
+        )
+        for fila in agregados.iterator(chunk_size=5000)
+    ]
+
+    with transaction.atomic():
+        resumen.delete()
+        ResumenMovimientoMensual.objects.bulk_create(filas, batch_size=2000)
+
+    logger.info(
+        f"📅 Resumen mensual empresa {empresa_servidor_id}: {len(filas)} filas "
+        f"({'todos los periodos' if periodos is None else ', '.join(sorted(set(periodos)))})"
+    )
+    return len(filas)
+
+
+def totales_por(empresas_ids, campos, tipo_documento='FACTURA_VENTA', **filtros):
+    """
+    Consulta agrupada única sobre el resumen: suma cantidad, valor y movimientos
+    agrupando por los campos pedidos (p. ej. ['periodo'] o ['empresa_servidor_id']).
+    """
+    return ResumenMovimientoMensual.objects.filter(
+        empresa_servidor_id__in=empresas_ids,
+        tipo_documento=tipo_documento,
+        **filtros
+    ).values(*campos).annotate(
+        total_articulos=Sum('cantidad_total'),
+        valor_total=Sum('valor_total'),
+        total_ventas=Sum('movimientos'),
+    ).order_by(*campos)
@@ -0,0 +1,265 @@
+"""
+Sincronización incremental (delta) de movimientos TNS por empresa.
+
+En lugar de elegir entre "ya extraído" y re-extraer el rango completo, guarda por
+EmpresaServidor una marca de agua (último FECHA/KARDEXID) y un checksum por mes.
+Cada ejecución:
+  1. Calcula en Firebird el checksum por mes de las filas hasta la marca de agua
+     (una sola consulta agrupada) y re-sincroniza solo los meses que cambiaron.
+  2. Trae las filas posteriores a la marca de agua y hace upsert por clave natural
+     (empresa_servidor, kardex_id, dekardex_id).
+  3. Guarda la nueva marca de agua y los checksums hasta ella.
+
+Toma la misma reserva de empresa y cupo de servidor que las extracciones
+(extraccion_scheduler.reservar_extraccion), así nunca corre a la vez que una
+extracción de la misma empresa.
+"""
+import calendar
+import hashlib
+import logging
+import uuid
+from datetime import date, datetime
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from ..models import EmpresaServidor, MovimientoInventario, SincronizacionMovimientos
+from .data_manager import CAMPOS_CLAVE, COLUMNAS_NO_ACTUALIZABLES, DataManager, deduplicar_por_clave
+from .extraccion_scheduler import liberar_extraccion, reservar_extraccion
+
+logger = logging.getLogger(__name__)
+
+
+class SincronizadorMovimientos:
+    """Motor de sincronización incremental de MovimientoInventario desde TNS."""
+
+    def __init__(self, data_manager: Optional[DataManager] = None):
+        self.data_manager = data_manager or DataManager()
+        self.batch_size = getattr(settings, 'EXTRACCION_BATCH_SIZE', 2000)
+
+    # ------------------------------------------------------------------ public
+    def sincronizar(self, empresa_servidor_id: int, fecha_inicio: Optional[date] = None,
+                    fecha_fin: Optional[date] = None) -> Dict:
+        emp_serv = EmpresaServidor.objects.select_related('servidor').get(id=empresa_servidor_id)
+        servidor = emp_serv.servidor
+
+        if servidor.tipo_servidor != 'FIREBIRD':
+            raise ValueError('La sincronización incremental solo soporta servidores Firebird (TNS).')
+        consulta = emp_serv.consulta_sql or ''
+
+        fecha_inicio = fecha_inicio or date(emp_serv.anio_fiscal, 1, 1)
+        fecha_fin = fecha_fin or date(emp_serv.anio_fiscal, 12, 31)
+
+        duenio = str(uuid.uuid4())
+        clave_cupo, rechazo = reservar_extraccion(emp_serv, duenio)
+        if rechazo is not None:
+            logger.info(f"⏭️ Sincronización {emp_serv.nombre} omitida: {rechazo.get('mensaje') or rechazo.get('error')}")
+            return {'empresa_servidor_id': emp_serv.id, **rechazo}
+        try:
+            return self._sincronizar(emp_serv, consulta, fecha_inicio, fecha_fin)
+        finally:
+            liberar_extraccion(emp_serv.id, clave_cupo, duenio)
+
+    def _sincronizar(self, emp_serv, consulta: str, fecha_inicio: date, fecha_fin: date) -> Dict:
+        marca, _ = SincronizacionMovimientos.objects.get_or_create(empresa_servidor=emp_serv)
+
+        conexion = self.data_manager._conectar_servidor_empresa(emp_serv.servidor, emp_serv.ruta_base)
+        try:
+            cursor = conexion.cursor()
+            try:
+                # Se decide por las columnas del resultado, no por el texto de la consulta
+                columnas = set(self.data_manager._columnas_consulta(cursor, consulta, fecha_inicio, fecha_fin))
+            finally:
+                cursor.close()
+            if not {'FECHA', 'KARDEXID', 'DEKARDEXID'} <= columnas:
+                raise ValueError(
+                    f'La consulta SQL de {emp_serv.nombre} debe exponer FECHA, KARDEXID y DEKARDEXID '
+                    f'para la sincronización incremental.'
+                )
+            con_precio = 'PRECIO_UNITARIO' in columnas
+
+            hwm = self._marca_hwm(marca.ultima_fecha, marca.ultimo_kardex_id)
+            periodos_cambiados = []
+            filas_periodos = 0
+
+            if hwm is None:
+                # Las filas extraídas antes sin clave natural se reemplazan por el upsert,
+                # en la misma transacción para que un fallo no deje los meses vacíos
+                with transaction.atomic():
+                    borradas, _ = MovimientoInventario.objects.filter(
+                        empresa_servidor=emp_serv, kardex_id__isnull=True,
+                        fecha__date__gte=fecha_inicio, fecha__date__lte=fecha_fin,
+                    ).delete()
+                    filas_delta, ultima_clave = self._sincronizar_delta(conexion, emp_serv, consulta, hwm,
+                                                                        fecha_inicio, fecha_fin)
+                if borradas:
+                    logger.info(f"🧹 {emp_serv.nombre}: {borradas} movimientos sin clave natural reemplazados")
+            else:
+                checksums_remotos = self._checksums_periodo(conexion, consulta, fecha_inicio, fecha_fin, hwm,
+                                                            con_precio)
+                periodos_cambiados = self._periodos_cambiados(marca.checksums_periodo or {}, checksums_remotos)
+                for periodo in periodos_cambiados:
+                    filas_periodos += self._resincronizar_periodo(conexion, emp_serv, consulta, periodo,
+                                                                  fecha_inicio, fecha_fin)
+                filas_delta, ultima_clave = self._sincronizar_delta(conexion, emp_serv, consulta, hwm,
+                                                                    fecha_inicio, fecha_fin)
+
+            if ultima_clave:
+                marca.ultima_fecha, marca.ultimo_kardex_id = ultima_clave
+            nuevo_hwm = self._marca_hwm(marca.ultima_fecha, marca.ultimo_kardex_id)
+            checksums = {}
+            if nuevo_hwm is not None:
+                checksums = self._checksums_periodo(conexion, consulta, fecha_inicio, fecha_fin, nuevo_hwm,
+                                                    con_precio)
+        finally:
+            if hasattr(conexion, 'close'):
+                try:
+                    conexion.close()
+                except Exception:
+                    pass
+
+        resultado = {
+            'estado': 'exito',
+            'empresa_servidor_id': emp_serv.id,
+            'filas_nuevas': filas_delta,
+            'periodos_resincronizados': periodos_cambiados,
+            'filas_periodos': filas_periodos,
+            'ultimo_kardex_id': marca.ultimo_kardex_id,
+        }
+        marca.checksums_periodo = checksums
+        marca.registros_sincronizados += filas_delta + filas_periodos
+        marca.ultima_sincronizacion = timezone.now()
+        marca.ultimo_resultado = resultado
+        marca.save()
+
+        if filas_delta or filas_periodos:
+            emp_serv.ultima_extraccion = timezone.now()
+            emp_serv.save(update_fields=['ultima_extraccion'])
+            # El delta abarca desde el mes de la marca de agua anterior hasta el fin del rango
+            inicio_delta = self.data_manager._deserializar_clave(hwm['fecha']) if hwm else fecha_inicio
+            self.data_manager.notificar_movimientos_actualizados(
+                emp_serv.id, max(self._como_fecha(inicio_delta), fecha_inicio), fecha_fin,
+                periodos=periodos_cambiados,
+            )
+
+        logger.info(
+            f"🔁 Sincronización {emp_serv.nombre}: {filas_delta} nuevas, "
+            f"{len(periodos_cambiados)} periodo(s) re-sincronizados"
+        )
+        return resultado
+
+    # ---------------------------------------------------------------- checksum
+    def _checksums_periodo(self, conexion, consulta: str, fecha_inicio: date, fecha_fin: date,
+                           hwm: Dict, con_precio: bool) -> Dict[str, str]:
+        """
+        Checksum por mes calculado en Firebird (filas, suma de claves y cantidades),
+        limitado a las filas hasta la marca de agua para que las filas nuevas no
+        marquen el mes como modificado.
+        """
+        extra = ''
+        if con_precio:
+            extra = ', SUM(Q.CANTIDAD * Q.PRECIO_UNITARIO)'
+        sql = (
+            f"SELECT EXTRACT(YEAR FROM Q.FECHA), EXTRACT(MONTH FROM Q.FECHA), COUNT(*), "
+            f"SUM(Q.KARDEXID), SUM(Q.DEKARDEXID), SUM(Q.CANTIDAD){extra} "
+            f"FROM ({consulta}) Q "
+            f"WHERE (Q.FECHA < ? OR (Q.FECHA = ? AND Q.KARDEXID <= ?)) "
+            f"GROUP BY EXTRACT(YEAR FROM Q.FECHA), EXTRACT(MONTH FROM Q.FECHA)"
+        )
+        cursor = conexion.cursor()
+        try:
+            fecha_hwm = self.data_manager._deserializar_clave(hwm['fecha'])
+            cursor.execute(sql, [fecha_inicio, fecha_fin, fecha_hwm, fecha_hwm, hwm['kardex_id']])
+            filas = cursor.fetchall()
+        finally:
+            cursor.close()
+
+        checksums = {}
+        for anio, mes, *agregados in filas:
+            huella = '|'.join(str(valor) for valor in agregados)
+            checksums[f"{int(anio):04d}-{int(mes):02d}"] = hashlib.md5(huella.encode()).hexdigest()
+        return checksums
+
+    def _periodos_cambiados(self, locales: Dict[str, str], remotos: Dict[str, str]) -> List[str]:
+        """Meses hasta la marca de agua cuyo checksum cambió, aparecieron o desaparecieron en TNS."""
+        return sorted(
+            periodo for periodo in set(locales) | set(remotos)
+            if locales.get(periodo) != remotos.get(periodo)
+        )
+
+    # ---------------------------------------------------------------- periodos
+    def _resincronizar_periodo(self, conexion, emp_serv, consulta: str, periodo: str,
+                               fecha_inicio: date, fecha_fin: date) -> int:
+        anio, mes = (int(parte) for parte in periodo.split('-'))
+        inicio = max(date(anio, mes, 1), fecha_inicio)
+        fin = min(date(anio, mes, calendar.monthrange(anio, mes)[1]), fecha_fin)
+
+        cursor = conexion.cursor()
+        try:
+            cursor.execute(consulta, [inicio, fin])
+            columnas = [desc[0].strip() for desc in cursor.description]
+            with transaction.atomic():
+                MovimientoInventario.objects.filter(
+                    empresa_servidor=emp_serv, fecha__date__gte=inicio, fecha__date__lte=fin
+                ).delete()
+                total = 0
+                for df in self.data_manager._lotes_por_kardex(cursor, columnas, self.batch_size, False):
+                    total += self._upsert(df, emp_serv)
+        finally:
+            cursor.close()
+
+        logger.info(f"♻️ {emp_serv.nombre}: periodo {periodo} re-sincronizado ({total} filas)")
+        return total
+
+    # ------------------------------------------------------------------- delta
+    def _sincronizar_delta(self, conexion, emp_serv, consulta: str, hwm: Optional[Dict],
+                           fecha_inicio: date, fecha_fin: date) -> Tuple[int, Optional[Tuple[datetime, int]]]:
+        sql, params = self.data_manager._consulta_keyset(consulta, fecha_inicio, fecha_fin, hwm, True)
+        cursor = conexion.cursor()
+        total = 0
+        ultima_clave = None
+        try:
+            cursor.execute(sql, params)
+            columnas = [desc[0].strip() for desc in cursor.description]
+            for df in self.data_manager._lotes_por_kardex(cursor, columnas, self.batch_size, True):
+                total += self._upsert(df, emp_serv)
+                ultima = df.iloc[-1]
+                ultima_clave = (self._fecha_aware(ultima['FECHA']), int(ultima['KARDEXID']))
+        finally:
+            cursor.close()
+        return total, ultima_clave
+
+    def _marca_hwm(self, ultima_fecha: Optional[datetime], ultimo_kardex_id: Optional[int]) -> Optional[Dict]:
+        """Marca de agua en el formato de DataManager._consulta_keyset (hora local de Firebird)."""
+        if ultimo_kardex_id is None or not ultima_fecha:
+            return None
+        fecha_local = timezone.localtime(ultima_fecha).replace(tzinfo=None)
+        return {'fecha': fecha_local.isoformat(), 'kardex_id': ultimo_kardex_id}
+
+    # ------------------------------------------------------------------ upsert
+    def _upsert(self, df, emp_serv) -> int:
+        if df.empty:
+            return 0
+        movimientos = deduplicar_por_clave(self.data_manager._transformar_movimientos(df, emp_serv))
+        campos_actualizables = [c for c in movimientos.columns if c not in COLUMNAS_NO_ACTUALIZABLES]
+        registros = movimientos.astype(object).where(movimientos.notna(), None).to_dict('records')
+        MovimientoInventario.objects.bulk_create(
+            [MovimientoInventario(**registro) for registro in registros],
+            batch_size=1000,
+            update_conflicts=True,
+            unique_fields=CAMPOS_CLAVE,
+            update_fields=campos_actualizables,
+        )
+        return len(registros)
+
+    def _como_fecha(self, valor) -> date:
+        return valor.date() if isinstance(valor, datetime) else valor
+
+    def _fecha_aware(self, fecha) -> datetime:
+        if not isinstance(fecha, datetime):
+            fecha = datetime.combine(fecha, datetime.min.time())
+        if timezone.is_naive(fecha):
+            fecha = timezone.make_aware(fecha)
+        return fecha
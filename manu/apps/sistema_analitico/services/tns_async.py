@@ -0,0 +1,141 @@
+"""
+Ejecución concurrente de consultas TNS (Firebird) para los endpoints públicos de e-commerce.
+
+firebirdsql es bloqueante, así que cada consulta corre en un hilo de un pool
+dedicado con su propia conexión del FirebirdConnectionPool, y se coordina con
+asyncio: las consultas independientes de una página viajan en paralelo por la
+WAN en lugar de una tras otra.
+
+Cada consulta tiene timeout; al vencer (o al cancelarse porque otra consulta del
+grupo falló) se cierra el socket de su conexión para que el hilo bloqueado en
+Firebird termine y la conexión se descarte del pool.
+
+Las vistas síncronas usan ejecutar(); el código async puede usar run_query() o
+gather() directamente. El objeto debe crearse en contexto síncrono (o vía
+sync_to_async) porque resuelve empresa.servidor con el ORM.
+"""
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+
+from apps.sistema_analitico.models import EmpresaServidor
+from .tns_bridge import TNSBridge
+
+logger = logging.getLogger(__name__)
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+class _EstadoConsulta:
+    """
+    Estado compartido entre el hilo que ejecuta una consulta y el event loop que
+    la puede abortar. Bajo `lock`: solo se aborta mientras la consulta está en
+    curso, y la devolución al pool ocurre con la decisión de descarte ya tomada,
+    así nunca se cierra el socket de una conexión que ya volvió al pool.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.en_curso = False
+        self.cancelado = False
+
+    def abortar(self, bridge: TNSBridge):
+        with self.lock:
+            self.cancelado = True
+            if self.en_curso:
+                bridge.abortar()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'TNS_ASYNC_MAX_WORKERS', 16),
+                thread_name_prefix='tns-async',
+            )
+        return _executor
+
+
+class TNSAsyncExecutor:
+    """Ejecuta consultas de una empresa TNS en paralelo con timeout y cancelación por consulta."""
+
+    def __init__(self, empresa: EmpresaServidor, timeout: Optional[float] = None):
+        self.empresa = empresa
+        # Resolver el servidor aquí (contexto síncrono): los hilos no deben tocar el ORM
+        self.servidor = empresa.servidor
+        self.timeout = timeout or getattr(settings, 'TNS_ASYNC_QUERY_TIMEOUT', 15)
+
+    # ------------------------------------------------------------------ async
+    async def run_query(self, sql: str, params: Optional[List[Any]] = None,
+                        timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+        bridge = TNSBridge(self.empresa)
+        estado = _EstadoConsulta()
+        loop = asyncio.get_running_loop()
+        futuro = loop.run_in_executor(_get_executor(), self._ejecutar, bridge, sql, params, estado)
+        try:
+            return await asyncio.wait_for(futuro, timeout or self.timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            estado.abortar(bridge)
+            raise
+
+    async def gather(self, consultas: Dict[str, Tuple[str, Optional[List[Any]]]],
+                     return_exceptions: bool = True) -> Dict[str, Any]:
+        """
+        Ejecuta {nombre: (sql, params)} en paralelo.
+
+        return_exceptions=True: cada nombre recibe sus filas o la excepción.
+        return_exceptions=False: la primera falla cancela las demás y se propaga.
+        """
+        tareas = {
+            nombre: asyncio.create_task(self.run_query(sql, params))
+            for nombre, (sql, params) in consultas.items()
+        }
+        if not return_exceptions:
+            _, pendientes = await asyncio.wait(tareas.values(), return_when=asyncio.FIRST_EXCEPTION)
+            for tarea in pendientes:
+                tarea.cancel()
+            await asyncio.gather(*tareas.values(), return_exceptions=True)
+            for nombre, tarea in tareas.items():
+                if not tarea.cancelled() and tarea.exception() is not None:
+                    logger.warning(f"[tns_async] Consulta '{nombre}' falló: {tarea.exception()}")
+                    raise tarea.exception()
+            return {nombre: tarea.result() for nombre, tarea in tareas.items()}
+
+        resultados = await asyncio.gather(*tareas.values(), return_exceptions=True)
+        for nombre, resultado in zip(tareas, resultados):
+            if isinstance(resultado, BaseException):
+                logger.warning(f"[tns_async] Consulta '{nombre}' falló: {resultado!r}")
+        return dict(zip(tareas, resultados))
+
+    # ------------------------------------------------------------------- sync
+    def ejecutar(self, consultas: Dict[str, Tuple[str, Optional[List[Any]]]],
+                 return_exceptions: bool = True) -> Dict[str, Any]:
+        """Punto de entrada para vistas síncronas (WSGI o ASGI)."""
+        return async_to_sync(self.gather)(consultas, return_exceptions)
+
+    # ---------------------------------------------------------------- helpers
+    def _ejecutar(self, bridge: TNSBridge, sql: str, params: Optional[List[Any]],
+                  estado: _EstadoConsulta) -> List[Dict[str, Any]]:
+        with estado.lock:
+            if estado.cancelado:
+                raise asyncio.CancelledError()
+            estado.en_curso = True
+        descartar = False
+        try:
+            return bridge.run_query(sql, params)
+        except Exception:
+            # Conexión abortada o en estado dudoso: no devolverla al pool
+            descartar = True
+            raise
+        finally:
+            with estado.lock:
+                estado.en_curso = False
+                # Cancelada (aunque haya terminado justo a tiempo): se descarta
+                bridge.close(discard=descartar or estado.cancelado)
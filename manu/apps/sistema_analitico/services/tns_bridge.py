@@ -1,4 +1,6 @@
+import functools
 import hashlib
+import logging
 import os
 from datetime import date
 from typing import Any, Dict, Iterable, List, Optional
@@ -125,6 +127,26 @@ except Exception as e:
     warnings.warn(f'No se pudo aplicar monkey patch para charset: {e}')
 
 from apps.sistema_analitico.models import EmpresaServidor
+from .firebird_pool import FirebirdConnectionPool, close_all_pools, get_pool, pool_stats
+from .tns_metadata import TNSMetadataCatalog
+from .tns_result_cache import invalidar_resultados_tns
+
+logger = logging.getLogger(__name__)
+
+
+def _abrir_conexion(host, port, database, user, password, charset) -> firebirdsql.Connection:
+    """
+    Fábrica de conexiones de los pools. Es una función de módulo con parámetros
+    planos: el pool vive todo el proceso y no debe retener ningún TNSBridge.
+    """
+    return firebirdsql.connect(
+        host=host,
+        database=database,
+        user=user,
+        password=password,
+        port=port,
+        charset=charset,
+    )
 
 
 class TNSBridge:
@@ -134,7 +156,6 @@ class TNSBridge:
     """
 
     _schema_cache: Dict[str, Dict[str, str]] = {}
-    _connection_pool: Dict[str, firebirdsql.Connection] = {}
 
     def __init__(self, empresa: EmpresaServidor):
         self.empresa = empresa
@@ -164,97 +185,113 @@ class TNSBridge:
         return self._schema_cache.setdefault(self.pool_key, {})
 
     # ----------------------------------------------------------------- connect
+    def _fabrica_conexiones(self):
+        # Usar latin-1 directamente (es superset de WIN1252 y más tolerante)
+        # latin-1 puede decodificar cualquier byte sin errores, luego normalizamos a UTF-8
+        return functools.partial(
+            _abrir_conexion,
+            self.servidor.host,
+            self.servidor.puerto or 3050,
+            self.empresa.ruta_base or self.servidor.ruta_maestra,
+            self.servidor.usuario,
+            self.servidor.password,
+            self.charset,
+        )
+
+    @property
+    def pool(self) -> FirebirdConnectionPool:
+        return get_pool(self.pool_key, self._fabrica_conexiones())
+
     def connect(self):
         if self.conn:
             return
 
         os.environ['ISC_CP'] = self.charset
-        port = self.servidor.puerto or 3050
-        database_path = self.empresa.ruta_base or self.servidor.ruta_maestra
-        if not database_path:
+        if not (self.empresa.ruta_base or self.servidor.ruta_maestra):
             raise ValueError('No se configuró la ruta de la base de datos TNS.')
 
-        # Limpiar pool si el charset cambió (para forzar nueva conexión con charset correcto)
-        if self.pool_key in self._connection_pool:
-            conn = self._connection_pool[self.pool_key]
-            try:
-                cur = conn.cursor()
-                cur.execute('SELECT 1 FROM RDB$DATABASE')
-                cur.fetchone()
-                cur.close()
-                # Verificar que el charset de la conexión sea el correcto
-                # Si no coincide, cerrar y crear nueva conexión
-                self.conn = conn
-            except Exception as e:
-                # Si hay error, remover del pool primero para evitar reutilización
-                self._connection_pool.pop(self.pool_key, None)
-                # Intentar cerrar de forma segura sin parsear mensajes de error
-                try:
-                    # Cerrar socket directamente si es posible (evita parsing de errores)
-                    if hasattr(conn, 'sock') and conn.sock:
-                        try:
-                            conn.sock.close()
-                        except Exception:
-                            pass
-                    # Intentar cerrar conexión normalmente
-                    if hasattr(conn, 'close'):
-                        conn.close()
-                except Exception:
-                    # Si todo falla, simplemente ignorar - ya removimos del pool
-                    pass
-
-        if not self.conn:
-            # Usar latin-1 directamente (es superset de WIN1252 y más tolerante)
-            # latin-1 puede decodificar cualquier byte sin errores, luego normalizamos a UTF-8
-            connection_charset = self.charset  # Ya es 'latin-1' por defecto
-            self.conn = firebirdsql.connect(
-                host=self.servidor.host,
-                database=database_path,
-                user=self.servidor.usuario,
-                password=self.servidor.password,
-                port=port,
-                charset=connection_charset,
-            )
-            self._connection_pool[self.pool_key] = self.conn
-
+        # Checkout del pool: la verificación de vida solo se hace si la conexión
+        # estuvo inactiva, y cada hilo obtiene su propia conexión
+        self.conn = self.pool.checkout()
         self.cursor = self.conn.cursor()
 
-    def close(self):
+    def close(self, discard: bool = False):
         if self.cursor:
             try:
                 self.cursor.close()
             except Exception:
-                pass
+                discard = True
             finally:
                 self.cursor = None
-        
-        # No cerrar conexión del pool, solo limpiar referencia local
-        if self.conn and self.pool_key in self._connection_pool:
-            # Solo limpiar referencia local, mantener conexión en pool
-            self.conn = None
-        elif self.conn:
-            # Si no está en pool, cerrarla
+
+        # Devolver la conexión al pool (no se cierra salvo que esté inservible)
+        if self.conn:
+            conn, self.conn = self.conn, None
+            self.pool.checkin(conn, discard=discard)
+
+    def abortar(self):
+        """
+        Corta desde otro hilo la consulta en curso cerrando el socket: el hilo
+        bloqueado en Firebird recibe un error y la conexión se descarta en close().
+        """
+        sock = getattr(self.conn, 'sock', None) if self.conn else None
+        if sock:
             try:
-                self.conn.close()
+                sock.close()
             except Exception:
                 pass
-            finally:
-                self.conn = None
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __del__(self):
+        # Red de seguridad: si el llamador olvidó close(), no perder el cupo del pool
+        try:
+            self.close()
+        except Exception:
+            pass
 
     # ----------------------------------------------------------------- helpers
     def _ensure_schema(self):
-        if self.schema_cache:
+        # Los nombres reales salen del catálogo persistente (compartido entre workers)
+        try:
+            tablas = self.metadata['tablas']
+        except Exception as e:
+            logger.warning(f"Catálogo de metadatos no disponible para {self.pool_key[:8]}: {e}")
+            if self.schema_cache:
+                return
+            self.connect()
+            self.cursor.execute("""
+                SELECT RDB$RELATION_NAME
+                FROM RDB$RELATIONS
+                WHERE RDB$SYSTEM_FLAG = 0 AND RDB$VIEW_BLR IS NULL
+            """)
+            self.schema_cache.update({
+                name.strip().upper(): name.strip()
+                for (name,) in self.cursor.fetchall()
+            })
             return
+        self._schema_cache[self.pool_key] = {clave: tabla['nombre'] for clave, tabla in tablas.items()}
+
+    @property
+    def metadata(self) -> Dict[str, Any]:
+        """Catálogo de tablas, columnas, índices y llaves (ver TNSMetadataCatalog)."""
+        return TNSMetadataCatalog(self.pool_key).obtener(self._cursor_metadata)
+
+    def refrescar_metadata(self) -> Dict[str, Any]:
+        return TNSMetadataCatalog(self.pool_key).refrescar(self._cursor_metadata)
+
+    def invalidar_metadata(self):
+        TNSMetadataCatalog(self.pool_key).invalidar()
+        self._schema_cache.pop(self.pool_key, None)
+
+    def _cursor_metadata(self):
         self.connect()
-        self.cursor.execute("""
-            SELECT RDB$RELATION_NAME
-            FROM RDB$RELATIONS
-            WHERE RDB$SYSTEM_FLAG = 0 AND RDB$VIEW_BLR IS NULL
-        """)
-        self.schema_cache.update({
-            name.strip().upper(): name.strip()
-            for (name,) in self.cursor.fetchall()
-        })
+        return self.cursor
 
     def list_tables(self) -> List[str]:
         self._ensure_schema()
@@ -276,8 +313,20 @@ class TNSBridge:
         self.connect()
         self.cursor.execute(sql, params or [])
         self.conn.commit()
+        self.invalidar_resultados()
         return self.cursor.rowcount
 
+    def _confirmar(self):
+        """
+        Confirma la transacción de una escritura. Obligatorio antes de close():
+        el pool hace rollback de lo pendiente al recibir la conexión.
+        """
+        self.conn.commit()
+
+    def invalidar_resultados(self, tablas: Optional[Iterable[str]] = None):
+        """Invalida la caché de TNSViewSet.records tras escribir (tablas=None = toda la base)."""
+        invalidar_resultados_tns(self.pool_key, tablas)
+
     def _normalize_value(self, value: Any) -> Any:
         if isinstance(value, bytes):
             return value.decode(self.charset, errors='ignore')
@@ -285,12 +334,20 @@ class TNSBridge:
 
     # ------------------------------------------------------------------ public
     def run_query(self, sql: str, params: Optional[List[Any]] = None) -> List[Dict[str, Any]]:
-        return self._execute(sql, params)
+        rows = self._execute(sql, params)
+        if not sql.lstrip().upper().startswith(('SELECT', 'WITH')):
+            # DML/DDL enviado por el endpoint query
+            self._confirmar()
+            self.invalidar_resultados()
+        return rows
 
     def call_procedure(self, name: str, params: Dict[str, Any]) -> List[Any]:
         placeholders = ', '.join(['?'] * len(params))
         sql = f"SELECT * FROM {name}({placeholders})"
-        return self._execute(sql, list(params.values()))
+        rows = self._execute(sql, list(params.values()))
+        # Los procedimientos pueden escribir
+        self._confirmar()
+        return rows
 
     # ---------------------------- specialized helpers ------------------------
     def get_consecutive(self, codcomp: str, codprefijo: str, sucursal: str = "00"):
@@ -322,15 +379,19 @@ class TNSBridge:
         ]
         sql = "SELECT * FROM TNS_INS_FACTURAVTA(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
         self._execute(sql, params)
+        # Consecutivo y factura en la misma transacción
+        self._confirmar()
+        # La factura toca KARDEX, DEKARDEX, consecutivos, cartera...: invalidar toda la base
+        self.invalidar_resultados()
         return numero
 
     # ----------------------------------------------------------------- cleanup
+    @classmethod
+    def pool_stats(cls) -> List[Dict[str, Any]]:
+        return pool_stats()
+
     @classmethod
     def cleanup(cls):
-        for conn in list(cls._connection_pool.values()):
-            try:
-                conn.close()
-            except Exception:
-                pass
-        cls._connection_pool.clear()
+        close_all_pools()
         cls._schema_cache.clear()
+        TNSMetadataCatalog._memoria.clear()
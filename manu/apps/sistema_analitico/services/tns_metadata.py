@@ -0,0 +1,264 @@
+"""
+Catálogo persistente de metadatos de bases TNS (Firebird).
+
+Por cada pool_key guarda en Redis: tablas, columnas (tipo, charset, nulabilidad),
+índices, llaves primarias y foráneas, y una estimación de filas por tabla
+(a partir de la selectividad de los índices únicos, RDB$STATISTICS).
+
+El catálogo se comparte entre workers y procesos: cada refresco incrementa una
+versión y los procesos guardan una copia local que solo se reutiliza mientras la
+versión en Redis no cambie. Pasado TNS_METADATA_TTL se vuelve a introspectar; si
+otro proceso ya está refrescando, se sigue usando la versión anterior.
+"""
+import logging
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+PREFIJO = 'tns_meta'
+FORMATO = 1  # Subir si cambia la estructura guardada
+
+# RDB$FIELDS.RDB$FIELD_TYPE -> nombre SQL
+TIPOS_FIREBIRD = {
+    7: 'SMALLINT',
+    8: 'INTEGER',
+    10: 'FLOAT',
+    12: 'DATE',
+    13: 'TIME',
+    14: 'CHAR',
+    16: 'BIGINT',
+    23: 'BOOLEAN',
+    27: 'DOUBLE PRECISION',
+    35: 'TIMESTAMP',
+    37: 'VARCHAR',
+    261: 'BLOB',
+}
+
+SQL_COLUMNAS = """
+    SELECT rf.RDB$RELATION_NAME, rf.RDB$FIELD_NAME, rf.RDB$FIELD_POSITION,
+           f.RDB$FIELD_TYPE, f.RDB$FIELD_SUB_TYPE, f.RDB$FIELD_LENGTH,
+           f.RDB$FIELD_PRECISION, f.RDB$FIELD_SCALE, f.RDB$CHARACTER_LENGTH,
+           COALESCE(rf.RDB$NULL_FLAG, f.RDB$NULL_FLAG, 0), cs.RDB$CHARACTER_SET_NAME
+    FROM RDB$RELATION_FIELDS rf
+    JOIN RDB$RELATIONS r ON r.RDB$RELATION_NAME = rf.RDB$RELATION_NAME
+    JOIN RDB$FIELDS f ON f.RDB$FIELD_NAME = rf.RDB$FIELD_SOURCE
+    LEFT JOIN RDB$CHARACTER_SETS cs ON cs.RDB$CHARACTER_SET_ID = f.RDB$CHARACTER_SET_ID
+    WHERE r.RDB$SYSTEM_FLAG = 0 AND r.RDB$VIEW_BLR IS NULL
+    ORDER BY rf.RDB$RELATION_NAME, rf.RDB$FIELD_POSITION
+"""
+
+SQL_INDICES = """
+    SELECT i.RDB$RELATION_NAME, i.RDB$INDEX_NAME, COALESCE(i.RDB$UNIQUE_FLAG, 0),
+           COALESCE(i.RDB$INDEX_INACTIVE, 0), COALESCE(i.RDB$INDEX_TYPE, 0),
+           i.RDB$STATISTICS, s.RDB$FIELD_NAME
+    FROM RDB$INDICES i
+    JOIN RDB$INDEX_SEGMENTS s ON s.RDB$INDEX_NAME = i.RDB$INDEX_NAME
+    JOIN RDB$RELATIONS r ON r.RDB$RELATION_NAME = i.RDB$RELATION_NAME
+    WHERE r.RDB$SYSTEM_FLAG = 0 AND r.RDB$VIEW_BLR IS NULL
+    ORDER BY i.RDB$RELATION_NAME, i.RDB$INDEX_NAME, s.RDB$FIELD_POSITION
+"""
+
+SQL_RESTRICCIONES = """
+    SELECT rc.RDB$RELATION_NAME, rc.RDB$CONSTRAINT_NAME, rc.RDB$CONSTRAINT_TYPE,
+           rc.RDB$INDEX_NAME, ref.RDB$CONST_NAME_UQ
+    FROM RDB$RELATION_CONSTRAINTS rc
+    LEFT JOIN RDB$REF_CONSTRAINTS ref ON ref.RDB$CONSTRAINT_NAME = rc.RDB$CONSTRAINT_NAME
+    WHERE rc.RDB$CONSTRAINT_TYPE IN ('PRIMARY KEY', 'UNIQUE', 'FOREIGN KEY')
+"""
+
+
+def _texto(valor: Any) -> Optional[str]:
+    """Los nombres del catálogo de Firebird vienen como CHAR rellenados con espacios."""
+    if valor is None:
+        return None
+    if isinstance(valor, bytes):
+        valor = valor.decode('iso8859_1', errors='replace')
+    return str(valor).strip()
+
+
+def _tipo_columna(tipo, subtipo, longitud, precision, escala, longitud_caracteres) -> str:
+    nombre = TIPOS_FIREBIRD.get(tipo, f'TIPO_{tipo}')
+    if tipo in (7, 8, 16) and escala and escala < 0:
+        base = 'DECIMAL' if subtipo == 2 else 'NUMERIC'
+        return f'{base}({precision or 18},{-escala})'
+    if tipo in (14, 37):
+        return f'{nombre}({longitud_caracteres or longitud})'
+    if tipo == 261:
+        return f'BLOB SUB_TYPE {subtipo or 0}'
+    return nombre
+
+
+def introspeccionar(cursor) -> Dict[str, Dict]:
+    """Lee RDB$ y arma el diccionario de tablas (clave: nombre en mayúsculas)."""
+    tablas: Dict[str, Dict] = {}
+
+    cursor.execute(SQL_COLUMNAS)
+    for (relacion, campo, posicion, tipo, subtipo, longitud, precision, escala,
+         longitud_caracteres, no_nulo, charset) in cursor.fetchall():
+        nombre = _texto(relacion)
+        tabla = tablas.setdefault(nombre.upper(), {
+            'nombre': nombre,
+            'columnas': {},
+            'pk': [],
+            'indices': {},
+            'fks': [],
+            'filas_estimadas': None,
+        })
+        tabla['columnas'][_texto(campo).upper()] = {
+            'tipo': _tipo_columna(tipo, subtipo, longitud, precision, escala, longitud_caracteres),
+            'charset': _texto(charset),
+            'nulo': not no_nulo,
+            'posicion': posicion,
+        }
+
+    cursor.execute(SQL_INDICES)
+    for relacion, indice, unico, inactivo, tipo_indice, selectividad, campo in cursor.fetchall():
+        tabla = tablas.get(_texto(relacion).upper())
+        if tabla is None:
+            continue
+        info = tabla['indices'].setdefault(_texto(indice), {
+            'columnas': [],
+            'unico': bool(unico),
+            'activo': not inactivo,
+            'descendente': tipo_indice == 1,
+            'selectividad': float(selectividad) if selectividad else None,
+        })
+        info['columnas'].append(_texto(campo).upper())
+
+    cursor.execute(SQL_RESTRICCIONES)
+    restricciones = [tuple(_texto(valor) for valor in fila) for fila in cursor.fetchall()]
+    indice_de_restriccion = {nombre: (relacion.upper(), indice) for relacion, nombre, _, indice, _ in restricciones}
+
+    def columnas_indice(relacion: str, indice: str) -> List[str]:
+        return list(tablas.get(relacion, {}).get('indices', {}).get(indice, {}).get('columnas', []))
+
+    for relacion, nombre, tipo, indice, referida in restricciones:
+        tabla = tablas.get(relacion.upper())
+        if tabla is None:
+            continue
+        if tipo == 'PRIMARY KEY':
+            tabla['pk'] = columnas_indice(relacion.upper(), indice)
+        elif tipo == 'FOREIGN KEY' and referida in indice_de_restriccion:
+            tabla_ref, indice_ref = indice_de_restriccion[referida]
+            tabla['fks'].append({
+                'nombre': nombre,
+                'columnas': columnas_indice(relacion.upper(), indice),
+                'tabla_ref': tabla_ref,
+                'columnas_ref': columnas_indice(tabla_ref, indice_ref),
+            })
+
+    # Firebird no guarda conteo de filas: en un índice único la selectividad es
+    # 1/filas, así que sirve como estimación (tan fresca como el último SET STATISTICS)
+    for tabla in tablas.values():
+        selectividades = [
+            info['selectividad'] for info in tabla['indices'].values()
+            if info['unico'] and info['activo'] and info['selectividad']
+        ]
+        if selectividades:
+            tabla['filas_estimadas'] = int(round(1 / min(selectividades)))
+
+    return tablas
+
+
+class TNSMetadataCatalog:
+    """Catálogo de metadatos versionado por base TNS (pool_key), persistido en Redis."""
+
+    # Copia local por proceso: pool_key -> catálogo
+    _memoria: Dict[str, Dict] = {}
+
+    def __init__(self, pool_key: str):
+        self.pool_key = pool_key
+        self.ttl = getattr(settings, 'TNS_METADATA_TTL', 86400)
+        self.espera_candado = getattr(settings, 'TNS_METADATA_LOCK_WAIT', 30)
+
+    @property
+    def clave(self) -> str:
+        return f"{PREFIJO}:{self.pool_key}"
+
+    @property
+    def clave_version(self) -> str:
+        return f"{PREFIJO}:ver:{self.pool_key}"
+
+    # ---------------------------------------------------------------- lectura
+    def obtener(self, abrir_cursor: Callable[[], Any]) -> Dict:
+        """
+        Retorna el catálogo vigente. abrir_cursor() solo se llama si hay que
+        introspectar (catálogo inexistente, de otro formato o vencido).
+        """
+        catalogo = self._leer()
+        if catalogo is not None and not self._vencido(catalogo):
+            return catalogo
+        return self.refrescar(abrir_cursor, respaldo=catalogo)
+
+    def _leer(self) -> Optional[Dict]:
+        version = cache.get(self.clave_version)
+        if not version:
+            return None
+        local = self._memoria.get(self.pool_key)
+        if local is not None and local['version'] == version:
+            return local
+        catalogo = cache.get(self.clave)
+        if not catalogo or catalogo.get('formato') != FORMATO or catalogo.get('version') != version:
+            return None
+        self._memoria[self.pool_key] = catalogo
+        return catalogo
+
+    def _vencido(self, catalogo: Dict) -> bool:
+        return time.time() - catalogo.get('generado_ts', 0) > self.ttl
+
+    # -------------------------------------------------------------- refresco
+    def refrescar(self, abrir_cursor: Callable[[], Any], respaldo: Optional[Dict] = None) -> Dict:
+        """Introspecta la base y publica una nueva versión (un solo proceso a la vez)."""
+        candado = f"{self.clave}:lock"
+        if not cache.add(candado, 1, timeout=self.espera_candado + 60):
+            if respaldo is not None:
+                # Otro proceso ya está refrescando: seguir con la versión anterior
+                return respaldo
+            limite = time.monotonic() + self.espera_candado
+            while time.monotonic() < limite:
+                time.sleep(0.1)
+                catalogo = self._leer()
+                if catalogo is not None:
+                    return catalogo
+            logger.warning(f"[tns_meta] Espera agotada para {self.pool_key[:8]}; introspectando directo")
+            return self._introspectar_y_guardar(abrir_cursor)
+
+        try:
+            return self._introspectar_y_guardar(abrir_cursor)
+        finally:
+            cache.delete(candado)
+
+    def _introspectar_y_guardar(self, abrir_cursor: Callable[[], Any]) -> Dict:
+        inicio = time.monotonic()
+        tablas = introspeccionar(abrir_cursor())
+        version = (cache.get(self.clave_version) or 0) + 1
+        catalogo = {
+            'formato': FORMATO,
+            'version': version,
+            'generado': timezone.now().isoformat(),
+            'generado_ts': time.time(),
+            'tablas': tablas,
+        }
+        # Primero el catálogo y luego la versión: quien lea la versión nueva ya encuentra sus datos
+        cache.set(self.clave, catalogo, timeout=None)
+        cache.set(self.clave_version, version, timeout=None)
+        self._memoria[self.pool_key] = catalogo
+        logger.info(
+            f"[tns_meta] Catálogo {self.pool_key[:8]} v{version}: {len(tablas)} tablas "
+            f"en {time.monotonic() - inicio:.2f}s"
+        )
+        return catalogo
+
+    def invalidar(self):
+        """Descarta el catálogo (p. ej. tras DDL); se reconstruye en el siguiente acceso."""
+        cache.delete(self.clave)
+        try:
+            cache.incr(self.clave_version)
+        except ValueError:
+            pass
+        self._memoria.pop(self.pool_key, None)
@@ -3,8 +3,11 @@ Constructor seguro de consultas SQL para Firebird
 Evita inyección SQL y construye queries dinámicas de forma segura
 """
 from typing import Any, Dict, List, Optional, Tuple
+import logging
 import re
 
+logger = logging.getLogger(__name__)
+
 
 class TNSQueryBuilder:
     """Constructor seguro de queries SQL para Firebird - EXACTAMENTE como BCE"""
@@ -22,13 +25,15 @@ class TNSQueryBuilder:
     # Operadores SQL seguros
     SAFE_OPERATORS = ['=', '!=', '<', '>', '<=', '>=', 'LIKE', 'CONTAINING', 'STARTING WITH']
     
-    def __init__(self, table_name: str, get_real_table_name_func=None):
+    def __init__(self, table_name: str, get_real_table_name_func=None, metadata: Optional[Dict[str, Dict]] = None):
         """
         Inicializa el builder
         get_real_table_name_func: función opcional para obtener el nombre real de la tabla (como BCE)
+        metadata: tablas del catálogo TNS (TNSMetadataCatalog) para validar campos sin ir a Firebird
         """
         self.table_name = self._validate_table_name(table_name)
         self.get_real_table_name = get_real_table_name_func or (lambda x: x.upper())
+        self.metadata = metadata
         self.fields: List[str] = []
         self.foreign_keys: List[Dict[str, Any]] = []
         self.filters: Dict[str, Any] = {}
@@ -112,6 +117,67 @@ class TNSQueryBuilder:
         self.page_size = page_size
         return self
     
+    def _resolver_columna(self, field: str, incluir_prefijo: bool = True) -> Tuple[str, str]:
+        """Retorna (tabla, columna) a la que apunta un campo: alias de FK, prefijo TABLA_ o tabla principal"""
+        field_upper = field.upper()
+        for fk in self.foreign_keys:
+            for col in fk.get('columns', []):
+                if col.get('as', '').upper() == field_upper:
+                    return fk['table'], col['name'].upper()
+        if incluir_prefijo:
+            for fk in self.foreign_keys:
+                if field_upper.startswith(fk['table'].upper() + '_'):
+                    return fk['table'], field_upper[len(fk['table']) + 1:]
+        return self.table_name, field_upper
+    
+    def _validar_columna(self, tabla: str, campo: str):
+        info = self.metadata.get(tabla.upper())
+        if info is None:
+            raise ValueError(f"Tabla '{tabla}' no encontrada")
+        if campo.upper() not in info['columnas']:
+            raise ValueError(f"Campo '{campo}' no existe en la tabla {tabla}")
+    
+    def validar_contra_metadata(self):
+        """Rechaza tablas y campos inexistentes usando el catálogo, antes de consultar Firebird"""
+        if not self.metadata:
+            return
+        for fk in self.foreign_keys:
+            self._validar_columna(fk.get('joinFrom') or self.table_name, fk['localField'])
+            self._validar_columna(fk['table'], fk['foreignField'])
+            for col in fk.get('columns', []):
+                self._validar_columna(fk['table'], col['name'])
+        for field in self.fields:
+            self._validar_columna(*self._resolver_columna(field, incluir_prefijo=False))
+        campos_filtro = [field for field in self.filters if field != 'OR']
+        for or_item in self.filters.get('OR', []):
+            if isinstance(or_item, dict):
+                campos_filtro.extend(or_item.keys())
+        for field in campos_filtro:
+            self._validar_columna(*self._resolver_columna(field))
+        for order in self.order_by:
+            self._validar_columna(*self._resolver_columna(order['field']))
+    
+    def _orden_indexado(self) -> List[str]:
+        """Columnas de la llave primaria (o del primer índice único activo) de la tabla principal"""
+        info = (self.metadata or {}).get(self.table_name)
+        if not info:
+            return []
+        if info.get('pk'):
+            return info['pk']
+        for indice in info.get('indices', {}).values():
+            if indice['unico'] and indice['activo']:
+                return indice['columnas']
+        return []
+    
+    def _columna_indexada(self, tabla: str, campo: str) -> bool:
+        info = (self.metadata or {}).get(tabla.upper())
+        if not info:
+            return True
+        return any(
+            indice['activo'] and indice['columnas'] and indice['columnas'][0] == campo.upper()
+            for indice in info.get('indices', {}).values()
+        )
+    
     def build_select_clause(self) -> Tuple[str, Dict[str, str]]:
         """Construye la cláusula SELECT"""
         import logging
@@ -406,6 +472,11 @@ class TNSQueryBuilder:
     def build_order_clause(self) -> str:
         """Construye la cláusula ORDER BY (exactamente como BCE)"""
         if not self.order_by:
+            # Sin orden explícito, FIRST/SKIP no garantiza páginas estables: ordenar por
+            # la llave primaria, que Firebird recorre por índice sin ordenar en memoria
+            columnas = self._orden_indexado()
+            if columnas:
+                return 'ORDER BY ' + ', '.join(f'a.{columna} ASC' for columna in columnas)
             return ''
         
         order_parts = []
@@ -426,6 +497,8 @@ class TNSQueryBuilder:
                 else:
                     # Campo principal: usar alias de tabla principal (sin comillas)
                     order_parts.append(f'a.{field} {direction}')
+                    if not self._columna_indexada(self.table_name, field):
+                        logger.info(f'ORDER BY {self.table_name}.{field} sin índice: Firebird ordenará en memoria')
             elif isinstance(order, str):
                 # Formato legacy: "field_DESC" o "field"
                 if order.endswith('_DESC'):
@@ -436,10 +509,11 @@ class TNSQueryBuilder:
         
         return 'ORDER BY ' + ', '.join(order_parts)
     
-    def build_base_query(self) -> Tuple[str, List[Any]]:
+    def build_base_query(self, include_order: bool = True) -> Tuple[str, List[Any]]:
         """Construye la query base completa (sin paginación) - EXACTAMENTE como BCE"""
         # Obtener nombre real de la tabla (como BCE)
         real_table_name = self.get_real_table_name(self.table_name)
+        self.validar_contra_metadata()
         
         select_clause, _ = self.build_select_clause()
         join_clauses_list = []
@@ -447,7 +521,7 @@ class TNSQueryBuilder:
         if join_clause_str:
             join_clauses_list.append(join_clause_str)
         where_clause, params = self.build_where_clause()
-        order_clause = self.build_order_clause()
+        order_clause = self.build_order_clause() if include_order else ''
         
         # Construir query base (EXACTAMENTE como BCE)
         base_query = f"""
@@ -472,7 +546,8 @@ class TNSQueryBuilder:
     
     def build_count_query(self) -> Tuple[str, List[Any]]:
         """Construye query para contar total usando subquery (EXACTAMENTE como BCE)"""
-        base_query, params = self.build_base_query()
+        # El orden no afecta el conteo: omitirlo evita un SORT innecesario en Firebird
+        base_query, params = self.build_base_query(include_order=False)
         
         # COUNT usando subquery (EXACTAMENTE como BCE)
         count_query = f'SELECT COUNT(*) FROM ({base_query})'
@@ -0,0 +1,116 @@
+"""
+Caché de resultados para consultas TNSViewSet.records.
+
+La clave es un hash canónico de (pool_key, SQL generado por TNSQueryBuilder,
+parámetros) más la versión de cada tabla involucrada. El conteo se guarda
+aparte (su SQL no depende de la página), así que las páginas 2..N no vuelven
+a ejecutar el COUNT contra Firebird.
+
+Invalidación: los caminos de escritura (crear_tercero, emit_invoice,
+procedimientos) incrementan la versión de la tabla o de toda la base; las
+claves antiguas quedan huérfanas y expiran por TTL.
+
+Protección contra estampida: solo el proceso que obtiene el candado (cache.add)
+ejecuta la consulta; el resto espera a que aparezca el valor y, si se agota la
+espera, consulta directamente.
+"""
+import hashlib
+import json
+import logging
+import time
+from typing import Any, Callable, Iterable, List, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+PREFIJO = 'tns_records'
+TODAS_LAS_TABLAS = '*'
+
+
+def _canonico(valor: Any) -> str:
+    return json.dumps(valor, sort_keys=True, default=str, separators=(',', ':'))
+
+
+class TNSResultCache:
+    """Caché Redis de conteos y páginas de TNSViewSet.records para una base TNS (pool_key)."""
+
+    def __init__(self, pool_key: str):
+        self.pool_key = pool_key
+        self.habilitado = getattr(settings, 'TNS_RECORDS_CACHE_ENABLED', True)
+        self.ttl_default = getattr(settings, 'TNS_RECORDS_CACHE_TTL', 60)
+        self.ttl_tablas = {
+            tabla.upper(): ttl for tabla, ttl in getattr(settings, 'TNS_RECORDS_CACHE_TTLS', {}).items()
+        }
+        self.espera_candado = getattr(settings, 'TNS_RECORDS_CACHE_LOCK_WAIT', 10)
+
+    # ----------------------------------------------------------------- claves
+    def _clave_version(self, tabla: str) -> str:
+        return f"{PREFIJO}:ver:{self.pool_key}:{tabla.upper()}"
+
+    def _versiones(self, tablas: Iterable[str]) -> List[Any]:
+        claves = [self._clave_version(TODAS_LAS_TABLAS)] + [self._clave_version(t) for t in sorted(set(tablas))]
+        versiones = cache.get_many(claves)
+        return [versiones.get(clave, 0) for clave in claves]
+
+    def clave(self, tipo: str, tablas: Iterable[str], sql: str, params: Optional[list]) -> str:
+        tablas = [t.upper() for t in tablas]
+        huella = _canonico([self.pool_key, ' '.join(sql.split()), params or [], self._versiones(tablas)])
+        return f"{PREFIJO}:{tipo}:{self.pool_key}:{hashlib.sha256(huella.encode()).hexdigest()}"
+
+    def ttl(self, tablas: Iterable[str]) -> int:
+        # Con varias tablas (JOINs) manda la más volátil
+        return min([self.ttl_tablas.get(t.upper(), self.ttl_default) for t in tablas] or [self.ttl_default])
+
+    # ---------------------------------------------------------------- lectura
+    def obtener_o_calcular(self, tipo: str, tablas: List[str], sql: str, params: Optional[list],
+                           calcular: Callable[[], Any]):
+        """
+        Retorna (valor, desde_cache). Si no está en caché ejecuta calcular() una sola
+        vez entre procesos concurrentes y guarda el resultado con el TTL de las tablas.
+        """
+        if not self.habilitado:
+            return calcular(), False
+
+        clave = self.clave(tipo, tablas, sql, params)
+        valor = cache.get(clave)
+        if valor is not None:
+            return valor, True
+
+        candado = f"{clave}:lock"
+        if not cache.add(candado, 1, timeout=self.espera_candado + 30):
+            limite = time.monotonic() + self.espera_candado
+            while time.monotonic() < limite:
+                time.sleep(0.05)
+                valor = cache.get(clave)
+                if valor is not None:
+                    return valor, True
+            logger.warning(f"[tns_cache] Espera agotada para {tipo} en {self.pool_key[:8]}; consultando directo")
+            return calcular(), False
+
+        try:
+            valor = calcular()
+            cache.set(clave, valor, timeout=self.ttl(tablas))
+            return valor, False
+        finally:
+            cache.delete(candado)
+
+    # ---------------------------------------------------------- invalidación
+    def invalidar(self, tablas: Optional[Iterable[str]] = None):
+        """Invalida las tablas indicadas, o toda la base si tablas es None."""
+        for tabla in (tablas if tablas is not None else [TODAS_LAS_TABLAS]):
+            clave = self._clave_version(tabla)
+            try:
+                cache.incr(clave)
+            except ValueError:
+                cache.set(clave, 1, timeout=None)
+        logger.debug(f"[tns_cache] Invalidado {self.pool_key[:8]}: {list(tablas) if tablas else 'todas'}")
+
+
+def invalidar_resultados_tns(pool_key: str, tablas: Optional[Iterable[str]] = None):
+    """Hook para caminos de escritura: nunca debe romper la operación que lo llama."""
+    try:
+        TNSResultCache(pool_key).invalidar(tablas)
+    except Exception as e:
+        logger.warning(f"[tns_cache] No se pudo invalidar caché de {pool_key[:8]}: {e}")
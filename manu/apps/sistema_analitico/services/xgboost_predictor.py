@@ -6,6 +6,7 @@ from sklearn.model_selection import train_test_split
 from sklearn.metrics import mean_absolute_error
 import logging
 import joblib
+from django.conf import settings
 
 logger = logging.getLogger(__name__)
 
@@ -57,8 +58,13 @@ class XGBoostPredictor:
 
         return df_features
     
-    def entrenar_modelo_demanda(self, df, target_col='cantidad', test_size=0.2):
-        """Método IDÉNTICO pero GUARDA feature_names"""
+    def entrenar_modelo_demanda(self, df, target_col='cantidad', test_size=0.2, modelo_base=None):
+        """
+        Método IDÉNTICO pero GUARDA feature_names.
+
+        modelo_base: XGBoostPredictor entrenado antes; si tiene las mismas características
+        se agregan árboles sobre su booster (warm start) con su mismo escalador.
+        """
         try:
             if target_col not in df.columns:
                 logger.error(f"DataFrame no tiene columna '{target_col}'")
@@ -91,11 +97,24 @@ class XGBoostPredictor:
 
             X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=test_size, random_state=42)
 
-            X_train_scaled = self.scaler.fit_transform(X_train)
-            X_test_scaled = self.scaler.transform(X_test)
+            base = self._modelo_base_compatible(modelo_base)
+            if base is not None:
+                # El booster anterior se entrenó sobre datos escalados con su escalador: se conserva
+                self.scaler = base.scaler
+                X_train_scaled = pd.DataFrame(self.scaler.transform(X_train), columns=feature_cols)
+                X_test_scaled = pd.DataFrame(self.scaler.transform(X_test), columns=feature_cols)
+                self.model = XGBRegressor(
+                    n_estimators=getattr(settings, 'ML_XGB_ARBOLES_INCREMENTALES', 25), random_state=42
+                )
+                # xgb_model se copia: el predictor base (compartido en el registro) no se modifica
+                self.model.fit(X_train_scaled, y_train, xgb_model=base.model.get_booster())
+                logger.info(f"🔁 XGBoost warm start sobre {base.model.get_booster().num_boosted_rounds()} árboles")
+            else:
+                X_train_scaled = self.scaler.fit_transform(X_train)
+                X_test_scaled = self.scaler.transform(X_test)
 
-            self.model = XGBRegressor(n_estimators=100, random_state=42)
-            self.model.fit(X_train_scaled, y_train)
+                self.model = XGBRegressor(n_estimators=100, random_state=42)
+                self.model.fit(X_train_scaled, y_train)
 
             # ✅ FORZAR feature_names en el modelo
             self.model.get_booster().feature_names = self.feature_names_
@@ -107,13 +126,26 @@ class XGBoostPredictor:
                 'mae': mae,
                 'datos_entrenamiento': len(X_train),
                 'datos_prueba': len(X_test),
-                'caracteristicas_usadas': self.feature_names_
+                'caracteristicas_usadas': self.feature_names_,
+                'warm_start': base is not None,
+                'arboles': self.model.get_booster().num_boosted_rounds()
             }
 
         except Exception as e:
             logger.error(f"Error entrenando XGBoost: {e}")
             return None
     
+    def _modelo_base_compatible(self, modelo_base):
+        """El warm start solo es válido con las mismas características y sin codificadores categóricos."""
+        if modelo_base is None or getattr(modelo_base, 'model', None) is None:
+            return None
+        if list(modelo_base.feature_names_ or []) != self.feature_names_:
+            logger.info("XGBoost: las características cambiaron, se entrena desde cero")
+            return None
+        if modelo_base.label_encoders or self.label_encoders or not hasattr(modelo_base.scaler, 'mean_'):
+            return None
+        return modelo_base
+
     def predecir_demanda(self, df_futuro):
         """Método SIMPLIFICADO y ROBUSTO"""
         try:
@@ -127,74 +159,86 @@ class XGBoostPredictor:
 
             logger.info(f"📊 Iniciando predicción con {len(df_futuro)} filas")
 
-            # ✅ OBTENER CARACTERÍSTICAS DE FORMA DIRECTA
-            if hasattr(self, 'feature_names_') and self.feature_names_:
-                feature_cols = self.feature_names_
-                logger.info(f"✅ Usando características guardadas: {feature_cols}")
-            else:
-                # Intentar del modelo
-                try:
-                    feature_cols = self.model.get_booster().feature_names
-                    logger.info(f"✅ Usando características del modelo: {feature_cols}")
-                except:
-                    # Características básicas por defecto
-                    feature_cols = ['mes', 'año', 'trimestre', 'dia_semana']
-                    logger.warning(f"⚠️ Usando características por defecto: {feature_cols}")
-
-            # ✅ PREPARAR DATOS con características específicas
-            df_features = pd.DataFrame()
-            
-            # Características temporales básicas
-            if 'fecha' in df_futuro.columns:
-                df_features['mes'] = df_futuro['fecha'].dt.month
-                df_features['año'] = df_futuro['fecha'].dt.year
-                df_features['trimestre'] = (df_features['mes'] - 1) // 3 + 1
-                df_features['dia_semana'] = df_futuro['fecha'].dt.dayofweek
+            predicciones = self.predecir_lote(df_futuro)
+
+            # ✅ FORMATEAR RESULTADOS (vectorizado)
+            fechas = df_futuro['fecha']
+            if pd.api.types.is_datetime64_any_dtype(fechas):
+                fechas = fechas.dt.strftime('%Y-%m-%d')
             else:
-                # Valores por defecto
-                df_features['mes'] = 1
-                df_features['año'] = 2025
-                df_features['trimestre'] = 1
-                df_features['dia_semana'] = 0
-
-            # ✅ COMPLETAR CARACTERÍSTICAS FALTANTES
-            for col in feature_cols:
-                if col not in df_features.columns:
-                    if col in ['total_transacciones', 'ventas_mes', 'compras_mes', 'bodegas_unicas']:
-                        df_features[col] = 1
-                    elif col in ['es_implante', 'es_instrumental', 'es_equipo_poder']:
-                        df_features[col] = 0
-                    else:
-                        df_features[col] = 0  # Valor por defecto
-
-            logger.info(f"🎯 Características finales: {df_features.columns.tolist()}")
-
-            # ✅ ESCALAR Y PREDECIR
-            X = df_features[feature_cols]
-            
-            # Verificar escalador
-            if not hasattr(self.scaler, 'mean_'):
-                logger.warning("🔄 Inicializando escalador básico")
-                from sklearn.preprocessing import StandardScaler
-                self.scaler = StandardScaler()
-                self.scaler.fit(X)
-            
-            X_scaled = self.scaler.transform(X)
-            predicciones = self.model.predict(X_scaled)
-
-            # ✅ FORMATEAR RESULTADOS
-            resultados = []
-            for i, (idx, row) in enumerate(df_futuro.iterrows()):
-                resultados.append({
-                    'fecha': row['fecha'].strftime('%Y-%m-%d') if hasattr(row['fecha'], 'strftime') else str(row['fecha']),
-                    'articulo_codigo': row['articulo_codigo'],
-                    'articulo_nombre': row['articulo_nombre'],
-                    'prediccion': max(float(predicciones[i]), 0)  # No negativos
-                })
+                fechas = fechas.astype(str)
+            resultados = pd.DataFrame({
+                'fecha': fechas.to_numpy(),
+                'articulo_codigo': df_futuro['articulo_codigo'].to_numpy(),
+                'articulo_nombre': df_futuro['articulo_nombre'].to_numpy(),
+                'prediccion': predicciones
+            }).to_dict('records')
 
             logger.info(f"✅ XGBoost generó {len(resultados)} predicciones")
             return resultados
 
         except Exception as e:
             logger.error(f"❌ Error en XGBoost: {e}")
-            return []
\ No newline at end of file
+            return []
+
+    def _columnas_features(self):
+        if hasattr(self, 'feature_names_') and self.feature_names_:
+            return self.feature_names_
+        # Intentar del modelo
+        try:
+            feature_cols = self.model.get_booster().feature_names
+            if feature_cols:
+                return feature_cols
+        except Exception:
+            pass
+        # Características básicas por defecto
+        logger.warning("⚠️ Usando características por defecto")
+        return ['mes', 'año', 'trimestre', 'dia_semana']
+
+    def matriz_features(self, df_futuro: pd.DataFrame) -> pd.DataFrame:
+        """
+        Matriz de características futuras (una fila por artículo-mes), construida por
+        columnas: temporales a partir de la fecha, las demás desde df_futuro (features
+        del feature store) y valores neutros para las que no vengan.
+        """
+        feature_cols = self._columnas_features()
+        n = len(df_futuro)
+        fechas = df_futuro['fecha'] if 'fecha' in df_futuro.columns else None
+        if fechas is not None and n and pd.api.types.is_datetime64_any_dtype(fechas):
+            mes = fechas.dt.month.to_numpy()
+            columnas = {
+                'mes': mes,
+                'año': fechas.dt.year.to_numpy(),
+                'trimestre': (mes - 1) // 3 + 1,
+                'dia_semana': fechas.dt.dayofweek.to_numpy(),
+            }
+        else:
+            # Valores por defecto
+            columnas = {'mes': np.full(n, 1), 'año': np.full(n, 2025), 'trimestre': np.full(n, 1), 'dia_semana': np.full(n, 0)}
+
+        # ✅ COMPLETAR CARACTERÍSTICAS FALTANTES
+        for col in feature_cols:
+            if col in columnas:
+                continue
+            if col in df_futuro.columns:
+                columnas[col] = df_futuro[col].to_numpy(dtype=float)
+            elif col in ['total_transacciones', 'ventas_mes', 'compras_mes', 'bodegas_unicas']:
+                columnas[col] = np.ones(n)
+            else:
+                columnas[col] = np.zeros(n)  # Valor por defecto
+        return pd.DataFrame({col: columnas[col] for col in feature_cols})
+
+    def predecir_lote(self, df_futuro) -> np.ndarray:
+        """Predicciones (no negativas) para todas las filas de df_futuro en una sola llamada al booster."""
+        X = self.matriz_features(df_futuro)
+
+        # Verificar escalador (sin modificar self: el predictor puede estar compartido en el registro)
+        scaler = self.scaler
+        if not hasattr(scaler, 'mean_'):
+            logger.warning("🔄 Inicializando escalador básico")
+            from sklearn.preprocessing import StandardScaler
+            scaler = StandardScaler()
+            scaler.fit(X)
+
+        X_scaled = scaler.transform(X)
+        return np.maximum(self.model.predict(X_scaled).astype(float), 0)  # No negativos
@@ -221,6 +221,271 @@ def descubrir_empresas_task(self, servidor_id):
         }
 
 
+@shared_task(bind=True, name='sistema_analitico.sincronizar_movimientos_empresa')
+def sincronizar_movimientos_empresa_task(self, empresa_servidor_id):
+    """
+    Tarea Celery para sincronizar de forma incremental los movimientos TNS de una empresa.
+    
+    Args:
+        empresa_servidor_id: ID de la EmpresaServidor a sincronizar
+    
+    Returns:
+        dict con resultado de la sincronización
+    """
+    from .services.sincronizador_movimientos import SincronizadorMovimientos
+    
+    try:
+        self.update_state(
+            state='PROCESSING',
+            meta={
+                'empresa_servidor_id': empresa_servidor_id,
+                'status': 'Sincronizando movimientos...'
+            }
+        )
+        resultado = SincronizadorMovimientos().sincronizar(empresa_servidor_id)
+        return {'status': 'ERROR' if resultado.get('estado') == 'error' else 'SUCCESS', **resultado}
+    except Exception as e:
+        logger.error(f"Error sincronizando movimientos de empresa {empresa_servidor_id}: {e}", exc_info=True)
+        return {
+            'status': 'ERROR',
+            'error': str(e),
+            'empresa_servidor_id': empresa_servidor_id
+        }
+
+
+@shared_task(name='sistema_analitico.sincronizar_movimientos_todas_empresas')
+def sincronizar_movimientos_todas_empresas_task():
+    """
+    Tarea Celery programada (beat) que lanza la sincronización incremental de
+    movimientos para las empresas con consulta SQL configurada del año fiscal
+    actual y el anterior. Los años más antiguos se sincronizan bajo demanda.
+    """
+    from .models import EmpresaServidor
+    from datetime import date
+    
+    anio_actual = date.today().year
+    empresas = EmpresaServidor.objects.filter(
+        estado='ACTIVO',
+        servidor__tipo_servidor='FIREBIRD',
+        anio_fiscal__gte=anio_actual - 1,
+        consulta_sql__isnull=False,
+    ).exclude(consulta_sql='')
+    
+    tareas = []
+    for empresa in empresas:
+        task = sincronizar_movimientos_empresa_task.delay(empresa.id)
+        tareas.append({'empresa_servidor_id': empresa.id, 'task_id': task.id})
+    
+    logger.info(f"🔁 Sincronización incremental lanzada para {len(tareas)} empresa(s)")
+    return {
+        'status': 'SUCCESS',
+        'total_empresas': len(tareas),
+        'tareas': tareas
+    }
+
+
+@shared_task(bind=True, name='sistema_analitico.extraer_datos_nit')
+def extraer_datos_nit_task(self, nit_normalizado, fecha_inicio, fecha_fin, forzar_reextraccion=False):
+    """
+    Extrae en paralelo todas las empresas/años fiscales de un NIT, respetando el
+    límite de extracciones concurrentes de cada servidor.
+    
+    Args:
+        nit_normalizado: NIT sin puntos ni DV
+        fecha_inicio / fecha_fin: Rango en formato YYYY-MM-DD (se recorta a cada año fiscal)
+        forzar_reextraccion: Si True, re-extrae aunque ya exista
+    
+    Returns:
+        dict con el resumen por empresa y el throughput por servidor
+    """
+    from .services.extraccion_scheduler import ExtraccionScheduler, empresas_por_nit
+    
+    try:
+        empresas = empresas_por_nit(nit_normalizado)
+        if not empresas:
+            return {
+                'status': 'ERROR',
+                'error': f'No hay empresas activas con consulta SQL para el NIT {nit_normalizado}'
+            }
+        
+        def reportar_progreso(resumen):
+            self.update_state(state='PROCESSING', meta={'nit_normalizado': nit_normalizado, **resumen})
+        
+        scheduler = ExtraccionScheduler(progreso_callback=reportar_progreso)
+        resumen = scheduler.ejecutar(
+            empresas,
+            datetime.strptime(fecha_inicio, '%Y-%m-%d').date(),
+            datetime.strptime(fecha_fin, '%Y-%m-%d').date(),
+            forzar_reextraccion=forzar_reextraccion,
+        )
+        
+        logger.info(
+            f"📦 Extracción NIT {nit_normalizado}: {resumen['terminados']}/{resumen['total_trabajos']} "
+            f"trabajos, {resumen['registros_guardados']} registros"
+        )
+        return {
+            'status': 'SUCCESS',
+            'nit_normalizado': nit_normalizado,
+            **resumen
+        }
+    
+    except Exception as e:
+        logger.error(f"Excepción en tarea extraer_datos_nit: {e}", exc_info=True)
+        return {
+            'status': 'ERROR',
+            'error': str(e),
+            'nit_normalizado': nit_normalizado
+        }
+
+
+@shared_task(bind=True, name='sistema_analitico.refrescar_cache_columnar')
+def refrescar_cache_columnar_task(self, empresa_servidor_id, periodos=None):
+    """
+    Reconstruye las particiones Parquet de movimientos de una empresa.
+    
+    Args:
+        empresa_servidor_id: ID de la EmpresaServidor
+        periodos: Lista de 'YYYY-MM' a refrescar (None = empresa completa)
+    
+    Returns:
+        dict con periodos y filas escritas
+    """
+    from .services.movimientos_columnar import MovimientosColumnarCache
+    
+    try:
+        resultado = MovimientosColumnarCache().refrescar_empresa(empresa_servidor_id, periodos)
+        return {
+            'status': 'SUCCESS',
+            'empresa_servidor_id': empresa_servidor_id,
+            **resultado
+        }
+    except Exception as e:
+        logger.error(f"Excepción en tarea refrescar_cache_columnar: {e}", exc_info=True)
+        return {
+            'status': 'ERROR',
+            'error': str(e),
+            'empresa_servidor_id': empresa_servidor_id
+        }
+
+
+@shared_task(bind=True, name='sistema_analitico.recalcular_features_ml')
+def recalcular_features_ml_task(self, empresa_servidor_id, periodos=None):
+    """
+    Recalcula el feature store ML (FeatureArticuloMensual) del NIT de una empresa
+    para los meses ingeridos y las derivadas que dependen de ellos.
+    
+    Args:
+        empresa_servidor_id: ID de la EmpresaServidor cuyos movimientos cambiaron
+        periodos: Lista de 'YYYY-MM' a recalcular (None = todos)
+    
+    Returns:
+        dict con las filas escritas
+    """
+    from .services.cache_pronosticos import invalidar_pronosticos
+    from .services.feature_store import recalcular_features_empresa
+    from .services.ml_entrenamiento import modelo_id_empresa
+    
+    try:
+        filas = recalcular_features_empresa(empresa_servidor_id, periodos)
+        # Las recomendaciones leen el histórico: los pronósticos en caché quedan obsoletos
+        invalidar_pronosticos(modelo_id_empresa(empresa_servidor_id))
+        return {
+            'status': 'SUCCESS',
+            'empresa_servidor_id': empresa_servidor_id,
+            'filas': filas
+        }
+    except Exception as e:
+        logger.error(f"Excepción en tarea recalcular_features_ml: {e}", exc_info=True)
+        return {
+            'status': 'ERROR',
+            'error': str(e),
+            'empresa_servidor_id': empresa_servidor_id
+        }
+
+
+@shared_task(bind=True, name='sistema_analitico.entrenar_modelos_empresa')
+def entrenar_modelos_empresa_task(self, empresa_servidor_id, modelo_id, forzar=False):
+    """
+    Entrena (o re-entrena incrementalmente) los modelos ML del NIT de una empresa.
+    Enrutada a la cola ML_ENTRENAMIENTO_QUEUE (ver CELERY_TASK_ROUTES).
+    
+    Args:
+        empresa_servidor_id: ID de cualquier EmpresaServidor del NIT
+        modelo_id: empresa_{nit}, clave de deduplicación de la cola
+        forzar: Si True, re-entrena desde cero aunque no haya movimientos nuevos
+    
+    Returns:
+        dict con el resultado del entrenamiento
+    """
+    import json
+    from .services.ml_engine import MLEngine
+    from .services.ml_entrenamiento import liberar_entrenamiento
+    
+    try:
+        self.update_state(
+            state='PROCESSING',
+            meta={
+                'empresa_servidor_id': empresa_servidor_id,
+                'modelo_id': modelo_id,
+                'status': 'Entrenando modelos...'
+            }
+        )
+        resultado = MLEngine().entrenar_modelos_empresa(empresa_servidor_id, incremental=not forzar)
+        if 'error' in resultado:
+            return {
+                'status': 'ERROR',
+                'error': resultado['error'],
+                'empresa_servidor_id': empresa_servidor_id,
+                'modelo_id': modelo_id
+            }
+        if resultado.get('estado') == 'modelos_entrenados':
+            precalentar_pronosticos_ml_task.delay(empresa_servidor_id, modelo_id)
+        # Métricas de numpy/xgboost a tipos JSON para el backend de resultados
+        return {'status': 'SUCCESS', **json.loads(json.dumps(resultado, default=str))}
+    except Exception as e:
+        logger.error(f"Error entrenando modelos de {modelo_id}: {e}", exc_info=True)
+        return {
+            'status': 'ERROR',
+            'error': str(e),
+            'empresa_servidor_id': empresa_servidor_id,
+            'modelo_id': modelo_id
+        }
+    finally:
+        liberar_entrenamiento(modelo_id, self.request.id)
+
+
+@shared_task(bind=True, name='sistema_analitico.precalentar_pronosticos_ml')
+def precalentar_pronosticos_ml_task(self, empresa_servidor_id, modelo_id):
+    """
+    Recalcula y deja en caché los pronósticos más consultados de un modelo recién
+    re-entrenado (ver services/cache_pronosticos.py).
+    
+    Args:
+        empresa_servidor_id: ID de cualquier EmpresaServidor del NIT
+        modelo_id: empresa_{nit}
+    
+    Returns:
+        dict con las combinaciones precalentadas
+    """
+    from .services.cache_pronosticos import precalentar_pronosticos
+    from .services.ml_engine import MLEngine
+    
+    try:
+        precalentadas = precalentar_pronosticos(MLEngine(), empresa_servidor_id, modelo_id)
+        return {
+            'status': 'SUCCESS',
+            'modelo_id': modelo_id,
+            'precalentadas': precalentadas
+        }
+    except Exception as e:
+        logger.error(f"Error precalentando pronósticos de {modelo_id}: {e}", exc_info=True)
+        return {
+            'status': 'ERROR',
+            'error': str(e),
+            'modelo_id': modelo_id
+        }
+
+
 @shared_task(bind=True, name='sistema_analitico.obtener_info_ciiu')
 def obtener_info_ciiu_task(self, codigo_ciiu: str, forzar_actualizacion: bool = False):
     """
@@ -521,25 +786,61 @@ def procesar_codigos_ciiu_masivo_task(self, codigos_ciiu: list):
         }
 
 
-@shared_task(bind=True, name='sistema_analitico.realizar_backup_empresa', rate_limit='4/m')  # Máximo 4 backups simultáneos por minuto
-def realizar_backup_empresa_task(self, empresa_id: int, configuracion_s3_id: int):
+@shared_task(bind=True, name='sistema_analitico.realizar_backup_empresa')
+def realizar_backup_empresa_task(self, empresa_id: int, configuracion_s3_id: int, cupo: str = None):
     """
     Tarea Celery para realizar backup de una empresa específica a S3.
     
+    La concurrencia la limita el planificador (backup_scheduler) por servidor: si la
+    tarea no trae un cupo reservado toma uno, y si el servidor está lleno se
+    reintenta cada BACKUP_ESPERA_CUPO segundos. Al terminar libera el cupo y
+    despacha el siguiente backup pendiente del mismo servidor.
+    
     Args:
         empresa_id: ID de la empresa
         configuracion_s3_id: ID de la configuración S3 a utilizar
+        cupo: Cupo del servidor reservado por el planificador (opcional)
         
     Returns:
         dict con resultado del backup
     """
+    from celery.exceptions import Retry
+    from django.conf import settings
     from .models import EmpresaServidor, ConfiguracionS3
     from .services.backup_s3_service import BackupS3Service
+    from .services import backup_scheduler
     
+    task_id = self.request.id
+    empresa = None
     try:
-        empresa = EmpresaServidor.objects.get(id=empresa_id)
+        empresa = EmpresaServidor.objects.select_related('servidor').get(id=empresa_id)
         config_s3 = ConfiguracionS3.objects.get(id=configuracion_s3_id, activo=True)
         
+        if not backup_scheduler.reservar_empresa(empresa_id, task_id):
+            empresa = None  # La reserva pertenece al otro backup
+            backup_scheduler.liberar_cupo(cupo, task_id)
+            logger.info(f"⏭️ Ya hay un backup en curso para la empresa {empresa_id}")
+            return {
+                'status': 'SKIPPED',
+                'empresa_id': empresa_id,
+                'mensaje': 'Ya hay un backup en curso para esta empresa'
+            }
+        if cupo is None:
+            cupo = backup_scheduler.tomar_cupo(empresa.servidor, task_id)
+            if cupo is None:
+                backup_scheduler.liberar_empresa(empresa_id, task_id)
+                espera = getattr(settings, 'BACKUP_ESPERA_CUPO', 60)
+                max_reintentos = getattr(settings, 'BACKUP_MAX_ESPERA_CUPO', 24 * 3600) // espera
+                if self.request.retries >= max_reintentos:
+                    logger.error(f"Backup de {empresa.nombre} cancelado: {empresa.servidor.nombre} sin cupos libres")
+                    return {
+                        'status': 'ERROR',
+                        'empresa_id': empresa_id,
+                        'error': f'El servidor {empresa.servidor.nombre} no tuvo cupos de backup libres'
+                    }
+                logger.info(f"⏳ Servidor {empresa.servidor.nombre} sin cupos de backup, reintentando en {espera}s")
+                raise self.retry(countdown=espera, max_retries=max_reintentos)
+        
         logger.info(f"🔄 Iniciando backup para empresa {empresa.nombre} (ID: {empresa_id})")
         
         # Crear servicio
@@ -573,7 +874,7 @@ def realizar_backup_empresa_task(self, empresa_id: int, configuracion_s3_id: int
         
         if exito:
             logger.info(f"Backup completado exitosamente para {empresa.nombre}: {backup_s3.ruta_s3}")
-            return {
+            resultado = {
                 'status': 'SUCCESS',
                 'empresa_id': empresa_id,
                 'backup_id': backup_s3.id,
@@ -583,32 +884,56 @@ def realizar_backup_empresa_task(self, empresa_id: int, configuracion_s3_id: int
             }
         else:
             logger.error(f"Error en backup para {empresa.nombre}: {mensaje_error}")
-            return {
+            backup_scheduler.registrar_fallo(empresa_id)
+            resultado = {
                 'status': 'ERROR',
                 'empresa_id': empresa_id,
                 'error': mensaje_error or 'Error desconocido al realizar backup'
             }
+        
+        _liberar_cupo_backup(empresa, cupo, task_id, configuracion_s3_id)
+        return resultado
             
+    except Retry:
+        raise
     except EmpresaServidor.DoesNotExist:
         logger.error(f"Empresa con ID {empresa_id} no existe")
+        backup_scheduler.liberar_cupo(cupo, task_id)
         return {
             'status': 'ERROR',
             'error': f'Empresa con ID {empresa_id} no existe'
         }
     except ConfiguracionS3.DoesNotExist:
         logger.error(f"Configuración S3 con ID {configuracion_s3_id} no existe o no está activa")
+        backup_scheduler.liberar_cupo(cupo, task_id)
+        backup_scheduler.liberar_empresa(empresa_id, task_id)
         return {
             'status': 'ERROR',
             'error': f'Configuración S3 con ID {configuracion_s3_id} no existe o no está activa'
         }
     except Exception as e:
         logger.error(f"Error inesperado en backup para empresa {empresa_id}: {e}", exc_info=True)
+        if empresa is not None:
+            backup_scheduler.registrar_fallo(empresa_id)
+            _liberar_cupo_backup(empresa, cupo, task_id, configuracion_s3_id)
         return {
             'status': 'ERROR',
             'error': str(e)
         }
 
 
+def _liberar_cupo_backup(empresa, cupo, task_id: str, configuracion_s3_id: int):
+    """Libera cupo y reserva del backup terminado y despacha el siguiente del mismo servidor."""
+    from .services import backup_scheduler
+    
+    backup_scheduler.liberar_cupo(cupo, task_id)
+    backup_scheduler.liberar_empresa(empresa.id, task_id)
+    try:
+        backup_scheduler.despachar(configuracion_s3_id, servidor_ids=[empresa.servidor_id])
+    except Exception as e:
+        logger.warning(f"⚠️ No se pudo despachar el siguiente backup de {empresa.servidor.nombre}: {e}")
+
+
 @shared_task(name='sistema_analitico.explorar_empresas_todos_servidores')
 def explorar_empresas_todos_servidores_task():
     """
@@ -682,6 +1007,42 @@ def explorar_empresas_todos_servidores_task():
         }
 
 
+@shared_task(bind=True, name='sistema_analitico.reconciliar_indice_s3')
+def reconciliar_indice_s3_task(self, configuracion_s3_id: int = None):
+    """
+    Reconcilia el índice de objetos S3 (ObjetoS3) con el contenido real del bucket.
+    Programada diariamente; la primera ejecución habilita el uso del índice en cuotas,
+    explorador de archivos y estadísticas.
+    
+    Args:
+        configuracion_s3_id: Configuración a reconciliar (por defecto todas las activas)
+    """
+    from .models import ConfiguracionS3
+    from .services.backup_s3_service import BackupS3Service
+    from .services import indice_s3
+    
+    configuraciones = ConfiguracionS3.objects.filter(activo=True)
+    if configuracion_s3_id:
+        configuraciones = ConfiguracionS3.objects.filter(id=configuracion_s3_id)
+    
+    resultados = []
+    errores = 0
+    for config in configuraciones:
+        try:
+            servicio = BackupS3Service(config)
+            resultado = indice_s3.reconciliar(config, servicio.s3_client, servicio.bucket_name)
+            resultados.append({'configuracion_s3_id': config.id, **resultado})
+        except Exception as e:
+            errores += 1
+            logger.error(f"❌ Error reconciliando índice S3 de {config.nombre}: {e}", exc_info=True)
+            resultados.append({'configuracion_s3_id': config.id, 'error': str(e)})
+    
+    return {
+        'status': 'ERROR' if errores and errores == len(resultados) else 'SUCCESS',
+        'configuraciones': resultados,
+    }
+
+
 @shared_task(bind=True, name='sistema_analitico.convertir_backup_a_gdb')
 def convertir_backup_a_gdb_task(self, descarga_temporal_id: int):
     """
@@ -695,9 +1056,7 @@ def convertir_backup_a_gdb_task(self, descarga_temporal_id: int):
     """
     from .models import DescargaTemporalBackup, ConfiguracionS3
     from .services.backup_s3_service import BackupS3Service
-    import tempfile
     import os
-    import subprocess
     import secrets
     
     try:
@@ -718,22 +1077,6 @@ def convertir_backup_a_gdb_task(self, descarga_temporal_id: int):
         
         servicio = BackupS3Service(config_s3)
         
-        # Descargar FBK desde S3
-        temp_dir = tempfile.gettempdir()
-        # Generar nombre de archivo temporal: usar backup.nombre_archivo si existe y no está vacío, sino generar uno por defecto
-        if backup.nombre_archivo and backup.nombre_archivo.strip():
-            nombre_temp = backup.nombre_archivo
-        else:
-            fecha_str = backup.fecha_backup.strftime('%Y%m%d_%H%M%S') if backup.fecha_backup else 'unknown'
-            nombre_temp = f"backup_{empresa.nit_normalizado if empresa else 'unknown'}_{fecha_str}.fbk"
-        temp_fbk = os.path.join(temp_dir, f"backup_{backup.id}_{nombre_temp}")
-        
-        servicio.s3_client.download_file(
-            servicio.bucket_name,
-            backup.ruta_s3,
-            temp_fbk
-        )
-        
         # Obtener nombre del archivo GDB
         ruta_base = empresa.ruta_base
         nombre_gdb = os.path.basename(ruta_base)
@@ -756,430 +1099,16 @@ def convertir_backup_a_gdb_task(self, descarga_temporal_id: int):
             else:
                 nombre_gdb = f"{empresa.codigo}.GDB"
         
-        # Crear ruta temporal para GDB (en una carpeta persistente para que dure 1 día)
-        gdb_dir = os.path.join(temp_dir, 'backups_gdb_temporales')
-        os.makedirs(gdb_dir, exist_ok=True)
-        temp_gdb = os.path.join(gdb_dir, f"{descarga.token}_{nombre_gdb}")
-        
-        # Buscar gbak
-        gbak_path = None
-        posibles_rutas = [
-            '/opt/firebird2.5/bin/gbak',
-            '/opt/firebird2.5/opt/firebird/bin/gbak',
-            '/usr/local/bin/gbak',
-            '/usr/bin/gbak',
-            'gbak'
-        ]
-        
-        for ruta in posibles_rutas:
-            if os.path.exists(ruta) or ruta == 'gbak':
-                try:
-                    result = subprocess.run(
-                        [ruta, '-?'],
-                        capture_output=True,
-                        timeout=5
-                    )
-                    gbak_path = ruta
-                    break
-                except:
-                    continue
-        
-        if not gbak_path:
-            descarga.estado = 'expirado'
-            descarga.save()
-            raise ValueError('No se encontró gbak para convertir el backup')
-        
-        # Verificar si el servidor Firebird está instalado (no solo gbak)
-        # Si gbak está en /opt/firebird2.5, el servidor probablemente también está ahí
-        firebird_server_path = None
-        posibles_servidores = [
-            '/opt/firebird2.5/bin/fbserver',
-            '/opt/firebird2.5/opt/firebird/bin/fbserver',
-            '/opt/firebird2.5/bin/firebird',
-            '/usr/sbin/fbserver',
-            '/usr/lib/firebird/2.5/bin/fbserver',
-            '/usr/lib/firebird/3.0/bin/fbserver'
-        ]
-        for ruta_servidor in posibles_servidores:
-            if os.path.exists(ruta_servidor):
-                firebird_server_path = ruta_servidor
-                logger.info(f"✅ Servidor Firebird encontrado en: {ruta_servidor}")
-                break
-        
-        # Si gbak está en /opt/firebird2.5, buscar servidor en la misma ubicación
-        if not firebird_server_path and gbak_path and '/opt/firebird2.5' in gbak_path:
-            # Extraer directorio base de gbak
-            gbak_dir = os.path.dirname(gbak_path)
-            posibles_rutas_relativas = [
-                os.path.join(gbak_dir, 'fbserver'),
-                os.path.join(gbak_dir, 'firebird'),
-                os.path.join(os.path.dirname(gbak_dir), 'fbserver'),
-                os.path.join(os.path.dirname(gbak_dir), 'firebird'),
-            ]
-            for ruta_rel in posibles_rutas_relativas:
-                if os.path.exists(ruta_rel):
-                    firebird_server_path = ruta_rel
-                    logger.info(f"✅ Servidor Firebird encontrado cerca de gbak: {ruta_rel}")
-                    break
-        
-        # Verificar si el servidor Firebird está corriendo (gbak -c lo requiere)
-        # Intentar verificar con systemctl o ps
-        firebird_running = False
-        try:
-            # Verificar si firebird está corriendo
-            check_firebird = subprocess.run(
-                ['systemctl', 'is-active', '--quiet', 'firebird2.5'],
-                capture_output=True,
-                timeout=2
-            )
-            if check_firebird.returncode == 0:
-                firebird_running = True
-                logger.info("✅ Servidor Firebird 2.5 está corriendo")
-        except:
-            try:
-                # Intentar con firebird3.0
-                check_firebird = subprocess.run(
-                    ['systemctl', 'is-active', '--quiet', 'firebird3.0'],
-                    capture_output=True,
-                    timeout=2
-                )
-                if check_firebird.returncode == 0:
-                    firebird_running = True
-                    logger.info("✅ Servidor Firebird 3.0 está corriendo")
-            except:
-                pass
-        
-        if not firebird_running:
-            # Intentar verificar con ps
-            try:
-                check_ps = subprocess.run(
-                    ['ps', 'aux'],
-                    capture_output=True,
-                    text=True,
-                    timeout=2
-                )
-                if 'firebird' in check_ps.stdout.lower() or 'fbserver' in check_ps.stdout.lower():
-                    firebird_running = True
-                    logger.info("✅ Servidor Firebird detectado en procesos")
-            except:
-                pass
-        
-        if not firebird_running:
-            logger.warning("⚠️ Servidor Firebird no detectado como corriendo. Intentando iniciarlo...")
-            
-            # Primero intentar con systemctl (si está configurado como servicio)
-            try:
-                start_result = subprocess.run(
-                    ['sudo', 'systemctl', 'start', 'firebird2.5'],
-                    capture_output=True,
-                    text=True,
-                    timeout=10
-                )
-                if start_result.returncode == 0:
-                    logger.info("✅ Servidor Firebird 2.5 iniciado exitosamente (systemctl)")
-                    firebird_running = True
-                    import time
-                    time.sleep(2)
-            except Exception as e:
-                logger.debug(f"systemctl firebird2.5 no disponible: {e}")
-            
-            # Si aún no está corriendo, intentar con firebird3.0
-            if not firebird_running:
-                try:
-                    start_result = subprocess.run(
-                        ['sudo', 'systemctl', 'start', 'firebird3.0'],
-                        capture_output=True,
-                        text=True,
-                        timeout=10
-                    )
-                    if start_result.returncode == 0:
-                        logger.info("✅ Servidor Firebird 3.0 iniciado exitosamente (systemctl)")
-                        firebird_running = True
-                        import time
-                        time.sleep(2)
-                except Exception as e:
-                    logger.debug(f"systemctl firebird3.0 no disponible: {e}")
-            
-            # Si tenemos la ruta del servidor pero no está corriendo, intentar iniciarlo directamente
-            # (para instalaciones manuales de Firebird 2.5 que no tienen systemd)
-            if not firebird_running and firebird_server_path:
-                logger.info(f"💡 Intentando iniciar servidor Firebird directamente desde: {firebird_server_path}")
-                logger.warning("⚠️ NOTA: Para instalaciones manuales, el servidor puede necesitar iniciarse manualmente.")
-                logger.warning("💡 Si el servidor no está corriendo, gbak -c fallará.")
-                logger.warning("💡 Opciones:")
-                logger.warning("   1. Iniciar servidor manualmente antes de solicitar conversión GDB")
-                logger.warning("   2. Configurar Firebird como servicio systemd")
-                logger.warning("   3. Usar Firebird en modo embedded (si está disponible)")
-            
-            if not firebird_running:
-                logger.error("❌ No se pudo iniciar el servidor Firebird. gbak -c requiere que el servidor esté corriendo.")
-                if firebird_server_path:
-                    logger.error(f"💡 Servidor encontrado en: {firebird_server_path}")
-                    logger.error("💡 Inicia manualmente el servidor antes de solicitar conversión GDB")
-                else:
-                    logger.error("💡 Instala el servidor Firebird: sudo apt-get install firebird3.0-server")
-                    logger.error("   O instala Firebird 2.5 manualmente (ver docs/INSTALAR_FIREBIRD_2.5_UBUNTU.md)")
-        
-        # Asegurar que el archivo de destino no exista (gbak -c requiere que no exista)
-        if os.path.exists(temp_gdb):
-            logger.warning(f"⚠️ El archivo GDB ya existe, eliminándolo: {temp_gdb}")
-            os.remove(temp_gdb)
-        
-        # Convertir FBK a GDB
-        # NOTA: gbak -c requiere que el servidor Firebird esté corriendo
-        # Para Firebird, el formato correcto para archivos locales es:
-        # - Con localhost/3050:ruta (puerto explícito) - más confiable
-        # - Con localhost:ruta (puerto por defecto 3050)
-        # Intentar primero con localhost/3050: (más explícito y confiable)
-        temp_gdb_firebird = f"localhost/3050:{temp_gdb}"
-        
-        comando = [
-            gbak_path,
-            '-c',  # Create database
-            '-v',  # Verbose
-            '-user', 'SYSDBA',
-            '-password', 'masterkey',
-            temp_fbk,  # Archivo FBK de origen (local)
-            temp_gdb_firebird  # Archivo GDB de destino (formato localhost/3050:)
-        ]
-        
-        logger.info(f"⏳ Convirtiendo backup a GDB: {' '.join(comando)}")
-        logger.info(f"📁 FBK origen: {temp_fbk}")
-        logger.info(f"📁 GDB destino: {temp_gdb} (formato Firebird: {temp_gdb_firebird})")
-        
-        # Configurar variables de entorno para manejar caracteres especiales
-        env = os.environ.copy()
-        env['LC_ALL'] = 'C.UTF-8'
-        env['LANG'] = 'C.UTF-8'
-        
-        # Asegurar que el directorio temporal existe y tiene permisos correctos
-        gdb_dir = os.path.dirname(temp_gdb)
-        os.makedirs(gdb_dir, exist_ok=True)
-        # Establecer umask para que los archivos se creen con permisos 644
-        import stat
-        old_umask = os.umask(0o022)  # Permisos: 644 (rw-r--r--)
-        
-        # Obtener tamaño del FBK para validar después
-        fbk_size = os.path.getsize(temp_fbk) if os.path.exists(temp_fbk) else 0
-        logger.info(f"📊 Tamaño del FBK: {fbk_size / (1024*1024):.2f} MB")
-        
-        try:
-            resultado = subprocess.run(
-                comando,
-                capture_output=True,
-                text=True,
-                timeout=600,  # 10 minutos máximo
-                env=env
-            )
-        finally:
-            # Restaurar umask original
-            os.umask(old_umask)
-        
-        # Verificar si hubo errores (incluso si returncode es 0, gbak puede reportar errores)
-        output_completo = (resultado.stdout or '') + (resultado.stderr or '')
-        tiene_error = (
-            resultado.returncode != 0 or
-            'ERROR:' in output_completo or
-            'failed to create database' in output_completo.lower() or
-            'Error reading data from the connection' in output_completo or
-            'do not recognize record type' in output_completo.lower()
-        )
-        
-        # Si falla, intentar con formato alternativo (sin puerto explícito)
-        if tiene_error:
-            error_msg = resultado.stderr or resultado.stdout or "Error desconocido"
-            logger.warning(f"⚠️ Primer intento falló. Error: {error_msg[:200]}")
-            
-            # Limpiar archivo parcial si existe
-            if os.path.exists(temp_gdb):
-                logger.warning(f"⚠️ Eliminando archivo GDB parcial: {temp_gdb}")
-                os.remove(temp_gdb)
-            
-            if "Error reading data from the connection" in error_msg or "Unable to complete network request" in error_msg:
-                logger.warning(f"⚠️ Intentando con formato localhost: (sin puerto explícito)...")
-                temp_gdb_firebird = f"localhost:{temp_gdb}"
-                comando[-1] = temp_gdb_firebird
-                logger.info(f"🔄 Reintentando con: {' '.join(comando)}")
-                
-                resultado = subprocess.run(
-                    comando,
-                    capture_output=True,
-                    text=True,
-                    timeout=600,
-                    env=env
-                )
-                
-                # Verificar de nuevo
-                output_completo = (resultado.stdout or '') + (resultado.stderr or '')
-                tiene_error = (
-                    resultado.returncode != 0 or
-                    'ERROR:' in output_completo or
-                    'failed to create database' in output_completo.lower() or
-                    'Error reading data from the connection' in output_completo
-                )
-        
-        # Limpiar FBK temporal
-        if os.path.exists(temp_fbk):
-            os.remove(temp_fbk)
-        
-        # Verificar que el archivo GDB se creó y tiene un tamaño razonable
-        gdb_existe = os.path.exists(temp_gdb)
-        gdb_size = os.path.getsize(temp_gdb) if gdb_existe else 0
-        
-        if gdb_existe:
-            logger.info(f"📊 Archivo GDB creado. Tamaño: {gdb_size / (1024*1024):.2f} MB")
-            # El GDB normalmente es más pequeño que el FBK (el FBK está comprimido)
-            # Para un FBK de 24MB, un GDB de 1.6MB puede ser razonable si está muy comprimido
-            # Pero si es menor a 500KB para un FBK grande, probablemente está incompleto
-            if fbk_size > 0 and gdb_size < (fbk_size * 0.02):  # Menos del 2% del tamaño del FBK
-                logger.error(f"❌ Archivo GDB demasiado pequeño ({gdb_size} bytes, {gdb_size / (1024*1024):.2f} MB) para un FBK de {fbk_size / (1024*1024):.2f} MB. Probablemente incompleto.")
-                tiene_error = True
-            elif gdb_size < 500 * 1024:  # Menos de 500KB en general
-                logger.error(f"❌ Archivo GDB demasiado pequeño ({gdb_size} bytes). Probablemente incompleto.")
-                tiene_error = True
-        
-        if tiene_error or not gdb_existe:
-            error_msg = resultado.stderr or resultado.stdout or "Error desconocido"
-            logger.error(f"❌ Error convirtiendo backup a GDB: {error_msg}")
-            logger.error(f"📊 Estado: returncode={resultado.returncode}, GDB existe={gdb_existe}, tamaño={gdb_size}")
-            
-            # Limpiar archivo parcial si existe
-            if gdb_existe:
-                try:
-                    os.remove(temp_gdb)
-                except:
-                    pass
-            
-            # Agregar mensaje más claro según el tipo de error
-            if "Unable to complete network request" in error_msg or "Error reading data from the connection" in error_msg:
-                error_msg += "\n\n💡 NOTA: gbak -c requiere que el servidor Firebird esté corriendo. Verifica con: sudo systemctl status firebird2.5 o firebird3.0"
-                error_msg += "\n💡 Si el servidor está corriendo, puede ser un problema de timeout o buffer. Intenta aumentar el timeout o verificar los logs del servidor."
-            elif "do not recognize record type" in error_msg.lower():
-                error_msg += "\n\n💡 NOTA: Este error puede indicar que el backup FBK está corrupto, incompleto, o fue creado con una versión incompatible de Firebird."
-                error_msg += "\n💡 Verifica que el backup FBK esté completo y no corrupto. Intenta crear un nuevo backup si el problema persiste."
-            
-            descarga.estado = 'expirado'
-            descarga.save()
-            raise Exception(f'Error al convertir backup a GDB: {error_msg}')
+        # Restaurar (o tomar de la caché) el GDB del backup: las descargas del mismo
+        # backup comparten el archivo y las solicitudes simultáneas una restauración
+        from .services.restauracion_gdb import obtener_gdb
+        temp_gdb = obtener_gdb(servicio, backup, nombre_gdb)
         
         # Guardar ruta del GDB
         descarga.ruta_gdb_temporal = temp_gdb
         descarga.estado = 'listo'
         descarga.save()
         
-        # Asegurar permisos de lectura para el usuario de Django/Celery
-        # El archivo GDB puede haber sido creado por el servidor Firebird con permisos del usuario 'firebird'
-        # Necesitamos hacerlo legible por el usuario que corre Django/Celery (probablemente 'victus')
-        # IMPORTANTE: Siempre ejecutar chown y chmod con sudo para asegurar permisos correctos
-        try:
-            import stat
-            import pwd
-            
-            # Obtener el usuario actual que ejecuta Celery/Django
-            try:
-                current_uid = os.getuid()
-                current_user_info = pwd.getpwuid(current_uid)
-                current_user = current_user_info.pw_name
-                current_gid = current_user_info.pw_gid
-                logger.info(f"👤 Usuario actual de Celery/Django: {current_user} (UID: {current_uid}, GID: {current_gid})")
-            except Exception as e:
-                # Fallback si no podemos obtener el usuario (Windows o error)
-                current_user = os.getenv('USER') or os.getenv('USERNAME') or 'victus'
-                logger.warning(f"⚠️ No se pudo obtener UID, usando usuario por defecto: {current_user}")
-            
-            # Obtener propietario actual del archivo ANTES de cambiar
-            try:
-                file_stat_before = os.stat(temp_gdb)
-                file_uid_before = file_stat_before.st_uid
-                file_gid_before = file_stat_before.st_gid
-                file_owner_before = pwd.getpwuid(file_uid_before).pw_name if file_uid_before else 'unknown'
-                logger.info(f"📁 Propietario ANTES: {file_owner_before} (UID: {file_uid_before}, GID: {file_gid_before})")
-            except Exception as e:
-                logger.warning(f"⚠️ No se pudo obtener propietario del archivo: {e}")
-                file_owner_before = 'unknown'
-            
-            # SIEMPRE ejecutar chown y chmod con sudo para asegurar permisos correctos
-            # Esto es necesario porque el archivo puede haber sido creado por Firebird con otro usuario
-            logger.info(f"🔧 Ejecutando chown y chmod para asegurar permisos correctos...")
-            
-            # Paso 1: Cambiar propietario con sudo (SIEMPRE, sin importar quién sea el propietario actual)
-            try:
-                result_chown = subprocess.run(
-                    ['sudo', 'chown', f'{current_user}:{current_user}', temp_gdb],
-                    check=True,
-                    timeout=10,
-                    capture_output=True,
-                    text=True
-                )
-                logger.info(f"✅ chown ejecutado exitosamente: {result_chown.stdout if result_chown.stdout else 'sin salida'}")
-            except subprocess.CalledProcessError as e:
-                logger.error(f"❌ Error en chown (código {e.returncode}): {e.stderr}")
-                # Continuar e intentar chmod de todas formas
-            except Exception as e:
-                logger.error(f"❌ Excepción ejecutando chown: {e}")
-                # Continuar e intentar chmod de todas formas
-            
-            # Paso 2: Establecer permisos 644 con sudo (SIEMPRE)
-            try:
-                result_chmod = subprocess.run(
-                    ['sudo', 'chmod', '644', temp_gdb],
-                    check=True,
-                    timeout=10,
-                    capture_output=True,
-                    text=True
-                )
-                logger.info(f"✅ chmod ejecutado exitosamente: {result_chmod.stdout if result_chmod.stdout else 'sin salida'}")
-            except subprocess.CalledProcessError as e:
-                logger.error(f"❌ Error en chmod (código {e.returncode}): {e.stderr}")
-                # Intentar chmod directo como fallback
-                try:
-                    os.chmod(temp_gdb, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
-                    logger.info(f"✅ chmod directo exitoso como fallback")
-                except Exception as e2:
-                    logger.error(f"❌ chmod directo también falló: {e2}")
-            except Exception as e:
-                logger.error(f"❌ Excepción ejecutando chmod: {e}")
-                # Intentar chmod directo como fallback
-                try:
-                    os.chmod(temp_gdb, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
-                    logger.info(f"✅ chmod directo exitoso como fallback")
-                except Exception as e2:
-                    logger.error(f"❌ chmod directo también falló: {e2}")
-            
-            # Paso 3: Verificar que el archivo es legible
-            if not os.access(temp_gdb, os.R_OK):
-                logger.error(f"❌ El archivo GDB aún no es legible después de cambiar permisos")
-                # Último intento: ejecutar ambos comandos de nuevo
-                logger.warning(f"⚠️ Intentando corrección final de permisos...")
-                try:
-                    subprocess.run(['sudo', 'chown', f'{current_user}:{current_user}', temp_gdb], check=True, timeout=10)
-                    subprocess.run(['sudo', 'chmod', '644', temp_gdb], check=True, timeout=10)
-                    if not os.access(temp_gdb, os.R_OK):
-                        raise Exception("El archivo GDB no es legible después de todos los intentos")
-                    logger.info(f"✅ Permisos corregidos en último intento")
-                except Exception as e:
-                    logger.error(f"❌ Error final estableciendo permisos: {e}")
-                    raise Exception(f"No se pudieron establecer permisos de lectura para el archivo GDB: {e}")
-            
-            # Paso 4: Verificar propietario y permisos finales
-            try:
-                final_stat = os.stat(temp_gdb)
-                final_owner = pwd.getpwuid(final_stat.st_uid).pw_name if final_stat.st_uid else 'unknown'
-                final_perms = oct(final_stat.st_mode)[-3:]
-                logger.info(f"✅ Permisos FINALES verificados: propietario={final_owner}, permisos={final_perms}, legible={os.access(temp_gdb, os.R_OK)}")
-                
-                # Verificar que el propietario es el correcto
-                if final_owner != current_user:
-                    logger.warning(f"⚠️ ADVERTENCIA: El propietario final ({final_owner}) no coincide con el usuario actual ({current_user})")
-                    logger.warning(f"⚠️ Esto puede causar problemas de lectura. Verifica los permisos manualmente si es necesario.")
-            except Exception as e:
-                logger.warning(f"⚠️ No se pudo verificar propietario final: {e}")
-            
-        except Exception as e:
-            logger.error(f"❌ Error crítico estableciendo permisos del GDB: {e}", exc_info=True)
-            # No fallar la tarea, pero registrar el error
-            # El usuario puede intentar cambiar permisos manualmente si es necesario
-        
         logger.info(f"✅ Backup convertido exitosamente a GDB: {temp_gdb}")
         
         # Enviar correo con el link de descarga
@@ -1598,31 +1527,24 @@ def enviar_backup_fbk_por_email_task(self, descarga_temporal_id: int):
         }
 
 
-@shared_task(name='sistema_analitico.procesar_backups_programados', rate_limit='20/m')  # Máximo 20 por minuto (aumentado de 10)
+@shared_task(name='sistema_analitico.procesar_backups_programados')
 def procesar_backups_programados_task():
     """
-    Tarea Celery programada para procesar backups de todas las empresas.
+    Tarea Celery programada (cada hora) que despacha los backups pendientes.
     
-    Estrategia optimizada para aprovechar recursos (18GB RAM):
-    - A las 1:00 AM: Procesa empresas del año fiscal actual (prioridad alta)
-    - Durante el día (7am-7pm): Procesa empresas de años anteriores (más de 30 días) - 10 por hora
-    - Horas nocturnas (7pm-6am): Procesa más empresas de años anteriores - 30 por hora
-    - Procesa en lotes con rate limiting adaptativo según hora del día
-    
-    Esta tarea debe ejecutarse cada hora.
+    El planificador global (services/backup_scheduler) trata cada servidor como un
+    recurso con max_backups_concurrentes cupos y un presupuesto de ancho de banda:
+    - Cola por servidor: año fiscal actual primero (a partir de su hora_backup),
+      luego años anteriores con backup de más de 30 días (solo en la ventana nocturna),
+      y dentro de cada grupo el backup más antiguo primero.
+    - Lanza tantos backups como cupos libres tenga cada servidor; cada backup que
+      termina despacha el siguiente de su servidor, así que esta tarea solo arranca
+      la cola y recoge lo que haya quedado sin cupo.
     """
-    from .models import EmpresaServidor, ConfiguracionS3
-    from .services.backup_s3_service import BackupS3Service
-    from datetime import date
+    from .models import ConfiguracionS3
+    from .services import backup_scheduler
     
     try:
-        hora_actual = timezone.now().time()
-        hora_actual_str = hora_actual.strftime('%H:%M')
-        anio_actual = date.today().year
-        
-        logger.info(f"Procesando backups programados para hora {hora_actual_str}")
-        
-        # Obtener configuración S3 activa
         config_s3 = ConfiguracionS3.objects.filter(activo=True).first()
         if not config_s3:
             logger.warning("No hay configuración S3 activa. Saltando backups programados.")
@@ -1631,86 +1553,20 @@ def procesar_backups_programados_task():
                 'mensaje': 'No hay configuración S3 activa'
             }
         
-        servicio_backup = BackupS3Service(config_s3)
-        
-        empresas_procesadas = 0
-        empresas_anio_actual = 0
-        empresas_anios_anteriores = 0
-        
-        # PRIORIDAD 1: Empresas del año fiscal actual a la hora programada (1:00 AM)
-        if hora_actual.hour == 1:  # Solo a la 1:00 AM
-            logger.info("🔄 Procesando backups de empresas del año fiscal actual (1:00 AM)")
-            empresas_anio_actual_list = EmpresaServidor.objects.filter(
-                backups_habilitados=True,
-                anio_fiscal=anio_actual
+        plan = backup_scheduler.despachar(config_s3.id)
+        for servidor in plan['servidores']:
+            logger.info(
+                f"🗓️ {servidor['servidor']}: {servidor['lanzados']} lanzados, {servidor['ocupados']}/"
+                f"{servidor['limite_concurrencia']} cupos ocupados, {servidor['en_cola']} en cola"
+                + (f" (~{servidor['horas_estimadas']} h)" if servidor['horas_estimadas'] is not None else '')
             )
-            
-            # Procesar en lotes de 20 para no sobrecargar
-            lote_size = 20
-            empresas_list = list(empresas_anio_actual_list)
-            
-            for i in range(0, len(empresas_list), lote_size):
-                lote = empresas_list[i:i + lote_size]
-                logger.info(f"Procesando lote {i//lote_size + 1} de empresas año actual ({len(lote)} empresas)")
-                
-                for empresa in lote:
-                    # Verificar si la hora programada coincide (margen de 5 minutos)
-                    hora_empresa = empresa.hora_backup
-                    diferencia_minutos = abs(
-                        (hora_actual.hour * 60 + hora_actual.minute) - 
-                        (hora_empresa.hour * 60 + hora_empresa.minute)
-                    )
-                    
-                    if diferencia_minutos <= 5:
-                        empresas_anio_actual += 1
-                        empresas_procesadas += 1
-                        logger.info(f"📦 Backup programado para {empresa.nombre} (año {empresa.anio_fiscal})")
-                        realizar_backup_empresa_task.delay(empresa.id, config_s3.id)
-        
-        # PRIORIDAD 2: Empresas de años anteriores que necesitan backup (más de 30 días)
-        # Estrategia adaptativa según hora del día:
-        # - Horas diurnas (7am-7pm): 10 empresas por hora (bajo consumo)
-        # - Horas nocturnas (7pm-6am): 30 empresas por hora (aprovecha recursos)
-        hora_actual_num = hora_actual.hour
-        es_hora_nocturna = hora_actual_num >= 19 or hora_actual_num < 6  # 7pm a 6am
-        
-        if es_hora_nocturna:
-            max_verificar = 150  # Verificar más empresas en horas nocturnas
-            max_procesar = 30   # Procesar más en horas nocturnas
-            logger.info("🌙 Horas nocturnas: procesando más backups (30 por hora)")
-        else:
-            max_verificar = 50  # Verificar menos empresas en horas diurnas
-            max_procesar = 10   # Procesar menos en horas diurnas
-            logger.info("☀️ Horas diurnas: procesando backups moderados (10 por hora)")
-        
-        logger.info("🔄 Verificando empresas de años anteriores que necesitan backup")
-        empresas_anios_anteriores_list = EmpresaServidor.objects.filter(
-            backups_habilitados=True,
-            anio_fiscal__lt=anio_actual
-        ).order_by('anio_fiscal', 'id')  # Ordenar para procesar de forma consistente
-        
-        empresas_que_necesitan_backup = []
-        for empresa in empresas_anios_anteriores_list[:max_verificar]:
-            necesita, anio = servicio_backup.necesita_backup_anio_anterior(empresa)
-            if necesita:
-                empresas_que_necesitan_backup.append(empresa)
-        
-        # Procesar según estrategia adaptativa
-        for empresa in empresas_que_necesitan_backup[:max_procesar]:
-            empresas_anios_anteriores += 1
-            empresas_procesadas += 1
-            logger.info(f"🔄 Backup necesario para {empresa.nombre} (año {empresa.anio_fiscal}, >30 días)")
-            realizar_backup_empresa_task.delay(empresa.id, config_s3.id)
-        
-        logger.info(f"✅ Backups programados lanzados: {empresas_procesadas} empresas "
-                   f"(Año actual: {empresas_anio_actual}, Años anteriores: {empresas_anios_anteriores})")
+        logger.info(f"✅ Backups programados: {plan['lanzados']} lanzados, {plan['en_cola']} en cola")
         
         return {
             'status': 'SUCCESS',
-            'hora_actual': hora_actual_str,
-            'empresas_procesadas': empresas_procesadas,
-            'empresas_anio_actual': empresas_anio_actual,
-            'empresas_anios_anteriores': empresas_anios_anteriores
+            'hora_actual': timezone.localtime().strftime('%H:%M'),
+            'empresas_procesadas': plan['lanzados'],
+            **plan
         }
         
     except Exception as e:
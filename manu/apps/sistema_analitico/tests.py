@@ -1,3 +1,332 @@
-from django.test import TestCase
+import io
+import os
+import tempfile
+from datetime import timedelta
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+from django.test import SimpleTestCase, override_settings
+from django.utils import timezone
+from scipy import stats
+
+from .services.backup_dedup import VENTANA, FragmentadorCDC, SubidaDeduplicada, hash_rodante, restaurar_desde_manifiesto
+from .services.inventory_optimizer import InventoryOptimizer
+from .services.prophet_batch_forecaster import FORMATO, ProphetBatchForecaster
+
+
+def _forecaster(inicio, horizonte=6):
+    pred = np.arange(2 * horizonte, dtype=float).reshape(2, horizonte)
+    return ProphetBatchForecaster.desde_estado({
+        'formato': FORMATO,
+        'frecuencia': 'ME',
+        'inicio': inicio,
+        'horizonte': horizonte,
+        'codigos': np.array(['A', 'B']),
+        'metodos': np.array(['ets', 'croston']),
+        'huellas': np.array(['', '']),
+        'pred': pred,
+        'minimo': pred,
+        'maximo': pred,
+    })
+
+
+class PronosticoPorFechasTests(SimpleTestCase):
+    def test_fechas_alineadas_por_paso_del_horizonte(self):
+        # Entrenado hasta marzo; se piden meses desde junio (ni el mes anterior ni el actual)
+        forecaster = _forecaster('2024-04-30')
+        fechas = pd.date_range('2024-06-15', periods=3, freq='ME', tz='America/Bogota')
+        resultado = forecaster.predecir(3, ['A', 'B'], fechas=fechas)
+
+        self.assertEqual(list(resultado['fecha'][:3]), ['2024-06-30', '2024-07-31', '2024-08-31'])
+        self.assertEqual(list(resultado['prediccion'][:3]), [2.0, 3.0, 4.0])
+        self.assertEqual(list(resultado['prediccion'][3:]), [8.0, 9.0, 10.0])
+
+    def test_fechas_fuera_del_horizonte_quedan_vacias(self):
+        forecaster = _forecaster('2024-04-30')
+        fechas = pd.date_range('2024-08-31', periods=4, freq='ME')
+        resultado = forecaster.predecir(4, ['A'], fechas=fechas)
+
+        self.assertEqual(list(resultado['prediccion'][:2]), [4.0, 5.0])
+        self.assertTrue(resultado['prediccion'][2:].isna().all())
+
+    def test_sin_fechas_empieza_en_el_mes_siguiente_al_entrenamiento(self):
+        resultado = _forecaster('2024-04-30').predecir(2, ['B'])
+        self.assertEqual(list(resultado['fecha']), ['2024-04-30', '2024-05-31'])
+        self.assertEqual(list(resultado['prediccion']), [6.0, 7.0])
+
+
+def _stock_optimo_por_articulo(df, nivel_servicio=0.95, lead_time_dias=30):
+    """Implementación anterior de calcular_stock_optimo (un filtro por artículo)."""
+    try:
+        resultados = []
+        for articulo in df['articulo_codigo'].unique():
+            df_articulo = df[df['articulo_codigo'] == articulo].copy()
+            if len(df_articulo) < 10:
+                continue
+
+            demanda_diaria = df_articulo.groupby('fecha')['cantidad'].sum()
+            demanda_promedio = demanda_diaria.mean()
+            desviacion_demanda = demanda_diaria.std()
+
+            demanda_lead_time = demanda_promedio * lead_time_dias
+            desviacion_lead_time = desviacion_demanda * np.sqrt(lead_time_dias)
+
+            z_score = stats.norm.ppf(nivel_servicio)
+            punto_reorden = demanda_lead_time + z_score * desviacion_lead_time
+            stock_seguridad = z_score * desviacion_lead_time
+
+            resultados.append({
+                'articulo_codigo': articulo,
+                'articulo_nombre': df_articulo['articulo_nombre'].iloc[0],
+                'demanda_promedio_diaria': round(demanda_promedio, 2),
+                'punto_reorden': round(punto_reorden),
+                'stock_seguridad': round(stock_seguridad)
+            })
+        return resultados
+    except Exception:
+        return []
+
+
+def _recomendaciones_iterrows(df_historicos, meses, demanda_pronosticada, limite=15):
+    """Implementación anterior de las recomendaciones de MLEngine (iterrows sobre todos los artículos)."""
+    recomendaciones = []
+    for _, articulo in df_historicos.iterrows():
+        demanda_proyectada = demanda_pronosticada.get(str(articulo['articulo_codigo']))
+        if demanda_proyectada is None:
+            demanda_mensual = articulo['ventas_totales'] / 12
+            demanda_proyectada = demanda_mensual * meses
+
+        cantidad_recomendada = max(int(demanda_proyectada * 1.2), 1)
+
+        urgencia = "MEDIA"
+        if articulo['ultima_venta']:
+            dias_desde_ultima_venta = (timezone.now() - articulo['ultima_venta']).days
+            if dias_desde_ultima_venta < 30:
+                urgencia = "ALTA"
+            elif dias_desde_ultima_venta > 90:
+                urgencia = "BAJA"
+
+        valor_total = articulo['valor_total_ventas'] or 0
+        if valor_total > 10000000:
+            clasificacion = "A"
+        elif valor_total > 1000000:
+            clasificacion = "B"
+        else:
+            clasificacion = "C"
+
+        precio_promedio = float(articulo['precio_promedio'] or 0)
+        inversion_estimada = cantidad_recomendada * precio_promedio
+
+        recomendaciones.append({
+            'articulo_codigo': articulo['articulo_codigo'],
+            'articulo_nombre': articulo['articulo_nombre'],
+            'clasificacion_abc': clasificacion,
+            'demanda_predicha': round(demanda_proyectada),
+            'cantidad_recomendada': cantidad_recomendada,
+            'ventas_historicas': articulo['ventas_totales'],
+            'transacciones_historicas': articulo['transacciones'],
+            'urgencia': urgencia,
+            'precio_promedio': precio_promedio,
+            'inversion_estimada': round(inversion_estimada, 2),
+            'ultima_venta': articulo['ultima_venta'].strftime('%Y-%m-%d') if articulo['ultima_venta'] else 'N/A'
+        })
+
+    orden_urgencia = {"ALTA": 3, "MEDIA": 2, "BAJA": 1}
+    recomendaciones.sort(key=lambda x: (orden_urgencia[x['urgencia']], x['demanda_predicha']), reverse=True)
+    return recomendaciones[:limite]
+
+
+def _historicos():
+    ahora = timezone.now()
+    hace = lambda dias: ahora - timedelta(days=dias)
+    # (código, ventas_totales, días desde la última venta); D, E, F y G empatan en urgencia y demanda
+    filas = [
+        ('A', 120.0, 5), ('D', 60.0, 45), ('B', 240.0, 200), ('E', 60.0, 50),
+        ('C', 36.0, 10), ('F', 60.0, 60), ('H', 12.0, None), ('G', 60.0, 70),
+        ('I', 600.0, 15), ('J', 6.0, 120),
+    ]
+    return pd.DataFrame({
+        'articulo_codigo': [codigo for codigo, _, _ in filas],
+        'articulo_nombre': [f'Artículo {codigo}' for codigo, _, _ in filas],
+        'ventas_totales': [ventas for _, ventas, _ in filas],
+        'transacciones': list(range(1, len(filas) + 1)),
+        'precio_promedio': [1000.0, 2500.5, 0.0, 80.0, 15000.0, 99.9, 10.0, 500.0, 300000.0, 1.0],
+        'ultima_venta': pd.Series([hace(dias) if dias is not None else None for _, _, dias in filas], dtype=object),
+        'valor_total_ventas': [2e7, 5e6, 1e5, None, 3e6, 1e6, 0.0, 2e6, 1.8e8, 6.0],
+    })
+
+
+class RecomendacionesVectorizadasTests(SimpleTestCase):
+    def setUp(self):
+        self.optimizer = InventoryOptimizer()
+
+    def test_igual_a_iterrows_con_empates_y_sin_ultima_venta(self):
+        df = _historicos()
+        pronostico = {'A': 33.4, 'I': 12.5, 'F': 30.0}
+        for limite in (3, 5, 15):
+            with self.subTest(limite=limite):
+                self.assertEqual(
+                    self.optimizer.recomendar_compras(df, 6, pronostico, limite=limite),
+                    _recomendaciones_iterrows(df, 6, pronostico, limite=limite),
+                )
+
+    def test_empates_conservan_el_orden_de_entrada(self):
+        recomendaciones = self.optimizer.recomendar_compras(_historicos(), 6, {}, limite=15)
+        medias = [r['articulo_codigo'] for r in recomendaciones if r['urgencia'] == 'MEDIA']
+        self.assertEqual(medias, ['D', 'E', 'F', 'G', 'H'])
+
+    def test_ultima_venta_nat_se_trata_como_sin_ventas(self):
+        # DataFrame construido desde el ORM: None llega como NaT en una columna datetime64
+        df = _historicos()
+        df_orm = df.assign(ultima_venta=pd.to_datetime(df['ultima_venta'], utc=True))
+        self.assertEqual(
+            self.optimizer.recomendar_compras(df_orm, 6, {}, limite=15),
+            _recomendaciones_iterrows(df, 6, {}, limite=15),
+        )
+        sin_venta = next(r for r in self.optimizer.recomendar_compras(df_orm, 6, {}) if r['articulo_codigo'] == 'H')
+        self.assertEqual((sin_venta['urgencia'], sin_venta['ultima_venta']), ('MEDIA', 'N/A'))
+
+
+def _movimientos():
+    fechas = pd.date_range('2024-01-01', periods=12, freq='D')
+    filas = []
+    for codigo, cantidades in (('X', [3, 5, 2, 8, 4, 6, 1, 7, 5, 3, 2, 4]), ('Y', [10, 12, 9, 11, 10, 13, 8, 12, 11, 10, 9, 12])):
+        filas += [(codigo, fecha, cantidad) for fecha, cantidad in zip(fechas, cantidades)]
+    # Z tiene dos movimientos el mismo día; W no llega al mínimo de 10 filas
+    filas += [('Z', fechas[0], 2), ('Z', fechas[0], 3), ('Z', fechas[1], 1)] + [('Z', fechas[i], i) for i in range(2, 9)]
+    filas += [('W', fechas[i], 1) for i in range(5)]
+    return pd.DataFrame({
+        'articulo_codigo': [codigo for codigo, _, _ in filas],
+        'articulo_nombre': [f'Artículo {codigo}' for codigo, _, _ in filas],
+        'fecha': [fecha for _, fecha, _ in filas],
+        'cantidad': [float(cantidad) for _, _, cantidad in filas],
+    })
+
+
+class StockOptimoVectorizadoTests(SimpleTestCase):
+    def setUp(self):
+        self.optimizer = InventoryOptimizer()
+
+    def test_igual_a_la_version_por_articulo(self):
+        df = _movimientos()
+        resultado = self.optimizer.calcular_stock_optimo(df)
+        self.assertEqual([r['articulo_codigo'] for r in resultado], ['X', 'Y', 'Z'])
+        self.assertEqual(resultado, _stock_optimo_por_articulo(df))
+
+    def test_articulo_de_un_solo_dia_tiene_stock_de_seguridad_cero(self):
+        # Antes la desviación NaN de un solo día hacía fallar round() y se perdía todo el resultado
+        un_dia = pd.DataFrame({
+            'articulo_codigo': ['U'] * 10,
+            'articulo_nombre': ['Artículo U'] * 10,
+            'fecha': [pd.Timestamp('2024-01-05')] * 10,
+            'cantidad': [2.0] * 10,
+        })
+        df = pd.concat([_movimientos(), un_dia], ignore_index=True)
+        self.assertEqual(_stock_optimo_por_articulo(df), [])
+
+        resultado = self.optimizer.calcular_stock_optimo(df)
+        self.assertEqual(resultado[:3], _stock_optimo_por_articulo(_movimientos()))
+        self.assertEqual(resultado[3], {
+            'articulo_codigo': 'U',
+            'articulo_nombre': 'Artículo U',
+            'demanda_promedio_diaria': 20.0,
+            'punto_reorden': 600,
+            'stock_seguridad': 0,
+        })
+
+
+def _flujo_backup(tamano=200_000, semilla=7):
+    """Bytes aleatorios con un tramo constante largo (sin cortes por contenido: fuerza cortes en `maximo`)."""
+    aleatorio = np.random.default_rng(semilla).integers(0, 256, tamano, dtype=np.uint8).tobytes()
+    return aleatorio[:tamano // 2] + bytes(20_000) + aleatorio[tamano // 2:]
+
+
+def _fragmentar(datos, bloques, promedio=256):
+    fragmentador = FragmentadorCDC(promedio)
+    chunks = []
+    inicio = 0
+    for tamano in bloques:
+        chunks += fragmentador.agregar(datos[inicio:inicio + tamano])
+        inicio += tamano
+    chunks += fragmentador.agregar(datos[inicio:])
+    return chunks + fragmentador.cerrar()
+
+
+class _S3EnMemoria:
+    def __init__(self):
+        self.objetos = {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objetos[Key] = bytes(Body)
+        return {'ETag': f'"{len(self.objetos)}"'}
+
+    def get_object(self, Bucket, Key):
+        return {'Body': io.BytesIO(self.objetos[Key])}
+
+    def get_paginator(self, operacion):
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        return [{'Contents': [
+            {'Key': key, 'Size': len(cuerpo)} for key, cuerpo in self.objetos.items() if key.startswith(Prefix)
+        ]}]
+
+
+class FragmentadorCDCTests(SimpleTestCase):
+    def test_hash_rodante_igual_a_la_definicion(self):
+        from .services.backup_dedup import _GEAR
+
+        datos = np.frombuffer(_flujo_backup(2_000), dtype=np.uint8)
+        esperado = [
+            sum(int(_GEAR[datos[i - k]]) << k for k in range(min(VENTANA, i + 1))) % 2 ** 32
+            for i in range(len(datos))
+        ]
+        self.assertEqual(hash_rodante(datos).tolist(), esperado)
+
+    def test_mismos_chunks_en_una_llamada_y_en_bloques(self):
+        datos = _flujo_backup()
+        completo = _fragmentar(datos, [])
+        self.assertGreater(len(completo), 100)
+
+        rng = np.random.default_rng(11)
+        particiones = {
+            'bytes_sueltos': [1] * 3_000,
+            'menores_que_la_ventana': rng.integers(1, VENTANA, 5_000).tolist(),
+            'aleatorios': rng.integers(1, 5_000, 100).tolist(),
+            'mayores_que_maximo': [4_096, 10_000, 65_536],
+        }
+        for nombre, bloques in particiones.items():
+            with self.subTest(particion=nombre):
+                self.assertEqual(_fragmentar(datos, bloques), completo)
+
+    def test_tamanos_dentro_de_los_limites_salvo_el_ultimo(self):
+        datos = _flujo_backup()
+        fragmentador = FragmentadorCDC(256)
+        chunks = _fragmentar(datos, np.random.default_rng(3).integers(1, 3_000, 150).tolist())
+
+        self.assertEqual(b''.join(chunks), datos)
+        for chunk in chunks[:-1]:
+            self.assertGreaterEqual(len(chunk), fragmentador.minimo)
+            self.assertLessEqual(len(chunk), fragmentador.maximo)
+        self.assertLessEqual(len(chunks[-1]), fragmentador.maximo)
+        # El tramo constante solo se puede cortar en `maximo`
+        self.assertIn(fragmentador.maximo, {len(chunk) for chunk in chunks})
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_restaurar_desde_manifiesto_reconstruye_el_flujo(self):
+        datos = _flujo_backup()
+        s3 = _S3EnMemoria()
+        subida = SubidaDeduplicada(s3, 'bucket', 'srv/900/backup.fbk.manifest.json', 'srv/900/chunks/',
+                                   chunk_promedio=256, workers=2)
+        subida.iniciar()
+        for inicio in range(0, len(datos), 7_777):
+            subida.escribir(datos[inicio:inicio + 7_777])
+        subida.completar()
+        # El tramo constante repite chunks de tamaño `maximo`: se suben una sola vez
+        self.assertGreater(subida.estadisticas['reutilizados'], 0)
+
+        with tempfile.TemporaryDirectory() as directorio:
+            destino = os.path.join(directorio, 'restaurado.fbk')
+            restaurar_desde_manifiesto(s3, 'bucket', 'srv/900/backup.fbk.manifest.json', destino, workers=2)
+            with open(destino, 'rb') as archivo:
+                self.assertEqual(archivo.read(), datos)
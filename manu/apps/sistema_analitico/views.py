@@ -9,6 +9,7 @@ import time
 import requests
 import base64
 from calendar import monthrange
+from collections import defaultdict
 from datetime import datetime, timedelta, date
 from decimal import Decimal
 import firebirdsql
@@ -16,8 +17,9 @@ import firebirdsql
 # 🔹 Django y DRF
 from django.conf import settings
 from django.db.models import Count, Sum, Avg, Max, Min, Q, F, Value
-from django.db.models.functions import TruncMonth, TruncYear, TruncQuarter, Coalesce
+from django.db.models.functions import TruncYear, TruncQuarter, Coalesce
 from django.utils import timezone
+from django.utils.functional import cached_property
 from django.http import HttpRequest
 
 from rest_framework import serializers, viewsets, status
@@ -39,6 +41,7 @@ from .models import (
     Servidor,
     EmpresaServidor,
     MovimientoInventario,
+    ResumenMovimientoMensual,
     UsuarioEmpresa,
     UserTenantProfile,
     APIKeyCliente,
@@ -60,6 +63,9 @@ from .models import (
 )
 from .serializers import *
 from .services.data_manager import DataManager
+from .services.extraccion_scheduler import extraer_con_cupo
+from .services.movimientos_columnar import MovimientosColumnarCache, agregar_por_articulo, fin_de_rango
+from .services.resumen_mensual import totales_por as totales_por_resumen
 from .services.ml_engine import MLEngine
 from .services.natural_response_orchestrator import NaturalResponseOrchestrator
 from .services.system_tester import SystemTester
@@ -2203,7 +2209,8 @@ class SistemaViewSet(viewsets.ViewSet):
         serializer = ExtraerDatosSerializer(data=request.data)
         if serializer.is_valid():
             try:
-                resultado = self.data_manager.extraer_datos_empresa(
+                # Mismo cupo por servidor que las extracciones por NIT y la sincronización
+                resultado = extraer_con_cupo(
                     empresa_servidor_id=serializer.validated_data['empresa_servidor_id'],
                     fecha_inicio=serializer.validated_data['fecha_inicio'],
                     fecha_fin=serializer.validated_data['fecha_fin']
@@ -2212,32 +2219,100 @@ class SistemaViewSet(viewsets.ViewSet):
             except Exception as e:
                 return Response({'error': str(e)}, status=500)
         return Response(serializer.errors, status=400)
+    
+    @action(detail=False, methods=['post'], url_path='extraer-datos-nit')
+    def extraer_datos_nit(self, request):
+        """
+        Extrae en segundo plano todas las empresas/años fiscales de un NIT.
+        Los servidores distintos se procesan en paralelo y cada servidor respeta
+        su max_extracciones_concurrentes. Retorna un task_id para consultar el progreso.
+        """
+        from .tasks import extraer_datos_nit_task
+        
+        serializer = ExtraerDatosNITSerializer(data=request.data)
+        if serializer.is_valid():
+            datos = serializer.validated_data
+            task = extraer_datos_nit_task.delay(
+                datos['nit_normalizado'],
+                datos['fecha_inicio'].isoformat(),
+                datos['fecha_fin'].isoformat(),
+                datos['forzar_reextraccion'],
+            )
+            return Response({
+                'estado': 'procesando',
+                'task_id': task.id,
+                'mensaje': 'La extracción se está procesando en segundo plano. Usa el task_id para consultar el progreso.',
+                'endpoint_progreso': f'/api/celery/task-status/{task.id}/'
+            }, status=status.HTTP_202_ACCEPTED)
+        
+        return Response(serializer.errors, status=400)
 
 class MLViewSet(viewsets.ViewSet):
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self.ml_engine = MLEngine()
+    @cached_property
+    def ml_engine(self):
+        # Liviano: los modelos vienen del registro del proceso, no se cargan por petición
+        return MLEngine()
     
     @action(detail=False, methods=['post'])
     def entrenar_modelos(self, request):
+        """Encola el entrenamiento en la cola ML; si el NIT ya está entrenando retorna esa misma tarea."""
+        from .services.ml_entrenamiento import encolar_entrenamiento
+        
         serializer = EntrenarModelosSerializer(data=request.data)
         if serializer.is_valid():
             try:
-                resultado = self.ml_engine.entrenar_modelos_empresa(
-                    empresa_servidor_id=serializer.validated_data['empresa_servidor_id']
+                encolado = encolar_entrenamiento(
+                    serializer.validated_data['empresa_servidor_id'],
+                    forzar=serializer.validated_data['forzar']
                 )
-                return Response(resultado)
+                return Response({
+                    'estado': 'en_curso' if encolado['duplicado'] else 'encolado',
+                    **encolado,
+                    'mensaje': 'El entrenamiento se ejecuta en segundo plano. Usa el task_id para consultar el progreso.',
+                    'endpoint_progreso': f'/api/celery/task-status/{encolado["task_id"]}/'
+                }, status=status.HTTP_202_ACCEPTED)
             except Exception as e:
                 return Response({'error': str(e)}, status=500)
         return Response(serializer.errors, status=400)
     
+    @action(detail=False, methods=['get'])
+    def estado_entrenamiento(self, request):
+        """Entrenamiento en curso (si hay) y estado del modelo guardado de una empresa."""
+        from celery.result import AsyncResult
+        from config.celery import app as celery_app
+        from .services.ml_entrenamiento import entrenamiento_en_curso, modelo_id_empresa
+        
+        empresa_servidor_id = request.query_params.get('empresa_servidor_id')
+        if not empresa_servidor_id:
+            return Response({'error': 'empresa_servidor_id es requerido'}, status=400)
+        try:
+            modelo_id = modelo_id_empresa(int(empresa_servidor_id))
+        except (ValueError, EmpresaServidor.DoesNotExist):
+            return Response({'error': f'Empresa con ID {empresa_servidor_id} no existe'}, status=404)
+        
+        respuesta = {
+            'modelo_id': modelo_id,
+            'entrenamiento': None,
+            'modelo': self.ml_engine.verificar_estado_modelo(int(empresa_servidor_id))
+        }
+        task_id = entrenamiento_en_curso(modelo_id)
+        if task_id:
+            tarea = AsyncResult(task_id, app=celery_app)
+            respuesta['entrenamiento'] = {
+                'task_id': task_id,
+                'state': tarea.state,
+                'meta': tarea.info if isinstance(tarea.info, dict) else None
+            }
+        return Response(respuesta)
+    
     @action(detail=False, methods=['post'])
     def predecir_demanda(self, request):
         serializer = PredecirDemandaSerializer(data=request.data)
         if serializer.is_valid():
             try:
                 resultado = self.ml_engine.predecir_demanda_articulos(
-                    modelo_id=serializer.validated_data['modelo_id'],
+                    serializer.validated_data['empresa_servidor_id'],
+                    articulos=serializer.validated_data['articulos'],
                     meses=serializer.validated_data['meses']
                 )
                 return Response(resultado)
@@ -2245,13 +2320,47 @@ class MLViewSet(viewsets.ViewSet):
                 return Response({'error': str(e)}, status=500)
         return Response(serializer.errors, status=400)
     
+    @action(detail=False, methods=['post'])
+    def predecir_lote(self, request):
+        """
+        Predicción de demanda para una lista de artículos (o 'all') y un horizonte.
+        La respuesta se transmite por lotes como JSON lines o stream Arrow.
+        """
+        from django.http import StreamingHttpResponse
+        from .services.prediccion_lote import FORMATOS, PYARROW_AVAILABLE, codificar
+        
+        serializer = PredecirLoteSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=400)
+        datos = serializer.validated_data
+        if datos['formato'] == 'arrow' and not PYARROW_AVAILABLE:
+            return Response({'error': 'El formato arrow requiere pyarrow instalado'}, status=400)
+        
+        try:
+            lote = self.ml_engine.predecir_demanda_lote(
+                datos['empresa_servidor_id'], articulos=datos['articulos'], meses=datos['meses']
+            )
+        except Exception as e:
+            return Response({'error': str(e)}, status=500)
+        if 'error' in lote:
+            return Response(lote, status=404)
+        
+        response = StreamingHttpResponse(
+            codificar(lote['lotes'], datos['formato']), content_type=FORMATOS[datos['formato']]
+        )
+        response['X-Modelo-Id'] = lote['modelo_id']
+        response['X-Modelo-Version'] = lote['version_modelo'] or ''
+        response['X-Total-Articulos'] = str(lote['total_articulos'])
+        response['X-Meses'] = str(lote['meses'])
+        return response
+    
     @action(detail=False, methods=['post'])
     def recomendaciones_compras(self, request):
         serializer = RecomendacionesComprasSerializer(data=request.data)
         if serializer.is_valid():
             try:
                 resultado = self.ml_engine.generar_recomendaciones_compras(
-                    modelo_id=serializer.validated_data['modelo_id'],
+                    serializer.validated_data['empresa_servidor_id'],
                     meses=serializer.validated_data['meses'],
                     nivel_servicio=serializer.validated_data['nivel_servicio']
                 )
@@ -2265,8 +2374,22 @@ class ConsultaNaturalViewSet(viewsets.ViewSet):
     
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.ml_engine = MLEngine()
         self.response_orchestrator = NaturalResponseOrchestrator()
+        self.cache_columnar = MovimientosColumnarCache()
+    
+    @cached_property
+    def ml_engine(self):
+        # Solo las consultas que usan modelos crean el motor (los modelos vienen del registro)
+        return MLEngine()
+    
+    def _movimientos_columnar(self, empresas_ids, fecha_inicio=None, fecha_fin=None,
+                              tipo_documento=None, columnas=None):
+        """DataFrame de movimientos desde la caché Parquet, o None para usar el ORM"""
+        try:
+            return self.cache_columnar.leer(empresas_ids, fecha_inicio, fecha_fin, tipo_documento, columnas)
+        except Exception as e:
+            logger.warning(f"⚠️ Caché columnar no disponible, usando ORM: {e}")
+            return None
     
     # En ConsultaNaturalViewSet, agregar este método
     def _obtener_empresas_para_consulta(self, request, empresa_servidor_id):
@@ -2873,8 +2996,6 @@ class ConsultaNaturalViewSet(viewsets.ViewSet):
     def _consultar_ventas_por_meses(self, consulta, empresa_servidor_id=None, request=None):
         """Consulta ventas por MÚLTIPLES meses específicos - ADAPTADO PARA MÚLTIPLES EMPRESAS"""
         try:
-            from apps.sistema_analitico.models import MovimientoInventario
-
             # ✅ OBTENER EMPRESAS SEGÚN CONTEXTO
             empresas_ids, es_consolidado = self._obtener_empresas_para_consulta(request, empresa_servidor_id)
 
@@ -2902,46 +3023,47 @@ class ConsultaNaturalViewSet(viewsets.ViewSet):
 
             anio = self._extraer_anio(consulta)
 
+            # ✅ UNA SOLA CONSULTA AGRUPADA sobre el resumen mensual (mes × artículo)
+            articulos_por_mes = defaultdict(list)
+            for fila in ResumenMovimientoMensual.objects.filter(
+                empresa_servidor_id__in=empresas_ids,
+                tipo_documento='FACTURA_VENTA',
+                periodo__in=[date(anio, mes['numero'], 1) for mes in meses_encontrados]
+            ).values('periodo', 'articulo_codigo').annotate(
+                articulo_nombre=Max('articulo_nombre'),
+                cantidad_vendida=Sum('cantidad_total'),
+                valor_total=Sum('valor_total'),
+                movimientos=Sum('movimientos')
+            ).order_by('periodo', '-cantidad_vendida'):
+                articulos_por_mes[fila['periodo'].month].append(fila)
+
             resultados_meses = []
 
             for mes_info in meses_encontrados:
-                mes_nombre = mes_info['nombre']
-                mes_num = mes_info['numero']
-
-                # Consulta base - ADAPTADA
-                query = MovimientoInventario.objects.filter(
-                    empresa_servidor_id__in=empresas_ids,
-                    fecha__year=anio,
-                    fecha__month=mes_num,
-                    tipo_documento='FACTURA_VENTA'
-                )
-
-                # Estadísticas del mes
-                ventas_mes = query.aggregate(
-                    total_articulos=Sum('cantidad'),
-                    total_ventas=Count('id'),
-                    valor_total=Sum('valor_total')
-                )
+                articulos = articulos_por_mes.get(mes_info['numero'], [])
 
-                total_ventas_count = ventas_mes['total_ventas'] or 0
-                valor_total_ventas = ventas_mes['valor_total'] or 0
+                total_ventas_count = sum(a['movimientos'] for a in articulos)
+                valor_total_ventas = sum((a['valor_total'] or 0) for a in articulos)
                 venta_promedio = valor_total_ventas / total_ventas_count if total_ventas_count > 0 else 0
 
-                # ✅ TODOS LOS ARTÍCULOS DEL MES (sin límite)
-                articulos_mes = query.values('articulo_codigo', 'articulo_nombre').annotate(
-                    cantidad_vendida=Sum('cantidad'),
-                    valor_total=Sum('valor_total')
-                ).order_by('-cantidad_vendida')
-
                 resultados_meses.append({
-                    'mes': mes_nombre,
+                    'mes': mes_info['nombre'],
                     'anio': anio,
-                    'total_articulos_vendidos': ventas_mes['total_articulos'] or 0,
+                    'total_articulos_vendidos': sum(a['cantidad_vendida'] for a in articulos),
                     'total_ventas': total_ventas_count,
                     'valor_total': float(valor_total_ventas),
                     'venta_promedio': float(venta_promedio),
-                    'articulos': list(articulos_mes),
-                    'total_referencias': len(list(articulos_mes))
+                    # ✅ TODOS LOS ARTÍCULOS DEL MES (sin límite)
+                    'articulos': [
+                        {
+                            'articulo_codigo': a['articulo_codigo'],
+                            'articulo_nombre': a['articulo_nombre'],
+                            'cantidad_vendida': a['cantidad_vendida'],
+                            'valor_total': a['valor_total']
+                        }
+                        for a in articulos
+                    ],
+                    'total_referencias': len(articulos)
                 })
 
             # Calcular totales generales
@@ -2998,19 +3120,56 @@ class ConsultaNaturalViewSet(viewsets.ViewSet):
             if not mes_num:
                 return {'error': 'No se pudo identificar el mes en la consulta'}
 
-            # Consulta base - ADAPTADA
-            query = MovimientoInventario.objects.filter(
-                empresa_servidor_id__in=empresas_ids,
-                fecha__year=anio,
-                fecha__month=mes_num,
-                tipo_documento='FACTURA_VENTA'
-            )
+            consulta_lower = consulta.lower()
+            mostrar_todas = any(palabra in consulta_lower for palabra in ['todas', 'todos', 'completo', 'completa', 'todas las', 'todos los'])
+
+            # ✅ CAMINO RÁPIDO: escaneo vectorizado sobre la caché Parquet del mes
+            inicio_mes = date(anio, mes_num, 1)
+            fin_mes = date(anio, mes_num, monthrange(anio, mes_num)[1])
+            df = self._movimientos_columnar(
+                empresas_ids, inicio_mes, fin_mes, 'FACTURA_VENTA',
+                ['articulo_codigo', 'articulo_nombre', 'cantidad', 'valor_total']
+            )
+            if df is not None:
+                ventas_mes = {
+                    'total_articulos': int(df['cantidad'].sum()),
+                    'total_ventas': len(df),
+                    'valor_total': float(df['valor_total'].sum()),
+                }
+                articulos_df = agregar_por_articulo(df).rename(columns={'total_vendido': 'cantidad_vendida'})
+                articulos_df = articulos_df.sort_values('cantidad_vendida', ascending=False)
+                if not mostrar_todas:
+                    articulos_df = articulos_df.head(5)
+                articulos_mes = [
+                    {
+                        'articulo_codigo': fila.articulo_codigo,
+                        'articulo_nombre': fila.articulo_nombre,
+                        'cantidad_vendida': int(fila.cantidad_vendida),
+                        'valor_total': float(fila.valor_total),
+                    }
+                    for fila in articulos_df.itertuples(index=False)
+                ]
+            else:
+                # Consulta base - ADAPTADA
+                query = MovimientoInventario.objects.filter(
+                    empresa_servidor_id__in=empresas_ids,
+                    fecha__year=anio,
+                    fecha__month=mes_num,
+                    tipo_documento='FACTURA_VENTA'
+                )
 
-            ventas_mes = query.aggregate(
-                total_articulos=Sum('cantidad'),
-                total_ventas=Count('id'),
-                valor_total=Sum('valor_total')
-            )
+                ventas_mes = query.aggregate(
+                    total_articulos=Sum('cantidad'),
+                    total_ventas=Count('id'),
+                    valor_total=Sum('valor_total')
+                )
+                articulos_mes = query.values('articulo_codigo', 'articulo_nombre').annotate(
+                    cantidad_vendida=Sum('cantidad'),
+                    valor_total=Sum('valor_total')
+                ).order_by('-cantidad_vendida')
+                if not mostrar_todas:
+                    # Límite por defecto (5 artículos) para consultas normales
+                    articulos_mes = articulos_mes[:5]
 
             # ✅ CORRECCIÓN: Calcular promedio manualmente
             total_ventas_count = ventas_mes['total_ventas'] or 0
@@ -3022,22 +3181,9 @@ class ConsultaNaturalViewSet(viewsets.ViewSet):
                 venta_promedio = 0
 
             # ✅ CORRECCIÓN CRÍTICA: OBTENER TODOS LOS ARTÍCULOS SIN LÍMITE CUANDO PIDE "TODAS"
-            consulta_lower = consulta.lower()
-            if any(palabra in consulta_lower for palabra in ['todas', 'todos', 'completo', 'completa', 'todas las', 'todos los']):
-                # SIN LÍMITE - TODAS LAS REFERENCIAS
-                articulos_mes = query.values('articulo_codigo', 'articulo_nombre').annotate(
-                    cantidad_vendida=Sum('cantidad'),
-                    valor_total=Sum('valor_total')
-                ).order_by('-cantidad_vendida')
-
+            if mostrar_todas:
                 mensaje_articulos = f'TODAS las referencias de artículos vendidos en {mes_nombre} {anio}'
             else:
-                # Límite por defecto (5 artículos) para consultas normales
-                articulos_mes = query.values('articulo_codigo', 'articulo_nombre').annotate(
-                    cantidad_vendida=Sum('cantidad'),
-                    valor_total=Sum('valor_total')
-                ).order_by('-cantidad_vendida')[:5]
-
                 mensaje_articulos = f'Principales artículos vendidos en {mes_nombre} {anio}'
 
             # Convertir a lista para serialización
@@ -3071,25 +3217,18 @@ class ConsultaNaturalViewSet(viewsets.ViewSet):
     def _consultar_ventas_por_anio(self, consulta, empresa_servidor_id=None, request=None):
         """Consulta ventas por año específico - ADAPTADO PARA MÚLTIPLES EMPRESAS"""
         try:
-            from apps.sistema_analitico.models import MovimientoInventario
-
             # ✅ OBTENER EMPRESAS SEGÚN CONTEXTO
             empresas_ids, es_consolidado = self._obtener_empresas_para_consulta(request, empresa_servidor_id)
 
             anio = self._extraer_anio(consulta)
 
-            # Consulta base - ADAPTADA
-            query = MovimientoInventario.objects.filter(
-                empresa_servidor_id__in=empresas_ids,
-                fecha__year=anio,
-                tipo_documento='FACTURA_VENTA'
-            )
-
-            ventas_anio = query.aggregate(
-                total_articulos=Sum('cantidad'),
-                total_ventas=Count('id'),
-                valor_total=Sum('valor_total')
-            )
+            # ✅ UNA SOLA CONSULTA AGRUPADA POR MES sobre el resumen mensual
+            meses = list(totales_por_resumen(empresas_ids, ['periodo'], periodo__year=anio))
+            ventas_anio = {
+                'total_articulos': sum(m['total_articulos'] or 0 for m in meses),
+                'total_ventas': sum(m['total_ventas'] or 0 for m in meses),
+                'valor_total': sum((m['valor_total'] or 0) for m in meses)
+            }
 
             # ✅ CORRECCIÓN: Calcular promedio manualmente
             total_ventas_count = ventas_anio['total_ventas'] or 0
@@ -3101,12 +3240,10 @@ class ConsultaNaturalViewSet(viewsets.ViewSet):
                 venta_promedio = 0
 
             # Ventas por mes del año - ADAPTADA
-            ventas_por_mes = query.annotate(
-                mes=TruncMonth('fecha')
-            ).values('mes').annotate(
-                total_ventas=Count('id'),
-                valor_total=Sum('valor_total')
-            ).order_by('mes')
+            ventas_por_mes = [
+                {'mes': m['periodo'], 'total_ventas': m['total_ventas'], 'valor_total': m['valor_total']}
+                for m in meses
+            ]
 
             # ✅ MENSAJE SEGÚN CONTEXTO
             mensaje = f'Ventas del año {anio}'
@@ -3354,96 +3491,121 @@ class ConsultaNaturalViewSet(viewsets.ViewSet):
             periodo_info = self._extraer_periodo_consulta(consulta)
             print(f"🔍 Periodo extraído: {periodo_info}")
 
-            # ✅ VERIFICAR DATOS EN TODAS LAS EMPRESAS DEL NIT
-            print(f"🔍 VERIFICANDO DATOS EN BD PARA TODAS LAS EMPRESAS:")
-
-            for emp_id in empresas_ids:
-                total_empresa = MovimientoInventario.objects.filter(
-                    empresa_servidor_id=emp_id
-                ).count()
-                print(f"   - Empresa {emp_id}: {total_empresa} registros")
-
-            # Total en TODAS las empresas
-            total_sin_filtros = MovimientoInventario.objects.filter(
-                empresa_servidor_id__in=empresas_ids
-            ).count()
-            print(f"   - TOTAL en todas las empresas: {total_sin_filtros} registros")
-
-            # Total ventas en TODAS las empresas
-            total_ventas = MovimientoInventario.objects.filter(
-                empresa_servidor_id__in=empresas_ids,
-                tipo_documento='FACTURA_VENTA'
-            ).count()
-            print(f"   - TOTAL ventas en todas las empresas: {total_ventas}")
+            limite = self._extraer_limite_consulta(consulta)
 
-            # Rango de fechas en TODA la base de datos
-            rango_fechas = MovimientoInventario.objects.filter(
-                empresa_servidor_id__in=empresas_ids
-            ).aggregate(
-                min_fecha=Min('fecha'),
-                max_fecha=Max('fecha')
+            # ✅ CAMINO RÁPIDO: agregación vectorizada sobre la caché Parquet
+            df = self._movimientos_columnar(
+                empresas_ids, periodo_info['fecha_inicio'], periodo_info['fecha_fin'], 'FACTURA_VENTA',
+                ['articulo_codigo', 'articulo_nombre', 'cantidad', 'valor_total', 'precio_unitario']
             )
-            print(f"   - Rango fechas en BD: {rango_fechas}")
+            if df is not None:
+                print(f"🧊 Consultando caché columnar: {len(df)} movimientos en el periodo")
+                agregado = agregar_por_articulo(df[df['cantidad'] > 0])
+                agregado = agregado.sort_values('total_vendido', ascending=False)
+                total_articulos = len(agregado)
+                if limite is not None:
+                    agregado = agregado.head(limite)
+                resultados_lista = [
+                    {
+                        'articulo_codigo': fila.articulo_codigo,
+                        'articulo_nombre': fila.articulo_nombre,
+                        'total_vendido': float(fila.total_vendido or 0),
+                        'total_valor': float(fila.valor_total or 0),
+                        'transacciones': int(fila.transacciones),
+                        'precio_promedio': float(fila.precio_promedio or 0)
+                    }
+                    for fila in agregado.itertuples(index=False)
+                ]
+            else:
+                # ✅ VERIFICAR DATOS EN TODAS LAS EMPRESAS DEL NIT
+                print(f"🔍 VERIFICANDO DATOS EN BD PARA TODAS LAS EMPRESAS:")
 
-            # Registros del periodo específico en TODAS las empresas
-            registros_periodo = MovimientoInventario.objects.filter(
-                empresa_servidor_id__in=empresas_ids,
-                fecha__range=[periodo_info['fecha_inicio'], periodo_info['fecha_fin']]
-            ).count()
-            print(f"   - Registros en periodo consultado: {registros_periodo}")
+                for emp_id in empresas_ids:
+                    total_empresa = MovimientoInventario.objects.filter(
+                        empresa_servidor_id=emp_id
+                    ).count()
+                    print(f"   - Empresa {emp_id}: {total_empresa} registros")
 
-            # ✅ CONSULTA REAL EN TODAS LAS EMPRESAS
-            query = MovimientoInventario.objects.filter(
-                empresa_servidor_id__in=empresas_ids,  # ✅ TODAS las empresas del NIT
-                cantidad__gt=0,
-                tipo_documento='FACTURA_VENTA',
-                fecha__range=[periodo_info['fecha_inicio'], periodo_info['fecha_fin']]
-            )
+                # Total en TODAS las empresas
+                total_sin_filtros = MovimientoInventario.objects.filter(
+                    empresa_servidor_id__in=empresas_ids
+                ).count()
+                print(f"   - TOTAL en todas las empresas: {total_sin_filtros} registros")
 
-            print(f"🔍 EJECUTANDO QUERY CON FILTROS:")
-            print(f"   - Empresas: {empresas_ids}")
-            print(f"   - Fecha inicio: {periodo_info['fecha_inicio']}")
-            print(f"   - Fecha fin: {periodo_info['fecha_fin']}")
+                # Total ventas en TODAS las empresas
+                total_ventas = MovimientoInventario.objects.filter(
+                    empresa_servidor_id__in=empresas_ids,
+                    tipo_documento='FACTURA_VENTA'
+                ).count()
+                print(f"   - TOTAL ventas en todas las empresas: {total_ventas}")
 
-            total_query = query.count()
-            print(f"🔍 TOTAL REGISTROS EN QUERY: {total_query}")
+                # Rango de fechas en TODA la base de datos
+                rango_fechas = MovimientoInventario.objects.filter(
+                    empresa_servidor_id__in=empresas_ids
+                ).aggregate(
+                    min_fecha=Min('fecha'),
+                    max_fecha=Max('fecha')
+                )
+                print(f"   - Rango fechas en BD: {rango_fechas}")
 
-            # Si no hay resultados, verificar qué hay sin filtros
-            if total_query == 0:
-                print(f"🔍 BUSCANDO SIN FILTRO DE FECHA:")
-                query_sin_fecha = MovimientoInventario.objects.filter(
+                # Registros del periodo específico en TODAS las empresas
+                registros_periodo = MovimientoInventario.objects.filter(
                     empresa_servidor_id__in=empresas_ids,
+                    fecha__range=[periodo_info['fecha_inicio'], fin_de_rango(periodo_info['fecha_fin'])]
+                ).count()
+                print(f"   - Registros en periodo consultado: {registros_periodo}")
+
+                # ✅ CONSULTA REAL EN TODAS LAS EMPRESAS
+                query = MovimientoInventario.objects.filter(
+                    empresa_servidor_id__in=empresas_ids,  # ✅ TODAS las empresas del NIT
                     cantidad__gt=0,
-                    tipo_documento='FACTURA_VENTA'
+                    tipo_documento='FACTURA_VENTA',
+                    fecha__range=[periodo_info['fecha_inicio'], fin_de_rango(periodo_info['fecha_fin'])]
                 )
-                total_sin_fecha = query_sin_fecha.count()
-                print(f"   - Total sin fecha: {total_sin_fecha}")
 
-            # Continuar con la consulta normal
-            resultados_query = query.values('articulo_codigo', 'articulo_nombre').annotate(
-                total_vendido=Sum('cantidad'),
-                total_valor=Sum('valor_total'),
-                transacciones=Count('id'),
-                precio_promedio=Avg('precio_unitario')
-            ).order_by('-total_vendido')
+                print(f"🔍 EJECUTANDO QUERY CON FILTROS:")
+                print(f"   - Empresas: {empresas_ids}")
+                print(f"   - Fecha inicio: {periodo_info['fecha_inicio']}")
+                print(f"   - Fecha fin: {periodo_info['fecha_fin']}")
+
+                total_query = query.count()
+                print(f"🔍 TOTAL REGISTROS EN QUERY: {total_query}")
+
+                # Si no hay resultados, verificar qué hay sin filtros
+                if total_query == 0:
+                    print(f"🔍 BUSCANDO SIN FILTRO DE FECHA:")
+                    query_sin_fecha = MovimientoInventario.objects.filter(
+                        empresa_servidor_id__in=empresas_ids,
+                        cantidad__gt=0,
+                        tipo_documento='FACTURA_VENTA'
+                    )
+                    total_sin_fecha = query_sin_fecha.count()
+                    print(f"   - Total sin fecha: {total_sin_fecha}")
 
-            total_articulos = resultados_query.count()
-            print(f"🔍 TOTAL ARTÍCULOS ENCONTRADOS: {total_articulos}")
+                # Continuar con la consulta normal
+                resultados_query = query.values('articulo_codigo', 'articulo_nombre').annotate(
+                    total_vendido=Sum('cantidad'),
+                    total_valor=Sum('valor_total'),
+                    transacciones=Count('id'),
+                    precio_promedio=Avg('precio_unitario')
+                ).order_by('-total_vendido')
 
-            limite = self._extraer_limite_consulta(consulta)
-            if limite is not None:
-                resultados_query = resultados_query[:limite]
+                total_articulos = resultados_query.count()
+                print(f"🔍 TOTAL ARTÍCULOS ENCONTRADOS: {total_articulos}")
 
-            resultados_lista = []
-            for item in resultados_query:
-                resultados_lista.append({
-                    'articulo_codigo': item['articulo_codigo'],
-                    'articulo_nombre': item['articulo_nombre'],
-                    'total_vendido': float(item['total_vendido'] or 0),
-                    'total_valor': float(item['total_valor'] or 0),
-                    'transacciones': item['transacciones'],
-                    'precio_promedio': float(item['precio_promedio'] or 0)
-                })
+                if limite is not None:
+                    resultados_query = resultados_query[:limite]
+
+                resultados_lista = []
+                for item in resultados_query:
+                    resultados_lista.append({
+                        'articulo_codigo': item['articulo_codigo'],
+                        'articulo_nombre': item['articulo_nombre'],
+                        'total_vendido': float(item['total_vendido'] or 0),
+                        'total_valor': float(item['total_valor'] or 0),
+                        'transacciones': item['transacciones'],
+                        'precio_promedio': float(item['precio_promedio'] or 0)
+                    })
 
             print(f"🔍 RESULTADOS FINALES: {len(resultados_lista)} artículos")
 
@@ -4485,8 +4647,6 @@ class ConsultaNaturalViewSet(viewsets.ViewSet):
     def _comparar_periodos(self, consulta, empresa_servidor_id=None, request=None):
         """Compara ventas entre dos periodos - ADAPTADO PARA MÚLTIPLES EMPRESAS"""
         try:
-            from apps.sistema_analitico.models import MovimientoInventario
-
             # ✅ OBTENER EMPRESAS SEGÚN CONTEXTO
             empresas_ids, es_consolidado = self._obtener_empresas_para_consulta(request, empresa_servidor_id)
 
@@ -4501,33 +4661,20 @@ class ConsultaNaturalViewSet(viewsets.ViewSet):
             ultimo_mes = hoy.replace(day=1) - timedelta(days=1)
             mes_anterior = ultimo_mes.replace(day=1) - timedelta(days=1)
 
-            # Consultas base - ADAPTADAS
-            query_ultimo_mes = MovimientoInventario.objects.filter(
-                empresa_servidor_id__in=empresas_ids,
-                fecha__year=ultimo_mes.year,
-                fecha__month=ultimo_mes.month,
-                tipo_documento='FACTURA_VENTA'
-            )
-
-            query_mes_anterior = MovimientoInventario.objects.filter(
-                empresa_servidor_id__in=empresas_ids,
-                fecha__year=mes_anterior.year,
-                fecha__month=mes_anterior.month,
-                tipo_documento='FACTURA_VENTA'
-            )
-
-            ventas_ultimo_mes = query_ultimo_mes.aggregate(
-                total_ventas=Count('id'),
-                valor_total=Sum('valor_total')
-            )
-
-            ventas_mes_anterior = query_mes_anterior.aggregate(
-                total_ventas=Count('id'),
-                valor_total=Sum('valor_total')
-            )
+            # ✅ UNA SOLA CONSULTA AGRUPADA POR MES sobre el resumen mensual
+            periodo_ultimo = date(ultimo_mes.year, ultimo_mes.month, 1)
+            periodo_anterior = date(mes_anterior.year, mes_anterior.month, 1)
+            por_periodo = {
+                fila['periodo']: fila
+                for fila in totales_por_resumen(
+                    empresas_ids, ['periodo'], periodo__in=[periodo_ultimo, periodo_anterior]
+                )
+            }
+            ventas_ultimo_mes = por_periodo.get(periodo_ultimo, {})
+            ventas_mes_anterior = por_periodo.get(periodo_anterior, {})
 
-            valor_ultimo_mes = ventas_ultimo_mes['valor_total'] or 0
-            valor_mes_anterior = ventas_mes_anterior['valor_total'] or 0
+            valor_ultimo_mes = ventas_ultimo_mes.get('valor_total') or 0
+            valor_mes_anterior = ventas_mes_anterior.get('valor_total') or 0
 
             if valor_mes_anterior > 0:
                 variacion = ((valor_ultimo_mes - valor_mes_anterior) / valor_mes_anterior) * 100
@@ -4544,11 +4691,11 @@ class ConsultaNaturalViewSet(viewsets.ViewSet):
                 'periodo_actual': f"{ultimo_mes.strftime('%B %Y')}",
                 'periodo_anterior': f"{mes_anterior.strftime('%B %Y')}",
                 'ventas_actual': {
-                    'total_ventas': ventas_ultimo_mes['total_ventas'] or 0,
+                    'total_ventas': ventas_ultimo_mes.get('total_ventas') or 0,
                     'valor_total': float(valor_ultimo_mes)
                 },
                 'ventas_anterior': {
-                    'total_ventas': ventas_mes_anterior['total_ventas'] or 0,
+                    'total_ventas': ventas_mes_anterior.get('total_ventas') or 0,
                     'valor_total': float(valor_mes_anterior)
                 },
                 'variacion': round(variacion, 2),
@@ -4564,8 +4711,6 @@ class ConsultaNaturalViewSet(viewsets.ViewSet):
     def _analizar_crecimiento(self, consulta, empresa_servidor_id=None, request=None):
         """Analiza crecimiento de ventas - ADAPTADO PARA MÚLTIPLES EMPRESAS"""
         try:
-            from apps.sistema_analitico.models import MovimientoInventario
-
             # ✅ OBTENER EMPRESAS SEGÚN CONTEXTO
             empresas_ids, es_consolidado = self._obtener_empresas_para_consulta(request, empresa_servidor_id)
 
@@ -4575,34 +4720,20 @@ class ConsultaNaturalViewSet(viewsets.ViewSet):
                 empresas_ids = [empresas_ids[0]]
                 es_consolidado = False
 
-            # Analizar últimos 6 meses vs anteriores 6 meses
-            hoy = timezone.now()
-            seis_meses_atras = hoy - timedelta(days=180)
-            doce_meses_atras = hoy - timedelta(days=360)
-
-            # Consultas base - ADAPTADAS
-            query_recientes = MovimientoInventario.objects.filter(
-                empresa_servidor_id__in=empresas_ids,
-                fecha__range=[seis_meses_atras, hoy],
-                tipo_documento='FACTURA_VENTA'
-            )
-
-            query_anteriores = MovimientoInventario.objects.filter(
-                empresa_servidor_id__in=empresas_ids,
-                fecha__range=[doce_meses_atras, seis_meses_atras],
-                tipo_documento='FACTURA_VENTA'
-            )
+            # Analizar últimos 6 meses (incluye el mes en curso) vs anteriores 6 meses
+            hoy = timezone.localtime().date()
+            meses = []
+            anio, mes = hoy.year, hoy.month
+            for _ in range(12):
+                meses.append(date(anio, mes, 1))
+                anio, mes = (anio - 1, 12) if mes == 1 else (anio, mes - 1)
+            meses_recientes = set(meses[:6])
 
-            ventas_recientes = query_recientes.aggregate(
-                valor_total=Sum('valor_total')
-            )
-
-            ventas_anteriores = query_anteriores.aggregate(
-                valor_total=Sum('valor_total')
-            )
+            # ✅ UNA SOLA CONSULTA AGRUPADA POR MES sobre el resumen mensual
+            por_mes = list(totales_por_resumen(empresas_ids, ['periodo'], periodo__in=meses))
 
-            valor_reciente = ventas_recientes['valor_total'] or 0
-            valor_anterior = ventas_anteriores['valor_total'] or 0
+            valor_reciente = sum((m['valor_total'] or 0) for m in por_mes if m['periodo'] in meses_recientes)
+            valor_anterior = sum((m['valor_total'] or 0) for m in por_mes if m['periodo'] not in meses_recientes)
 
             if valor_anterior > 0:
                 crecimiento = ((valor_reciente - valor_anterior) / valor_anterior) * 100
@@ -4610,11 +4741,10 @@ class ConsultaNaturalViewSet(viewsets.ViewSet):
                 crecimiento = 100 if valor_reciente > 0 else 0
 
             # Tendencias mensuales - ADAPTADA
-            tendencias = query_recientes.annotate(
-                mes=TruncMonth('fecha')
-            ).values('mes').annotate(
-                valor_mensual=Sum('valor_total')
-            ).order_by('mes')
+            tendencias = [
+                {'mes': m['periodo'], 'valor_mensual': m['valor_total']}
+                for m in por_mes if m['periodo'] in meses_recientes
+            ]
 
             # ✅ MENSAJE SEGÚN CONTEXTO
             mensaje = f'Análisis de crecimiento: {round(crecimiento, 2)}%'
@@ -4853,24 +4983,46 @@ class ConsultaNaturalViewSet(viewsets.ViewSet):
             # Analizar últimos 6 meses
             fecha_limite = timezone.now() - timedelta(days=180)
 
-            # Consulta base - ADAPTADA
-            rotacion_articulos_query = MovimientoInventario.objects.filter(
-                empresa_servidor_id__in=empresas_ids,
-                fecha__gte=fecha_limite,
-                tipo_documento='FACTURA_VENTA'
-            ).values('articulo_codigo', 'articulo_nombre').annotate(
-                total_vendido=Sum('cantidad'),
-                valor_total=Sum('valor_total'),
-                transacciones=Count('id'),
-                ultima_venta=Max('fecha')
-            ).order_by('-total_vendido')
+            # ✅ CAMINO RÁPIDO: agregación vectorizada sobre la caché Parquet
+            df = self._movimientos_columnar(
+                empresas_ids, timezone.localtime(fecha_limite).replace(tzinfo=None), None, 'FACTURA_VENTA',
+                ['articulo_codigo', 'articulo_nombre', 'cantidad', 'valor_total']
+            )
+            if df is not None:
+                agregado = agregar_por_articulo(df).sort_values('total_vendido', ascending=False)
+                total_articulos = len(agregado)
+                if limite is not None:
+                    agregado = agregado.head(limite)
+                rotacion_articulos_query = [
+                    {
+                        'articulo_codigo': fila.articulo_codigo,
+                        'articulo_nombre': fila.articulo_nombre,
+                        'total_vendido': int(fila.total_vendido),
+                        'valor_total': fila.valor_total,
+                        'transacciones': int(fila.transacciones),
+                        'ultima_venta': timezone.make_aware(fila.ultima_venta.to_pydatetime()),
+                    }
+                    for fila in agregado.itertuples(index=False)
+                ]
+            else:
+                # Consulta base - ADAPTADA
+                rotacion_articulos_query = MovimientoInventario.objects.filter(
+                    empresa_servidor_id__in=empresas_ids,
+                    fecha__gte=fecha_limite,
+                    tipo_documento='FACTURA_VENTA'
+                ).values('articulo_codigo', 'articulo_nombre').annotate(
+                    total_vendido=Sum('cantidad'),
+                    valor_total=Sum('valor_total'),
+                    transacciones=Count('id'),
+                    ultima_venta=Max('fecha')
+                ).order_by('-total_vendido')
 
-            # ✅ CALCULAR TOTAL REAL
-            total_articulos = rotacion_articulos_query.count()
+                # ✅ CALCULAR TOTAL REAL
+                total_articulos = rotacion_articulos_query.count()
 
-            # ✅ APLICAR LÍMITE SI ES NECESARIO
-            if limite is not None:
-                rotacion_articulos_query = rotacion_articulos_query[:limite]
+                # ✅ APLICAR LÍMITE SI ES NECESARIO
+                if limite is not None:
+                    rotacion_articulos_query = rotacion_articulos_query[:limite]
 
             rotacion_articulos = []
             for articulo in rotacion_articulos_query:
@@ -5148,7 +5300,7 @@ class ConsultaNaturalViewSet(viewsets.ViewSet):
     def _comparar_anios_especificos(self, consulta, empresa_servidor_id, anio_actual, anio_comparar):
         """Compara años fiscales específicos"""
         try:
-            from apps.sistema_analitico.models import EmpresaServidor, MovimientoInventario
+            from apps.sistema_analitico.models import EmpresaServidor
 
             # Obtener empresa actual
             empresa_actual = EmpresaServidor.objects.get(id=empresa_servidor_id)
@@ -5221,8 +5373,6 @@ class ConsultaNaturalViewSet(viewsets.ViewSet):
     def _comparar_trimestres_entre_anios(self, empresa_id_actual, empresa_id_anterior, trimestre, anio_actual, anio_anterior):
         """Compara trimestres específicos entre años"""
         try:
-            from apps.sistema_analitico.models import MovimientoInventario
-
             # Definir meses del trimestre
             meses_trimestre = {
                 1: [1, 2, 3],   # Enero-Marzo
@@ -5233,29 +5383,20 @@ class ConsultaNaturalViewSet(viewsets.ViewSet):
 
             meses = meses_trimestre.get(trimestre, [1, 2, 3])
 
-            # Ventas trimestre actual
-            ventas_actual = MovimientoInventario.objects.filter(
-                empresa_servidor_id=empresa_id_actual,
-                fecha__year=anio_actual,
-                fecha__month__in=meses,
-                tipo_documento='FACTURA_VENTA'
-            ).aggregate(
-                total_ventas=Count('id'),
-                articulos_vendidos=Sum('cantidad'),
-                valor_total=Sum('valor_total')
-            )
-
-            # Ventas trimestre anterior
-            ventas_anterior = MovimientoInventario.objects.filter(
-                empresa_servidor_id=empresa_id_anterior,
-                fecha__year=anio_anterior,
-                fecha__month__in=meses,
-                tipo_documento='FACTURA_VENTA'
-            ).aggregate(
-                total_ventas=Count('id'),
-                articulos_vendidos=Sum('cantidad'),
-                valor_total=Sum('valor_total')
-            )
+            # ✅ UNA SOLA CONSULTA AGRUPADA POR (EMPRESA, AÑO) sobre el resumen mensual:
+            # cada empresa solo cuenta los meses de su propio año
+            por_empresa_anio = {
+                (fila['empresa_servidor_id'], fila['periodo__year']): fila
+                for fila in totales_por_resumen(
+                    [empresa_id_actual, empresa_id_anterior], ['empresa_servidor_id', 'periodo__year'],
+                    periodo__in=(
+                        [date(anio_actual, mes, 1) for mes in meses] +
+                        [date(anio_anterior, mes, 1) for mes in meses]
+                    )
+                )
+            }
+            ventas_actual = self._totales_resumen(por_empresa_anio.get((empresa_id_actual, anio_actual)))
+            ventas_anterior = self._totales_resumen(por_empresa_anio.get((empresa_id_anterior, anio_anterior)))
 
             valor_actual = ventas_actual['valor_total'] or 0
             valor_anterior = ventas_anterior['valor_total'] or 0
@@ -5309,30 +5450,27 @@ class ConsultaNaturalViewSet(viewsets.ViewSet):
         except Exception as e:
             return {'error': f'Error comparando trimestres: {str(e)}'}
 
+    def _totales_resumen(self, fila):
+        """Adapta una fila de totales_por_resumen al formato de los aggregate() de comparación"""
+        fila = fila or {}
+        return {
+            'total_ventas': fila.get('total_ventas') or 0,
+            'articulos_vendidos': fila.get('total_articulos') or 0,
+            'valor_total': fila.get('valor_total') or 0
+        }
+
     def _comparar_anios_completos(self, empresa_id_actual, empresa_id_anterior, anio_actual, anio_anterior):
         """Compara años fiscales completos"""
         try:
-            from apps.sistema_analitico.models import MovimientoInventario
-
-            # Ventas año actual
-            ventas_actual = MovimientoInventario.objects.filter(
-                empresa_servidor_id=empresa_id_actual,
-                tipo_documento='FACTURA_VENTA'
-            ).aggregate(
-                total_ventas=Count('id'),
-                articulos_vendidos=Sum('cantidad'),
-                valor_total=Sum('valor_total')
-            )
-
-            # Ventas año anterior
-            ventas_anterior = MovimientoInventario.objects.filter(
-                empresa_servidor_id=empresa_id_anterior,
-                tipo_documento='FACTURA_VENTA'
-            ).aggregate(
-                total_ventas=Count('id'),
-                articulos_vendidos=Sum('cantidad'),
-                valor_total=Sum('valor_total')
-            )
+            # ✅ UNA SOLA CONSULTA AGRUPADA POR EMPRESA sobre el resumen mensual
+            por_empresa = {
+                fila['empresa_servidor_id']: fila
+                for fila in totales_por_resumen(
+                    [empresa_id_actual, empresa_id_anterior], ['empresa_servidor_id']
+                )
+            }
+            ventas_actual = self._totales_resumen(por_empresa.get(empresa_id_actual))
+            ventas_anterior = self._totales_resumen(por_empresa.get(empresa_id_anterior))
 
             valor_actual = ventas_actual['valor_total'] or 0
             valor_anterior = ventas_anterior['valor_total'] or 0
@@ -5429,13 +5567,14 @@ class ConsultaNaturalViewSet(viewsets.ViewSet):
             from apps.sistema_analitico.models import EmpresaServidor, MovimientoInventario
             
             estados = {
-                'ml_engine_activo': hasattr(self, 'ml_engine') and self.ml_engine is not None,
+                'ml_engine_activo': self.ml_engine is not None,
                 'response_orchestrator_activo': hasattr(self, 'response_orchestrator') and self.response_orchestrator is not None,
                 'empresas_activas': EmpresaServidor.objects.filter(estado='ACTIVO').count(),
                 'total_movimientos': MovimientoInventario.objects.count(),
                 'total_empresas': EmpresaServidor.objects.count(),
                 'ultima_actualizacion': timezone.now().isoformat(),
-                'modelos_entrenados': len(self.ml_engine.modelos_entrenados) if hasattr(self.ml_engine, 'modelos_entrenados') else 0
+                'modelos_entrenados': len(self.ml_engine.registro.modelos_en_memoria()),
+                'registro_modelos': self.ml_engine.registro.estadisticas()
             }
             return Response(estados)
         except Exception as e:
@@ -6187,10 +6326,13 @@ class TNSViewSet(APIKeyAwareViewSet, viewsets.ViewSet):
         serializer.is_valid(raise_exception=True)
         bridge = self._build_bridge(request, serializer.validated_data)
         try:
-            rows = bridge.run_query(
-                serializer.validated_data['sql'],
-                serializer.validated_data.get('params'),
-            )
+            sql = serializer.validated_data['sql']
+            rows = bridge.run_query(sql, serializer.validated_data.get('params'))
+            if sql.lstrip().upper().startswith(('INSERT', 'UPDATE', 'DELETE', 'MERGE', 'EXECUTE')):
+                bridge.invalidar_resultados()
+            elif sql.lstrip().upper().startswith(('CREATE', 'ALTER', 'DROP', 'RECREATE')):
+                bridge.invalidar_metadata()
+                bridge.invalidar_resultados()
             return Response({'rows': rows})
         finally:
             bridge.close()
@@ -6232,6 +6374,8 @@ class TNSViewSet(APIKeyAwareViewSet, viewsets.ViewSet):
                 params_list = []
             
             result = bridge.call_procedure(serializer.validated_data['procedure'], params_list)
+            # Un procedimiento puede escribir en cualquier tabla: invalidar toda la base
+            bridge.invalidar_resultados()
             return Response({'result': result})
         finally:
             bridge.close()
@@ -6257,6 +6401,36 @@ class TNSViewSet(APIKeyAwareViewSet, viewsets.ViewSet):
         finally:
             bridge.close()
 
+    @action(detail=False, methods=['get'])
+    def metadata(self, request):
+        """
+        Catálogo de metadatos de la base TNS (columnas, índices, llaves, filas estimadas).
+        GET /api/tns/metadata/?empresa_servidor_id=1&table_name=KARDEX&refrescar=true
+        """
+        serializer = TNSMetadataSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        bridge = self._build_bridge(request, serializer.validated_data)
+        try:
+            if serializer.validated_data.get('refrescar'):
+                catalogo = bridge.refrescar_metadata()
+            else:
+                catalogo = bridge.metadata
+            respuesta = {'version': catalogo['version'], 'generado': catalogo['generado']}
+            table_name = serializer.validated_data.get('table_name')
+            if table_name:
+                tabla = catalogo['tablas'].get(table_name.upper())
+                if tabla is None:
+                    return Response(
+                        {'error': f"Tabla '{table_name}' no encontrada"},
+                        status=status.HTTP_404_NOT_FOUND
+                    )
+                respuesta['tabla'] = tabla
+            else:
+                respuesta['tablas'] = catalogo['tablas']
+            return Response(respuesta)
+        finally:
+            bridge.close()
+
     @action(detail=False, methods=['get'], url_path='admin_empresas')
     def admin_empresas(self, request):
         serializer = TNSAdminEmpresasSerializer(data=request.query_params)
@@ -6364,11 +6538,8 @@ class TNSViewSet(APIKeyAwareViewSet, viewsets.ViewSet):
         print(f"      Bridge charset: {bridge.charset}")
         
         try:
-            print("   [5.1] Conectando a Firebird...")
-            bridge.connect()
-            print("   [5.1] ✓ Conexión exitosa")
-            
-            # Función para obtener nombre real de tabla (como BCE)
+            # La conexión se toma del pool solo si hay que consultar Firebird
+            # (esquema o resultados fuera de caché)
             print("   [5.2] Obteniendo esquema de base de datos...")
             def get_real_table_name(table_name):
                 bridge._ensure_schema()
@@ -6384,9 +6555,17 @@ class TNSViewSet(APIKeyAwareViewSet, viewsets.ViewSet):
             print(f"      Campos: {len(serializer.validated_data.get('fields', []))}")
             print(f"      Foreign keys: {len(serializer.validated_data.get('foreign_keys', []))}")
             
+            # Catálogo de metadatos (Redis): valida campos y elige orden indexado sin ir a Firebird
+            try:
+                metadata_tablas = bridge.metadata['tablas']
+            except Exception as meta_error:
+                logger.warning(f'Catálogo de metadatos TNS no disponible: {meta_error}')
+                metadata_tablas = None
+            
             query_builder = TNSQueryBuilder(
                 serializer.validated_data['table_name'],
-                get_real_table_name_func=get_real_table_name
+                get_real_table_name_func=get_real_table_name,
+                metadata=metadata_tablas
             )
             
             print("   [5.4] Agregando campos, foreign keys, filtros y orden...")
@@ -6400,201 +6579,218 @@ class TNSViewSet(APIKeyAwareViewSet, viewsets.ViewSet):
             )
             print("   [5.4] ✓ Query builder configurado")
             
-            # Ejecutar query de conteo primero (como BCE)
-            print("   [5.5] Ejecutando query de conteo...")
+            # Caché de resultados (Redis): conteo y página por (pool_key, SQL, params)
+            from math import ceil
+            from .services.tns_result_cache import TNSResultCache
+            result_cache = TNSResultCache(bridge.pool_key)
+            tablas_consulta = [query_builder.table_name] + [fk['table'] for fk in query_builder.foreign_keys]
             count_query, count_params = query_builder.build_count_query()
-            print("=" * 80)
-            print("   [SQL COUNT] QUERY DE CONTEO COMPLETA:")
-            print("=" * 80)
-            print(count_query)
-            if count_params:
-                print(f"\n   [SQL COUNT] Parámetros: {count_params}")
-            print("=" * 80)
-            bridge.cursor.execute(count_query, count_params)
-            total_records = bridge.cursor.fetchone()[0]
-            print(f"   [5.5] ✓ Total de registros: {total_records}")
-            
-            # Ejecutar query de datos (como BCE)
-            print("   [5.6] Ejecutando query de datos...")
             paginated_query, params = query_builder.build_query()
-            print("=" * 80)
-            print("   [SQL SELECT] QUERY DE DATOS COMPLETA:")
-            print("=" * 80)
-            print(paginated_query)
-            if params:
-                print(f"\n   [SQL SELECT] Parámetros: {params}")
-            print("=" * 80)
-            try:
-                bridge.cursor.execute(paginated_query, params)
-                print("   [5.6] ✓ Query ejecutada")
-            except (UnicodeDecodeError, ValueError) as decode_error:
-                # Si hay error de decodificación en firebirdsql, intentar con charset alternativo
-                print(f"   [5.6] ⚠ Error de decodificación: {decode_error}")
-                print(f"      Tipo: {type(decode_error)}")
-                # Cerrar cursor y reconectar con charset alternativo
-                try:
-                    bridge.cursor.close()
-                except:
-                    pass
-                bridge.close()
-                # Cambiar charset a latin-1 y reconectar
-                original_charset = bridge.charset
-                bridge.charset = 'latin-1'
-                print(f"   [5.6-RETRY] Reintentando con charset: {bridge.charset} (original: {original_charset})")
+            
+            def ejecutar_conteo():
+                # Ejecutar query de conteo primero (como BCE)
+                print("   [5.5] Ejecutando query de conteo...")
+                print("=" * 80)
+                print("   [SQL COUNT] QUERY DE CONTEO COMPLETA:")
+                print("=" * 80)
+                print(count_query)
+                if count_params:
+                    print(f"\n   [SQL COUNT] Parámetros: {count_params}")
+                print("=" * 80)
+                bridge.connect()
+                bridge.cursor.execute(count_query, count_params)
+                total_records = bridge.cursor.fetchone()[0]
+                print(f"   [5.5] ✓ Total de registros: {total_records}")
+                return total_records
+            
+            total_records, count_desde_cache = result_cache.obtener_o_calcular(
+                'count', tablas_consulta, count_query, count_params, ejecutar_conteo
+            )
+            
+            def ejecutar_datos():
+                # Ejecutar query de datos (como BCE)
+                print("   [5.6] Ejecutando query de datos...")
+                print("=" * 80)
+                print("   [SQL SELECT] QUERY DE DATOS COMPLETA:")
+                print("=" * 80)
+                print(paginated_query)
+                if params:
+                    print(f"\n   [SQL SELECT] Parámetros: {params}")
+                print("=" * 80)
                 bridge.connect()
-                bridge.cursor.execute(paginated_query, params)
-                print("   [5.6-RETRY] ✓ Query ejecutada con charset alternativo")
-            
-            # Decodificar nombres de columnas correctamente (pueden venir como bytes)
-            print("   [6] Decodificando nombres de columnas...")
-            columns = []
-            for idx, desc in enumerate(bridge.cursor.description or []):
-                col_name = desc[0]
-                should_log = idx < 5  # Log solo las primeras 5 columnas
-                if should_log:
-                    print(f"      Columna {idx}: tipo={type(col_name)}, valor={repr(str(col_name)[:50]) if col_name else None}")
-                if isinstance(col_name, bytes):
+                try:
+                    bridge.cursor.execute(paginated_query, params)
+                    print("   [5.6] ✓ Query ejecutada")
+                except (UnicodeDecodeError, ValueError) as decode_error:
+                    # Si hay error de decodificación en firebirdsql, intentar con charset alternativo
+                    print(f"   [5.6] ⚠ Error de decodificación: {decode_error}")
+                    print(f"      Tipo: {type(decode_error)}")
+                    # Cerrar cursor y reconectar con charset alternativo
                     try:
-                        col_name = col_name.decode(bridge.charset, errors='replace')
-                        if should_log:
-                            print(f"         ✓ Decodificado con {bridge.charset}")
-                    except (UnicodeDecodeError, LookupError) as e:
-                        if should_log:
-                            print(f"         ⚠ Error con {bridge.charset}: {e}")
+                        bridge.cursor.close()
+                    except:
+                        pass
+                    bridge.close()
+                    # Cambiar charset a latin-1 y reconectar
+                    original_charset = bridge.charset
+                    bridge.charset = 'latin-1'
+                    print(f"   [5.6-RETRY] Reintentando con charset: {bridge.charset} (original: {original_charset})")
+                    bridge.connect()
+                    bridge.cursor.execute(paginated_query, params)
+                    print("   [5.6-RETRY] ✓ Query ejecutada con charset alternativo")
+            
+                # Decodificar nombres de columnas correctamente (pueden venir como bytes)
+                print("   [6] Decodificando nombres de columnas...")
+                columns = []
+                for idx, desc in enumerate(bridge.cursor.description or []):
+                    col_name = desc[0]
+                    should_log = idx < 5  # Log solo las primeras 5 columnas
+                    if should_log:
+                        print(f"      Columna {idx}: tipo={type(col_name)}, valor={repr(str(col_name)[:50]) if col_name else None}")
+                    if isinstance(col_name, bytes):
                         try:
-                            col_name = col_name.decode('latin-1', errors='replace')
+                            col_name = col_name.decode(bridge.charset, errors='replace')
                             if should_log:
-                                print(f"         ✓ Decodificado con latin-1")
-                        except Exception as e2:
+                                print(f"         ✓ Decodificado con {bridge.charset}")
+                        except (UnicodeDecodeError, LookupError) as e:
                             if should_log:
-                                print(f"         ⚠ Error con latin-1: {e2}")
+                                print(f"         ⚠ Error con {bridge.charset}: {e}")
                             try:
-                                col_name = col_name.decode('utf-8', errors='replace')
-                                if should_log:
-                                    print(f"         ✓ Decodificado con utf-8")
-                            except Exception as e3:
+                                col_name = col_name.decode('latin-1', errors='replace')
                                 if should_log:
-                                    print(f"         ⚠ Error con utf-8: {e3}")
-                                col_name = str(col_name, errors='replace')
+                                    print(f"         ✓ Decodificado con latin-1")
+                            except Exception as e2:
                                 if should_log:
-                                    print(f"         ✓ Convertido a string")
-                # Asegurar que sea string y UTF-8 válido
-                if isinstance(col_name, str):
-                    try:
-                        col_name.encode('utf-8')
-                    except UnicodeEncodeError as e:
-                        if should_log:
-                            print(f"         ⚠ Error encoding UTF-8: {e}, normalizando...")
-                        col_name = col_name.encode('utf-8', errors='replace').decode('utf-8')
-                columns.append(col_name.strip() if isinstance(col_name, str) else str(col_name).strip())
-            print(f"   [6] ✓ {len(columns)} columnas procesadas")
-            
-            # Procesar resultados con column_mapping (como BCE)
-            from math import ceil
-            _, column_mapping = query_builder.build_select_clause()
-            print("   [7] Procesando filas...")
-            rows = []
-            row_count = 0
-            try:
-                all_rows = bridge.cursor.fetchall()
-                print(f"      Total de filas a procesar: {len(all_rows)}")
-                for row_idx, row in enumerate(all_rows):
-                    if row_idx < 3:  # Log solo las primeras 3 filas
-                        print(f"      Procesando fila {row_idx + 1}...")
-                    row_dict = {}
-                    for idx, col in enumerate(columns):
+                                    print(f"         ⚠ Error con latin-1: {e2}")
+                                try:
+                                    col_name = col_name.decode('utf-8', errors='replace')
+                                    if should_log:
+                                        print(f"         ✓ Decodificado con utf-8")
+                                except Exception as e3:
+                                    if should_log:
+                                        print(f"         ⚠ Error con utf-8: {e3}")
+                                    col_name = str(col_name, errors='replace')
+                                    if should_log:
+                                        print(f"         ✓ Convertido a string")
+                    # Asegurar que sea string y UTF-8 válido
+                    if isinstance(col_name, str):
                         try:
-                            value = row[idx]
-                            if row_idx < 3 and idx < 3:  # Log solo primeros valores
-                                print(f"         [{col}] tipo={type(value)}, valor={repr(str(value)[:30]) if value else None}")
-                            # Usar función helper para decodificar correctamente (ya normaliza a UTF-8)
-                            value = _decode_firebird_value(value)
-                            # Mapear nombre de columna a alias original (como BCE)
-                            final_col = next((k for k, v in column_mapping.items() if v == col), col)
-                            row_dict[final_col] = value
-                        except (UnicodeDecodeError, UnicodeEncodeError) as e:
-                            # Si hay error de codificación en un campo específico, usar valor por defecto
-                            print(f"         ⚠ Error de codificación en columna {col}: {e}")
-                            logger.warning(f'Error de codificación en columna {col}: {e}')
-                            final_col = next((k for k, v in column_mapping.items() if v == col), col)
-                            row_dict[final_col] = None
-                        except Exception as e:
-                            # Otro error, usar valor por defecto
-                            print(f"         ⚠ Error procesando columna {col}: {e}")
-                            logger.warning(f'Error procesando columna {col}: {e}')
-                            final_col = next((k for k, v in column_mapping.items() if v == col), col)
-                            row_dict[final_col] = None
-                    rows.append(row_dict)
-                    row_count += 1
-                print(f"   [7] ✓ {row_count} filas procesadas")
-            except (UnicodeDecodeError, UnicodeEncodeError) as e:
-                logger.error(f'Error de codificación al procesar filas: {e}', exc_info=True)
-                # Retornar error específico
-                return Response(
-                    {'error': f'Error de codificación de caracteres: {str(e)}. Verifique la configuración de charset de Firebird.'},
-                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
-                )
-            
-            page = serializer.validated_data.get('page', 1)
-            page_size = serializer.validated_data.get('page_size', 50)
-            
-            # Limpiar y normalizar todos los valores para JSON (asegurar UTF-8)
-            def clean_for_json(obj):
-                """Recursivamente limpia valores para asegurar serialización JSON segura"""
-                if isinstance(obj, dict):
-                    return {str(k): clean_for_json(v) for k, v in obj.items()}
-                elif isinstance(obj, list):
-                    return [clean_for_json(item) for item in obj]
-                elif isinstance(obj, bytes):
-                    # Decodificar bytes
-                    return _decode_firebird_value(obj)
-                elif isinstance(obj, str):
-                    # Asegurar UTF-8 válido
-                    try:
-                        # Si ya es UTF-8 válido, retornar tal cual
-                        obj.encode('utf-8')
-                        return obj
-                    except UnicodeEncodeError:
-                        # Si no es UTF-8 válido, normalizar
-                        return _decode_firebird_value(obj.encode('latin-1', errors='replace'))
-                elif obj is None:
-                    return None
-                elif isinstance(obj, (int, float, bool)):
-                    return obj
-                elif isinstance(obj, Decimal):
-                    # Convertir Decimal a float para JSON
-                    return float(obj)
-                elif hasattr(obj, 'isoformat'):  # datetime, date
-                    return obj.isoformat()
-                else:
-                    # Para otros tipos, convertir a string
-                    try:
-                        str_val = str(obj)
-                        # Asegurar que el string sea UTF-8 válido
-                        return _decode_firebird_value(str_val.encode('latin-1', errors='replace') if isinstance(str_val, str) else str_val)
-                    except Exception:
+                            col_name.encode('utf-8')
+                        except UnicodeEncodeError as e:
+                            if should_log:
+                                print(f"         ⚠ Error encoding UTF-8: {e}, normalizando...")
+                            col_name = col_name.encode('utf-8', errors='replace').decode('utf-8')
+                    columns.append(col_name.strip() if isinstance(col_name, str) else str(col_name).strip())
+                print(f"   [6] ✓ {len(columns)} columnas procesadas")
+            
+                # Procesar resultados con column_mapping (como BCE)
+                _, column_mapping = query_builder.build_select_clause()
+                print("   [7] Procesando filas...")
+                rows = []
+                row_count = 0
+                try:
+                    all_rows = bridge.cursor.fetchall()
+                    print(f"      Total de filas a procesar: {len(all_rows)}")
+                    for row_idx, row in enumerate(all_rows):
+                        if row_idx < 3:  # Log solo las primeras 3 filas
+                            print(f"      Procesando fila {row_idx + 1}...")
+                        row_dict = {}
+                        for idx, col in enumerate(columns):
+                            try:
+                                value = row[idx]
+                                if row_idx < 3 and idx < 3:  # Log solo primeros valores
+                                    print(f"         [{col}] tipo={type(value)}, valor={repr(str(value)[:30]) if value else None}")
+                                # Usar función helper para decodificar correctamente (ya normaliza a UTF-8)
+                                value = _decode_firebird_value(value)
+                                # Mapear nombre de columna a alias original (como BCE)
+                                final_col = next((k for k, v in column_mapping.items() if v == col), col)
+                                row_dict[final_col] = value
+                            except (UnicodeDecodeError, UnicodeEncodeError) as e:
+                                # Si hay error de codificación en un campo específico, usar valor por defecto
+                                print(f"         ⚠ Error de codificación en columna {col}: {e}")
+                                logger.warning(f'Error de codificación en columna {col}: {e}')
+                                final_col = next((k for k, v in column_mapping.items() if v == col), col)
+                                row_dict[final_col] = None
+                            except Exception as e:
+                                # Otro error, usar valor por defecto
+                                print(f"         ⚠ Error procesando columna {col}: {e}")
+                                logger.warning(f'Error procesando columna {col}: {e}')
+                                final_col = next((k for k, v in column_mapping.items() if v == col), col)
+                                row_dict[final_col] = None
+                        rows.append(row_dict)
+                        row_count += 1
+                    print(f"   [7] ✓ {row_count} filas procesadas")
+                except (UnicodeDecodeError, UnicodeEncodeError) as e:
+                    logger.error(f'Error de codificación al procesar filas: {e}', exc_info=True)
+                    # Se propaga para que el handler externo responda 500 (no se cachea)
+                    raise
+            
+                # Limpiar y normalizar todos los valores para JSON (asegurar UTF-8)
+                def clean_for_json(obj):
+                    """Recursivamente limpia valores para asegurar serialización JSON segura"""
+                    if isinstance(obj, dict):
+                        return {str(k): clean_for_json(v) for k, v in obj.items()}
+                    elif isinstance(obj, list):
+                        return [clean_for_json(item) for item in obj]
+                    elif isinstance(obj, bytes):
+                        # Decodificar bytes
+                        return _decode_firebird_value(obj)
+                    elif isinstance(obj, str):
+                        # Asegurar UTF-8 válido
+                        try:
+                            # Si ya es UTF-8 válido, retornar tal cual
+                            obj.encode('utf-8')
+                            return obj
+                        except UnicodeEncodeError:
+                            # Si no es UTF-8 válido, normalizar
+                            return _decode_firebird_value(obj.encode('latin-1', errors='replace'))
+                    elif obj is None:
                         return None
+                    elif isinstance(obj, (int, float, bool)):
+                        return obj
+                    elif isinstance(obj, Decimal):
+                        # Convertir Decimal a float para JSON
+                        return float(obj)
+                    elif hasattr(obj, 'isoformat'):  # datetime, date
+                        return obj.isoformat()
+                    else:
+                        # Para otros tipos, convertir a string
+                        try:
+                            str_val = str(obj)
+                            # Asegurar que el string sea UTF-8 válido
+                            return _decode_firebird_value(str_val.encode('latin-1', errors='replace') if isinstance(str_val, str) else str_val)
+                        except Exception:
+                            return None
             
-            # Limpiar rows antes de serializar
-            try:
-                cleaned_rows = clean_for_json(rows)
-            except Exception as clean_error:
-                logger.error(f'Error limpiando datos para JSON: {clean_error}', exc_info=True)
-                # Si falla la limpieza, intentar limpieza más básica
+                # Limpiar rows antes de serializar
                 try:
-                    # Limpieza básica: solo decodificar bytes
-                    cleaned_rows = []
-                    for row in rows:
-                        cleaned_row = {}
-                        for k, v in row.items():
-                            if isinstance(v, bytes):
-                                cleaned_row[k] = _decode_firebird_value(v)
-                            else:
-                                cleaned_row[k] = v
-                        cleaned_rows.append(cleaned_row)
-                except Exception as e2:
-                    logger.error(f'Error incluso con limpieza básica: {e2}', exc_info=True)
-                    cleaned_rows = rows
+                    cleaned_rows = clean_for_json(rows)
+                except Exception as clean_error:
+                    logger.error(f'Error limpiando datos para JSON: {clean_error}', exc_info=True)
+                    # Si falla la limpieza, intentar limpieza más básica
+                    try:
+                        # Limpieza básica: solo decodificar bytes
+                        cleaned_rows = []
+                        for row in rows:
+                            cleaned_row = {}
+                            for k, v in row.items():
+                                if isinstance(v, bytes):
+                                    cleaned_row[k] = _decode_firebird_value(v)
+                                else:
+                                    cleaned_row[k] = v
+                            cleaned_rows.append(cleaned_row)
+                    except Exception as e2:
+                        logger.error(f'Error incluso con limpieza básica: {e2}', exc_info=True)
+                        cleaned_rows = rows
+                return cleaned_rows
+            
+            cleaned_rows, datos_desde_cache = result_cache.obtener_o_calcular(
+                'page', tablas_consulta, paginated_query, params, ejecutar_datos
+            )
+            print(f"   [8] Caché: conteo={'HIT' if count_desde_cache else 'MISS'}, datos={'HIT' if datos_desde_cache else 'MISS'}")
+            
+            page = serializer.validated_data.get('page', 1)
+            page_size = serializer.validated_data.get('page_size', 50)
             
             # Agregar URLs de imágenes si es consulta de MATERIAL
             nit_normalizado = None
@@ -6989,6 +7185,7 @@ class TNSViewSet(APIKeyAwareViewSet, viewsets.ViewSet):
                             WHERE TERID = ?
                         """, (telefono, terid))
                         bridge.conn.commit()
+                        bridge.invalidar_resultados(['TERCEROS'])
                         logger.info(f"📞 Teléfono actualizado: {telefono}")
                 
                 # NO crear el tercero aquí - se creará cuando el usuario complete el formulario
@@ -7130,6 +7327,7 @@ class TNSViewSet(APIKeyAwareViewSet, viewsets.ViewSet):
                 update_sql = f"UPDATE TERCEROS SET {', '.join(update_fields)} WHERE TERID = ?"
                 cursor.execute(update_sql, update_params)
                 bridge.conn.commit()
+                bridge.invalidar_resultados(['TERCEROS'])
                 
                 logger.info(f"✅ Tercero actualizado: TERID={terid}, NIT={nit_normalizado}")
                 
@@ -7189,6 +7387,7 @@ class TNSViewSet(APIKeyAwareViewSet, viewsets.ViewSet):
                 logger.info(f"📞 Teléfono actualizado: {telefono}")
             
             bridge.conn.commit()
+            bridge.invalidar_resultados(['TERCEROS'])
             
             # Obtener el TERID del tercero creado
             cursor.execute("""
@@ -9482,6 +9681,21 @@ class ServerManagementViewSet(APIKeyAwareViewSet, viewsets.ViewSet):
             logger.error(f"Error listando tareas de Celery: {e}")
             return Response({'error': str(e)}, status=500)
     
+    @action(detail=False, methods=['get'])
+    def tns_pool_stats(self, request):
+        """Estadísticas de los pools de conexiones Firebird de este proceso"""
+        try:
+            pools = TNSBridge.pool_stats()
+            return Response({
+                'pools': pools,
+                'total_pools': len(pools),
+                'total_connections': sum(p['size'] for p in pools),
+                'total_in_use': sum(p['in_use'] for p in pools),
+            })
+        except Exception as e:
+            logger.error(f"Error obteniendo estadísticas del pool TNS: {e}")
+            return Response({'error': str(e)}, status=500)
+    
     @action(detail=False, methods=['get'])
     def celery_active_tasks(self, request):
         """Obtiene tareas activas de Celery en tiempo real"""
@@ -9645,8 +9859,7 @@ def public_catalog_view(request):
             logger.warning(f"Error obteniendo logo: {e}")
         
         # SQL QUERIES PREDEFINIDOS (QUEMADOS) - NO EXPONER records
-        from .services.tns_bridge import TNSBridge
-        bridge = TNSBridge(empresa)
+        from .services.tns_async import TNSAsyncExecutor
         
         try:
             # 1. PRODUCTOS BÁSICOS (con precio > 0)
@@ -9667,9 +9880,6 @@ def public_catalog_view(request):
             WHERE MS.PRECIO1 > 0
             ORDER BY M.CODIGO
             """
-            productos = bridge.run_query(productos_sql)
-            print(f"   ✅ {len(productos)} productos cargados")
-            
             # 2. CATEGORÍAS (GRUPMAT)
             categorias_sql = """
             SELECT DISTINCT
@@ -9682,9 +9892,6 @@ def public_catalog_view(request):
             WHERE MS.PRECIO1 > 0
             ORDER BY G.CODIGO
             """
-            categorias = bridge.run_query(categorias_sql)
-            print(f"   ✅ {len(categorias)} categorías cargadas")
-            
             # 3. MÁS VENDIDOS (últimos 30 días, PRECIO1 > 1000)
             mas_vendidos_sql = """
             SELECT FIRST 50
@@ -9708,8 +9915,18 @@ def public_catalog_view(request):
             GROUP BY DK.MATID, M.CODIGO, M.DESCRIP, G.CODIGO, G.DESCRIP, MS.PRECIO1, M.UNIDAD, M.PESO, M.CODBARRA
             ORDER BY VENTAS DESC, MS.PRECIO1 DESC
             """
-            mas_vendidos = bridge.run_query(mas_vendidos_sql)
-            print(f"   ✅ {len(mas_vendidos)} más vendidos cargados")
+            
+            # Las tres consultas son independientes: se ejecutan en paralelo (una conexión
+            # cada una) y si una falla o vence su timeout se cancelan las demás
+            resultados = TNSAsyncExecutor(empresa).ejecutar({
+                'productos': (productos_sql, None),
+                'categorias': (categorias_sql, None),
+                'mas_vendidos': (mas_vendidos_sql, None),
+            }, return_exceptions=False)
+            productos = resultados['productos']
+            categorias = resultados['categorias']
+            mas_vendidos = resultados['mas_vendidos']
+            print(f"   ✅ {len(productos)} productos, {len(categorias)} categorías, {len(mas_vendidos)} más vendidos cargados")
             
             # Seleccionar 5 aleatorios de los más vendidos
             import random
@@ -9717,8 +9934,6 @@ def public_catalog_view(request):
                 mas_vendidos = random.sample(mas_vendidos, 5)
                 print(f"   ✅ Seleccionados 5 aleatorios de más vendidos")
             
-            bridge.close()
-            
             # Obtener NIT normalizado para buscar imágenes
             nit_normalizado = _normalize_nit(empresa.nit) if empresa.nit else ''
             
@@ -9785,8 +10000,7 @@ def public_catalog_view(request):
             return Response(response_data, status=200)
             
         except Exception as e:
-            bridge.close()
-            print(f"   ❌ ERROR ejecutando queries: {e}")
+            print(f"   ❌ ERROR ejecutando queries: {e!r}")
             import traceback
             print(traceback.format_exc())
             logger.error(f"Error en public_catalog_view: {e}")
@@ -10149,56 +10363,53 @@ def resolve_domain_view(request):
         if include_products:
             print(f"   📦 Incluyendo productos iniciales en la respuesta...")
             try:
-                from .services.tns_bridge import TNSBridge
-                bridge = TNSBridge(empresa)
+                from .services.tns_async import TNSAsyncExecutor
                 
                 # Productos básicos (materialprecio)
-                try:
-                    productos_sql = """
-                    SELECT FIRST 200 DISTINCT 
-                        M.CODIGO, M.DESCRIP, M.MATID,
-                        G.CODIGO as GM_CODIGO, G.DESCRIP as GM_DESCRIP,
-                        MS.PRECIO1
-                    FROM MATERIAL M
-                    LEFT JOIN GRUPMAT G ON G.GRUPMATID = M.GRUPMATID
-                    LEFT JOIN MATERIALSUC MS ON MS.MATID = M.MATID
-                    WHERE MS.PRECIO1 > 0
-                    ORDER BY M.CODIGO
-                    """
-                    productos = bridge.run_query(productos_sql)
-                    response_data['productos'] = productos[:200]  # Limitar a 200
-                    print(f"      ✅ {len(productos)} productos cargados")
-                except Exception as e:
-                    print(f"      ⚠️  Error cargando productos: {e}")
-                    response_data['productos'] = []
+                productos_sql = """
+                SELECT FIRST 200 DISTINCT 
+                    M.CODIGO, M.DESCRIP, M.MATID,
+                    G.CODIGO as GM_CODIGO, G.DESCRIP as GM_DESCRIP,
+                    MS.PRECIO1
+                FROM MATERIAL M
+                LEFT JOIN GRUPMAT G ON G.GRUPMATID = M.GRUPMATID
+                LEFT JOIN MATERIALSUC MS ON MS.MATID = M.MATID
+                WHERE MS.PRECIO1 > 0
+                ORDER BY M.CODIGO
+                """
                 
                 # Más vendidos (últimos 30 días)
-                try:
-                    mas_vendidos_sql = """
-                    SELECT FIRST 50
-                        DK.MATID, 
-                        COUNT(*) as VENTAS,
-                        M.CODIGO, M.DESCRIP,
-                        G.CODIGO as GM_CODIGO, G.DESCRIP as GM_DESCRIP,
-                        MS.PRECIO1
-                    FROM DEKARDEX DK
-                    LEFT JOIN KARDEX K ON K.KARDEXID = DK.KARDEXID
-                    LEFT JOIN MATERIAL M ON M.MATID = DK.MATID
-                    LEFT JOIN GRUPMAT G ON G.GRUPMATID = M.GRUPMATID
-                    LEFT JOIN MATERIALSUC MS ON MS.MATID = M.MATID
-                    WHERE CAST(K.FECHA AS TIMESTAMP) BETWEEN DATEADD(-30 DAY TO CURRENT_TIMESTAMP) AND CURRENT_TIMESTAMP
-                      AND MS.PRECIO1 > 1000
-                    GROUP BY DK.MATID, M.CODIGO, M.DESCRIP, G.CODIGO, G.DESCRIP, MS.PRECIO1
-                    ORDER BY VENTAS DESC, MS.PRECIO1 DESC
-                    """
-                    mas_vendidos = bridge.run_query(mas_vendidos_sql)
-                    response_data['mas_vendidos'] = mas_vendidos[:50]  # Limitar a 50
-                    print(f"      ✅ {len(mas_vendidos)} más vendidos cargados")
-                except Exception as e:
-                    print(f"      ⚠️  Error cargando más vendidos: {e}")
-                    response_data['mas_vendidos'] = []
+                mas_vendidos_sql = """
+                SELECT FIRST 50
+                    DK.MATID, 
+                    COUNT(*) as VENTAS,
+                    M.CODIGO, M.DESCRIP,
+                    G.CODIGO as GM_CODIGO, G.DESCRIP as GM_DESCRIP,
+                    MS.PRECIO1
+                FROM DEKARDEX DK
+                LEFT JOIN KARDEX K ON K.KARDEXID = DK.KARDEXID
+                LEFT JOIN MATERIAL M ON M.MATID = DK.MATID
+                LEFT JOIN GRUPMAT G ON G.GRUPMATID = M.GRUPMATID
+                LEFT JOIN MATERIALSUC MS ON MS.MATID = M.MATID
+                WHERE CAST(K.FECHA AS TIMESTAMP) BETWEEN DATEADD(-30 DAY TO CURRENT_TIMESTAMP) AND CURRENT_TIMESTAMP
+                  AND MS.PRECIO1 > 1000
+                GROUP BY DK.MATID, M.CODIGO, M.DESCRIP, G.CODIGO, G.DESCRIP, MS.PRECIO1
+                ORDER BY VENTAS DESC, MS.PRECIO1 DESC
+                """
                 
-                bridge.close()
+                # En paralelo; cada consulta falla (o vence) por separado y se reemplaza por []
+                resultados = TNSAsyncExecutor(empresa).ejecutar({
+                    'productos': (productos_sql, None),
+                    'mas_vendidos': (mas_vendidos_sql, None),
+                })
+                limites = {'productos': 200, 'mas_vendidos': 50}
+                for clave, filas in resultados.items():
+                    if isinstance(filas, BaseException):
+                        print(f"      ⚠️  Error cargando {clave}: {filas!r}")
+                        response_data[clave] = []
+                    else:
+                        response_data[clave] = filas[:limites[clave]]
+                        print(f"      ✅ {len(filas)} {clave} cargados")
             except Exception as e:
                 print(f"   ⚠️  Error incluyendo productos: {e}")
                 response_data['productos'] = []
@@ -10405,12 +10616,9 @@ def formas_pago_ecommerce_view(request):
             status=status.HTTP_400_BAD_REQUEST
         )
     
-    bridge = TNSBridge(empresa)
-    bridge.connect()
+    from .services.tns_async import TNSAsyncExecutor
     
     try:
-        cursor = bridge.conn.cursor()
-        
         # Obtener usuario TNS de la configuración de e-commerce
         usuario_tns = config.usuario_tns
         
@@ -10418,21 +10626,25 @@ def formas_pago_ecommerce_view(request):
         variab_formas_pago = f"GFPPERMITIDAS{usuario_tns}"
         logger.info(f"[ecommerce] Buscando variable de formas de pago: {variab_formas_pago}")
         
-        # Obtener GFPPERMITIDAS{usuario_tns} de VARIOS
-        cursor.execute("""
-            SELECT CAST(contenido AS VARCHAR(500)) 
-            FROM varios 
-            WHERE variab = ?
-        """, (variab_formas_pago,))
+        # GFPPERMITIDAS{usuario_tns} de VARIOS y el catálogo FORMAPAGO (tabla pequeña) se
+        # consultan en paralelo; el filtro por códigos permitidos se hace en Python
+        resultados = TNSAsyncExecutor(empresa).ejecutar({
+            'permitidas': ("""
+                SELECT CAST(contenido AS VARCHAR(500)) AS CONTENIDO
+                FROM varios 
+                WHERE variab = ?
+            """, [variab_formas_pago]),
+            'formas_pago': ("SELECT CODIGO, DESCRIP FROM FORMAPAGO", None),
+        }, return_exceptions=False)
         
-        resultado = cursor.fetchone()
-        if not resultado or not resultado[0]:
+        permitidas = resultados['permitidas']
+        if not permitidas or not permitidas[0].get('CONTENIDO'):
             return Response(
                 {'error': f'No se encontró configuración de formas de pago ({variab_formas_pago})'},
                 status=status.HTTP_404_NOT_FOUND
             )
         
-        codigos_str = resultado[0].strip()
+        codigos_str = permitidas[0]['CONTENIDO'].strip()
         # Formato: "codigo1,codigo2," (siempre termina en coma)
         # Remover la coma final si existe
         if codigos_str.endswith(','):
@@ -10447,20 +10659,16 @@ def formas_pago_ecommerce_view(request):
                 status=status.HTTP_404_NOT_FOUND
             )
         
-        # Obtener descripciones de FORMAPAGO
-        placeholders = ','.join(['?' for _ in codigos])
-        cursor.execute(f"""
-            SELECT CODIGO, DESCRIP 
-            FROM FORMAPAGO 
-            WHERE CODIGO IN ({placeholders})
-        """, codigos)
-        
+        # Descripciones de FORMAPAGO para los códigos permitidos
         formas_pago = []
-        for row in cursor.fetchall():
-            codigo, descrip = row
+        for row in resultados['formas_pago']:
+            codigo = (row.get('CODIGO') or '').strip()
+            if codigo not in codigos:
+                continue
+            descrip = row.get('DESCRIP')
             formas_pago.append({
-                'codigo': codigo.strip() if codigo else '',
-                'descripcion': descrip.strip() if descrip else codigo.strip() if codigo else ''
+                'codigo': codigo,
+                'descripcion': descrip.strip() if descrip else codigo
             })
         
         logger.info(f"[ecommerce] Formas de pago cargadas: {len(formas_pago)} opciones")
@@ -10470,13 +10678,11 @@ def formas_pago_ecommerce_view(request):
         })
         
     except Exception as e:
-        logger.error(f"[ecommerce] Error cargando formas de pago: {e}", exc_info=True)
+        logger.error(f"[ecommerce] Error cargando formas de pago: {e!r}", exc_info=True)
         return Response(
             {'error': f'Error al cargar formas de pago: {str(e)}'},
             status=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
-    finally:
-        bridge.close()
 
 @api_view(['GET'])
 @permission_classes([AllowAny])
@@ -11722,9 +11928,13 @@ class BackupS3ViewSet(APIKeyAwareViewSet, viewsets.ModelViewSet):
             else:
                 base_prefix = f"{server_name}/"
             
-            # Listar objetos en S3
-            paginator = servicio.s3_client.get_paginator('list_objects_v2')
-            pages = paginator.paginate(Bucket=servicio.bucket_name, Prefix=base_prefix, Delimiter='/')
+            # Listar objetos: desde el índice si está reconciliado (prefijos de carpeta), si no en S3
+            from .services import indice_s3
+            if base_prefix.endswith('/') and indice_s3.indice_disponible(config_s3):
+                pages = [indice_s3.pagina_directorio(config_s3, base_prefix)]
+            else:
+                paginator = servicio.s3_client.get_paginator('list_objects_v2')
+                pages = paginator.paginate(Bucket=servicio.bucket_name, Prefix=base_prefix, Delimiter='/')
             
             carpetas = []
             archivos = []
@@ -11947,7 +12157,7 @@ class BackupS3ViewSet(APIKeyAwareViewSet, viewsets.ModelViewSet):
             
             backups = BackupS3.objects.filter(empresa_servidor=empresa, estado='completado')
             
-            return Response({
+            datos = {
                 'empresa_id': empresa_id,
                 'empresa_nombre': empresa.nombre,
                 'tamano_actual_gb': tamano_actual,
@@ -11958,7 +12168,18 @@ class BackupS3ViewSet(APIKeyAwareViewSet, viewsets.ModelViewSet):
                     str(anio): backups.filter(anio_fiscal=anio).count()
                     for anio in backups.values_list('anio_fiscal', flat=True).distinct()
                 }
-            }, status=status.HTTP_200_OK)
+            }
+            
+            # Desglose del espacio por año fiscal (solo con el índice de objetos reconciliado)
+            from .services import indice_s3
+            if indice_s3.indice_disponible(config_s3):
+                server_name = empresa.servidor.nombre.replace(' ', '_').replace('/', '_').replace('\\', '_')
+                datos['tamano_por_anio_gb'] = {
+                    anio: round(total / (1024 * 1024 * 1024), 2)
+                    for anio, total in indice_s3.tamano_por_anio(config_s3, server_name, empresa.nit_normalizado).items()
+                }
+            
+            return Response(datos, status=status.HTTP_200_OK)
             
         except EmpresaServidor.DoesNotExist:
             return Response(
@@ -12151,7 +12372,9 @@ class BackupS3ViewSet(APIKeyAwareViewSet, viewsets.ModelViewSet):
                 fecha_str = backup.fecha_backup.strftime('%Y%m%d_%H%M%S') if backup.fecha_backup else 'unknown'
                 nombre_temp = f"backup_{empresa.nit_normalizado if empresa else 'unknown'}_{fecha_str}.fbk"
             
-            # Asegurar que el nombre tenga extensión .fbk
+            # Asegurar que el nombre tenga extensión .fbk (los comprimidos/deduplicados se descargan como .fbk)
+            from .services.backup_streaming import nombre_fbk
+            nombre_temp = nombre_fbk(nombre_temp)
             if not nombre_temp.lower().endswith('.fbk'):
                 nombre_temp = f"{os.path.splitext(nombre_temp)[0]}.fbk"
             
@@ -12160,7 +12383,9 @@ class BackupS3ViewSet(APIKeyAwareViewSet, viewsets.ModelViewSet):
             logger.info(f"📥 Descargando backup {backup.id}: nombre_temp='{nombre_temp}', nombre_archivo='{backup.nombre_archivo}'")
             
             try:
-                servicio.s3_client.download_file(
+                from .services.backup_streaming import descargar_backup_fbk
+                descargar_backup_fbk(
+                    servicio.s3_client,
                     servicio.bucket_name,
                     backup.ruta_s3,
                     temp_fbk
@@ -12503,11 +12728,16 @@ def descargar_backup_por_token(request, token):
                 empresa = backup.empresa_servidor
                 fecha_str = backup.fecha_backup.strftime('%Y%m%d_%H%M%S') if backup.fecha_backup else 'unknown'
                 nombre_temp = f"backup_{empresa.nit_normalizado if empresa else 'unknown'}_{fecha_str}.fbk"
+            # Los backups comprimidos (.fbk.zst) o deduplicados (.fbk.manifest.json) se descargan como .fbk
+            from .services.backup_streaming import nombre_fbk
+            nombre_temp = nombre_fbk(nombre_temp)
             temp_fbk = os.path.join(temp_dir, f"backup_{backup.id}_{nombre_temp}")
             
             logger.info(f"📥 Descargando desde S3: bucket={servicio.bucket_name}, key={backup.ruta_s3}, destino={temp_fbk}")
             try:
-                servicio.s3_client.download_file(
+                from .services.backup_streaming import descargar_backup_fbk
+                descargar_backup_fbk(
+                    servicio.s3_client,
                     servicio.bucket_name,
                     backup.ruta_s3,
                     temp_fbk
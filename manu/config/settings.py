@@ -273,6 +273,13 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'America/Bogota'  # Zona horaria de Bogotá, Colombia
+# Cola del entrenamiento ML. Por defecto la cola 'celery' que consume el worker desplegado (celerycore.service);
+# para aislarlo usar p. ej. ML_ENTRENAMIENTO_QUEUE=ml y un worker que la consuma (celery -A config worker -Q ml -c 2)
+ML_ENTRENAMIENTO_QUEUE = env('ML_ENTRENAMIENTO_QUEUE', default='celery')
+CELERY_TASK_ROUTES = {
+    'sistema_analitico.entrenar_modelos_empresa': {'queue': ML_ENTRENAMIENTO_QUEUE},
+    'sistema_analitico.precalentar_pronosticos_ml': {'queue': ML_ENTRENAMIENTO_QUEUE},
+}
 
 # Configuración de Celery Beat (tareas programadas)
 from celery.schedules import crontab
@@ -295,8 +302,120 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'sistema_analitico.limpiar_descargas_expiradas',
         'schedule': crontab(hour=2, minute=0),  # Todos los días a las 2:00 AM
     },
+    # Sincronización incremental de movimientos TNS (solo filas nuevas o meses modificados)
+    'sincronizar-movimientos-incremental': {
+        'task': 'sistema_analitico.sincronizar_movimientos_todas_empresas',
+        'schedule': crontab(hour=3, minute=0),  # Todos los días a las 3:00 AM
+    },
+    # Reconciliar el índice de objetos S3 con el bucket (cuotas y explorador leen el índice)
+    'reconciliar-indice-s3': {
+        'task': 'sistema_analitico.reconciliar_indice_s3',
+        'schedule': crontab(hour=4, minute=30),  # Todos los días a las 4:30 AM
+    },
 }
 
+# ==================== Extracción de movimientos TNS ====================
+EXTRACCION_BATCH_SIZE = env.int('EXTRACCION_BATCH_SIZE', default=2000)  # Filas por fetchmany en extracción streaming
+EXTRACCION_MAX_WORKERS = env.int('EXTRACCION_MAX_WORKERS', default=8)  # Hilos totales del planificador de extracción multi-empresa
+EXTRACCION_CUPO_TTL = env.int('EXTRACCION_CUPO_TTL', default=6 * 3600)  # Segundos antes de liberar el cupo/empresa de un worker caído
+EXTRACCION_ESPERA_CUPO = env.int('EXTRACCION_ESPERA_CUPO', default=600)  # Máximo que una extracción espera un cupo libre en su servidor
+
+# ==================== Caché columnar de movimientos (Parquet) ====================
+MOVIMIENTOS_PARQUET_ENABLED = env.bool('MOVIMIENTOS_PARQUET_ENABLED', default=True)  # Consultas analíticas desde Parquet (requiere pyarrow)
+MOVIMIENTOS_PARQUET_DIR = env('MOVIMIENTOS_PARQUET_DIR', default=str(BASE_DIR / 'data' / 'parquet_movimientos'))
+MOVIMIENTOS_PARQUET_OBJETIVO_MS = env.int('MOVIMIENTOS_PARQUET_OBJETIVO_MS', default=500)  # Escaneos más lentos se registran como warning
+
+# ==================== Caché de resultados TNS (TNSViewSet.records) ====================
+TNS_RECORDS_CACHE_ENABLED = env.bool('TNS_RECORDS_CACHE_ENABLED', default=True)
+TNS_RECORDS_CACHE_TTL = env.int('TNS_RECORDS_CACHE_TTL', default=60)  # Segundos por defecto para conteos y páginas
+TNS_RECORDS_CACHE_LOCK_WAIT = env.int('TNS_RECORDS_CACHE_LOCK_WAIT', default=10)  # Espera máxima por otra petición que ya consulta lo mismo
+TNS_RECORDS_CACHE_TTLS = {  # TTL por tabla (catálogos cambian poco, movimientos mucho)
+    'MATERIAL': 300,
+    'GRUPMAT': 900,
+    'TERCEROS': 300,
+    'KARDEX': 30,
+    'DEKARDEX': 30,
+}
+
+# ==================== Catálogo de metadatos TNS ====================
+TNS_METADATA_TTL = env.int('TNS_METADATA_TTL', default=86400)  # Segundos antes de volver a introspectar RDB$ (DDL por /api/tns/query/ invalida antes)
+TNS_METADATA_LOCK_WAIT = env.int('TNS_METADATA_LOCK_WAIT', default=30)  # Espera máxima mientras otro worker construye el catálogo
+
+# ==================== Consultas TNS concurrentes (e-commerce público) ====================
+TNS_ASYNC_MAX_WORKERS = env.int('TNS_ASYNC_MAX_WORKERS', default=16)  # Hilos por proceso para consultas Firebird en paralelo
+TNS_ASYNC_QUERY_TIMEOUT = env.int('TNS_ASYNC_QUERY_TIMEOUT', default=15)  # Segundos por consulta antes de cancelarla
+
+# ==================== Registro de modelos ML (MLEngine) ====================
+ML_REGISTRY_MAX_MODELOS = env.int('ML_REGISTRY_MAX_MODELOS', default=20)  # Modelos empresa_{nit} en memoria por proceso (LRU)
+ML_REGISTRY_MAX_MB = env.int('ML_REGISTRY_MAX_MB', default=512)  # Tope aproximado (tamaño de los artefactos en disco) antes de expulsar
+ML_STORE_VERSIONES = env.int('ML_STORE_VERSIONES', default=3)  # Versiones de artefactos conservadas por modelo (la vigente incluida)
+
+# ==================== Cola de entrenamiento ML ====================
+ML_ENTRENAMIENTO_LOCK_TTL = env.int('ML_ENTRENAMIENTO_LOCK_TTL', default=3 * 3600)  # Segundos máximos de un entrenamiento antes de liberar la deduplicación
+ML_REENTRENAMIENTO_MIN_MOVIMIENTOS = env.int('ML_REENTRENAMIENTO_MIN_MOVIMIENTOS', default=500)  # Movimientos nuevos mínimos para re-entrenar incrementalmente
+ML_XGB_ARBOLES_INCREMENTALES = env.int('ML_XGB_ARBOLES_INCREMENTALES', default=25)  # Árboles agregados al booster anterior en un warm start
+ML_PREDICCION_LOTE_ARTICULOS = env.int('ML_PREDICCION_LOTE_ARTICULOS', default=5000)  # Artículos por lote en /api/ml/predecir_lote/ (cada lote se transmite al predecirse)
+
+# ==================== Caché de pronósticos ML ====================
+ML_PRONOSTICOS_CACHE_ENABLED = env.bool('ML_PRONOSTICOS_CACHE_ENABLED', default=True)
+ML_PRONOSTICOS_CACHE_TTL = env.int('ML_PRONOSTICOS_CACHE_TTL', default=24 * 3600)  # Segundos; re-entrenar o ingerir movimientos invalida antes
+ML_PRONOSTICOS_PRECALENTAR = env.int('ML_PRONOSTICOS_PRECALENTAR', default=3)  # Combinaciones más consultadas que se recalculan tras re-entrenar
+
+# ==================== Registro MLflow asíncrono ====================
+MLFLOW_ASYNC = env.bool('MLFLOW_ASYNC', default=True)  # Encolar los registros MLflow y escribirlos en un hilo de fondo
+MLFLOW_MUESTREO_PREDICCIONES = env.float('MLFLOW_MUESTREO_PREDICCIONES', default=0.1)  # Fracción de predicciones registradas en MLflow (1.0 = todas)
+MLFLOW_MAX_FILAS_ARTEFACTO = env.int('MLFLOW_MAX_FILAS_ARTEFACTO', default=1000)  # Filas máximas de las tablas CSV adjuntas a cada run
+MLFLOW_COLA_MAX_EVENTOS = env.int('MLFLOW_COLA_MAX_EVENTOS', default=1000)  # Eventos en memoria por proceso antes de enviar al spool
+MLFLOW_SPOOL_DIR = env('MLFLOW_SPOOL_DIR', default=os.path.join(BASE_DIR, 'mlflow_spool'))  # Eventos pendientes si la cola está llena o MLflow no responde
+
+# ==================== Backups Firebird en streaming (gbak → S3) ====================
+BACKUP_STREAMING_ENABLED = env.bool('BACKUP_STREAMING_ENABLED', default=True)  # gbak escribe a stdout y se sube por multipart sin .fbk temporal
+BACKUP_STREAMING_PARTE_MB = env.int('BACKUP_STREAMING_PARTE_MB', default=16)  # Tamaño inicial de cada parte (mínimo 5 MB; crece para no pasar de 10.000 partes)
+BACKUP_STREAMING_WORKERS = env.int('BACKUP_STREAMING_WORKERS', default=4)  # Partes subiéndose en paralelo; memoria ≈ (workers + 1) × parte
+BACKUP_STREAMING_ZSTD = env.bool('BACKUP_STREAMING_ZSTD', default=False)  # Comprimir el flujo con zstd sin deduplicar (requiere zstandard; se guarda como .fbk.zst)
+BACKUP_STREAMING_ZSTD_NIVEL = env.int('BACKUP_STREAMING_ZSTD_NIVEL', default=3)
+BACKUP_STREAMING_TIMEOUT = env.int('BACKUP_STREAMING_TIMEOUT', default=6 * 3600)  # Segundos máximos del pipeline completo
+BACKUP_STREAMING_TIMEOUT_SIN_PROGRESO = env.int('BACKUP_STREAMING_TIMEOUT_SIN_PROGRESO', default=300)  # Segundos sin datos de gbak = proceso colgado
+BACKUP_DEDUP_ENABLED = env.bool('BACKUP_DEDUP_ENABLED', default=True)  # Chunks por contenido comprimidos + manifiesto por backup (solo en streaming)
+BACKUP_DEDUP_CHUNK_MB = env.int('BACKUP_DEDUP_CHUNK_MB', default=4)  # Tamaño promedio de chunk (mínimo ¼, máximo 4×)
+
+# ==================== Índice de objetos S3 ====================
+S3_INDICE_ENABLED = env.bool('S3_INDICE_ENABLED', default=True)  # Cuotas, explorador y estadísticas desde ObjetoS3 (tras la primera reconciliación) en lugar de listar S3
+
+# ==================== Planificador global de backups ====================
+# Concurrencia y ancho de banda por servidor: Servidor.max_backups_concurrentes / ancho_banda_backup_mbps
+BACKUP_VENTANA_INICIO = env.int('BACKUP_VENTANA_INICIO', default=19)  # Hora desde la que se despachan backups de años anteriores
+BACKUP_VENTANA_FIN = env.int('BACKUP_VENTANA_FIN', default=7)  # Hora hasta la que se despachan (el año actual sigue su hora_backup)
+BACKUP_DIAS_ANIOS_ANTERIORES = env.int('BACKUP_DIAS_ANIOS_ANTERIORES', default=30)  # Antigüedad a partir de la cual se renueva el backup de un año anterior
+BACKUP_CUPO_TTL = env.int('BACKUP_CUPO_TTL', default=8 * 3600)  # Segundos antes de liberar el cupo de un worker caído (mayor que BACKUP_STREAMING_TIMEOUT)
+BACKUP_ESPERA_CUPO = env.int('BACKUP_ESPERA_CUPO', default=60)  # Reintento de backups manuales cuando el servidor no tiene cupos
+BACKUP_MAX_ESPERA_CUPO = env.int('BACKUP_MAX_ESPERA_CUPO', default=24 * 3600)  # Tiempo máximo esperando cupo antes de fallar
+BACKUP_ESPERA_TRAS_ERROR = env.int('BACKUP_ESPERA_TRAS_ERROR', default=3600)  # Segundos fuera de la cola para una empresa cuyo backup falló
+
+# ==================== Restauración de backups a GDB ====================
+BACKUP_GDB_CACHE_DIR = env('BACKUP_GDB_CACHE_DIR', default='')  # Caché de GDB restaurados ('' = {tempdir}/backups_gdb_cache); el usuario de Firebird debe poder atravesarla (755)
+BACKUP_GDB_GRUPO_FIREBIRD = env('BACKUP_GDB_GRUPO_FIREBIRD', default='')  # Grupo del usuario del worker y de Firebird para los directorios de restauración ('' = directorios 777)
+BACKUP_GDB_CACHE_MAX_GB = env.int('BACKUP_GDB_CACHE_MAX_GB', default=20)  # Tamaño máximo de la caché (LRU; las descargas vigentes no se expulsan)
+BACKUP_GDB_RESTAURACION_TIMEOUT = env.int('BACKUP_GDB_RESTAURACION_TIMEOUT', default=3600)  # Máximo por restauración y espera de una restauración ajena
+BACKUP_GDB_FIREBIRD_HOST = env('BACKUP_GDB_FIREBIRD_HOST', default='localhost')  # Servidor Firebird que restaura (debe ver el disco de la caché)
+BACKUP_GDB_FIREBIRD_PORT = env.int('BACKUP_GDB_FIREBIRD_PORT', default=3050)
+BACKUP_GDB_FIREBIRD_USER = env('BACKUP_GDB_FIREBIRD_USER', default='SYSDBA')
+BACKUP_GDB_FIREBIRD_PASSWORD = env('BACKUP_GDB_FIREBIRD_PASSWORD', default='masterkey')
+
+# ==================== Pronóstico de demanda por artículo ====================
+PROPHET_MAX_WORKERS = env.int('PROPHET_MAX_WORKERS', default=0)  # Procesos para ajustar Prophet en paralelo (0 = min(4, CPUs))
+PROPHET_MIN_MESES = env.int('PROPHET_MIN_MESES', default=12)  # Meses de historia mínimos para ajustar Prophet a un artículo
+PROPHET_MAX_ARTICULOS = env.int('PROPHET_MAX_ARTICULOS', default=300)  # Artículos de mayor volumen con Prophet; el resto usa Croston/ETS
+PROPHET_HORIZONTE_MESES = env.int('PROPHET_HORIZONTE_MESES', default=24)  # Meses pronosticados y guardados por artículo
+
+# ==================== Pool de conexiones Firebird (TNSBridge) ====================
+TNS_POOL_MIN_SIZE = env.int('TNS_POOL_MIN_SIZE', default=0)  # Conexiones que se conservan aunque estén ociosas
+TNS_POOL_MAX_SIZE = env.int('TNS_POOL_MAX_SIZE', default=8)  # Máximo de conexiones por base de datos y proceso
+TNS_POOL_TIMEOUT = env.float('TNS_POOL_TIMEOUT', default=30)  # Segundos esperando una conexión libre
+TNS_POOL_MAX_IDLE = env.float('TNS_POOL_MAX_IDLE', default=300)  # Segundos ociosa antes de cerrarse
+TNS_POOL_MAX_LIFETIME = env.float('TNS_POOL_MAX_LIFETIME', default=3600)  # Vida máxima de una conexión
+TNS_POOL_PING_AFTER_IDLE = env.float('TNS_POOL_PING_AFTER_IDLE', default=30)  # Ping solo si estuvo ociosa más de esto
+
 # ==================== Configuración de Cache ====================
 CACHES = {
     'default': {